@@ -1,45 +1,100 @@
+from typing import Optional
 from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.core.config import settings
 from app.core.database import get_db
+from app.models.diagram import Diagram
 from app.models.user import User
 from app.services.auth import get_current_user
-from app.schemas.ai import AICleanRequest, AICleanResponse
+from app.schemas.ai import AICleanRequest, AICleanResponse, AIJobCreate, AIJobResponse
+from app.services.ai_jobs import AIJobQueue
+from app.api.v1.endpoints.websocket import manager
 import logging
 
 router = APIRouter()
 logger = logging.getLogger(__name__)
 
+job_queue = AIJobQueue(
+    settings.AI_JOB_WORKERS,
+    settings.AI_JOBS_PER_USER,
+    settings.AI_JOB_MAX_PENDING_PER_USER,
+    settings.AI_JOB_RETENTION_SECONDS,
+    notify=manager.broadcast_to_diagram_sync
+)
+
+async def _job_room(db: AsyncSession, diagram_id: int, user: User) -> Optional[str]:
+    """Room that should see a job's progress; None unless the user may open that diagram"""
+    row = (await db.execute(
+        select(Diagram.owner_id, Diagram.is_public).where(Diagram.id == diagram_id)
+    )).first()
+    if row is None or (row.owner_id != user.id and not row.is_public):
+        return None
+    return str(diagram_id)
+
+@router.post("/jobs", response_model=AIJobResponse, status_code=status.HTTP_202_ACCEPTED)
+async def submit_job(
+    request: AIJobCreate,
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """Queue a clean or interpret pass; progress and the result are pushed to the diagram's room"""
+    room = await _job_room(db, request.diagram_id, current_user)
+    # Release the pooled connection before the (possibly slow) dedupe hash
+    await db.close()
+    job, deduplicated = await job_queue.submit(
+        request.kind,
+        request.diagram_data,
+        current_user.id,
+        request.diagram_id,
+        room=room,
+        options=request.cleaning_options.model_dump() if request.kind == "clean" else None
+    )
+    logger.info(f"AI {request.kind} job {job.id} submitted by user {current_user.username}")
+    return AIJobResponse(**job.to_dict(diagram_id=request.diagram_id), deduplicated=deduplicated)
+
+@router.get("/jobs/{job_id}", response_model=AIJobResponse)
+async def get_job(
+    job_id: str,
+    current_user: User = Depends(get_current_user)
+):
+    """Poll a job submitted by the current user"""
+    job = job_queue.get(job_id, current_user.id)
+    if job is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Job not found"
+        )
+    return AIJobResponse(**job.to_dict(diagram_id=job.diagram_ids.get(current_user.id)))
+
 @router.post("/clean", response_model=AICleanResponse)
 async def clean_diagram(
     request: AICleanRequest,
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    current_user: User = Depends(get_current_user)
 ):
-    """Clean and align diagram using AI"""
+    """Clean and align diagram: snap to grid, align edges and centers, equalize spacing, remove overlaps"""
     try:
-        # This is a placeholder implementation
-        # In production, you would integrate with OpenAI, Gemini, or other AI services
-        
         logger.info(f"AI cleaning requested by user {current_user.username} for diagram {request.diagram_id}")
-        
-        # Simulate AI processing
-        cleaned_data = {
-            "shapes": request.diagram_data.get("shapes", []),
-            "connections": request.diagram_data.get("connections", []),
-            "improvements": [
-                "Aligned shapes to grid",
-                "Standardized spacing",
-                "Improved visual hierarchy"
-            ]
-        }
-        
+
+        # Same queue as /ai/jobs, so the pass runs in a worker process under the per-user limit
+        job, _ = await job_queue.submit(
+            "clean", request.diagram_data, current_user.id, request.diagram_id,
+            options=request.cleaning_options.model_dump()
+        )
+        await job.done.wait()
+        if job.status != "succeeded":
+            raise RuntimeError(job.error)
+
         return AICleanResponse(
             success=True,
-            cleaned_data=cleaned_data,
-            message="Diagram cleaned successfully using AI",
-            processing_time_ms=1500
+            cleaned_data=job.result["cleaned_data"],
+            message="Diagram cleaned successfully",
+            processing_time_ms=job.result["processing_time_ms"],
+            improvements=job.result["improvements"]
         )
-        
+
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"AI cleaning failed: {e}")
         raise HTTPException(
@@ -50,38 +105,31 @@ async def clean_diagram(
 @router.post("/interpret")
 async def interpret_diagram(
     request: AICleanRequest,
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    current_user: User = Depends(get_current_user)
 ):
-    """Interpret diagram content and suggest improvements"""
+    """Interpret diagram structure: type, decision points, cycles, orphans and disconnected parts"""
     try:
         logger.info(f"AI interpretation requested by user {current_user.username}")
-        
-        # Placeholder implementation
-        interpretation = {
-            "diagram_type": "flowchart",
-            "confidence": 0.85,
-            "suggestions": [
-                "Consider adding more descriptive labels",
-                "The flow direction could be more consistent",
-                "Some shapes could be grouped for better organization"
-            ],
-            "detected_elements": [
-                "decision points",
-                "process steps",
-                "data flows"
-            ]
-        }
-        
+
+        job, _ = await job_queue.submit("interpret", request.diagram_data, current_user.id, request.diagram_id)
+        # Finished at submit time means the interpretation cache or an earlier identical job answered
+        cached = job.finished
+        await job.done.wait()
+        if job.status != "succeeded":
+            raise RuntimeError(job.error)
+
         return {
             "success": True,
-            "interpretation": interpretation
+            "interpretation": job.result,
+            "content_hash": job.key.split(":", 1)[1],
+            "cached": cached
         }
-        
+
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"AI interpretation failed: {e}")
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="AI interpretation failed"
         )
-
@@ -1,9 +1,10 @@
 from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from app.core.database import get_db
 from app.models.user import User
 from app.schemas.user import UserCreate, UserLogin, UserResponse, Token
-from app.services.auth import authenticate_user, create_access_token, get_password_hash, get_current_user
+from app.services.auth import authenticate_user, create_access_token, get_password_hash_async, get_current_user
 from datetime import timedelta
 import logging
 
@@ -11,11 +12,13 @@ router = APIRouter()
 logger = logging.getLogger(__name__)
 
 @router.post("/register", response_model=UserResponse)
-async def register(user_data: UserCreate, db: Session = Depends(get_db)):
+async def register(user_data: UserCreate, db: AsyncSession = Depends(get_db)):
     """Register a new user"""
     try:
         # Check if username already exists
-        existing_user = db.query(User).filter(User.username == user_data.username).first()
+        existing_user = (await db.execute(
+            select(User).where(User.username == user_data.username)
+        )).scalars().first()
         if existing_user:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
@@ -24,15 +27,18 @@ async def register(user_data: UserCreate, db: Session = Depends(get_db)):
         
         # Check if email already exists
         if user_data.email:
-            existing_email = db.query(User).filter(User.email == user_data.email).first()
+            existing_email = (await db.execute(
+                select(User).where(User.email == user_data.email)
+            )).scalars().first()
             if existing_email:
                 raise HTTPException(
                     status_code=status.HTTP_400_BAD_REQUEST,
                     detail="Email already registered"
                 )
         
-        # Create new user
-        hashed_password = get_password_hash(user_data.password)
+        # Create new user; release the pooled connection while the hash runs
+        await db.rollback()
+        hashed_password = await get_password_hash_async(user_data.password)
         db_user = User(
             username=user_data.username,
             email=user_data.email,
@@ -42,8 +48,8 @@ async def register(user_data: UserCreate, db: Session = Depends(get_db)):
         )
         
         db.add(db_user)
-        db.commit()
-        db.refresh(db_user)
+        await db.commit()
+        await db.refresh(db_user)
         
         logger.info(f"New user registered: {user_data.username}")
         
@@ -62,18 +68,18 @@ async def register(user_data: UserCreate, db: Session = Depends(get_db)):
         raise
     except Exception as e:
         logger.error(f"Registration failed: {e}")
-        db.rollback()
+        await db.rollback()
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="Registration failed"
         )
 
 @router.post("/login", response_model=Token)
-async def login(user_credentials: UserLogin, db: Session = Depends(get_db)):
+async def login(user_credentials: UserLogin, db: AsyncSession = Depends(get_db)):
     """Authenticate user and return access token"""
     try:
         # Authenticate user
-        user = authenticate_user(db, user_credentials.username, user_credentials.password)
+        user = await authenticate_user(db, user_credentials.username, user_credentials.password)
         if not user:
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
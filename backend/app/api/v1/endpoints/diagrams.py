@@ -1,79 +1,298 @@
-from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
-from typing import List
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Request, Response, status
+from sqlalchemy import String, and_, delete, or_, select, type_coerce, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import defer, load_only
+from typing import List, Literal, Optional, Union
+from datetime import datetime
+import asyncio
+import base64
+import binascii
+import json
+import math
+from app.api.v1.endpoints.websocket import manager
+from app.core.compression import compress, negotiate_encoding, variant_etag
+from app.core.config import settings
 from app.core.database import get_db
 from app.models.user import User
 from app.models.diagram import Diagram
-from app.schemas.diagram import DiagramCreate, DiagramUpdate, DiagramResponse
+from app.models.diagram_element import DiagramElement
+from app.models.diagram_history import DiagramCheckpoint, DiagramRevision
+from app.schemas.diagram import (
+    DiagramCreate, DiagramUpdate, DiagramResponse, DiagramSummary, DiagramPatch, DiagramPatchResponse,
+    DiagramRegionResponse, DiagramSearchResult, DiagramVersion
+)
 from app.services.auth import get_current_user
+from app.services.blob_store import BlobResponse, blob_store
+from app.services.diagram_crdt import DiagramCrdt
+from app.services.diagram_history import (
+    REVISION_CREATE, REVISION_OPS, REVISION_REPLACE, REVISION_SAVE, VersionUnavailable, load_version, record_revision
+)
+from app.services.diagram_ops import DiagramDocument, DiagramOperationError, diff_operations
+from app.services.diagram_storage import (
+    STORAGE_ELEMENTS, blob_digest, load_data, load_many, load_region, store_data, store_thumbnail, stored_form,
+    write_document
+)
+from app.services.document_store import VersionConflict, document_store
+from app.services.response_cache import diagram_etag, diagram_response_cache, etag_matches
+from app.services.search_index import extract_text, search_document, search_index
+from app.services.spatial_index import DiagramSpatialIndex, spatial_index_cache
+from app.services.thumbnails import SVG_MEDIA_TYPE, thumbnail_renderer
 
 router = APIRouter()
 
+SUMMARY_COLUMNS = (
+    Diagram.id, Diagram.title, Diagram.description, Diagram.owner_id,
+    Diagram.is_public, Diagram.version, Diagram.created_at, Diagram.updated_at, Diagram.thumbnail_blob
+)
+# Older thumbnails are Base64 in the row, newer ones are in the blob store
+HAS_THUMBNAIL = or_(Diagram.thumbnail_blob.isnot(None), Diagram.thumbnail.isnot(None))
+THUMBNAIL_TAG_LENGTH = 16  # Digest characters in a thumbnail URL's ?v=
+ROOM_UNAVAILABLE = "The diagram's live room is not responding; try again"
+
+def _encode_cursor(diagram: Diagram) -> str:
+    raw = json.dumps([diagram.updated_at.strftime("%Y-%m-%d %H:%M:%S.%f"), diagram.id])
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def _decode_cursor(cursor: str):
+    try:
+        updated_at, diagram_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.strptime(updated_at, "%Y-%m-%d %H:%M:%S.%f"), int(diagram_id)
+    except (ValueError, TypeError, binascii.Error):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def _cursor_timestamp(db: AsyncSession, value: datetime):
+    """Bind a cursor timestamp so it compares correctly with stored updated_at values.
+
+    SQLite stores server-generated timestamps as 'YYYY-MM-DD HH:MM:SS' text, while the
+    DateTime type would bind a datetime with a '.ffffff' suffix that sorts after it.
+    """
+    if db.bind.dialect.name == "sqlite":
+        text = value.strftime("%Y-%m-%d %H:%M:%S")
+        if value.microsecond:
+            text += value.strftime(".%f")
+        return type_coerce(text, String)
+    return value
+
+def _thumbnail_url(diagram_id: int, blob: Optional[str] = None) -> str:
+    url = f"/api/v1/diagrams/{diagram_id}/thumbnail"
+    # Blob thumbnails are versioned by digest, so the URL names one image and can be cached for good
+    return f"{url}?v={blob[:THUMBNAIL_TAG_LENGTH]}" if blob else url
+
+def _diagram_thumbnail_url(diagram: Diagram) -> Optional[str]:
+    return _thumbnail_url(diagram.id, diagram.thumbnail_blob) if diagram.thumbnail_blob or diagram.thumbnail else None
+
+def _diagram_response(diagram: Diagram, data: dict, version: int) -> DiagramResponse:
+    return DiagramResponse(
+        id=diagram.id,
+        title=diagram.title,
+        description=diagram.description,
+        data=data,
+        thumbnail=diagram.thumbnail,
+        thumbnail_url=_diagram_thumbnail_url(diagram),
+        owner_id=diagram.owner_id,
+        is_public=diagram.is_public,
+        version=version,
+        created_at=diagram.created_at,
+        updated_at=diagram.updated_at
+    )
+
+def _etag_headers(etag: str) -> dict:
+    # no-cache: browsers may keep the body but must revalidate it on every open
+    return {"ETag": etag, "Cache-Control": "private, no-cache", "Vary": "Accept-Encoding"}
+
 @router.post("/", response_model=DiagramResponse)
 async def create_diagram(
     diagram_data: DiagramCreate,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """Create a new diagram"""
     diagram = Diagram(
         title=diagram_data.title,
         description=diagram_data.description,
-        data=diagram_data.data,
         owner_id=current_user.id,
         is_public=diagram_data.is_public
     )
     
     db.add(diagram)
-    db.commit()
-    db.refresh(diagram)
+    await store_data(db, diagram, diagram_data.data)
+    await db.flush()
+    await record_revision(db, diagram.id, diagram.version, REVISION_CREATE, diagram_data.data, user_id=current_user.id)
+    await search_index.upsert(db, [search_document(
+        diagram.id, diagram.title, diagram.description, diagram.owner_id, diagram.is_public,
+        await asyncio.to_thread(extract_text, diagram_data.data)
+    )])
+    await db.commit()
+    await db.refresh(diagram)
+    thumbnail_renderer.schedule([diagram.id])
     
     return DiagramResponse(
         id=diagram.id,
         title=diagram.title,
         description=diagram.description,
-        data=diagram.data,
+        data=diagram_data.data,
         thumbnail=diagram.thumbnail,
+        thumbnail_url=_diagram_thumbnail_url(diagram),
         owner_id=diagram.owner_id,
         is_public=diagram.is_public,
+        version=diagram.version,
         created_at=diagram.created_at,
         updated_at=diagram.updated_at
     )
 
-@router.get("/", response_model=List[DiagramResponse])
+@router.get("/", response_model=List[Union[DiagramResponse, DiagramSummary]])
 async def get_diagrams(
+    response: Response,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     skip: int = 0,
-    limit: int = 100
+    limit: int = Query(100, ge=1, le=100),
+    view: Literal["full", "summary"] = "full",
+    scope: Literal["all", "owned", "public"] = "all",
+    cursor: Optional[str] = None
 ):
-    """Get user's diagrams and public diagrams"""
-    diagrams = db.query(Diagram).filter(
-        (Diagram.owner_id == current_user.id) | (Diagram.is_public == True)
-    ).offset(skip).limit(limit).all()
+    """Get user's diagrams and public diagrams, newest first.
+
+    `view=summary` leaves out data and thumbnail at the SQL level and links thumbnails
+    instead. Pass the X-Next-Cursor response header back as `cursor` for the next page.
+    """
+    if scope == "owned":
+        visibility = Diagram.owner_id == current_user.id
+    elif scope == "public":
+        visibility = Diagram.is_public == True
+    else:
+        visibility = (Diagram.owner_id == current_user.id) | (Diagram.is_public == True)
+    
+    if view == "summary":
+        query = select(Diagram, HAS_THUMBNAIL).options(load_only(*SUMMARY_COLUMNS))
+    else:
+        query = select(Diagram)
+    query = query.where(visibility).order_by(Diagram.updated_at.desc(), Diagram.id.desc())
+    
+    if cursor:
+        updated_at, last_id = _decode_cursor(cursor)
+        updated_at = _cursor_timestamp(db, updated_at)
+        query = query.where(or_(
+            Diagram.updated_at < updated_at,
+            and_(Diagram.updated_at == updated_at, Diagram.id < last_id)
+        ))
+    elif skip:
+        query = query.offset(skip)
+    
+    result = await db.execute(query.limit(limit))
+    rows = result.all() if view == "summary" else result.scalars().all()
+    diagrams = [row[0] for row in rows] if view == "summary" else rows
+    if len(diagrams) == limit:
+        response.headers["X-Next-Cursor"] = _encode_cursor(diagrams[-1])
+    if view == "full":
+        data = await load_many(db, [(d.id, d.storage, d.data) for d in diagrams])
+    
+    if view == "summary":
+        return [
+            DiagramSummary(
+                id=d.id,
+                title=d.title,
+                description=d.description,
+                is_public=d.is_public,
+                owner_id=d.owner_id,
+                version=d.version,
+                thumbnail_url=_thumbnail_url(d.id, d.thumbnail_blob) if has_thumbnail else None,
+                created_at=d.created_at,
+                updated_at=d.updated_at
+            ) for d, has_thumbnail in rows
+        ]
     
     return [
         DiagramResponse(
             id=d.id,
             title=d.title,
             description=d.description,
-            data=d.data,
+            data=data[d.id],
             thumbnail=d.thumbnail,
+            thumbnail_url=_diagram_thumbnail_url(d),
             owner_id=d.owner_id,
             is_public=d.is_public,
+            version=d.version,
             created_at=d.created_at,
             updated_at=d.updated_at
         ) for d in diagrams
     ]
 
+@router.get("/search", response_model=List[DiagramSearchResult])
+async def search_diagrams(
+    q: str = Query(..., min_length=1, max_length=200),
+    scope: Literal["all", "owned", "public"] = "all",
+    limit: int = Query(20, ge=1, le=100),
+    offset: int = Query(0, ge=0, le=1000),
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """Ranked full-text search over titles, descriptions and shape labels the user may see"""
+    hits = await search_index.search(db, q, scope, current_user.id, limit, offset)
+    if not hits:
+        return []
+    
+    rows = (await db.execute(
+        select(Diagram, HAS_THUMBNAIL)
+        .options(load_only(*SUMMARY_COLUMNS))
+        .where(Diagram.id.in_([hit.id for hit in hits]))
+    )).all()
+    by_id = {d.id: (d, has_thumbnail) for d, has_thumbnail in rows}
+    
+    results = []
+    for hit in hits:
+        if hit.id not in by_id:
+            continue
+        d, has_thumbnail = by_id[hit.id]
+        live = document_store.get(d.id)
+        results.append(DiagramSearchResult(
+            id=d.id,
+            title=d.title,
+            description=d.description,
+            is_public=d.is_public,
+            owner_id=d.owner_id,
+            version=live.version if live else d.version,
+            thumbnail_url=_thumbnail_url(d.id, d.thumbnail_blob) if has_thumbnail else None,
+            created_at=d.created_at,
+            updated_at=d.updated_at,
+            score=hit.score,
+            snippet=hit.snippet
+        ))
+    return results
+
+async def _flush_history(diagram_id: int):
+    """Write a room's pending revisions so history reads see every version up to the live one"""
+    live = document_store.get(diagram_id)
+    if live is None or not live.pending_revisions:
+        return
+    if not manager.sequenced_elsewhere(str(diagram_id)):
+        await document_store.flush([diagram_id])
+        return
+    # Only the process sequencing the room writes its history
+    try:
+        await manager.request_flush(str(diagram_id))
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=ROOM_UNAVAILABLE)
+
 @router.get("/{diagram_id}", response_model=DiagramResponse)
 async def get_diagram(
     diagram_id: int,
+    version: Optional[int] = Query(None, ge=1, description="Return the data as of this earlier version"),
+    if_none_match: Optional[str] = Header(None),
+    accept_encoding: Optional[str] = Header(None),
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
-    """Get a specific diagram by ID"""
-    diagram = db.query(Diagram).filter(Diagram.id == diagram_id).first()
+    """Get a specific diagram by ID; with `version`, data is as of that version while metadata stays current.
+
+    The current version is served with an ETag: a matching If-None-Match gets 304, and the
+    encoded body is cached per version so repeated opens skip loading and serializing data.
+    Large bodies are sent in the best Accept-Encoding, compressed once per version and cached.
+    """
+    # Data and thumbnail stay unloaded until the body is known not to be cached
+    diagram = (await db.execute(
+        select(Diagram).options(defer(Diagram.data), defer(Diagram.thumbnail)).where(Diagram.id == diagram_id)
+    )).scalars().first()
     
     if not diagram:
         raise HTTPException(status_code=404, detail="Diagram not found")
@@ -81,27 +300,265 @@ async def get_diagram(
     if not diagram.is_public and diagram.owner_id != current_user.id:
         raise HTTPException(status_code=403, detail="Access denied")
     
-    return DiagramResponse(
-        id=diagram.id,
-        title=diagram.title,
-        description=diagram.description,
-        data=diagram.data,
-        thumbnail=diagram.thumbnail,
-        owner_id=diagram.owner_id,
-        is_public=diagram.is_public,
-        created_at=diagram.created_at,
-        updated_at=diagram.updated_at
+    # An active room holds newer data than the row until its next flush
+    live = document_store.get(diagram.id)
+    current_version = live.version if live else diagram.version
+    
+    if version is not None and version != current_version:
+        if version > current_version:
+            raise HTTPException(status_code=404, detail=f"Diagram is at version {current_version}")
+        await _flush_history(diagram_id)
+        try:
+            data = await load_version(db, diagram_id, version)
+        except VersionUnavailable as e:
+            raise HTTPException(status_code=404, detail=str(e))
+        await db.refresh(diagram, ["thumbnail", "thumbnail_blob"])
+        return _diagram_response(diagram, data, version)
+    
+    etag = diagram_etag(diagram.id, current_version, diagram.updated_at, diagram.thumbnail_blob)
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=_etag_headers(etag))
+    
+    body = diagram_response_cache.get(diagram.id, etag)
+    if body is None:
+        # Reloading version and updated_at with the data keeps body and ETag consistent if a write landed meanwhile
+        await db.refresh(diagram, [
+            "data", "storage", "thumbnail", "thumbnail_blob", "version", "updated_at", "title", "description", "is_public"
+        ])
+        live = document_store.get(diagram.id)
+        if live is None:
+            # Elements are read after the row: a write landing in between pairs newer data with
+            # the older ETag, which is replaced on the next read rather than served as current
+            data = await load_data(db, diagram.id, diagram.storage, diagram.data)
+            live = document_store.get(diagram.id)
+        current_version = live.version if live else diagram.version
+        # No await between here and the encode, so the live document cannot change underneath it
+        if live:
+            data = live.data
+        etag = diagram_etag(diagram.id, current_version, diagram.updated_at, diagram.thumbnail_blob)
+        body = _diagram_response(diagram, data, current_version).model_dump_json().encode()
+        diagram_response_cache.put(diagram.id, etag, body)
+    
+    encoding = negotiate_encoding(accept_encoding) if len(body) >= settings.COMPRESSION_MIN_BYTES else None
+    if encoding is None:
+        return Response(content=body, media_type="application/json", headers=_etag_headers(etag))
+    compressed = diagram_response_cache.get_variant(diagram.id, etag, encoding)
+    if compressed is None:
+        compressed = await compress(body, encoding)
+        diagram_response_cache.put_variant(diagram.id, etag, encoding, compressed)
+    return Response(
+        content=compressed,
+        media_type="application/json",
+        headers={**_etag_headers(variant_etag(etag, encoding)), "Content-Encoding": encoding}
+    )
+
+@router.get("/{diagram_id}/versions", response_model=List[DiagramVersion])
+async def get_diagram_versions(
+    diagram_id: int,
+    before: Optional[int] = Query(None, ge=1, description="Only versions older than this one"),
+    limit: int = Query(50, ge=1, le=500),
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """Recorded versions of a diagram, newest first; any of them can be read with GET ?version="""
+    row = (await db.execute(
+        select(Diagram.owner_id, Diagram.is_public).where(Diagram.id == diagram_id)
+    )).first()
+    
+    if not row:
+        raise HTTPException(status_code=404, detail="Diagram not found")
+    
+    if not row.is_public and row.owner_id != current_user.id:
+        raise HTTPException(status_code=403, detail="Access denied")
+    
+    await _flush_history(diagram_id)
+    query = select(DiagramRevision).where(DiagramRevision.diagram_id == diagram_id)
+    if before is not None:
+        query = query.where(DiagramRevision.version < before)
+    revisions = (await db.execute(query.order_by(DiagramRevision.version.desc()).limit(limit))).scalars().all()
+    
+    checkpointed = set()
+    if revisions:
+        checkpointed = set((await db.execute(
+            select(DiagramCheckpoint.version).where(
+                DiagramCheckpoint.diagram_id == diagram_id,
+                DiagramCheckpoint.version.between(revisions[-1].version, revisions[0].version)
+            )
+        )).scalars())
+    
+    return [
+        DiagramVersion(
+            version=revision.version,
+            kind=revision.kind,
+            op_count=revision.op_count,
+            user_id=revision.user_id,
+            checkpoint=revision.version in checkpointed,
+            created_at=revision.created_at
+        ) for revision in revisions
+    ]
+
+def _parse_bbox(bbox: str):
+    try:
+        bounds = tuple(float(value) for value in bbox.split(","))
+    except ValueError:
+        bounds = ()
+    if len(bounds) != 4 or not all(math.isfinite(value) for value in bounds) \
+            or bounds[0] > bounds[2] or bounds[1] > bounds[3]:
+        raise HTTPException(status_code=422, detail="bbox must be min_x,min_y,max_x,max_y")
+    return bounds
+
+@router.get("/{diagram_id}/region", response_model=DiagramRegionResponse)
+async def get_diagram_region(
+    diagram_id: int,
+    bbox: str = Query(..., description="Viewport as min_x,min_y,max_x,max_y in diagram units"),
+    zoom: float = Query(1.0, gt=0, description="Screen pixels per diagram unit"),
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """Shapes intersecting a viewport and their connections, with sub-pixel shapes culled at this zoom"""
+    bounds = _parse_bbox(bbox)
+    row = (await db.execute(
+        select(Diagram.owner_id, Diagram.is_public, Diagram.version, Diagram.storage).where(Diagram.id == diagram_id)
+    )).first()
+    
+    if not row:
+        raise HTTPException(status_code=404, detail="Diagram not found")
+    
+    if not row.is_public and row.owner_id != current_user.id:
+        raise HTTPException(status_code=403, detail="Access denied")
+    
+    live = document_store.get(diagram_id)
+    version = live.version if live else row.version
+    index = spatial_index_cache.get(diagram_id, version)
+    if index is None and not live and row.storage == STORAGE_ELEMENTS:
+        # Stored per element: read just the viewport from the bbox index instead of building an R-tree
+        region = await load_region(db, diagram_id, bounds, zoom, settings.REGION_LOD_MIN_PIXELS)
+    else:
+        if index is None:
+            # Snapshot in the same step as reading the version so the index matches it
+            if live:
+                data = live.document.snapshot()
+            else:
+                stored = await db.scalar(select(Diagram.data).where(Diagram.id == diagram_id))
+                data = await load_data(db, diagram_id, row.storage, stored)
+            index = await asyncio.to_thread(DiagramSpatialIndex, data or {})
+            spatial_index_cache.put(diagram_id, version, index)
+        region = index.region(bounds, zoom, settings.REGION_LOD_MIN_PIXELS)
+    
+    return DiagramRegionResponse(
+        id=diagram_id,
+        version=version,
+        bbox=list(bounds),
+        zoom=zoom,
+        **region
+    )
+
+@router.get("/{diagram_id}/thumbnail")
+async def get_diagram_thumbnail(
+    diagram_id: int,
+    size: Optional[int] = Query(None, ge=1, description="Smallest rendered size at least this many pixels wide"),
+    v: Optional[str] = Query(None, description="Thumbnail version from thumbnail_url; makes the response cacheable for good"),
+    if_none_match: Optional[str] = Header(None),
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """Serve a diagram's thumbnail as an image instead of inline Base64"""
+    row = (await db.execute(
+        select(
+            Diagram.owner_id, Diagram.is_public, Diagram.thumbnail_blob, Diagram.thumbnail_type,
+            Diagram.thumbnail_sizes, Diagram.thumbnail
+        ).where(Diagram.id == diagram_id)
+    )).first()
+    
+    if not row:
+        raise HTTPException(status_code=404, detail="Diagram not found")
+    
+    if not row.is_public and row.owner_id != current_user.id:
+        raise HTTPException(status_code=403, detail="Access denied")
+    
+    if row.thumbnail_blob:
+        digest, media_type = row.thumbnail_blob, row.thumbnail_type or "image/png"
+        if size is not None and row.thumbnail_sizes:
+            # Server renders: the smallest one covering the requested size, else the largest
+            rendered = sorted((int(width), blob) for width, blob in row.thumbnail_sizes.items())
+            digest = next((blob for width, blob in rendered if width >= size), rendered[-1][1])
+            media_type = SVG_MEDIA_TYPE
+        # Content-addressed: the digest is a strong validator, and the file is streamed without being read
+        current = v is not None and v == row.thumbnail_blob[:THUMBNAIL_TAG_LENGTH]
+        headers = {
+            "ETag": f'"{digest}"',
+            "Cache-Control": "private, max-age=31536000, immutable" if current else "private, max-age=300"
+        }
+        if etag_matches(if_none_match, headers["ETag"]):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+        return BlobResponse(blob_store.path(digest), media_type, headers=headers)
+    
+    if not row.thumbnail:
+        raise HTTPException(status_code=404, detail="Thumbnail not found")
+    
+    # Stored either as a data URL ("data:image/png;base64,...") or as bare Base64 PNG
+    media_type, encoded = "image/png", row.thumbnail
+    if encoded.startswith("data:") and "," in encoded:
+        header, encoded = encoded.split(",", 1)
+        media_type = header[5:].split(";", 1)[0] or media_type
+    try:
+        content = base64.b64decode(encoded)
+    except (ValueError, binascii.Error):
+        raise HTTPException(status_code=422, detail="Stored thumbnail is not valid Base64")
+    
+    return Response(
+        content=content,
+        media_type=media_type,
+        headers={"Cache-Control": "private, max-age=300"}
     )
 
+@router.put("/{diagram_id}/thumbnail", status_code=status.HTTP_204_NO_CONTENT)
+async def put_diagram_thumbnail(
+    diagram_id: int,
+    request: Request,
+    content_type: Optional[str] = Header(None),
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """Replace a diagram's thumbnail with the image sent as the raw request body"""
+    media_type = (content_type or "").split(";", 1)[0].strip().lower()
+    if not media_type.startswith("image/"):
+        raise HTTPException(status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, detail="Thumbnail must be an image/* body")
+    
+    diagram = (await db.execute(
+        select(Diagram).options(defer(Diagram.data), defer(Diagram.thumbnail)).where(Diagram.id == diagram_id)
+    )).scalars().first()
+    
+    if not diagram:
+        raise HTTPException(status_code=404, detail="Diagram not found")
+    
+    if diagram.owner_id != current_user.id:
+        raise HTTPException(status_code=403, detail="Access denied")
+    
+    content = bytearray()
+    async for chunk in request.stream():
+        content += chunk
+        if len(content) > settings.THUMBNAIL_MAX_BYTES:
+            raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail="Thumbnail is too large")
+    if not content:
+        raise HTTPException(status_code=422, detail="Thumbnail is empty")
+    
+    # Identical images (templates, re-uploads) share one file
+    await store_thumbnail(db, diagram, bytes(content), media_type)
+    await db.commit()
+    # updated_at moved, so the diagram's ETag did too; this just frees the old body
+    diagram_response_cache.discard(diagram_id)
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
+
 @router.put("/{diagram_id}", response_model=DiagramResponse)
 async def update_diagram(
     diagram_id: int,
     diagram_data: DiagramUpdate,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """Update a diagram"""
-    diagram = db.query(Diagram).filter(Diagram.id == diagram_id).first()
+    diagram = await db.get(Diagram, diagram_id)
     
     if not diagram:
         raise HTTPException(status_code=404, detail="Diagram not found")
@@ -109,33 +566,211 @@ async def update_diagram(
     if diagram.owner_id != current_user.id:
         raise HTTPException(status_code=403, detail="Access denied")
     
-    # Update fields
-    for field, value in diagram_data.dict(exclude_unset=True).items():
-        setattr(diagram, field, value)
+    # A room sequenced by another process is stored by it first; this then saves over the row
+    # like a closed room and has every process reload it
+    elsewhere = manager.sequenced_elsewhere(str(diagram.id))
+    if elsewhere:
+        try:
+            await manager.request_flush(str(diagram.id))
+        except asyncio.TimeoutError:
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=ROOM_UNAVAILABLE)
+        await db.refresh(diagram)
     
-    db.commit()
-    db.refresh(diagram)
+    # Hold the write-behind lock so a pending room flush cannot overwrite this save
+    async with document_store.write_lock:
+        live = None if elsewhere else document_store.get(diagram.id)
+        current_version = live.version if live else diagram.version
+        if diagram_data.version is not None and diagram_data.version != current_version:
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail=f"Version conflict: diagram is at version {current_version}"
+            )
+        
+        # The room's revisions up to current_version must be stored before this one
+        if live:
+            await document_store.flush_held([diagram.id])
+        previous_data = live.document.snapshot() if live else await load_data(db, diagram.id, diagram.storage, diagram.data)
+        
+        # Record the save as ops when it can be, so history does not hold a full copy per save
+        if diagram_data.data is None:
+            kind, operations, new_data = REVISION_SAVE, [], previous_data
+        else:
+            operations = await asyncio.to_thread(diff_operations, previous_data, diagram_data.data)
+            kind = REVISION_SAVE if operations is not None else REVISION_REPLACE
+            new_data = diagram_data.data
+        content = await asyncio.to_thread(extract_text, new_data)
+        
+        # Claimed before anything else is written, so a save or room flush from another process
+        # that landed meanwhile fails this one instead of being overwritten by it
+        claimed = await db.execute(
+            update(Diagram)
+            .where(Diagram.id == diagram.id, Diagram.version == current_version)
+            .values(version=current_version + 1)
+            .execution_options(synchronize_session=False)
+        )
+        if claimed.rowcount == 0:
+            await db.rollback()
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail="Version conflict: diagram changed while saving"
+            )
+        
+        # Update fields
+        for field, value in diagram_data.model_dump(exclude_unset=True, exclude={"version", "data"}).items():
+            setattr(diagram, field, value)
+        if diagram_data.data is not None:
+            if operations is not None and diagram.storage == STORAGE_ELEMENTS:
+                # Only the elements the save changed are rewritten
+                document = DiagramDocument(previous_data)
+                document.track_changes()
+                document.apply(operations)
+                await write_document(db, diagram.id, document)
+            else:
+                await store_data(db, diagram, new_data)
+        diagram.version = current_version + 1
+        ops_since_checkpoint = await record_revision(
+            db, diagram.id, diagram.version, kind, new_data, operations, current_user.id,
+            previous=(current_version, previous_data)
+        )
+        await search_index.upsert(db, [search_document(
+            diagram.id, diagram.title, diagram.description, diagram.owner_id, diagram.is_public, content
+        )])
+        
+        await db.commit()
+        await db.refresh(diagram)
+        
+        # This process's copy of a room sequenced elsewhere takes the save too
+        live = document_store.get(diagram.id)
+        if live:
+            live.is_public = diagram.is_public
+            if diagram_data.data is not None:
+                document_store.replace(
+                    diagram.id, new_data, diagram.version, ops_since_checkpoint, diagram.storage,
+                    blob_digest(diagram.storage, diagram.data)
+                )
+            else:
+                live.version = diagram.version
+                live.ops_since_checkpoint = ops_since_checkpoint
+    manager.document_replaced(str(diagram.id))
+    # The new version has a new ETag anyway; this just frees the old body
+    diagram_response_cache.discard(diagram.id)
+    if diagram_data.data is not None:
+        thumbnail_renderer.schedule([diagram.id])
     
-    return DiagramResponse(
-        id=diagram.id,
-        title=diagram.title,
-        description=diagram.description,
-        data=diagram.data,
-        thumbnail=diagram.thumbnail,
-        owner_id=diagram.owner_id,
-        is_public=diagram.is_public,
-        created_at=diagram.created_at,
-        updated_at=diagram.updated_at
-    )
+    return _diagram_response(diagram, live.document.snapshot() if live else new_data, diagram.version)
+
+@router.patch("/{diagram_id}", response_model=DiagramPatchResponse)
+async def patch_diagram(
+    diagram_id: int,
+    patch: DiagramPatch,
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """Apply shape-level operations made against a known diagram version"""
+    diagram = (await db.execute(
+        select(Diagram).options(defer(Diagram.data), defer(Diagram.thumbnail)).where(Diagram.id == diagram_id)
+    )).scalars().first()
+    
+    if not diagram:
+        raise HTTPException(status_code=404, detail="Diagram not found")
+    
+    if diagram.owner_id != current_user.id:
+        raise HTTPException(status_code=403, detail="Access denied")
+    
+    operations = [operation.model_dump(exclude_none=True) for operation in patch.operations]
+    
+    if manager.sequenced_elsewhere(str(diagram_id)):
+        # The process sequencing the room applies the batch and broadcasts it
+        try:
+            version = await manager.forward_ops(str(diagram_id), operations, patch.version, current_user)
+        except asyncio.TimeoutError:
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=ROOM_UNAVAILABLE)
+        except VersionConflict as e:
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail=f"Version conflict: diagram is at version {e.current_version}"
+            )
+        except DiagramOperationError as e:
+            raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=str(e))
+        diagram_response_cache.discard(diagram_id)
+        return DiagramPatchResponse(id=diagram_id, version=version)
+    
+    async with document_store.write_lock:
+        live = document_store.get(diagram_id)
+        try:
+            if live:
+                # The room's document is authoritative; the write-behind flush persists it
+                merged = document_store.merge(
+                    diagram_id, operations, base_version=patch.version, user_id=current_user.id, strict=True
+                )
+                version, applied = merged.version, merged.operations
+            else:
+                if diagram.version != patch.version:
+                    raise VersionConflict(diagram.version)
+                column = await db.scalar(select(Diagram.data).where(Diagram.id == diagram_id))
+                stored = await load_data(db, diagram_id, diagram.storage, column)
+                document = DiagramDocument(stored)
+                document.track_changes()
+                # No room, so nothing to merge with; this resolves moves and reorders the way a room would
+                applied, _ = DiagramCrdt().merge(document, operations, strict=True)
+                data = document.data
+                # Element-backed diagrams keep the row as is apart from the version
+                values = {"version": Diagram.version + 1}
+                if diagram.storage != STORAGE_ELEMENTS:
+                    values["storage"], values["data"] = await stored_form(db, data)
+                result = await db.execute(
+                    update(Diagram)
+                    .where(Diagram.id == diagram_id, Diagram.version == patch.version)
+                    .values(**values)
+                    .execution_options(synchronize_session=False)
+                )
+                if result.rowcount == 0:
+                    await db.rollback()
+                    raise VersionConflict(await db.scalar(select(Diagram.version).where(Diagram.id == diagram_id)))
+                if diagram.storage == STORAGE_ELEMENTS:
+                    await write_document(db, diagram_id, document)
+                await blob_store.release(db, [blob_digest(diagram.storage, column)])
+                version = patch.version + 1
+                await record_revision(
+                    db, diagram_id, version, REVISION_OPS, data, applied, current_user.id,
+                    previous=(patch.version, stored)
+                )
+                # Moves cannot change any text
+                if any(operation["op"] != "move" for operation in operations):
+                    await search_index.update_content(db, [{"diagram_id": diagram_id, "content": await asyncio.to_thread(extract_text, data)}])
+                await db.commit()
+                # Room edits are scheduled by the write-behind flush instead
+                thumbnail_renderer.schedule([diagram_id])
+        except VersionConflict as e:
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail=f"Version conflict: diagram is at version {e.current_version}"
+            )
+        except DiagramOperationError as e:
+            raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=str(e))
+    diagram_response_cache.discard(diagram_id)
+    
+    if live and applied:
+        manager.broadcast_to_diagram_sync(
+            str(diagram_id),
+            {
+                "type": "drawing_update",
+                "data": {"ops": applied, "version": version},
+                "user_id": current_user.id,
+                "username": current_user.username
+            }
+        )
+    
+    return DiagramPatchResponse(id=diagram_id, version=version)
 
 @router.delete("/{diagram_id}")
 async def delete_diagram(
     diagram_id: int,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """Delete a diagram"""
-    diagram = db.query(Diagram).filter(Diagram.id == diagram_id).first()
+    diagram = await db.get(Diagram, diagram_id)
     
     if not diagram:
         raise HTTPException(status_code=404, detail="Diagram not found")
@@ -143,7 +778,28 @@ async def delete_diagram(
     if diagram.owner_id != current_user.id:
         raise HTTPException(status_code=403, detail="Access denied")
     
-    db.delete(diagram)
-    db.commit()
+    # A room flush in progress finishes first, and none starts again until its document is gone,
+    # so no history, element rows or blob references are written back for the deleted row
+    async with document_store.write_lock:
+        # The row may have been flushed while we waited
+        await db.refresh(diagram, ["storage", "data", "thumbnail_blob", "thumbnail_sizes"])
+        checkpoint_blobs = (await db.execute(
+            select(DiagramCheckpoint.data_blob).where(DiagramCheckpoint.diagram_id == diagram_id, DiagramCheckpoint.data_blob.isnot(None))
+        )).scalars().all()
+        await blob_store.release(db, [
+            blob_digest(diagram.storage, diagram.data), diagram.thumbnail_blob, *(diagram.thumbnail_sizes or {}).values(),
+            *checkpoint_blobs
+        ])
+        await db.execute(delete(DiagramRevision).where(DiagramRevision.diagram_id == diagram_id))
+        await db.execute(delete(DiagramCheckpoint).where(DiagramCheckpoint.diagram_id == diagram_id))
+        await db.execute(delete(DiagramElement).where(DiagramElement.diagram_id == diagram_id))
+        await search_index.delete(db, diagram_id)
+        await db.delete(diagram)
+        await db.commit()
+        document_store.discard(diagram_id)
+    # Members are told and disconnected rather than left editing a document that is gone
+    manager.room_deleted(str(diagram_id))
+    spatial_index_cache.discard(diagram_id)
+    diagram_response_cache.discard(diagram_id)
     
     return {"message": "Diagram deleted successfully"}
@@ -1,43 +1,308 @@
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Depends, HTTPException
-from typing import Dict, List
-import json
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List, Optional, Set, Tuple, Union
+import asyncio
+import itertools
 import logging
-from app.services.auth import get_current_user
+import time
+import uuid
+from app.core.config import settings
+from app.core.database import AsyncSessionLocal
+from app.core.metrics import registry
+from app.services.auth import get_current_user_ws
+from app.services.backplane import Backplane, create_backplane
+from app.services.diagram_crdt import parse_vector
+from app.services.diagram_ops import DiagramOperationError
+from app.services.document_store import DocumentStore, VersionConflict, document_store
+from app.services.presence import PresenceAggregator, merge_cursor_batches, without_cursor
+from app.services.room_log import RoomLog, RoomSnapshot
+from app.services.ws_codec import JSON_CODEC, FrameDecodeError, negotiate
 from app.models.user import User
 
 router = APIRouter()
 logger = logging.getLogger(__name__)
 
+OVERFLOW_DROP_OLDEST = "drop_oldest"
+OVERFLOW_COALESCE = "coalesce"
+OVERFLOW_DISCONNECT = "disconnect"
+
+# Message types where only the latest frame per sender (or, for cursor batches, per room) matters
+COALESCIBLE_MESSAGE_TYPES = {"cursor_move", "cursors"}
+# Inbound types counted by name; anything else a client sends is counted as "other"
+CLIENT_MESSAGE_TYPES = {"drawing_update", "cursor_move", "ping", "sync_request"}
+# Broadcasts that get no sequence number and are not replayed: the next tick supersedes them anyway
+UNSEQUENCED_MESSAGE_TYPES = {"cursors"}
+
+SYNC_RESUME = "resume"
+SYNC_SNAPSHOT = "snapshot"
+SYNC_NONE = "none"
+# Rebuilds of a snapshot that went stale while it was being encoded before one is encoded inline
+SNAPSHOT_ATTEMPTS = 3
+# Close code for the members of a room whose diagram was deleted
+ROOM_DELETED_CLOSE_CODE = 4004
+
+WS_MESSAGES_RECEIVED = registry.counter("ws_messages_received", "Messages received from clients, by type", ("type",))
+WS_BROADCASTS = registry.counter("ws_broadcasts", "Room broadcasts delivered in this process, by message type", ("type",))
+WS_BROADCAST_FRAMES = registry.counter("ws_broadcast_frames", "Frames queued to peers by room broadcasts, by message type", ("type",))
+WS_BROADCAST_SECONDS = registry.histogram(
+    "ws_broadcast_duration_seconds", "Time to serialize a broadcast and queue it to every local peer", ("type",)
+)
+WS_SEND_DELAY_SECONDS = registry.histogram(
+    "ws_send_delay_seconds", "Time a frame waited in a client's outbound queue before it was written"
+)
+WS_DROPPED_FRAMES = registry.counter(
+    "ws_dropped_frames", "Outbound frames discarded, by overflow policy (coalesce counts superseded frames)", ("reason",)
+)
+_DROPPED_OLDEST = WS_DROPPED_FRAMES.labels(OVERFLOW_DROP_OLDEST)
+_DROPPED_COALESCED = WS_DROPPED_FRAMES.labels(OVERFLOW_COALESCE)
+_DROPPED_DISCONNECT = WS_DROPPED_FRAMES.labels(OVERFLOW_DISCONNECT)
+WS_ROOM_SYNCS = registry.counter(
+    "ws_room_syncs", "How joining clients were brought up to date: resume, snapshot (cached or built) or none", ("mode",)
+)
+
+class ClientConnection:
+    """Outbound side of one WebSocket: a bounded frame queue drained by its own writer task"""
+
+    def __init__(self, websocket: WebSocket, max_size: int, overflow_policy: str, on_failure, codec=JSON_CODEC):
+        self.websocket = websocket
+        self.codec = codec
+        self.max_size = max(1, max_size)
+        self.overflow_policy = overflow_policy
+        self.dropped_frames = 0
+        self.closed = False
+        # (code, reason) to close with once the queued frames are written
+        self._closing: Optional[Tuple[int, str]] = None
+        # Each slot is [coalesce_key, frame, enqueued_at, message] so a pending frame can be replaced in place
+        self._slots: Deque[list] = deque()
+        self._pending_by_key: Dict[Tuple, list] = {}
+        self._ready = asyncio.Event()
+        self._on_failure = on_failure
+        self._writer_task: Optional[asyncio.Task] = None
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._slots)
+
+    def start(self):
+        self._writer_task = asyncio.create_task(self._writer())
+
+    def stop(self):
+        self.closed = True
+        self._slots.clear()
+        self._pending_by_key.clear()
+        if self._writer_task and not self._writer_task.done():
+            self._writer_task.cancel()
+
+    def close_when_drained(self, code: int, reason: str):
+        """Write what is already queued, then close the socket; later frames are refused"""
+        self._closing = (code, reason)
+        self._ready.set()
+
+    def enqueue(self, frame: Union[str, bytes], coalesce_key: Optional[Tuple] = None, message: Optional[dict] = None) -> bool:
+        """Queue a serialized frame without awaiting the peer; returns False if it was not accepted.
+
+        `message` is what `frame` encodes; coalescible frames need it to merge cursor batches.
+        """
+        if self.closed or self._closing is not None:
+            return False
+
+        if coalesce_key is not None and self.overflow_policy == OVERFLOW_COALESCE:
+            pending = self._pending_by_key.get(coalesce_key)
+            if pending is not None:
+                if message is not None and message.get("type") == "cursors" and pending[3] is not None:
+                    # Batches only hold the cursors that moved, so the pending one's others are kept
+                    message = merge_cursor_batches(pending[3], message)
+                    frame = self.codec.encode(message)
+                pending[1], pending[3] = frame, message
+                _DROPPED_COALESCED.inc()
+                return True
+
+        if len(self._slots) >= self.max_size:
+            if self.overflow_policy == OVERFLOW_DISCONNECT:
+                self.dropped_frames += 1
+                _DROPPED_DISCONNECT.inc()
+                logger.warning("Outbound queue full, disconnecting slow client")
+                self._on_failure(self, 1013, "Client too slow")
+                return False
+            self._drop_oldest()
+
+        slot = [coalesce_key, frame, time.perf_counter(), message if coalesce_key is not None else None]
+        self._slots.append(slot)
+        if coalesce_key is not None and self.overflow_policy == OVERFLOW_COALESCE:
+            self._pending_by_key[coalesce_key] = slot
+        self._ready.set()
+        return True
+
+    def _drop_oldest(self):
+        key = self._slots.popleft()[0]
+        self._forget_key(key)
+        self.dropped_frames += 1
+        _DROPPED_OLDEST.inc()
+
+    def _forget_key(self, key: Optional[Tuple]):
+        if key is not None:
+            self._pending_by_key.pop(key, None)
+
+    async def _writer(self):
+        try:
+            while True:
+                while not self._slots:
+                    if self._closing is not None:
+                        await self.websocket.close(code=self._closing[0], reason=self._closing[1])
+                        return
+                    self._ready.clear()
+                    await self._ready.wait()
+                key, frame, enqueued_at, _ = self._slots.popleft()
+                self._forget_key(key)
+                if self.codec.binary:
+                    await self.websocket.send_bytes(frame)
+                else:
+                    await self.websocket.send_text(frame)
+                WS_SEND_DELAY_SECONDS.observe(time.perf_counter() - enqueued_at)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"WebSocket send failed: {e}")
+            self._on_failure(self, None, None)
+
 # Store active connections
 class ConnectionManager:
-    def __init__(self):
+    """Rooms of WebSocket clients in this process.
+
+    Every room broadcast except cursor batches carries a per-room `seq` and is kept in the
+    room's RoomLog. A client reconnecting with ?epoch=&last_seq= (and ?member= to skip its own
+    messages) gets just what it missed; a new joiner in a room with a live document gets a
+    cached diagram_snapshot plus the buffered broadcasts after it. drawing_update frames at or
+    below the snapshot's version are already part of it.
+
+    Only the backplane's sequencer merges edits into live documents and writes them back; other
+    processes forward their clients' ops to it and apply its broadcasts in version order.
+    """
+
+    def __init__(
+        self,
+        queue_size: int = settings.WS_MESSAGE_QUEUE_SIZE,
+        overflow_policy: str = settings.WS_OVERFLOW_POLICY,
+        backplane: Optional[Backplane] = None,
+        replay_buffer_size: int = settings.WS_REPLAY_BUFFER_SIZE,
+        replay_retention: float = settings.WS_REPLAY_RETENTION_SECONDS,
+        documents: Optional[DocumentStore] = None
+    ):
         self.active_connections: Dict[str, List[WebSocket]] = {}
         self.user_connections: Dict[WebSocket, Dict] = {}
+        self.outbound: Dict[WebSocket, ClientConnection] = {}
+        self._members_by_id: Dict[str, WebSocket] = {}
+        self.queue_size = queue_size
+        self.overflow_policy = overflow_policy
+        self.presence = PresenceAggregator(settings.WS_PRESENCE_TICK_HZ, self.broadcast_to_diagram_sync)
+        # Room members connected to other processes, keyed by room then member id
+        self.remote_members: Dict[str, Dict[str, Dict]] = {}
+        self.backplane = backplane or create_backplane(settings.WS_BACKPLANE, settings.WS_BACKPLANE_SOCKET)
+        self.backplane.set_handler(self._on_backplane_message, on_reconnect=self._on_backplane_reconnect)
+        self._member_ids = itertools.count(1)
+        self._started = False
+        self.room_logs: Dict[str, RoomLog] = {}
+        self.replay_buffer_size = replay_buffer_size
+        self.replay_retention = replay_retention
+        self._epochs = itertools.count(1)
+        self.documents = documents or document_store
+        # Rooms the sequencer keeps open for members connected elsewhere
+        self.held_rooms: Set[str] = set()
+        # Actions waiting for a room's document to open, in arrival order
+        self._opening: Dict[str, List[Callable[[], None]]] = {}
+        # Rooms this replica asked to be flushed so it can reload them, and sequenced ops
+        # buffered while they reload
+        self._resyncing: Set[str] = set()
+        self._reloading: Dict[str, List[dict]] = {}
+        self._requests: Dict[str, asyncio.Future] = {}
+        self._flush_waiters: Dict[str, List[asyncio.Future]] = {}
+
+    def connection_counts(self):
+        """(room, local connections) for every room with a connection in this process"""
+        return [((room,), len(connections)) for room, connections in self.active_connections.items()]
+
+    def queued_frames(self):
+        """(room, frames waiting in its peers' outbound queues)"""
+        totals: Dict[str, int] = {}
+        for websocket, client in self.outbound.items():
+            room = self.user_connections.get(websocket, {}).get("diagram_id")
+            if room is not None:
+                totals[room] = totals.get(room, 0) + client.queue_depth
+        return [((room,), depth) for room, depth in totals.items()]
+
+    def max_queue_depth(self):
+        return [((), max((client.queue_depth for client in self.outbound.values()), default=0))]
+
+    async def start(self):
+        if not self._started:
+            self._started = True
+            self.documents.is_writer = lambda: self.backplane.sequencer
+            self.documents.flush_listeners.append(self._announce_flushed)
+            await self.backplane.start()
+
+    def _member(self, info: Dict) -> Dict:
+        return {
+            "member_id": info["member_id"],
+            "user_id": info["user_id"],
+            "username": info["username"],
+            "diagram_id": info["diagram_id"]
+        }
+
+    async def connect(
+        self,
+        websocket: WebSocket,
+        diagram_id: str,
+        user: User,
+        last_seq: Optional[int] = None,
+        epoch: Optional[str] = None,
+        member: Optional[str] = None
+    ):
+        """Accept with the best subprotocol the client offered, bring the client up to date and return the codec in use"""
+        await self.start()
+        codec = negotiate(websocket.scope.get("subprotocols") or [])
+        await websocket.accept(subprotocol=codec.subprotocol)
 
-    async def connect(self, websocket: WebSocket, diagram_id: str, user: User):
-        await websocket.accept()
-        
-        if diagram_id not in self.active_connections:
-            self.active_connections[diagram_id] = []
-        
-        self.active_connections[diagram_id].append(websocket)
+        client = ClientConnection(websocket, self.queue_size, self.overflow_policy, self._handle_client_failure, codec)
+        client.start()
+        self.outbound[websocket] = client
+        log = self._room_log(diagram_id)
+        room_id = self.documents.parse_room_id(diagram_id)
+        live = self.documents.get(room_id) if room_id is not None else None
+        # Sync frames, the state message and the tail leave room for each other in the outbound queue
+        max_tail = client.max_size - 2
+
+        missed = log.since(last_seq, member) if epoch == log.epoch and last_seq is not None else None
+        if missed is not None and len(missed) > max_tail:
+            missed = None
+        snapshot, snapshot_frame, cached = None, None, False
+        if missed is None and live is not None:
+            try:
+                snapshot, snapshot_frame, cached = await self._snapshot(log, live, codec, max_tail)
+            except BaseException:
+                self.outbound.pop(websocket, None)
+                client.stop()
+                raise
+
+        # Nothing below awaits: the client joins the room right after the frames that bring it up
+        # to date, so no broadcast falls between them and live delivery
+        if missed is not None:
+            mode, tail = SYNC_RESUME, missed
+        elif snapshot is not None:
+            mode, tail = SYNC_SNAPSHOT, log.since(snapshot.seq)
+        else:
+            mode, tail = SYNC_NONE, []
+
+        log.idle_since = None
+        self.active_connections.setdefault(diagram_id, []).append(websocket)
         self.user_connections[websocket] = {
+            "member_id": f"{self.backplane.node_id}:{next(self._member_ids)}",
             "user_id": user.id,
             "username": user.username,
             "diagram_id": diagram_id
         }
-        
-        # Notify others that user joined
-        await self.broadcast_to_diagram(
-            diagram_id,
-            {
-                "type": "user_joined",
-                "user_id": user.id,
-                "username": user.username
-            },
-            exclude_websocket=websocket
-        )
-        
+        member_id = self.user_connections[websocket]["member_id"]
+        self._members_by_id[member_id] = websocket
+
         # Send current users in the diagram
         users_in_diagram = [
             {
@@ -46,26 +311,153 @@ class ConnectionManager:
             }
             for conn in self.user_connections.values()
             if conn["diagram_id"] == diagram_id
+        ] + [
+            {
+                "user_id": member["user_id"],
+                "username": member["username"]
+            }
+            for member in self.remote_members.get(diagram_id, {}).values()
         ]
-        
-        await websocket.send_text(json.dumps({
+
+        self.send_personal_message(websocket, {
             "type": "diagram_state",
-            "users": users_in_diagram
-        }))
-        
-        logger.info(f"User {user.username} joined diagram {diagram_id}")
+            "users": users_in_diagram,
+            "member_id": member_id,
+            "epoch": log.epoch,
+            "seq": log.seq,
+            "sync": mode
+        })
+        if snapshot_frame is not None:
+            client.enqueue(snapshot_frame)
+        for message in tail:
+            self.send_personal_message(websocket, message)
+        WS_ROOM_SYNCS.labels(mode if snapshot is None else "snapshot_cached" if cached else "snapshot_built").inc()
+
+        self.backplane.publish({"kind": "join", "member": self._member(self.user_connections[websocket])})
+
+        # Notify others that user joined
+        self.broadcast_to_diagram_sync(
+            diagram_id,
+            {
+                "type": "user_joined",
+                "user_id": user.id,
+                "username": user.username
+            },
+            exclude_websocket=websocket
+        )
+
+        if live is not None and len(self.active_connections[diagram_id]) == 1:
+            # The copy opened here may be behind the sequencer's
+            self._resync(diagram_id)
+
+        logger.info(f"User {user.username} joined diagram {diagram_id} ({codec.name}, {mode})")
+        return codec
+
+    def _room_log(self, diagram_id: str) -> RoomLog:
+        now = time.monotonic()
+        expired = [
+            room for room, log in self.room_logs.items()
+            if log.idle_since is not None and now - log.idle_since > self.replay_retention
+        ]
+        for room in expired:
+            del self.room_logs[room]
+        log = self.room_logs.get(diagram_id)
+        if log is None:
+            log = self.room_logs[diagram_id] = RoomLog(f"{self.backplane.node_id[:12]}.{next(self._epochs)}", self.replay_buffer_size)
+        return log
+
+    @staticmethod
+    def _snapshot_current(log: RoomLog, snapshot: RoomSnapshot, live, max_tail: int) -> bool:
+        """Whether the snapshot plus the buffered broadcasts after it add up to the live document"""
+        tail = log.since(snapshot.seq)
+        if tail is None or len(tail) > max_tail:
+            return False
+        version = snapshot.version
+        for message in tail:
+            data = message.get("data")
+            if message.get("type") == "drawing_update" and isinstance(data, dict) and isinstance(data.get("version"), int):
+                version = max(version, data["version"])
+        # A REST replace moves the version without a broadcast, so it fails this too
+        return version == live.version
+
+    def _room_snapshot(self, log: RoomLog, live, max_tail: int) -> Tuple[RoomSnapshot, bool]:
+        """The cached snapshot if it is still current, else a new one; and whether it was cached"""
+        snapshot = log.snapshot
+        if snapshot is not None and self._snapshot_current(log, snapshot, live, max_tail):
+            return snapshot, True
+        log.snapshot = RoomSnapshot(log.seq, live.version, self._snapshot_message(log, live))
+        return log.snapshot, False
+
+    @staticmethod
+    def _snapshot_message(log: RoomLog, live) -> dict:
+        return {
+            "type": "diagram_snapshot",
+            "seq": log.seq,
+            "version": live.version,
+            "data": live.document.snapshot(),
+            # What a later sync_request measures itself against
+            "base": live.crdt.base,
+            "vector": dict(live.crdt.vector)
+        }
+
+    def send_sync(self, websocket: WebSocket, diagram_id: str, live, base: Optional[str], vector: Dict[str, int]):
+        """Answer a sync_request: the writes the client has not seen, or a fresh snapshot if its base is gone"""
+        log = self._room_log(diagram_id)
+        crdt = live.crdt
+        if base != crdt.base:
+            self.send_personal_message(websocket, self._snapshot_message(log, live))
+            return
+        self.send_personal_message(websocket, {
+            "type": "sync_delta",
+            "seq": log.seq,
+            "version": live.version,
+            "base": crdt.base,
+            "vector": dict(crdt.vector),
+            "ops": crdt.delta(live.document, vector)
+        })
+
+    async def _snapshot(self, log: RoomLog, live, codec, max_tail: int) -> Tuple[RoomSnapshot, Union[str, bytes], bool]:
+        """A snapshot that is current when returned, its frame for `codec`, and whether both came from the cache"""
+        cached = True
+        for _ in range(SNAPSHOT_ATTEMPTS):
+            snapshot, reused = self._room_snapshot(log, live, max_tail)
+            frame = snapshot.frames.get(codec.name)
+            cached = cached and reused and frame is not None
+            if frame is None:
+                # Large documents encode (and, for binary clients, deflate) off the event loop
+                frame = snapshot.frames[codec.name] = await asyncio.to_thread(codec.encode, snapshot.message)
+            if self._snapshot_current(log, snapshot, live, max_tail):
+                return snapshot, frame, cached
+        # Busy room: build and encode without yielding so it cannot go stale again
+        snapshot, reused = self._room_snapshot(log, live, max_tail)
+        frame = snapshot.frames.get(codec.name)
+        if frame is None:
+            frame = snapshot.frames[codec.name] = codec.encode(snapshot.message)
+        return snapshot, frame, False
 
     def disconnect(self, websocket: WebSocket):
         if websocket in self.user_connections:
-            user_info = self.user_connections[websocket]
+            user_info = self.user_connections.pop(websocket)
             diagram_id = user_info["diagram_id"]
-            
+            self._members_by_id.pop(user_info["member_id"], None)
+
+            client = self.outbound.pop(websocket, None)
+            if client:
+                client.stop()
+            self.presence.remove_member(diagram_id, user_info["member_id"])
+            self.backplane.publish({"kind": "leave", "member": self._member(user_info)})
+
             # Remove from active connections
             if diagram_id in self.active_connections:
                 self.active_connections[diagram_id].remove(websocket)
                 if not self.active_connections[diagram_id]:
                     del self.active_connections[diagram_id]
-            
+                    log = self.room_logs.get(diagram_id)
+                    if log is not None:
+                        # Kept for WS_REPLAY_RETENTION_SECONDS so a lone client can still resume
+                        log.idle_since = time.monotonic()
+                        log.snapshot = None
+
             # Notify others that user left
             self.broadcast_to_diagram_sync(
                 diagram_id,
@@ -74,90 +466,555 @@ class ConnectionManager:
                     "user_id": user_info["user_id"],
                     "username": user_info["username"]
                 },
-                exclude_websocket=websocket
+                exclude_websocket=websocket,
+                origin=user_info["member_id"]
             )
-            
-            del self.user_connections[websocket]
+
             logger.info(f"User {user_info['username']} left diagram {diagram_id}")
 
+    def close_room(self, diagram_id: str, message: dict, code: int, reason: str):
+        """Send `message` to the room's local members, then close each connection once its queue is written"""
+        for websocket in list(self.active_connections.get(diagram_id, ())):
+            self.send_personal_message(websocket, message)
+            client = self.outbound.get(websocket)
+            if client:
+                client.close_when_drained(code, reason)
+        # Nothing in it may be resumed
+        self.room_logs.pop(diagram_id, None)
+
+    def room_deleted(self, diagram_id: str):
+        """Close a deleted diagram's room here and in every other process; call after its document is discarded"""
+        self._close_deleted_room(diagram_id)
+        self.backplane.publish({"kind": "room_deleted", "room": diagram_id})
+
+    def _close_deleted_room(self, diagram_id: str):
+        self.close_room(
+            diagram_id, {"type": "diagram_deleted", "diagram_id": diagram_id}, ROOM_DELETED_CLOSE_CODE, "Diagram deleted"
+        )
+
+    async def _discard_deleted(self, diagram_id: str):
+        room_id = self.documents.parse_room_id(diagram_id)
+        if room_id is not None:
+            # After any flush in progress, like the process that deleted it
+            async with self.documents.write_lock:
+                self.documents.discard(room_id)
+        self.held_rooms.discard(diagram_id)
+        self._close_deleted_room(diagram_id)
+
+    async def shutdown(self):
+        await self.presence.stop()
+        await self.backplane.stop()
+        if self._announce_flushed in self.documents.flush_listeners:
+            self.documents.flush_listeners.remove(self._announce_flushed)
+        self.held_rooms.clear()
+        self._started = False
+
+    def _on_backplane_message(self, envelope: dict):
+        kind = envelope.get("kind")
+        if kind == "broadcast":
+            room, message, member = envelope["room"], envelope["message"], envelope.get("member")
+            self._replicate_remote_ops(room, message)
+            self._deliver(room, message, self._members_by_id.get(member), member)
+        elif kind == "join":
+            member = envelope["member"]
+            self.remote_members.setdefault(member["diagram_id"], {})[member["member_id"]] = {
+                **member, "node": envelope["origin"]
+            }
+            self._sync_holds()
+        elif kind == "leave":
+            member = envelope["member"]
+            room = self.remote_members.get(member["diagram_id"], {})
+            room.pop(member["member_id"], None)
+            if not room:
+                self.remote_members.pop(member["diagram_id"], None)
+            self._sync_holds()
+        elif kind == "presence_request":
+            self._publish_presence_snapshot()
+        elif kind == "presence_snapshot":
+            for member in envelope["members"]:
+                self.remote_members.setdefault(member["diagram_id"], {})[member["member_id"]] = {
+                    **member, "node": envelope["origin"]
+                }
+            self._sync_holds()
+        elif kind == "room_deleted":
+            asyncio.create_task(self._discard_deleted(envelope["room"]))
+        elif kind == "node_down":
+            for room_id in list(self.remote_members):
+                room = self.remote_members[room_id]
+                for member_id in [m for m, member in room.items() if member["node"] == envelope["node"]]:
+                    del room[member_id]
+                if not room:
+                    del self.remote_members[room_id]
+            self._sync_holds()
+        elif kind == "ops":
+            if self.backplane.sequencer:
+                room = envelope["room"]
+                self._when_open(room, lambda: self._sequence(
+                    room, envelope["data"], envelope.get("user_id"), envelope.get("username"), envelope.get("member"),
+                    envelope.get("request"), envelope.get("base_version"), envelope.get("strict", False)
+                ))
+        elif kind == "ops_error":
+            websocket = self._members_by_id.get(envelope.get("member"))
+            if websocket is not None:
+                self.send_personal_message(websocket, {"type": "error", "message": envelope["message"]})
+            future = self._requests.get(envelope.get("request"))
+            if future is not None and not future.done():
+                current_version = envelope.get("current_version")
+                future.set_exception(
+                    VersionConflict(current_version) if current_version is not None else DiagramOperationError(envelope["message"])
+                )
+        elif kind == "ops_result":
+            future = self._requests.get(envelope.get("request"))
+            if future is not None and not future.done():
+                future.set_result(envelope["version"])
+        elif kind == "flush_request":
+            if self.backplane.sequencer:
+                room = envelope["room"]
+                self._when_open(room, lambda: asyncio.create_task(self._flush_and_announce(room)))
+        elif kind == "flushed":
+            self._on_flushed(envelope["room"], envelope.get("version"))
+        elif kind == "replaced":
+            self._start_reload(envelope["room"])
+
+    def _on_backplane_reconnect(self):
+        # The set of reachable nodes may have changed: rebuild remote presence from scratch
+        self.remote_members.clear()
+        self._sync_holds()
+        self._publish_presence_snapshot()
+        self.backplane.publish({"kind": "presence_request"})
+        # The sequencer may have changed too: line this process's copies up with its
+        self._resyncing.clear()
+        for room in list(self.active_connections):
+            room_id = self.documents.parse_room_id(room)
+            if room_id is not None and self.documents.get(room_id) is not None:
+                self._resync(room)
+
+    def _publish_presence_snapshot(self):
+        self.backplane.publish({
+            "kind": "presence_snapshot",
+            "members": [self._member(info) for info in self.user_connections.values()]
+        })
+
+    def sequenced_elsewhere(self, diagram_id: str) -> bool:
+        """Whether edits to this room's live document must go through another process"""
+        if self.backplane.sequencer:
+            return False
+        room_id = self.documents.parse_room_id(diagram_id)
+        return room_id is not None and (self.documents.get(room_id) is not None or diagram_id in self.remote_members)
+
+    def submit_drawing_update(self, websocket: WebSocket, diagram_id: str, data: Any, user: User, live):
+        """Merge a client's drawing_update if this process sequences the room, else forward it to the one that does"""
+        operations = data.get("ops") if isinstance(data, dict) else None
+        if live is None or not isinstance(operations, list):
+            # No document to apply it to: relayed as it is
+            self.broadcast_to_diagram_sync(
+                diagram_id,
+                {"type": "drawing_update", "data": data, "user_id": user.id, "username": user.username},
+                exclude_websocket=websocket
+            )
+            return
+        member_id = self.user_connections[websocket]["member_id"]
+        if self.backplane.sequencer:
+            self._when_open(diagram_id, lambda: self._sequence(diagram_id, data, user.id, user.username, member_id))
+        else:
+            self.backplane.publish({
+                "kind": "ops", "room": diagram_id, "data": data,
+                "user_id": user.id, "username": user.username, "member": member_id
+            })
+
+    async def forward_ops(
+        self, diagram_id: str, operations: List[Dict[str, Any]], base_version: Optional[int], user: User
+    ) -> int:
+        """Have the sequencer apply a REST op batch; returns the new version or raises what apply() would.
+
+        Raises asyncio.TimeoutError if no answer comes within WS_SEQUENCER_TIMEOUT_SECONDS.
+        """
+        request = uuid.uuid4().hex
+        future = self._requests[request] = asyncio.get_running_loop().create_future()
+        self.backplane.publish({
+            "kind": "ops", "room": diagram_id, "data": {"ops": operations}, "user_id": user.id,
+            "username": user.username, "request": request, "base_version": base_version, "strict": True
+        })
+        try:
+            return await asyncio.wait_for(future, settings.WS_SEQUENCER_TIMEOUT_SECONDS)
+        finally:
+            self._requests.pop(request, None)
+
+    async def request_flush(self, diagram_id: str) -> Optional[int]:
+        """Have the sequencer write a room back; returns the version it stored (None if it has no document).
+
+        Raises asyncio.TimeoutError if no answer comes within WS_SEQUENCER_TIMEOUT_SECONDS.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._flush_waiters.setdefault(diagram_id, []).append(future)
+        self.backplane.publish({"kind": "flush_request", "room": diagram_id})
+        try:
+            return await asyncio.wait_for(future, settings.WS_SEQUENCER_TIMEOUT_SECONDS)
+        finally:
+            waiters = self._flush_waiters.get(diagram_id)
+            if waiters and future in waiters:
+                waiters.remove(future)
+                if not waiters:
+                    del self._flush_waiters[diagram_id]
+
+    def document_replaced(self, diagram_id: str):
+        """Make every other process reload a room whose stored document was just saved over"""
+        self.backplane.publish({"kind": "replaced", "room": diagram_id})
+
+    def _sequence(
+        self,
+        diagram_id: str,
+        data: Dict[str, Any],
+        user_id: Optional[int],
+        username: Optional[str],
+        member: Optional[str] = None,
+        request: Optional[str] = None,
+        base_version: Optional[int] = None,
+        strict: bool = False
+    ):
+        """Merge an op batch into the room's document and broadcast it with the version it became"""
+        room_id = self.documents.parse_room_id(diagram_id)
+        try:
+            result = self.documents.merge(room_id, data["ops"], base_version, user_id, strict)
+        except (VersionConflict, DiagramOperationError) as e:
+            websocket = self._members_by_id.get(member)
+            if websocket is not None:
+                self.send_personal_message(websocket, {"type": "error", "message": str(e)})
+            else:
+                self.backplane.publish({
+                    "kind": "ops_error", "member": member, "request": request, "message": str(e),
+                    "current_version": e.current_version if isinstance(e, VersionConflict) else None
+                })
+            return
+        # With nothing left (everything lost to later writes, which every peer has or is about to
+        # get) there is nothing to send
+        if result.operations:
+            self.broadcast_to_diagram_sync(
+                diagram_id,
+                {
+                    "type": "drawing_update",
+                    "data": {**data, "ops": result.operations, "version": result.version},
+                    "user_id": user_id,
+                    "username": username
+                },
+                # The server rewrote some ops (moves, reorders): the sender applies the result too
+                origin=member if result.exact else None
+            )
+        if request is not None:
+            self.backplane.publish({"kind": "ops_result", "request": request, "version": result.version})
+
+    def _replicate_remote_ops(self, diagram_id: str, message: dict):
+        """Apply a drawing_update the sequencer broadcast to this process's copy, in version order"""
+        data = message.get("data")
+        if self.backplane.sequencer or message.get("type") != "drawing_update" or not isinstance(data, dict):
+            return
+        room_id = self.documents.parse_room_id(diagram_id)
+        live = self.documents.get(room_id) if room_id is not None else None
+        operations, version = data.get("ops"), data.get("version")
+        if live is None or not isinstance(operations, list) or not isinstance(version, int):
+            return
+        waiting = self._reloading.get(diagram_id)
+        if waiting is not None:
+            waiting.append(lambda: self._replicate_remote_ops(diagram_id, message))
+            return
+        if version <= live.version:
+            return
+        if version > live.version + 1:
+            # Missed some: the stored document catches up
+            self._resync(diagram_id)
+            return
+        try:
+            self.documents.merge(room_id, operations, user_id=message.get("user_id"), version=version)
+        except (VersionConflict, DiagramOperationError) as e:
+            logger.warning(f"Sequenced ops for diagram {diagram_id} did not apply here: {e}")
+            self._resync(diagram_id)
+
+    def _resync(self, diagram_id: str):
+        """Ask the sequencer to store a room this replica may be behind on; _on_flushed reloads it"""
+        if self.backplane.sequencer or diagram_id in self._resyncing:
+            return
+        self._resyncing.add(diagram_id)
+        self.backplane.publish({"kind": "flush_request", "room": diagram_id})
+
+    def _on_flushed(self, diagram_id: str, version: Optional[int]):
+        room_id = self.documents.parse_room_id(diagram_id)
+        live = self.documents.get(room_id) if room_id is not None else None
+        if live is not None and not self.backplane.sequencer:
+            if version is not None:
+                self.documents.settle(room_id, version)
+            if (version is not None and live.version < version) or (version is None and diagram_id in self._resyncing):
+                self._start_reload(diagram_id)
+            else:
+                self._resyncing.discard(diagram_id)
+        for future in self._flush_waiters.pop(diagram_id, []):
+            if not future.done():
+                future.set_result(version)
+
+    async def _flush_and_announce(self, diagram_id: str):
+        room_id = self.documents.parse_room_id(diagram_id)
+        try:
+            await self.documents.flush([room_id])
+        except Exception as e:
+            logger.error(f"Flush of diagram {diagram_id} for another process failed: {e}")
+        live = self.documents.get(room_id)
+        self.backplane.publish({"kind": "flushed", "room": diagram_id, "version": live.flushed_version if live else None})
+
+    def _announce_flushed(self, diagram_ids: List[int]):
+        """Flush listener: tell the replicas what is stored so they can drop their copies of that history"""
+        for diagram_id in diagram_ids:
+            live = self.documents.get(diagram_id)
+            if live is not None:
+                self.backplane.publish({"kind": "flushed", "room": str(diagram_id), "version": live.flushed_version})
+
+    def _start_reload(self, diagram_id: str):
+        room_id = self.documents.parse_room_id(diagram_id)
+        if room_id is None or self.documents.get(room_id) is None:
+            self._resyncing.discard(diagram_id)
+            return
+        if diagram_id in self._reloading or diagram_id in self._opening:
+            # Already reading the stored document
+            return
+        self._reloading[diagram_id] = []
+        asyncio.create_task(self._reload(diagram_id, room_id))
+
+    async def _reload(self, diagram_id: str, room_id: int):
+        """Replace a room's document with the stored one, then run what waited for it"""
+        live = self.documents.get(room_id)
+        version = live.version if live is not None else None
+        try:
+            live = await self.documents.reload(room_id)
+        except Exception as e:
+            logger.error(f"Reload of diagram {diagram_id} failed: {e}")
+        finally:
+            self._resyncing.discard(diagram_id)
+            waiting = self._reloading.pop(diagram_id, [])
+        for action in waiting:
+            action()
+        if live is None or live.version == version:
+            return
+        # Members here may have missed edits: bring them up to date from the new copy
+        log = self._room_log(diagram_id)
+        log.snapshot = None
+        for websocket in list(self.active_connections.get(diagram_id, ())):
+            self.send_personal_message(websocket, self._snapshot_message(log, live))
+
+    def _when_open(self, diagram_id: str, action: Callable[[], Any]):
+        """Run `action` once the room's document is open here, after what is already waiting for it"""
+        room_id = self.documents.parse_room_id(diagram_id)
+        if room_id is None:
+            return
+        waiting = self._opening.get(diagram_id, self._reloading.get(diagram_id))
+        if waiting is not None:
+            waiting.append(action)
+        elif self.documents.get(room_id) is not None:
+            action()
+        else:
+            self._opening[diagram_id] = [action]
+            asyncio.create_task(self._hold(diagram_id, room_id))
+
+    async def _hold(self, diagram_id: str, room_id: int):
+        """Open a room's document for members connected elsewhere (or ops sent from there)"""
+        try:
+            live = await self.documents.open(room_id)
+        except Exception as e:
+            logger.error(f"Could not open diagram {diagram_id} for other processes: {e}")
+            live = None
+        if live is not None:
+            self.held_rooms.add(diagram_id)
+        # Without a document they fail as edits to a deleted diagram
+        for action in self._opening.pop(diagram_id, []):
+            action()
+        if live is not None:
+            # Members may have left (or this process stopped sequencing) while it opened
+            self._sync_holds()
+
+    def _sync_holds(self):
+        """Hold rooms with remote members open while this process sequences; release the rest"""
+        wanted = set(self.remote_members) if self.backplane.sequencer else set()
+        for diagram_id in self.held_rooms - wanted:
+            self.held_rooms.discard(diagram_id)
+            self.documents.release(self.documents.parse_room_id(diagram_id))
+        for diagram_id in wanted - self.held_rooms:
+            room_id = self.documents.parse_room_id(diagram_id)
+            if room_id is not None and diagram_id not in self._opening:
+                self._opening[diagram_id] = []
+                asyncio.create_task(self._hold(diagram_id, room_id))
+
+    def _handle_client_failure(self, client: ClientConnection, close_code: Optional[int], reason: Optional[str]):
+        """Drop a client whose writer failed or whose queue overflowed under the disconnect policy"""
+        websocket = client.websocket
+        self.disconnect(websocket)
+        if close_code is not None:
+            asyncio.create_task(self._close_quietly(websocket, close_code, reason))
+
+    @staticmethod
+    async def _close_quietly(websocket: WebSocket, code: int, reason: str):
+        try:
+            await websocket.close(code=code, reason=reason)
+        except Exception:
+            pass
+
+    @staticmethod
+    def _coalesce_key(message: dict, diagram_id: Optional[str] = None) -> Optional[Tuple]:
+        if message.get("type") in COALESCIBLE_MESSAGE_TYPES:
+            # Cursor batches carry no user_id, so they coalesce per room
+            return (message["type"], diagram_id, message.get("user_id"))
+        return None
+
+    def send_personal_message(self, websocket: WebSocket, message: dict):
+        client = self.outbound.get(websocket)
+        if client:
+            diagram_id = self.user_connections.get(websocket, {}).get("diagram_id")
+            client.enqueue(client.codec.encode(message), self._coalesce_key(message, diagram_id), message)
+
     async def broadcast_to_diagram(self, diagram_id: str, message: dict, exclude_websocket: WebSocket = None):
-        if diagram_id in self.active_connections:
-            for connection in self.active_connections[diagram_id]:
-                if connection != exclude_websocket:
-                    try:
-                        await connection.send_text(json.dumps(message))
-                    except:
-                        # Remove broken connection
-                        self.disconnect(connection)
-
-    def broadcast_to_diagram_sync(self, diagram_id: str, message: dict, exclude_websocket: WebSocket = None):
-        if diagram_id in self.active_connections:
-            for connection in self.active_connections[diagram_id]:
-                if connection != exclude_websocket:
-                    try:
-                        connection.send_text(json.dumps(message))
-                    except:
-                        # Remove broken connection
-                        self.disconnect(connection)
+        self.broadcast_to_diagram_sync(diagram_id, message, exclude_websocket)
+
+    def broadcast_to_diagram_sync(
+        self, diagram_id: str, message: dict, exclude_websocket: WebSocket = None, origin: Optional[str] = None
+    ):
+        """Deliver to local peers and publish to other processes; never waits on a peer.
+
+        `origin` is the member id the message came from, when that is not `exclude_websocket`'s;
+        wherever that member is connected, it is not sent the message.
+        """
+        if origin is None and exclude_websocket is not None:
+            origin = self.user_connections.get(exclude_websocket, {}).get("member_id")
+        elif exclude_websocket is None:
+            exclude_websocket = self._members_by_id.get(origin)
+        self._deliver(diagram_id, message, exclude_websocket, origin)
+        self.backplane.publish({"kind": "broadcast", "room": diagram_id, "message": message, "member": origin})
+
+    def _deliver(self, diagram_id: str, message: dict, exclude_websocket: WebSocket = None, origin: Optional[str] = None):
+        """Stamp and buffer the message, serialize it once per protocol in use and hand the frame to every local peer's queue"""
+        log = self.room_logs.get(diagram_id)
+        if log is not None and message.get("type") not in UNSEQUENCED_MESSAGE_TYPES:
+            if origin is None and exclude_websocket is not None:
+                origin = self.user_connections.get(exclude_websocket, {}).get("member_id")
+            message = log.append(message, origin)
+        connections = self.active_connections.get(diagram_id)
+        if not connections:
+            return
+
+        started = time.perf_counter()
+        frames: Dict[str, Union[str, bytes]] = {}
+        coalesce_key = self._coalesce_key(message, diagram_id)
+        # Members with a cursor in this batch get it without their own
+        own_cursors = {cursor.get("member_id") for cursor in message["cursors"]} if message.get("type") == "cursors" else ()
+        queued = 0
+        # Copy: an overflowing client may be disconnected while we iterate
+        for connection in list(connections):
+            if connection != exclude_websocket:
+                client = self.outbound.get(connection)
+                if client:
+                    member_id = self.user_connections.get(connection, {}).get("member_id")
+                    if member_id in own_cursors:
+                        personal = without_cursor(message, member_id)
+                        if personal["cursors"]:
+                            queued += client.enqueue(client.codec.encode(personal), coalesce_key, personal)
+                        continue
+                    frame = frames.get(client.codec.name)
+                    if frame is None:
+                        frame = frames[client.codec.name] = client.codec.encode(message)
+                    queued += client.enqueue(frame, coalesce_key, message)
+
+        message_type = message.get("type", "unknown")
+        WS_BROADCASTS.labels(message_type).inc()
+        WS_BROADCAST_FRAMES.labels(message_type).inc(queued)
+        WS_BROADCAST_SECONDS.labels(message_type).observe(time.perf_counter() - started)
 
 manager = ConnectionManager()
 
+registry.callback("ws_connections", "Open WebSocket connections in this process, by room", "gauge",
+                  manager.connection_counts, ("room",))
+registry.callback("ws_outbound_queued_frames", "Frames waiting in outbound queues, by room", "gauge",
+                  manager.queued_frames, ("room",))
+registry.callback("ws_outbound_queue_max_frames", "Deepest single outbound queue in this process", "gauge",
+                  manager.max_queue_depth)
+
 @router.websocket("/{diagram_id}")
 async def websocket_endpoint(
     websocket: WebSocket,
     diagram_id: str,
-    token: str = None
+    token: str = None,
+    last_seq: Optional[int] = None,
+    epoch: Optional[str] = None,
+    member: Optional[str] = None
 ):
     try:
         # Basic token validation (you can enhance this)
         if not token:
             await websocket.close(code=4001, reason="Token required")
             return
-        
-        # For now, accept all connections (implement proper auth later)
-        user = {"id": 1, "username": "Anonymous"}  # Placeholder
-        
-        await manager.connect(websocket, diagram_id, user)
-        
+
+        async with AsyncSessionLocal() as db:
+            user = await get_current_user_ws(token, db)
+
+        if user is None:
+            await websocket.close(code=4001, reason="Invalid token")
+            return
+
+        # Rooms backed by a stored diagram share one authoritative document
+        documents = manager.documents
+        room_id = documents.parse_room_id(diagram_id)
+        live = await documents.open(room_id) if room_id is not None else None
+        if live is not None and not live.is_public and live.owner_id != user.id:
+            documents.release(room_id)
+            await websocket.close(code=4003, reason="Access denied")
+            return
+
+        # A reconnecting client passes the epoch, last seq and member id it last saw to resume
+        codec = await manager.connect(websocket, diagram_id, user, last_seq, epoch, member)
+
         try:
             while True:
-                data = await websocket.receive_text()
-                message = json.loads(data)
-                
+                frame = await websocket.receive()
+                if frame["type"] == "websocket.disconnect":
+                    raise WebSocketDisconnect(frame.get("code", 1000))
+                try:
+                    message = codec.decode(frame["bytes"] if frame.get("bytes") is not None else frame.get("text"))
+                except FrameDecodeError as e:
+                    manager.send_personal_message(websocket, {"type": "error", "message": str(e)})
+                    continue
+
+                message_type = message.get("type")
+                WS_MESSAGES_RECEIVED.labels(
+                    message_type if isinstance(message_type, str) and message_type in CLIENT_MESSAGE_TYPES else "other"
+                ).inc()
+
                 # Handle different message types
                 if message["type"] == "drawing_update":
-                    # Broadcast drawing updates to other users
-                    await manager.broadcast_to_diagram(
-                        diagram_id,
-                        {
-                            "type": "drawing_update",
-                            "data": message["data"],
-                            "user_id": user["id"],
-                            "username": user["username"]
-                        },
-                        exclude_websocket=websocket
-                    )
-                
+                    manager.submit_drawing_update(websocket, diagram_id, message["data"], user, live)
+
                 elif message["type"] == "cursor_move":
-                    # Broadcast cursor position
-                    await manager.broadcast_to_diagram(
-                        diagram_id,
-                        {
-                            "type": "cursor_move",
-                            "position": message["position"],
-                            "user_id": user["id"],
-                            "username": user["username"]
-                        },
-                        exclude_websocket=websocket
+                    # Coalesced per connection and sent as a batched "cursors" frame on the presence tick
+                    manager.presence.update(
+                        diagram_id, manager.user_connections[websocket]["member_id"], user.id, user.username, message["position"]
                     )
-                
+
+                elif message["type"] == "sync_request":
+                    # A client that diverged (offline edits, lost frames) sends its base and state vector
+                    if live is None:
+                        manager.send_personal_message(websocket, {"type": "error", "message": "Room has no document to sync"})
+                        continue
+                    try:
+                        vector = parse_vector(message.get("vector", {}))
+                    except DiagramOperationError as e:
+                        manager.send_personal_message(websocket, {"type": "error", "message": str(e)})
+                        continue
+                    manager.send_sync(websocket, diagram_id, live, message.get("base"), vector)
+
                 elif message["type"] == "ping":
                     # Respond to ping
-                    await websocket.send_text(json.dumps({"type": "pong"}))
-                
+                    manager.send_personal_message(websocket, {"type": "pong"})
+
         except WebSocketDisconnect:
+            pass
+        finally:
             manager.disconnect(websocket)
-            
+            if live is not None:
+                documents.release(room_id)
+
     except Exception as e:
         logger.error(f"WebSocket error: {e}")
         await websocket.close(code=4000, reason="Internal error")
@@ -0,0 +1,135 @@
+import asyncio
+import gzip
+from typing import Callable, Dict, List, Optional
+from starlette.datastructures import Headers, MutableHeaders
+from app.core.config import settings
+
+try:
+    import brotli
+except ImportError:  # Optional: without it clients are offered gzip/zstd only
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # Optional: without it clients are offered gzip/br only
+    zstandard = None
+
+# Higher levels shrink diagram JSON by only 2-3% more for 3-5x the CPU (benchmarks/bench_compression.py)
+LEVELS = {"gzip": 6, "br": 5, "zstd": 3}
+
+COMPRESSIBLE_TYPES = ("application/json", "text/", "image/svg+xml", "application/xml", "application/javascript")
+
+def _zstd(data: bytes, level: int) -> bytes:
+    # ZstdCompressor is not thread-safe, and bodies are compressed on worker threads
+    return zstandard.ZstdCompressor(level=level).compress(data)
+
+COMPRESSORS: Dict[str, Callable[[bytes, int], bytes]] = {"gzip": lambda data, level: gzip.compress(data, level, mtime=0)}
+if brotli is not None:
+    COMPRESSORS["br"] = lambda data, level: brotli.compress(data, quality=level)
+if zstandard is not None:
+    COMPRESSORS["zstd"] = _zstd
+
+def available_encodings() -> List[str]:
+    """Configured encodings this process can produce, in server preference order"""
+    return [encoding for encoding in settings.COMPRESSION_ENCODINGS if encoding in COMPRESSORS]
+
+def negotiate_encoding(accept_encoding: Optional[str]) -> Optional[str]:
+    """Best encoding from an Accept-Encoding header; None means send the body as is"""
+    if not accept_encoding:
+        return None
+    weights: Dict[str, float] = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        weights[name.strip().lower()] = quality
+
+    best, best_quality = None, 0.0
+    for encoding in available_encodings():
+        quality = weights.get(encoding, weights.get("*", 0.0))
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+def compressible(content_type: Optional[str]) -> bool:
+    return bool(content_type) and content_type.startswith(COMPRESSIBLE_TYPES)
+
+async def compress(data: bytes, encoding: str) -> bytes:
+    """Compress, on a worker thread for large bodies; all three codecs release the GIL while working"""
+    compressor, level = COMPRESSORS[encoding], LEVELS[encoding]
+    if len(data) < settings.COMPRESSION_THREAD_MIN_BYTES:
+        return compressor(data, level)
+    return await asyncio.to_thread(compressor, data, level)
+
+def variant_etag(etag: str, encoding: str) -> str:
+    """Strong ETag of one content-coding of a representation ("1-2-ab" -> "1-2-ab-br")"""
+    if etag.endswith('"'):
+        return f'{etag[:-1]}-{encoding}"'
+    return etag
+
+def base_etag(etag: str) -> str:
+    for encoding in COMPRESSORS:
+        suffix = f'-{encoding}"'
+        if etag.endswith(suffix):
+            return etag[:-len(suffix)] + '"'
+    return etag
+
+class CompressionMiddleware:
+    """Pure ASGI middleware compressing single-message responses above COMPRESSION_MIN_BYTES.
+
+    Responses that already carry a Content-Encoding (precompressed, cached bodies) and
+    streamed responses pass through untouched.
+    """
+
+    def __init__(self, app, minimum_size: int = settings.COMPRESSION_MIN_BYTES):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = negotiate_encoding(Headers(scope=scope).get("accept-encoding"))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start = None
+
+        async def send_wrapper(message):
+            nonlocal start
+            if message["type"] == "http.response.start":
+                start = message
+                return
+            if start is None:
+                await send(message)
+                return
+
+            pending, start = start, None
+            headers = MutableHeaders(raw=pending["headers"])
+            body = message.get("body", b"")
+            if (
+                message.get("more_body")
+                or "content-encoding" in headers
+                or len(body) < self.minimum_size
+                or not compressible(headers.get("content-type"))
+            ):
+                await send(pending)
+                await send(message)
+                return
+
+            body = await compress(body, encoding)
+            headers["Content-Encoding"] = encoding
+            headers["Content-Length"] = str(len(body))
+            headers.add_vary_header("Accept-Encoding")
+            if "etag" in headers:
+                headers["ETag"] = variant_etag(headers["etag"], encoding)
+            await send(pending)
+            await send({"type": "http.response.body", "body": body})
+
+        await self.app(scope, receive, send_wrapper)
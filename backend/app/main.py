@@ -1,13 +1,25 @@
 import asyncio
 import logging
 from contextlib import asynccontextmanager
-from fastapi import FastAPI
+from fastapi import FastAPI, Response
 from fastapi.middleware.cors import CORSMiddleware
 
+from app.core.compression import CompressionMiddleware
 from app.core.config import settings
-from app.core.database import engine
-from app.models import Base
+from app.core.database import AsyncSessionLocal, engine
+from app.core.metrics import CONTENT_TYPE, MetricsMiddleware, registry
 from app.api.v1.api import api_router
+from app.api.v1.endpoints.websocket import manager
+from app.api.v1.endpoints.ai import job_queue
+from app.services.auth import auth_cache
+from app.services.blob_store import blob_store
+from app.services.diagram_interpreter import interpretation_cache
+from app.services.document_store import document_store
+from app.services.response_cache import diagram_response_cache
+from app.services.search_index import search_index
+from app.services.spatial_index import spatial_index_cache
+from app.services.thumbnails import thumbnail_renderer
+from app.tools.schema import upgrade_schema
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -18,17 +30,33 @@ async def lifespan(app: FastAPI):
     # Startup
     logger.info("Starting up application...")
     try:
-        # Create database tables synchronously for SQLite
-        Base.metadata.create_all(bind=engine)
-        logger.info("Database tables created")
+        # Also adds the columns an older database lacks, which create_all leaves alone
+        async with engine.begin() as conn:
+            await upgrade_schema(conn)
+        logger.info("Database schema up to date")
+        await search_index.start(engine, AsyncSessionLocal)
+        await blob_store.start()
     except Exception as e:
         logger.error(f"Database setup failed: {e}")
         raise
     
+    # Join the cross-process room backplane before accepting traffic
+    await manager.start()
+    # Spawn the AI worker processes up front so the first job does not pay for it
+    await job_queue.start()
+    await thumbnail_renderer.start()
+    
     yield
     
     # Shutdown
     logger.info("Shutting down application...")
+    # Documents first: the final flush needs to know this process still sequences its rooms
+    await document_store.shutdown()
+    await manager.shutdown()
+    await job_queue.shutdown()
+    await thumbnail_renderer.shutdown()
+    await blob_store.shutdown()
+    await engine.dispose()
 
 # Create FastAPI app
 app = FastAPI(
@@ -47,6 +75,13 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Large JSON responses not already compressed by their endpoint
+app.add_middleware(CompressionMiddleware)
+
+# Outermost, so per-route latency includes every other middleware
+if settings.METRICS_ENABLED:
+    app.add_middleware(MetricsMiddleware)
+
 # Include API router
 app.include_router(api_router, prefix="/api/v1")
 
@@ -56,5 +91,18 @@ async def root():
 
 @app.get("/health")
 async def health_check():
-    return {"status": "healthy"}
+    return {
+        "status": "healthy",
+        "auth_cache": auth_cache.stats(),
+        "interpretation_cache": interpretation_cache.stats(),
+        "ai_jobs": job_queue.snapshot(),
+        "spatial_index_cache": spatial_index_cache.stats(),
+        "diagram_response_cache": diagram_response_cache.stats(),
+        "blob_store": blob_store.stats,
+        "thumbnail_renders": thumbnail_renderer.stats
+    }
 
+if settings.METRICS_ENABLED:
+    @app.get("/metrics", include_in_schema=False)
+    async def metrics():
+        return Response(registry.render(), media_type=CONTENT_TYPE)
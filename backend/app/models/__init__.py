@@ -1,6 +1,9 @@
 from .user import User
 from .diagram import Diagram
+from .diagram_element import DiagramElement
+from .diagram_history import DiagramRevision, DiagramCheckpoint
 from .collaboration_session import CollaborationSession
+from .blob import Blob
 from app.core.database import Base
 
-__all__ = ["User", "Diagram", "CollaborationSession", "Base"]
+__all__ = ["User", "Diagram", "DiagramElement", "DiagramRevision", "DiagramCheckpoint", "CollaborationSession", "Blob", "Base"]
@@ -0,0 +1,15 @@
+from sqlalchemy import Column, Integer, String, DateTime
+from sqlalchemy.sql import func
+from app.core.database import Base
+
+class Blob(Base):
+    """A file in the content-addressed blob store and how many rows reference it"""
+    __tablename__ = "blobs"
+    
+    digest = Column(String(64), primary_key=True)  # sha256 of the content, hex; also the file name
+    size = Column(Integer, nullable=False)
+    refcount = Column(Integer, nullable=False, default=0)  # Unreferenced blobs are deleted by BlobStore.collect
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    
+    def __repr__(self):
+        return f"<Blob(digest='{self.digest}', size={self.size}, refcount={self.refcount})>"
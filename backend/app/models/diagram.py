@@ -1,20 +1,34 @@
-from sqlalchemy import Column, Integer, String, DateTime, Text, ForeignKey, JSON, Boolean
+from sqlalchemy import Column, Integer, String, DateTime, Text, ForeignKey, JSON, Boolean, Index
 from sqlalchemy.sql import func
 from sqlalchemy.orm import relationship
 from app.core.database import Base
 
 class Diagram(Base):
     __tablename__ = "diagrams"
+    __table_args__ = (
+        # Keyset pagination of the dashboard list, newest first, per visibility filter
+        Index("ix_diagrams_owner_updated", "owner_id", "updated_at", "id"),
+        Index("ix_diagrams_public_updated", "is_public", "updated_at", "id"),
+        Index("ix_diagrams_updated", "updated_at", "id"),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     title = Column(String(200), nullable=False)
     description = Column(Text)
     data = Column(JSON, nullable=False)  # Canvas data, shapes, connections
-    thumbnail = Column(Text)  # Base64 encoded thumbnail
+    # json: everything is in data; elements: shapes and connections are diagram_elements rows;
+    # blob: data is {"digest", "size"} of the JSON document in the blob store
+    storage = Column(String(20), nullable=False, default="json", server_default="json")
+    thumbnail = Column(Text)  # Base64 encoded thumbnail (older rows; new thumbnails go to the blob store)
+    thumbnail_blob = Column(String(64))  # Digest of the thumbnail in the blob store
+    thumbnail_type = Column(String(100))  # Media type of the blob thumbnail
+    thumbnail_sizes = Column(JSON)  # Server renders: {"<size>": digest}; the largest is also thumbnail_blob
+    thumbnail_hash = Column(String(64))  # Render hash of the data the renders were drawn from
     owner_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     is_public = Column(Boolean, default=False)
+    version = Column(Integer, nullable=False, default=1, server_default="1")  # Bumped on every change
     created_at = Column(DateTime(timezone=True), server_default=func.now())
-    updated_at = Column(DateTime(timezone=True), onupdate=func.now())
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
     
     # Relationships
     owner = relationship("User", back_populates="diagrams")
@@ -0,0 +1,36 @@
+from sqlalchemy import Column, Integer, String, Float, Text, ForeignKey, Index
+from app.core.database import Base
+
+class DiagramElement(Base):
+    """One shape or connection of a diagram stored with storage="elements".
+
+    The diagrams row keeps every other key of the data; reads reassemble the collections
+    in `position` order, which only ever grows, so array (z-)order survives removals.
+    """
+    __tablename__ = "diagram_elements"
+    __table_args__ = (
+        # Reassembly in array order
+        Index("ix_diagram_elements_position", "diagram_id", "collection", "position"),
+        # Viewport reads answered from the index, payloads fetched only for hits
+        Index("ix_diagram_elements_bbox", "diagram_id", "collection", "min_x", "max_x", "min_y", "max_y"),
+        # Connections attached to a set of shapes
+        Index("ix_diagram_elements_source", "diagram_id", "collection", "source_key"),
+        Index("ix_diagram_elements_target", "diagram_id", "collection", "target_key"),
+    )
+    
+    diagram_id = Column(Integer, ForeignKey("diagrams.id"), primary_key=True)
+    collection = Column(String(20), primary_key=True)  # shapes or connections
+    element_key = Column(Text, primary_key=True)  # JSON encoding of the element id
+    position = Column(Integer, nullable=False)
+    # Shape bounding box; null for connections and shapes without geometry
+    min_x = Column(Float)
+    min_y = Column(Float)
+    max_x = Column(Float)
+    max_y = Column(Float)
+    # Connection endpoints, as element keys of the shapes they join
+    source_key = Column(Text)
+    target_key = Column(Text)
+    payload = Column(Text, nullable=False)  # The element as compact JSON
+    
+    def __repr__(self):
+        return f"<DiagramElement(diagram_id={self.diagram_id}, collection='{self.collection}', key={self.element_key})>"
@@ -0,0 +1,40 @@
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, JSON, Index, UniqueConstraint
+from sqlalchemy.sql import func
+from app.core.database import Base
+
+class DiagramRevision(Base):
+    """One row per diagram version: the operations that produced it from the previous version"""
+    __tablename__ = "diagram_revisions"
+    __table_args__ = (
+        UniqueConstraint("diagram_id", "version", name="uq_diagram_revisions_version"),
+    )
+    
+    id = Column(Integer, primary_key=True, index=True)
+    diagram_id = Column(Integer, ForeignKey("diagrams.id"), nullable=False)
+    version = Column(Integer, nullable=False)
+    kind = Column(String(20), nullable=False)  # baseline, create, ops, save or replace
+    operations = Column(JSON)  # Replayable op batch for "ops" and "save"; null otherwise
+    op_count = Column(Integer, nullable=False, default=0)
+    user_id = Column(Integer, ForeignKey("users.id"))
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    
+    def __repr__(self):
+        return f"<DiagramRevision(diagram_id={self.diagram_id}, version={self.version}, kind='{self.kind}')>"
+
+class DiagramCheckpoint(Base):
+    """Full diagram data at one version; reads replay revisions forward from the nearest checkpoint"""
+    __tablename__ = "diagram_checkpoints"
+    __table_args__ = (
+        # Not unique: a process taking over a room's writes may checkpoint a version again
+        Index("ix_diagram_checkpoints_version", "diagram_id", "version"),
+    )
+    
+    id = Column(Integer, primary_key=True, index=True)
+    diagram_id = Column(Integer, ForeignKey("diagrams.id"), nullable=False)
+    version = Column(Integer, nullable=False)
+    data = Column(JSON, nullable=False)  # Empty when the snapshot is in the blob store
+    data_blob = Column(String(64))  # Digest of the snapshot in the blob store
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    
+    def __repr__(self):
+        return f"<DiagramCheckpoint(diagram_id={self.diagram_id}, version={self.version})>"
@@ -1,10 +1,36 @@
-from pydantic import BaseModel
-from typing import Dict, Any, List
+from pydantic import BaseModel, Field
+from typing import Dict, Any, List, Literal, Optional
+
+class AICleanOptions(BaseModel):
+    grid_size: float = Field(10, ge=0)  # 0 disables grid snapping
+    align_tolerance: Optional[float] = Field(None, ge=0)  # Defaults to half the grid size
+    spacing_tolerance: float = Field(0.5, ge=0)  # Max gap spread, relative to the mean gap, that still gets equalized
+    min_gap: Optional[float] = Field(None, ge=0)  # Defaults to the grid size
+    snap_to_grid: bool = True
+    align: bool = True
+    equalize_spacing: bool = True
+    remove_overlaps: bool = True
 
 class AICleanRequest(BaseModel):
     diagram_id: int
     diagram_data: Dict[str, Any]
-    cleaning_options: Dict[str, Any] = {}
+    cleaning_options: AICleanOptions = AICleanOptions()
+
+class AIJobCreate(AICleanRequest):
+    kind: Literal["clean", "interpret"]
+
+class AIJobResponse(BaseModel):
+    job_id: str
+    kind: str
+    diagram_id: int
+    status: str  # queued, running, succeeded or failed
+    progress: float
+    created_at: float
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    error: Optional[str] = None
+    result: Optional[Dict[str, Any]] = None
+    deduplicated: bool = False
 
 class AICleanResponse(BaseModel):
     success: bool
@@ -1,6 +1,6 @@
 from pydantic import BaseModel
 from datetime import datetime
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List, Literal, Tuple, Union
 
 class DiagramBase(BaseModel):
     title: str
@@ -16,14 +16,74 @@ class DiagramUpdate(BaseModel):
     description: Optional[str] = None
     data: Optional[Dict[str, Any]] = None
     is_public: Optional[bool] = None
+    version: Optional[int] = None  # When set, the update is rejected unless it matches
 
 class DiagramResponse(DiagramBase):
     id: int
-    thumbnail: Optional[str] = None
+    thumbnail: Optional[str] = None  # Base64, older diagrams only
+    thumbnail_url: Optional[str] = None
     owner_id: int
+    version: int
     created_at: datetime
     updated_at: datetime
     
     class Config:
         from_attributes = True
 
+
+class DiagramSummary(BaseModel):
+    """Dashboard list entry: everything except the canvas data and inline thumbnail"""
+    id: int
+    title: str
+    description: Optional[str] = None
+    is_public: bool
+    owner_id: int
+    version: int
+    thumbnail_url: Optional[str] = None
+    created_at: datetime
+    updated_at: datetime
+
+class DiagramSearchResult(DiagramSummary):
+    """Search hit: the dashboard entry plus its relevance and a highlighted «match» excerpt"""
+    score: float
+    snippet: Optional[str] = None
+
+class DiagramOperation(BaseModel):
+    op: Literal["add", "update", "remove", "move", "reorder"]
+    collection: Literal["shapes", "connections"] = "shapes"
+    id: Optional[Union[str, int]] = None  # Target element for update, remove, move and reorder
+    element: Optional[Dict[str, Any]] = None  # New element for add
+    changes: Optional[Dict[str, Any]] = None  # Fields to overwrite for update
+    dx: Optional[Union[int, float]] = None
+    dy: Optional[Union[int, float]] = None
+    after: Optional[Union[str, int]] = None  # Reorder: element to place this one directly above; omitted means bottom
+    ts: Optional[Tuple[int, str]] = None  # Lamport timestamp [counter, replica id]; the server stamps ops without one
+
+class DiagramPatch(BaseModel):
+    version: int  # Version the operations were made against
+    operations: List[DiagramOperation]
+
+class DiagramPatchResponse(BaseModel):
+    id: int
+    version: int
+
+class DiagramRegionResponse(BaseModel):
+    """Viewport slice of a diagram; context_shapes are off-viewport ends of the returned connections"""
+    id: int
+    version: int
+    bbox: List[float]
+    zoom: float
+    shapes: List[Dict[str, Any]]
+    connections: List[Dict[str, Any]]
+    context_shapes: List[Dict[str, Any]]
+    total_shapes: int
+    culled: int  # Shapes in the viewport dropped as smaller than REGION_LOD_MIN_PIXELS at this zoom
+
+class DiagramVersion(BaseModel):
+    """One entry of a diagram's history; `checkpoint` versions are stored in full, others as ops"""
+    version: int
+    kind: str  # baseline, create, ops, save or replace
+    op_count: int
+    user_id: Optional[int] = None
+    checkpoint: bool
+    created_at: Optional[datetime] = None
@@ -0,0 +1,259 @@
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Dict, Optional, Set
+import asyncio
+import hashlib
+import json
+import logging
+import multiprocessing
+import time
+import uuid
+from fastapi import HTTPException, status
+from app.services.diagram_cleanup import DiagramCleaner
+from app.services.diagram_interpreter import content_hash, diagram_interpreter, interpretation_cache
+
+logger = logging.getLogger(__name__)
+
+JOB_KINDS = ("clean", "interpret")
+
+# Stage-based progress pushed with each status change
+JOB_PROGRESS = {"queued": 0.0, "running": 0.5, "succeeded": 1.0, "failed": 1.0}
+
+def run_clean(data: Dict[str, Any], options: Dict[str, Any]) -> Dict[str, Any]:
+    """Process-pool entry point for /ai/clean"""
+    started = time.perf_counter()
+    cleaned_data, improvements = DiagramCleaner(**options).clean(data)
+    return {
+        "cleaned_data": cleaned_data,
+        "improvements": improvements,
+        "processing_time_ms": round((time.perf_counter() - started) * 1000)
+    }
+
+def run_interpret(data: Dict[str, Any]) -> Dict[str, Any]:
+    """Process-pool entry point for /ai/interpret"""
+    return diagram_interpreter.interpret(data)
+
+def _warm_up():
+    return None
+
+def job_key(kind: str, data: Dict[str, Any], options: Dict[str, Any]) -> str:
+    """Dedupe key: identical submissions share one job"""
+    if kind == "interpret":
+        # Same key the interpretation cache uses, so geometry-only edits still dedupe
+        return f"interpret:{content_hash(data)}"
+    canonical = json.dumps([data, options], separators=(",", ":"), sort_keys=True, default=str)
+    return f"clean:{hashlib.sha256(canonical.encode()).hexdigest()}"
+
+class AIJob:
+    def __init__(self, kind: str, key: str, user_id: int, diagram_id: int, room: Optional[str]):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.key = key
+        self.diagram_id = diagram_id
+        self.owner_id = user_id
+        self.user_ids: Set[int] = {user_id}
+        # Every room (and the diagram behind it) and user that submitted this job, for deduped joiners
+        self.rooms: Dict[str, int] = {room: diagram_id} if room is not None else {}
+        self.diagram_ids: Dict[int, int] = {user_id: diagram_id}
+        self.status = "queued"
+        self.result: Optional[Dict[str, Any]] = None
+        self.error: Optional[str] = None
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.done = asyncio.Event()
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("succeeded", "failed")
+
+    def to_dict(self, include_result: bool = True, diagram_id: Optional[int] = None) -> Dict[str, Any]:
+        job = {
+            "job_id": self.id,
+            "kind": self.kind,
+            "diagram_id": self.diagram_id if diagram_id is None else diagram_id,
+            "status": self.status,
+            "progress": JOB_PROGRESS[self.status],
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "error": self.error
+        }
+        if include_result:
+            job["result"] = self.result
+        return job
+
+class AIJobQueue:
+    """Runs AI passes in a process pool so they use every core and never block the event loop.
+
+    Each user may have `max_per_user` jobs running at once and `max_pending_per_user`
+    queued or running before submissions are refused with 429. Submissions with the same
+    dedupe key join the job already in flight (or recently finished) instead of running
+    again. Every status change is handed to `notify(room, message)` for each room that
+    submitted the job, which pushes it to that diagram's WebSocket room.
+    """
+
+    def __init__(
+        self,
+        workers: int,
+        max_per_user: int,
+        max_pending_per_user: int,
+        retention_seconds: float,
+        notify: Optional[Callable[[str, dict], None]] = None
+    ):
+        self.workers = max(1, workers)
+        self.max_per_user = max(1, max_per_user)
+        self.max_pending_per_user = max(self.max_per_user, max_pending_per_user)
+        self.retention_seconds = retention_seconds
+        self.notify = notify
+        self.jobs: Dict[str, AIJob] = {}
+        self._by_key: Dict[str, AIJob] = {}
+        self._slots: Dict[int, asyncio.Semaphore] = {}
+        self._pending: Dict[int, int] = {}
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self.stats = {"submitted": 0, "deduplicated": 0, "cache_hits": 0, "succeeded": 0, "failed": 0, "rejected": 0}
+
+    def _executor(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            # spawn: forking a process that holds DB connections and event-loop threads is unsafe
+            self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+        return self._pool
+
+    async def start(self):
+        """Start the worker processes now rather than on the first job"""
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*[loop.run_in_executor(self._executor(), _warm_up) for _ in range(self.workers)])
+
+    async def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    def get(self, job_id: str, user_id: int) -> Optional[AIJob]:
+        job = self.jobs.get(job_id)
+        return job if job is not None and user_id in job.user_ids else None
+
+    async def submit(
+        self,
+        kind: str,
+        data: Dict[str, Any],
+        user_id: int,
+        diagram_id: int,
+        room: Optional[str] = None,
+        options: Optional[Dict[str, Any]] = None
+    ):
+        """Queue a job and return (job, deduplicated)"""
+        self._purge()
+        options = options or {}
+        key = await asyncio.to_thread(job_key, kind, data, options)
+
+        existing = self._by_key.get(key)
+        if existing is not None and existing.status != "failed":
+            existing.user_ids.add(user_id)
+            existing.diagram_ids[user_id] = diagram_id
+            self.stats["deduplicated"] += 1
+            if room is not None and room not in existing.rooms:
+                # The new room gets the current state now and every later status change
+                existing.rooms[room] = diagram_id
+                self._notify_room(room, existing)
+            return existing, True
+
+        if self._pending.get(user_id, 0) >= self.max_pending_per_user:
+            self.stats["rejected"] += 1
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail=f"At most {self.max_pending_per_user} AI jobs may be pending per user"
+            )
+
+        job = AIJob(kind, key, user_id, diagram_id, room)
+        self.jobs[job.id] = job
+        self._by_key[key] = job
+        self.stats["submitted"] += 1
+
+        if kind == "interpret":
+            cached = interpretation_cache.get(key.split(":", 1)[1])
+            if cached is not None:
+                self.stats["cache_hits"] += 1
+                self._finish(job, "succeeded", result=cached)
+                return job, False
+
+        self._pending[user_id] = self._pending.get(user_id, 0) + 1
+        self._notify(job)
+        if kind == "clean":
+            asyncio.create_task(self._run(job, run_clean, data, options))
+        else:
+            asyncio.create_task(self._run(job, run_interpret, data))
+        return job, False
+
+    async def _run(self, job: AIJob, func, *args):
+        slots = self._slots.setdefault(job.owner_id, asyncio.Semaphore(self.max_per_user))
+        try:
+            async with slots:
+                job.status = "running"
+                job.started_at = time.time()
+                self._notify(job)
+                result = await self._execute(func, *args)
+            if job.kind == "interpret":
+                interpretation_cache.put(job.key.split(":", 1)[1], result)
+            self._finish(job, "succeeded", result=result)
+        except Exception as e:
+            logger.error(f"AI job {job.id} ({job.kind}) failed: {e}")
+            self._finish(job, "failed", error=str(e) or e.__class__.__name__)
+        finally:
+            remaining = self._pending.get(job.owner_id, 1) - 1
+            if remaining > 0:
+                self._pending[job.owner_id] = remaining
+            else:
+                self._pending.pop(job.owner_id, None)
+                self._slots.pop(job.owner_id, None)
+
+    async def _execute(self, func, *args):
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(self._executor(), func, *args)
+        except BrokenProcessPool:
+            # A worker died (OOM, segfault); replace the pool so later jobs still run
+            logger.warning("AI worker pool broke; restarting it")
+            self._pool = None
+            raise
+
+    def _finish(self, job: AIJob, status_: str, result: Optional[Dict[str, Any]] = None, error: Optional[str] = None):
+        job.status = status_
+        job.result = result
+        job.error = error
+        job.started_at = job.started_at or time.time()
+        job.finished_at = time.time()
+        self.stats[status_] += 1
+        if status_ == "failed" and self._by_key.get(job.key) is job:
+            del self._by_key[job.key]
+        job.done.set()
+        self._notify(job)
+
+    def _notify(self, job: AIJob):
+        for room in list(job.rooms):
+            self._notify_room(room, job)
+
+    def _notify_room(self, room: str, job: AIJob):
+        if self.notify is None:
+            return
+        try:
+            message = {"type": "ai_job", "job": job.to_dict(include_result=job.finished, diagram_id=job.rooms[room])}
+            self.notify(room, message)
+        except Exception as e:
+            logger.error(f"AI job notification failed: {e}")
+
+    def _purge(self):
+        cutoff = time.time() - self.retention_seconds
+        expired = [job for job in self.jobs.values() if job.finished and job.finished_at < cutoff]
+        for job in expired:
+            del self.jobs[job.id]
+            if self._by_key.get(job.key) is job:
+                del self._by_key[job.key]
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            **self.stats,
+            "workers": self.workers,
+            "active": sum(self._pending.values()),
+            "retained": len(self.jobs)
+        }
@@ -1,12 +1,19 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from typing import Optional, Union
+from typing import Dict, Optional, Set, Tuple, Union
+import asyncio
+import math
+import time
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 from fastapi import Depends, HTTPException, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from sqlalchemy.orm import Session
+from sqlalchemy import event, select
+from sqlalchemy.ext.asyncio import AsyncSession
 from app.core.config import settings
 from app.core.database import get_db
+from app.core.metrics import registry
 from app.models.user import User
 
 # Password hashing
@@ -15,6 +22,93 @@ pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 # JWT token scheme
 security = HTTPBearer()
 
+class AuthCache:
+    """Bounded LRU of verified tokens and the (detached) users they resolve to.
+
+    Entries expire after `ttl_seconds` or at the token's own expiry, whichever is sooner,
+    and every entry for a user is dropped as soon as that user row changes.
+    """
+
+    def __init__(self, max_size: int, ttl_seconds: float):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[str, Tuple[float, User]]" = OrderedDict()
+        self._tokens_by_user: Dict[int, Set[str]] = {}
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, token: str) -> Optional[User]:
+        entry = self._entries.get(token)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, user = entry
+        if expires_at <= time.monotonic():
+            self._remove(token)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(token)
+        self.hits += 1
+        return user
+
+    def put(self, token: str, user: User, token_expiry: Optional[float] = None):
+        if self.max_size <= 0:
+            return
+        lifetime = self.ttl_seconds
+        if token_expiry is not None:
+            lifetime = min(lifetime, token_expiry - time.time())
+        if lifetime <= 0:
+            return
+        self._remove(token)
+        self._entries[token] = (time.monotonic() + lifetime, user)
+        self._tokens_by_user.setdefault(user.id, set()).add(token)
+        while len(self._entries) > self.max_size:
+            self._remove(next(iter(self._entries)))
+
+    def invalidate_user(self, user_id: int):
+        tokens = self._tokens_by_user.pop(user_id, set())
+        for token in tokens:
+            self._entries.pop(token, None)
+        self.invalidations += len(tokens)
+
+    def clear(self):
+        self._entries.clear()
+        self._tokens_by_user.clear()
+
+    def _remove(self, token: str):
+        entry = self._entries.pop(token, None)
+        if entry is not None:
+            tokens = self._tokens_by_user.get(entry[1].id)
+            if tokens is not None:
+                tokens.discard(token)
+                if not tokens:
+                    del self._tokens_by_user[entry[1].id]
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "invalidations": self.invalidations
+        }
+
+auth_cache = AuthCache(settings.AUTH_CACHE_SIZE, settings.AUTH_CACHE_TTL_SECONDS)
+
+registry.callback("auth_cache_hits", "Token lookups served from the auth cache", "counter", lambda: [((), auth_cache.hits)])
+registry.callback("auth_cache_misses", "Token lookups that went to the database", "counter", lambda: [((), auth_cache.misses)])
+registry.callback("auth_cache_invalidations", "Cached tokens dropped because their user changed", "counter",
+                  lambda: [((), auth_cache.invalidations)])
+registry.callback("auth_cache_entries", "Tokens currently cached", "gauge", lambda: [((), auth_cache.stats()["size"])])
+
+@event.listens_for(User, "after_update")
+@event.listens_for(User, "after_delete")
+def _invalidate_cached_user(mapper, connection, target: User):
+    # ORM-level only: bulk query.update() / raw SQL bypass this and rely on the TTL
+    auth_cache.invalidate_user(target.id)
+
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     """Verify a password against its hash"""
     return pwd_context.verify(plain_password, hashed_password)
@@ -23,6 +117,56 @@ def get_password_hash(password: str) -> str:
     """Generate password hash"""
     return pwd_context.hash(password)
 
+class PasswordHashPool:
+    """Runs bcrypt (100-300 ms of CPU per call) on dedicated threads instead of the event loop.
+
+    bcrypt releases the GIL, so the loop keeps serving REST and WebSocket traffic while
+    hashes run. At most `workers` hashes run at once; once `max_pending` calls are running
+    or queued, new ones are refused with 503 and a Retry-After estimated from recent timings.
+    """
+
+    def __init__(self, workers: int, max_pending: int):
+        self.workers = max(1, workers)
+        self.max_pending = max(self.workers, max_pending)
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="password-hash")
+        self.pending = 0
+        self.rejected = 0
+        self._avg_seconds = 0.2
+
+    async def run(self, func, *args):
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            retry_after = max(1, math.ceil(self.pending / self.workers * self._avg_seconds))
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Authentication is busy, please retry",
+                headers={"Retry-After": str(retry_after)},
+            )
+        
+        self.pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, self._timed, func, args)
+        finally:
+            self.pending -= 1
+
+    def _timed(self, func, args):
+        started = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            # Exponentially weighted so the Retry-After estimate follows the host's real speed
+            self._avg_seconds = 0.8 * self._avg_seconds + 0.2 * (time.perf_counter() - started)
+
+password_hash_pool = PasswordHashPool(settings.PASSWORD_HASH_WORKERS, settings.PASSWORD_HASH_MAX_PENDING)
+
+async def verify_password_async(plain_password: str, hashed_password: str) -> bool:
+    """Verify a password on the hashing pool"""
+    return await password_hash_pool.run(verify_password, plain_password, hashed_password)
+
+async def get_password_hash_async(password: str) -> str:
+    """Generate a password hash on the hashing pool"""
+    return await password_hash_pool.run(get_password_hash, password)
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -> str:
     """Create JWT access token"""
     to_encode = data.copy()
@@ -46,18 +190,44 @@ def verify_token(token: str) -> Optional[dict]:
     except JWTError:
         return None
 
-def authenticate_user(db: Session, username: str, password: str) -> Optional[User]:
-    """Authenticate user with username and password"""
-    user = db.query(User).filter(User.username == username).first()
+async def authenticate_user(db: AsyncSession, username: str, password: str) -> Optional[User]:
+    """Authenticate user with username and password without blocking the event loop"""
+    user = (await db.execute(select(User).where(User.username == username))).scalars().first()
     if not user:
         return None
-    if not verify_password(password, user.password_hash):
+    # Hand the pooled connection back while the hash runs so a login burst cannot exhaust the pool
+    db.expunge(user)
+    await db.rollback()
+    if not await verify_password_async(password, user.password_hash):
         return None
     return user
 
-def get_current_user(
+async def _resolve_user(token: str, db: AsyncSession) -> Optional[User]:
+    """Verify a token and load its active user, consulting the auth cache first"""
+    user = auth_cache.get(token)
+    if user is not None:
+        return user
+    
+    payload = verify_token(token)
+    if payload is None:
+        return None
+    
+    username: str = payload.get("sub")
+    if username is None:
+        return None
+    
+    user = (await db.execute(select(User).where(User.username == username))).scalars().first()
+    if user is None or not user.is_active:
+        return None
+    
+    # Detach so a commit later in this request cannot expire the cached instance
+    db.expunge(user)
+    auth_cache.put(token, user, payload.get("exp"))
+    return user
+
+async def get_current_user(
     credentials: HTTPAuthorizationCredentials = Depends(security),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ) -> User:
     """Get current authenticated user from JWT token"""
     credentials_exception = HTTPException(
@@ -66,37 +236,12 @@ def get_current_user(
         headers={"WWW-Authenticate": "Bearer"},
     )
     
-    try:
-        payload = verify_token(credentials.credentials)
-        if payload is None:
-            raise credentials_exception
-        
-        username: str = payload.get("sub")
-        if username is None:
-            raise credentials_exception
-            
-    except JWTError:
-        raise credentials_exception
-    
-    user = db.query(User).filter(User.username == username).first()
+    user = await _resolve_user(credentials.credentials, db)
     if user is None:
         raise credentials_exception
     
     return user
 
-def get_current_user_ws(token: str, db: Session) -> Optional[User]:
+async def get_current_user_ws(token: str, db: AsyncSession) -> Optional[User]:
     """Get current user for WebSocket connections"""
-    try:
-        payload = verify_token(token)
-        if payload is None:
-            return None
-        
-        username: str = payload.get("sub")
-        if username is None:
-            return None
-            
-        user = db.query(User).filter(User.username == username).first()
-        return user
-        
-    except JWTError:
-        return None
+    return await _resolve_user(token, db)
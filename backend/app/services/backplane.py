@@ -0,0 +1,247 @@
+import abc
+import asyncio
+import fcntl
+import json
+import logging
+import os
+import struct
+import uuid
+from typing import Callable, Dict, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+_HEADER = struct.Struct("!I")
+# Frames are dropped for a peer whose socket buffer grows past this instead of buffering without bound
+MAX_PEER_BUFFER_BYTES = 8 * 1024 * 1024
+
+class Backplane(abc.ABC):
+    """Carries room broadcasts and presence changes between processes serving the same rooms.
+
+    Envelopes are plain dicts with a "kind" ("broadcast", "join", "leave", "presence_request",
+    "presence_snapshot", "node_down", "room_deleted", or one of the room document kinds "ops",
+    "ops_error", "ops_result", "flush_request", "flushed" and "replaced") and the publishing
+    node's id in "origin". Handlers are only called for envelopes published by other nodes.
+
+    One node is the sequencer: it gives every live document edit its version and is the only
+    node that writes room documents back, so versions never fork between processes.
+    """
+
+    def __init__(self):
+        self.node_id = uuid.uuid4().hex
+        self._handler: Optional[Callable[[dict], None]] = None
+        self._on_reconnect: Optional[Callable[[], None]] = None
+
+    def set_handler(self, handler: Callable[[dict], None], on_reconnect: Optional[Callable[[], None]] = None):
+        self._handler = handler
+        self._on_reconnect = on_reconnect
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    @property
+    def sequencer(self) -> bool:
+        return True
+
+    @abc.abstractmethod
+    def publish(self, envelope: dict):
+        """Send an envelope to every other node; never waits on them"""
+
+    def _dispatch(self, envelope: dict):
+        if self._handler is None or envelope.get("origin") == self.node_id:
+            return
+        try:
+            self._handler(envelope)
+        except Exception as e:
+            logger.error(f"Backplane handler failed: {e}")
+
+class InProcessBackplane(Backplane):
+    """Single-process deployment: every room member is local, so nothing needs to travel"""
+
+    def publish(self, envelope: dict):
+        pass
+
+def _encode(envelope: dict) -> bytes:
+    payload = json.dumps(envelope).encode()
+    return _HEADER.pack(len(payload)) + payload
+
+async def _read_frame(reader: asyncio.StreamReader):
+    """Return (envelope, raw frame) so the broker can relay without re-encoding"""
+    header = await reader.readexactly(_HEADER.size)
+    (length,) = _HEADER.unpack(header)
+    payload = await reader.readexactly(length)
+    return json.loads(payload), header + payload
+
+def _write(writer: asyncio.StreamWriter, frame: bytes) -> bool:
+    if writer.is_closing() or writer.transport.get_write_buffer_size() > MAX_PEER_BUFFER_BYTES:
+        return False
+    writer.write(frame)
+    return True
+
+class UnixSocketBackplane(Backplane):
+    """Multi-process backplane over a local Unix socket, with no external service.
+
+    The worker holding an exclusive lock on `<socket_path>.lock` is the broker: it binds the
+    socket and relays every frame to the other workers, which connect to it as clients. The
+    OS releases the lock when the broker exits, so a survivor takes over and everyone
+    re-announces their room members. The broker is the sequencer; a worker that cannot reach
+    any broker sequences its own rooms until it can.
+    """
+
+    def __init__(self, socket_path: str, reconnect_delay: float = 0.5):
+        super().__init__()
+        self.socket_path = socket_path
+        self.reconnect_delay = reconnect_delay
+        self.is_broker = False
+        self._lock_fd: Optional[int] = None
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._peers: Dict[asyncio.StreamWriter, Optional[str]] = {}
+        self._peer_tasks: Set[asyncio.Task] = set()
+        self._upstream: Optional[asyncio.StreamWriter] = None
+        self._task: Optional[asyncio.Task] = None
+        self._connected = asyncio.Event()
+        self.frames_dropped = 0
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+            # Give the first connection attempt a chance so early publishes are not lost
+            try:
+                await asyncio.wait_for(self._connected.wait(), timeout=2.0)
+            except asyncio.TimeoutError:
+                logger.warning("Backplane not connected yet; continuing in local-only mode")
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        # Closing the links ends the peer readers with EOF
+        self._close_links()
+        if self._peer_tasks:
+            await asyncio.wait(list(self._peer_tasks), timeout=1.0)
+
+    @property
+    def sequencer(self) -> bool:
+        return self.is_broker or self._upstream is None
+
+    def publish(self, envelope: dict):
+        envelope = {**envelope, "origin": self.node_id}
+        frame = _encode(envelope)
+        if self.is_broker:
+            self._relay(frame, exclude=None)
+        elif self._upstream is not None:
+            if not _write(self._upstream, frame):
+                self.frames_dropped += 1
+
+    def _relay(self, frame: bytes, exclude: Optional[asyncio.StreamWriter]):
+        for writer in list(self._peers):
+            if writer is not exclude and not _write(writer, frame):
+                self.frames_dropped += 1
+
+    async def _run(self):
+        while True:
+            try:
+                if await self._try_become_broker():
+                    self._connected.set()
+                    self._announce_reconnect()
+                    await self._server.serve_forever()
+                else:
+                    await self._run_client()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Backplane link lost: {e}")
+            self._close_links()
+            self._connected.clear()
+            await asyncio.sleep(self.reconnect_delay)
+
+    async def _try_become_broker(self) -> bool:
+        fd = os.open(f"{self.socket_path}.lock", os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self._lock_fd = fd
+        # Any socket file left at the path belongs to a dead broker; asyncio replaces it
+        self._server = await asyncio.start_unix_server(self._serve_peer, path=self.socket_path)
+        self.is_broker = True
+        logger.info(f"Backplane broker listening on {self.socket_path}")
+        return True
+
+    async def _serve_peer(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        task = asyncio.current_task()
+        self._peer_tasks.add(task)
+        self._peers[writer] = None
+        try:
+            while True:
+                envelope, frame = await _read_frame(reader)
+                self._peers[writer] = envelope.get("origin")
+                self._relay(frame, exclude=writer)
+                self._dispatch(envelope)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self._peer_tasks.discard(task)
+            origin = self._peers.pop(writer, None)
+            writer.close()
+            if origin is not None:
+                # Tell everyone (including ourselves) to forget that node's room members
+                down = {"kind": "node_down", "node": origin, "origin": self.node_id}
+                self._relay(_encode(down), exclude=None)
+                if self._handler:
+                    self._handler(down)
+
+    async def _run_client(self):
+        reader, writer = await asyncio.open_unix_connection(self.socket_path)
+        self.is_broker = False
+        self._upstream = writer
+        self._connected.set()
+        self._announce_reconnect()
+        try:
+            while True:
+                envelope, _ = await _read_frame(reader)
+                self._dispatch(envelope)
+        except asyncio.IncompleteReadError:
+            logger.warning("Backplane broker went away")
+        finally:
+            self._upstream = None
+
+    def _announce_reconnect(self):
+        if self._on_reconnect:
+            try:
+                self._on_reconnect()
+            except Exception as e:
+                logger.error(f"Backplane reconnect hook failed: {e}")
+
+    def _close_links(self):
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+            try:
+                os.unlink(self.socket_path)
+            except OSError:
+                pass
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+        for writer in list(self._peers):
+            writer.close()
+        self._peers.clear()
+        if self._upstream is not None:
+            self._upstream.close()
+            self._upstream = None
+        self.is_broker = False
+
+def create_backplane(kind: str, socket_path: str) -> Backplane:
+    if kind == "memory":
+        return InProcessBackplane()
+    if kind == "unix":
+        return UnixSocketBackplane(socket_path)
+    raise ValueError(f"Unknown WS_BACKPLANE '{kind}'")
@@ -0,0 +1,240 @@
+import asyncio
+import hashlib
+import json
+import logging
+import mmap
+import os
+import tempfile
+from collections import Counter
+from typing import Any, Dict, Iterable, List, Optional
+from sqlalchemy import bindparam, delete, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.responses import Response
+from app.core.config import settings
+from app.core.database import AsyncSessionLocal
+from app.core.metrics import registry
+from app.models.blob import Blob
+
+logger = logging.getLogger(__name__)
+
+# Bytes per body message when a blob is streamed from its mapping
+STREAM_CHUNK_BYTES = 256 * 1024
+
+blobs = Blob.__table__
+
+def content_digest(content: bytes) -> str:
+    return hashlib.sha256(content).hexdigest()
+
+def encode_json(data: Any) -> bytes:
+    return json.dumps(data, separators=(",", ":"), ensure_ascii=False).encode()
+
+_refcount_statements: Dict[str, Any] = {}
+
+def _refcount_statement(dialect: str):
+    """INSERT ... ON CONFLICT adding `refcount` references to a blob row, creating it if needed"""
+    statement = _refcount_statements.get(dialect)
+    if statement is None:
+        dialect_insert = postgresql.insert if dialect == "postgresql" else sqlite.insert
+        statement = dialect_insert(blobs)
+        statement = _refcount_statements[dialect] = statement.on_conflict_do_update(
+            index_elements=[blobs.c.digest],
+            set_={"refcount": blobs.c.refcount + statement.excluded.refcount}
+        )
+    return statement
+
+_RELEASE_STATEMENT = update(blobs).where(blobs.c.digest == bindparam("b_digest")).values(
+    refcount=blobs.c.refcount - bindparam("b_count")
+)
+
+class BlobStore:
+    """Content-addressed files under `root` (ab/cd/abcd...) with their reference counts in the blobs table.
+
+    Identical content is stored once: putting it again only adds a reference. References
+    are taken and dropped inside the caller's transaction, so they commit or roll back with
+    the rows that hold the digests; files nobody references any more are deleted by collect().
+    """
+
+    def __init__(
+        self,
+        root: str = settings.BLOB_STORE_PATH,
+        min_bytes: int = settings.BLOB_MIN_BYTES,
+        session_factory=AsyncSessionLocal,
+        gc_interval: float = settings.BLOB_GC_INTERVAL_SECONDS
+    ):
+        self.root = root
+        self.min_bytes = min_bytes
+        self.session_factory = session_factory
+        self.gc_interval = gc_interval
+        self._gc_task: Optional[asyncio.Task] = None
+        self.stats = {"puts": 0, "deduplicated": 0, "files_written": 0, "released": 0, "collected": 0}
+
+    def path(self, digest: str) -> str:
+        return os.path.join(self.root, digest[:2], digest[2:4], digest)
+
+    def _write_files(self, contents: Dict[str, bytes]) -> int:
+        """Write the files that do not exist yet: to a temporary name, fsynced, then renamed into place"""
+        written = 0
+        for digest, content in contents.items():
+            path = self.path(digest)
+            if os.path.exists(path):
+                continue
+            directory = os.path.dirname(path)
+            os.makedirs(directory, exist_ok=True)
+            fd, temporary = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+            try:
+                with os.fdopen(fd, "wb") as file:
+                    file.write(content)
+                    file.flush()
+                    os.fsync(file.fileno())
+                os.replace(temporary, path)
+            except BaseException:
+                try:
+                    os.unlink(temporary)
+                except OSError:
+                    pass
+                raise
+            written += 1
+        return written
+
+    async def put_many(self, db: AsyncSession, contents: List[bytes]) -> List[str]:
+        """Add one reference per item (stored once per distinct content) and return their digests"""
+        if not contents:
+            return []
+        digests = await asyncio.to_thread(lambda: [content_digest(content) for content in contents])
+        unique = dict(zip(digests, contents))
+        counts = Counter(digests)
+        # The reference is taken before the file is checked, so a concurrent collect() either
+        # sees it and keeps the file or has already removed the file, which is written again below
+        await db.execute(_refcount_statement(db.bind.dialect.name), [
+            {"digest": digest, "size": len(content), "refcount": counts[digest]} for digest, content in unique.items()
+        ])
+        written = await asyncio.to_thread(self._write_files, unique)
+        self.stats["puts"] += len(contents)
+        self.stats["deduplicated"] += len(contents) - written
+        self.stats["files_written"] += written
+        return digests
+
+    async def put(self, db: AsyncSession, content: bytes) -> str:
+        return (await self.put_many(db, [content]))[0]
+
+    def wants(self, size: int) -> bool:
+        """Whether an encoded document of `size` bytes belongs in the blob store rather than its row"""
+        return 0 < self.min_bytes <= size
+
+    async def put_json(self, db: AsyncSession, data: Any) -> Optional[Dict[str, Any]]:
+        """Store `data` as a blob when its JSON reaches BLOB_MIN_BYTES; returns {"digest", "size"} or None"""
+        if self.min_bytes <= 0:
+            return None
+        content = await asyncio.to_thread(encode_json, data)
+        if not self.wants(len(content)):
+            return None
+        return {"digest": await self.put(db, content), "size": len(content)}
+
+    async def release(self, db: AsyncSession, digests: Iterable[Optional[str]]):
+        """Drop one reference per digest (None entries are ignored)"""
+        counts = Counter(digest for digest in digests if digest)
+        if counts:
+            await db.execute(_RELEASE_STATEMENT, [{"b_digest": digest, "b_count": count} for digest, count in counts.items()])
+            self.stats["released"] += sum(counts.values())
+
+    def _read(self, digest: str) -> bytes:
+        with open(self.path(digest), "rb") as file:
+            return file.read()
+
+    async def read(self, digest: str) -> bytes:
+        return await asyncio.to_thread(self._read, digest)
+
+    async def read_json(self, digest: str) -> Any:
+        return await asyncio.to_thread(lambda: json.loads(self._read(digest)))
+
+    def _unlink(self, digest: str):
+        try:
+            os.unlink(self.path(digest))
+        except FileNotFoundError:
+            pass
+
+    async def collect(self) -> int:
+        """Delete unreferenced blobs, one short transaction each; returns how many were removed"""
+        removed = 0
+        async with self.session_factory() as db:
+            digests = (await db.execute(select(blobs.c.digest).where(blobs.c.refcount <= 0))).scalars().all()
+            for digest in digests:
+                try:
+                    # Re-checked in the DELETE: the blob may have been referenced again since the select
+                    result = await db.execute(delete(blobs).where(blobs.c.digest == digest, blobs.c.refcount <= 0))
+                    if result.rowcount:
+                        # Unlinked before the commit: if the commit fails, the row still says unreferenced
+                        # and a later put() writes the file again
+                        await asyncio.to_thread(self._unlink, digest)
+                        removed += 1
+                    await db.commit()
+                except Exception:
+                    await db.rollback()
+                    raise
+        self.stats["collected"] += removed
+        return removed
+
+    async def start(self):
+        await asyncio.to_thread(os.makedirs, self.root, exist_ok=True)
+        if self.gc_interval > 0 and (self._gc_task is None or self._gc_task.done()):
+            self._gc_task = asyncio.create_task(self._run())
+
+    async def shutdown(self):
+        if self._gc_task and not self._gc_task.done():
+            self._gc_task.cancel()
+            try:
+                await self._gc_task
+            except asyncio.CancelledError:
+                pass
+        self._gc_task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.gc_interval)
+            try:
+                removed = await self.collect()
+                if removed:
+                    logger.info(f"Removed {removed} unreferenced blobs")
+            except Exception as e:
+                logger.error(f"Blob collection failed: {e}")
+
+class BlobResponse(Response):
+    """Sends a blob file without reading it into memory.
+
+    Servers offering the ASGI zero-copy send extension get the file descriptor (sendfile);
+    otherwise the file is memory-mapped and sent in STREAM_CHUNK_BYTES slices straight from
+    the page cache.
+    """
+
+    def __init__(self, path: str, media_type: str, headers: Optional[Dict[str, str]] = None):
+        self.path = path
+        self.status_code = 200
+        self.media_type = media_type
+        self.background = None
+        self.init_headers(headers)
+
+    async def __call__(self, scope, receive, send):
+        with open(self.path, "rb") as file:
+            size = os.fstat(file.fileno()).st_size
+            self.headers["content-length"] = str(size)
+            await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+            if scope.get("method") == "HEAD":
+                await send({"type": "http.response.body", "body": b""})
+                return
+            if "http.response.zerocopysend" in scope.get("extensions", {}):
+                await send({"type": "http.response.zerocopysend", "file": file.fileno(), "more_body": False})
+                return
+            if size == 0:
+                # Zero-length files cannot be mapped
+                await send({"type": "http.response.body", "body": b""})
+                return
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                for start in range(0, size, STREAM_CHUNK_BYTES):
+                    end = min(start + STREAM_CHUNK_BYTES, size)
+                    await send({"type": "http.response.body", "body": mapped[start:end], "more_body": end < size})
+
+blob_store = BlobStore()
+
+registry.callback("blob_store_events", "Blob puts, deduplicated puts, files written, references released and blobs collected",
+                  "counter", lambda: [((event,), count) for event, count in blob_store.stats.items()], ("event",))
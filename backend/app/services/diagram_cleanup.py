@@ -0,0 +1,332 @@
+from itertools import chain
+from typing import Any, Dict, List, Optional, Tuple
+import numpy as np
+from app.services.spatial_index import expand_counts
+
+# Broad-phase candidates beyond this mean the diagram is one big pile; resolving it pairwise is not useful
+MAX_OVERLAP_PAIRS = 2_000_000
+# Positions are written rounded to 2 decimals, so anything smaller is not a move
+MIN_MOVE = 0.005
+
+def _segment_starts(sorted_labels: np.ndarray) -> np.ndarray:
+    return np.flatnonzero(np.r_[True, sorted_labels[1:] != sorted_labels[:-1]])
+
+def _cluster(values: np.ndarray, tolerance: float) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Group values lying within `tolerance` of their group's smallest value.
+
+    Returns (label per value, group sizes, group means). Grouping is anchored at each
+    group's minimum so a long run of evenly spaced values does not chain into one group.
+    """
+    if values.size == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, np.zeros(0)
+    order = np.argsort(values, kind="stable")
+    ordered = values[order]
+    chains = np.r_[0, np.cumsum(np.diff(ordered) > tolerance)]
+    starts = _segment_starts(chains)
+    chain_min = np.repeat(ordered[starts], np.diff(np.r_[starts, ordered.size]))
+    sub = np.floor((ordered - chain_min) / tolerance).astype(np.int64) if tolerance > 0 else np.zeros(ordered.size, np.int64)
+    keys = chains * (sub.max() + 1) + sub
+    sorted_labels = np.r_[0, np.cumsum(keys[1:] != keys[:-1])]
+    labels = np.empty_like(sorted_labels)
+    labels[order] = sorted_labels
+    counts = np.bincount(labels)
+    means = np.bincount(labels, weights=values) / counts
+    return labels, counts, means
+
+class DiagramCleaner:
+    """Deterministic layout clean-up over shape geometry held as NumPy arrays.
+
+    Passes run in order: align near-collinear centers and leading edges, snap leading
+    edges to the grid, equalize nearly-even gaps inside aligned rows and columns, then
+    push overlapping shapes apart. Only `x`/`y` are rewritten; shapes without numeric
+    geometry and all other keys pass through untouched.
+    """
+
+    def __init__(
+        self,
+        grid_size: float = 10,
+        align_tolerance: Optional[float] = None,
+        spacing_tolerance: float = 0.5,
+        min_gap: Optional[float] = None,
+        snap_to_grid: bool = True,
+        align: bool = True,
+        equalize_spacing: bool = True,
+        remove_overlaps: bool = True,
+        max_overlap_passes: int = 16
+    ):
+        self.grid_size = max(float(grid_size), 0.0)
+        self.align_tolerance = float(align_tolerance) if align_tolerance is not None else max(self.grid_size / 2, 1.0)
+        self.spacing_tolerance = spacing_tolerance
+        self.min_gap = float(min_gap) if min_gap is not None else self.grid_size
+        self.snap_to_grid = snap_to_grid and self.grid_size > 0
+        self.align = align
+        self.equalize_spacing = equalize_spacing
+        self.remove_overlaps = remove_overlaps
+        self.max_overlap_passes = max_overlap_passes
+
+    def clean(self, data: Dict[str, Any]) -> Tuple[Dict[str, Any], List[str]]:
+        """Return (cleaned diagram data, human-readable list of what changed)"""
+        shapes = list(data.get("shapes") or [])
+        positions, x, y, w, h = self._extract(shapes)
+        improvements: List[str] = []
+
+        if positions:
+            original_x, original_y = x.copy(), y.copy()
+            x, column_groups, aligned_x, snapped_x = self._align_axis(x, w)
+            y, row_groups, aligned_y, snapped_y = self._align_axis(y, h)
+            if aligned_x or aligned_y:
+                improvements.append(f"Aligned {aligned_x + aligned_y} shape edges and centers")
+            if snapped_x or snapped_y:
+                improvements.append(f"Snapped shapes to a {self._format(self.grid_size)}px grid")
+
+            if self.equalize_spacing:
+                # Shapes sharing a y anchor form a row and are spaced along x, and vice versa
+                x, rows = self._equalize(x, w, row_groups)
+                y, columns = self._equalize(y, h, column_groups)
+                if rows or columns:
+                    improvements.append(f"Equalized spacing in {rows} rows and {columns} columns")
+
+            if self.remove_overlaps:
+                x, y, resolved, remaining = self._separate(x, y, w, h)
+                if remaining is None:
+                    improvements.append("Skipped overlap removal: too many shapes are stacked on each other")
+                else:
+                    if resolved:
+                        improvements.append(f"Resolved {resolved} overlapping shape pairs")
+                    if remaining:
+                        improvements.append(f"{remaining} overlapping pairs could not be separated")
+
+            moved = np.flatnonzero((x != original_x) | (y != original_y))
+            for i, new_x, new_y in zip(moved.tolist(), self._format_array(x[moved]), self._format_array(y[moved])):
+                position = positions[i]
+                shapes[position] = {**shapes[position], "x": new_x, "y": new_y}
+            improvements.insert(0, f"Repositioned {moved.size} of {len(shapes)} shapes")
+
+        cleaned = dict(data)
+        cleaned["shapes"] = shapes
+        cleaned["connections"] = list(data.get("connections") or [])
+        return cleaned, improvements
+
+    @staticmethod
+    def _extract(shapes: List[Any]):
+        positions = [position for position, shape in enumerate(shapes) if isinstance(shape, dict)]
+        try:
+            geometry = np.fromiter(chain.from_iterable(
+                (shape.get("x", 0), shape.get("y", 0), shape.get("width", 0), shape.get("height", 0))
+                for shape in (shapes[position] for position in positions)
+            ), dtype=np.float64, count=4 * len(positions)).reshape(-1, 4)
+        except (TypeError, ValueError):
+            # Some shape has a non-numeric field; fall back to converting one shape at a time
+            rows = []
+            for position in positions:
+                shape = shapes[position]
+                try:
+                    rows.append((float(shape.get("x", 0)), float(shape.get("y", 0)),
+                                 float(shape.get("width", 0) or 0), float(shape.get("height", 0) or 0)))
+                except (TypeError, ValueError):
+                    rows.append((np.nan,) * 4)
+            geometry = np.array(rows, dtype=np.float64).reshape(-1, 4)
+
+        # A missing size counts as zero; a missing position means the shape cannot be placed
+        sizes = np.nan_to_num(geometry[:, 2:], nan=0.0, posinf=0.0, neginf=0.0)
+        usable = np.isfinite(geometry[:, 0]) & np.isfinite(geometry[:, 1])
+        positions = [position for position, keep in zip(positions, usable.tolist()) if keep]
+        w = np.maximum(sizes[usable, 0], 0)
+        h = np.maximum(sizes[usable, 1], 0)
+        return positions, geometry[usable, 0], geometry[usable, 1], w, h
+
+    @staticmethod
+    def _format(value: float):
+        value = round(float(value), 2)
+        return int(value) if value.is_integer() else value
+
+    @staticmethod
+    def _format_array(values: np.ndarray) -> List[Any]:
+        rounded = np.round(values, 2)
+        formatted = rounded.astype(object)
+        integral = rounded == np.floor(rounded)
+        formatted[integral] = rounded[integral].astype(np.int64)
+        return formatted.tolist()
+
+    def _snap(self, values: np.ndarray) -> np.ndarray:
+        if not self.snap_to_grid:
+            return values
+        return np.round(values / self.grid_size) * self.grid_size
+
+    def _align_axis(self, start: np.ndarray, size: np.ndarray):
+        """Align and snap one axis.
+
+        Returns (new starts, alignment group per shape or -1, shapes moved by alignment,
+        shapes moved by snapping). The grid applies to leading edges, so a shape already
+        on it stays there; a center-aligned group puts its widest member's edge on the grid.
+        """
+        target = start.copy()
+        groups = np.full(start.size, -1, dtype=np.int64)
+        result = self._snap(start)
+        if self.align:
+            # Centers first, then leading edges for shapes no center group claimed
+            labels, counts, means = _cluster(start + size / 2, self.align_tolerance)
+            by_center = np.flatnonzero(counts[labels] > 1)
+            labels = labels[by_center]
+            widest = np.zeros(counts.size)
+            np.maximum.at(widest, labels, size[by_center])
+            half = size[by_center] / 2
+            target[by_center] = means[labels] - half
+            result[by_center] = self._snap(means - widest / 2)[labels] + widest[labels] / 2 - half
+            groups[by_center] = labels
+
+            rest = np.flatnonzero(groups < 0)
+            labels, counts, means = _cluster(start[rest], self.align_tolerance)
+            by_edge = counts[labels] > 1
+            target[rest[by_edge]] = means[labels[by_edge]]
+            result[rest[by_edge]] = self._snap(means)[labels[by_edge]]
+            groups[rest[by_edge]] = labels[by_edge] + (groups.max() + 1)
+        aligned = int(np.count_nonzero(np.abs(target - start) >= MIN_MOVE))
+        snapped = int(np.count_nonzero(np.abs(result - target) >= MIN_MOVE))
+        return result, groups, aligned, snapped
+
+    def _equalize(self, start: np.ndarray, size: np.ndarray, groups: np.ndarray):
+        """Evenly space runs of 3+ shapes per group whose gaps are already nearly equal"""
+        members = np.flatnonzero(groups >= 0)
+        if members.size < 3:
+            return start, 0
+        order = members[np.lexsort((start[members], groups[members]))]
+        g = groups[order]
+        s = start[order]
+        e = s + size[order]
+
+        same = g[1:] == g[:-1]
+        gaps = s[1:] - e[:-1]
+        gap_groups = g[1:][same]
+        gaps = gaps[same]
+        if gaps.size == 0:
+            return start, 0
+        starts = _segment_starts(gap_groups)
+        counts = np.diff(np.r_[starts, gaps.size])
+        low = np.minimum.reduceat(gaps, starts)
+        high = np.maximum.reduceat(gaps, starts)
+        mean = np.add.reduceat(gaps, starts) / counts
+        eligible = (counts >= 2) & (low > 0) & (high - low <= self.spacing_tolerance * mean)
+        if not eligible.any():
+            return start, 0
+
+        target = np.zeros(g.max() + 1)
+        keep = np.zeros(g.max() + 1, dtype=bool)
+        group_ids = gap_groups[starts]
+        target[group_ids[eligible]] = np.maximum(self._snap(mean[eligible]), self.min_gap)
+        keep[group_ids[eligible]] = True
+
+        step = size[order] + target[g]
+        before = np.cumsum(step) - step
+        first = np.maximum.accumulate(np.where(np.r_[True, ~same], np.arange(g.size), 0))
+        placed = s[first] + before - before[first]
+
+        result = start.copy()
+        selected = keep[g]
+        result[order[selected]] = placed[selected]
+        # Runs that were already evenly spaced are not reported
+        changed = selected & (np.abs(placed - s) >= MIN_MOVE)
+        return result, int(np.unique(g[changed]).size)
+
+    @staticmethod
+    def _cell_size(w, h) -> float:
+        solid = (w > 0) & (h > 0)
+        if not solid.any():
+            return 1.0
+        return max(2 * float(np.median(np.maximum(w[solid], h[solid]))), 1.0)
+
+    @staticmethod
+    def _overlapping_pairs(x, y, w, h, cell: float, active: Optional[np.ndarray] = None):
+        """Index pairs of overlapping shapes via a uniform grid broad phase; None if there are too many candidates.
+
+        With an `active` mask only cells covered by an active shape are searched, which
+        finds every overlapping pair that involves at least one active shape.
+        """
+        solid = np.flatnonzero((w > 0) & (h > 0))
+        if solid.size < 2:
+            return np.zeros(0, np.int64), np.zeros(0, np.int64)
+        xs, ys, ws, hs = x[solid], y[solid], w[solid], h[solid]
+        x0, y0 = np.floor(xs / cell), np.floor(ys / cell)
+        spans_x = (np.floor((xs + ws) / cell) - x0 + 1).astype(np.int64)
+        spans_y = (np.floor((ys + hs) / cell) - y0 + 1).astype(np.int64)
+        cover = spans_x * spans_y
+        if cover.sum() > MAX_OVERLAP_PAIRS:
+            return None
+
+        # One entry per (shape, covered cell), grouped by cell
+        owner, local = expand_counts(cover)
+        origin_x, origin_y = x0.min(), y0.min()
+        gx = (x0[owner] - origin_x).astype(np.int64) + local % spans_x[owner]
+        gy = (y0[owner] - origin_y).astype(np.int64) + local // spans_x[owner]
+        rows = int(gy.max()) + 1
+        key = gx * rows + gy
+        if active is not None:
+            touched = np.isin(key, key[active[solid[owner]]])
+            owner, key = owner[touched], key[touched]
+        # Entries are generated in owner order, so a stable sort keeps owners ordered inside a cell
+        order = np.argsort(key, kind="stable")
+        owner, key = owner[order], key[order]
+        cell_starts = _segment_starts(key)
+        cell_ends = np.repeat(np.r_[cell_starts[1:], owner.size], np.diff(np.r_[cell_starts, owner.size]))
+        after = cell_ends - np.arange(owner.size) - 1
+        if after.sum() > MAX_OVERLAP_PAIRS:
+            return None
+
+        left, offset = expand_counts(after)
+        i, j = owner[left], owner[left + 1 + offset]
+        hit = ((np.minimum(xs[i] + ws[i], xs[j] + ws[j]) > np.maximum(xs[i], xs[j]))
+               & (np.minimum(ys[i] + hs[i], ys[j] + hs[j]) > np.maximum(ys[i], ys[j])))
+        i, j, home = i[hit], j[hit], key[left[hit]]
+        # A pair sharing several cells is reported only from the cell holding its overlap's corner
+        home_x = (np.floor(np.maximum(xs[i], xs[j]) / cell) - origin_x).astype(np.int64)
+        home_y = (np.floor(np.maximum(ys[i], ys[j]) / cell) - origin_y).astype(np.int64)
+        own = home_x * rows + home_y == home
+        return solid[i[own]], solid[j[own]]
+
+    def _separate(self, x, y, w, h):
+        """Push overlapping shapes right or down along their shallower overlap.
+
+        Returns (x, y, pairs resolved, pairs remaining); remaining is None when the
+        diagram has too many overlap candidates to resolve.
+        """
+        x, y = x.copy(), y.copy()
+        cell = self._cell_size(w, h)
+        initial = None
+        # Every pair still overlapping after a pass includes a shape that pass moved
+        moved = None
+        for _ in range(self.max_overlap_passes):
+            pairs = self._overlapping_pairs(x, y, w, h, cell, moved)
+            if pairs is None:
+                return x, y, 0, None
+            i, j = pairs
+            if initial is None:
+                initial = i.size
+            if i.size == 0:
+                return x, y, initial, 0
+            x_overlap = np.minimum(x[i] + w[i], x[j] + w[j]) - np.maximum(x[i], x[j])
+            y_overlap = np.minimum(y[i] + h[i], y[j] + h[j]) - np.maximum(y[i], y[j])
+
+            along_x = x_overlap <= y_overlap
+            # The shape further right (or down) moves; ties go to the later shape so runs are repeatable
+            mover_x = np.where((x[j] > x[i]) | ((x[j] == x[i]) & (j > i)), j, i)
+            mover_y = np.where((y[j] > y[i]) | ((y[j] == y[i]) & (j > i)), j, i)
+            dx = np.zeros(x.size)
+            dy = np.zeros(y.size)
+            np.maximum.at(dx, mover_x[along_x], self._push(x_overlap[along_x]))
+            np.maximum.at(dy, mover_y[~along_x], self._push(y_overlap[~along_x]))
+            x += dx
+            y += dy
+            moved = (dx > 0) | (dy > 0)
+
+        pairs = self._overlapping_pairs(x, y, w, h, cell, moved)
+        if pairs is None:
+            return x, y, 0, None
+        remaining = int(pairs[0].size)
+        return x, y, max(initial - remaining, 0), remaining
+
+    def _push(self, overlap: np.ndarray) -> np.ndarray:
+        distance = overlap + self.min_gap
+        if self.snap_to_grid:
+            return np.ceil(distance / self.grid_size) * self.grid_size
+        return distance
@@ -0,0 +1,392 @@
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+import math
+import uuid
+from app.services.diagram_ops import ELEMENT_COLLECTIONS, DiagramDocument, DiagramOperationError, connection_endpoints
+
+# Lamport timestamp: (counter, replica id); compared as a tuple, so equal counters are ordered by replica
+Timestamp = Tuple[int, str]
+ElementKey = Tuple[str, Any]
+
+ZERO: Timestamp = (0, "")
+MERGE_OPERATION_TYPES = ("add", "update", "remove", "move", "reorder")
+Z_FIELD = "z"
+MAX_REPLICA_LENGTH = 64
+# Client counters further ahead of the document clock are rejected: one would win every write after it
+MAX_CLOCK_JUMP = 1_000_000
+
+# Stamps ops that arrive without a timestamp (REST, older clients), unique per process
+SERVER_REPLICA = f"s{uuid.uuid4().hex[:8]}"
+
+def parse_timestamp(value: Any) -> Timestamp:
+    if (
+        isinstance(value, (list, tuple)) and len(value) == 2
+        and isinstance(value[0], int) and not isinstance(value[0], bool) and value[0] >= 0
+        and isinstance(value[1], str) and 0 < len(value[1]) <= MAX_REPLICA_LENGTH
+    ):
+        return value[0], value[1]
+    raise DiagramOperationError("ts must be [counter, replica id]")
+
+def parse_vector(value: Any) -> Dict[str, int]:
+    """A state vector ({replica id: highest counter seen}) from a client"""
+    if not isinstance(value, dict) or not all(
+        isinstance(replica, str) and isinstance(counter, int) and not isinstance(counter, bool)
+        for replica, counter in value.items()
+    ):
+        raise DiagramOperationError("vector must map replica ids to counters")
+    return value
+
+def covered(ts: Timestamp, vector: Dict[str, int]) -> bool:
+    """Whether a replica with this state vector has already seen the write stamped `ts`"""
+    return ts[0] <= vector.get(ts[1], 0)
+
+def _z(element: Dict[str, Any]) -> Optional[float]:
+    z = element.get(Z_FIELD)
+    return float(z) if isinstance(z, (int, float)) and not isinstance(z, bool) and math.isfinite(z) else None
+
+def z_order(elements: List[Any]) -> List[Any]:
+    """Elements bottom to top: by `z` when the collection uses it (ties by id), else in array order"""
+    if not any(isinstance(element, dict) and _z(element) is not None for element in elements):
+        return list(elements)
+    return sorted(elements, key=lambda element: (
+        (_z(element) or 0.0, str(element.get("id"))) if isinstance(element, dict) else (0.0, "")
+    ))
+
+class DiagramCrdt:
+    """Merge state for one live document: ops from any replica, in any order, converge.
+
+    Every element field is a last-writer-wins register ordered by Lamport timestamp; fields
+    not written since the document was loaded (or the element was added) take the element's
+    add timestamp, ZERO for loaded ones. Removal leaves a tombstone that updates never undo;
+    only an add stamped after it brings the id back. A relative move is resolved into absolute
+    x/y writes, so it merges like any other field.
+
+    Z-order is a sequence of fractional `z` positions (ties broken by id): a reorder writes
+    one element's register with a position between its new neighbours, so concurrent
+    reorders never shift anything else. Diagrams get positions on their first reorder.
+
+    `vector` records the highest counter seen per replica. A client that fell behind sends
+    its own and gets back delta(): only the writes it has not seen. `base` names this state:
+    a vector taken against another base (the document was reloaded or replaced) is
+    meaningless, and such a client needs a snapshot instead.
+    """
+
+    def __init__(self, replica: str = SERVER_REPLICA):
+        self.replica = replica
+        self.base = uuid.uuid4().hex[:12]
+        self.clock = 0
+        self.vector: Dict[str, int] = {}
+        # Field timestamps that differ from the element's add timestamp
+        self.registers: Dict[ElementKey, Dict[str, Timestamp]] = {}
+        self.added: Dict[ElementKey, Timestamp] = {}
+        self.removed: Dict[ElementKey, Timestamp] = {}
+        # Highest z per collection; computed on first use, None while a collection has no positions
+        self.max_z: Dict[str, Optional[float]] = {}
+
+    def merge(
+        self, document: DiagramDocument, operations: List[Dict[str, Any]], strict: bool = False
+    ) -> Tuple[List[Dict[str, Any]], bool]:
+        """Apply what survives of `operations` to `document`; returns those ops, stamped, and whether they are exact.
+
+        Not exact means some were rewritten (moves, reorders, re-adds) and the sender should
+        apply the result rather than its own version. `strict` keeps the checks plain batches
+        have always had: ops on missing elements and duplicate adds raise DiagramOperationError
+        instead of losing the merge.
+        """
+        batch = _Batch(self, document, strict)
+        for position, operation in enumerate(operations):
+            batch.resolve(position, operation)
+        # Validates the whole batch before changing anything; merge state is only committed after
+        document.apply(batch.operations)
+        batch.commit()
+        return batch.operations, batch.exact
+
+    def delta(self, document: DiagramDocument, vector: Dict[str, int]) -> List[Dict[str, Any]]:
+        """Ops carrying every write a replica with `vector` has not seen, with their timestamps"""
+        operations = []
+        full = set()
+        for key, ts in self.added.items():
+            element = document.get(*key)
+            if element is not None and not covered(ts, vector):
+                operations.append({"op": "add", "collection": key[0], "element": element, "ts": list(ts)})
+                full.add(key)
+        for key, registers in self.registers.items():
+            element = document.get(*key)
+            if element is None or key in full:
+                continue
+            by_ts: Dict[Timestamp, Dict[str, Any]] = {}
+            for field, ts in registers.items():
+                if field in element and not covered(ts, vector):
+                    by_ts.setdefault(ts, {})[field] = element[field]
+            operations.extend(
+                {"op": "update", "collection": key[0], "id": key[1], "changes": changes, "ts": list(ts)}
+                for ts, changes in sorted(by_ts.items())
+            )
+        operations.extend(
+            {"op": "remove", "collection": key[0], "id": key[1], "ts": list(ts)}
+            for key, ts in self.removed.items() if not covered(ts, vector)
+        )
+        return operations
+
+class _Batch:
+    """One merge in progress: changes stay in overlays until the document has accepted the batch"""
+
+    def __init__(self, crdt: DiagramCrdt, document: DiagramDocument, strict: bool):
+        self.crdt = crdt
+        self.document = document
+        self.strict = strict
+        self.clock = crdt.clock
+        self.vector: Dict[str, int] = {}
+        # None marks an element removed by this batch
+        self.elements: Dict[ElementKey, Optional[Dict[str, Any]]] = {}
+        self.registers: Dict[ElementKey, Dict[str, Timestamp]] = {}
+        self.added: Dict[ElementKey, Timestamp] = {}
+        self.removed: Dict[ElementKey, Timestamp] = {}
+        self.max_z: Dict[str, Optional[float]] = {}
+        self.operations: List[Dict[str, Any]] = []
+        self.exact = True
+
+    def commit(self):
+        crdt = self.crdt
+        crdt.clock = self.clock
+        for replica, counter in self.vector.items():
+            crdt.vector[replica] = max(crdt.vector.get(replica, 0), counter)
+        for key, ts in self.removed.items():
+            crdt.removed[key] = ts
+            crdt.added.pop(key, None)
+            crdt.registers.pop(key, None)
+        for key, ts in self.added.items():
+            crdt.added[key] = ts
+            crdt.removed.pop(key, None)
+            crdt.registers.pop(key, None)
+        for key, registers in self.registers.items():
+            if key not in self.removed:
+                crdt.registers[key] = registers
+        crdt.max_z.update(self.max_z)
+
+    # Lookups through the overlays
+
+    def element(self, key: ElementKey) -> Optional[Dict[str, Any]]:
+        if key in self.elements:
+            return self.elements[key]
+        return self.document.get(*key)
+
+    def added_ts(self, key: ElementKey) -> Timestamp:
+        if key in self.added:
+            return self.added[key]
+        return ZERO if key in self.removed else self.crdt.added.get(key, ZERO)
+
+    def removed_ts(self, key: ElementKey) -> Optional[Timestamp]:
+        if key in self.added:
+            return None
+        return self.removed.get(key, self.crdt.removed.get(key))
+
+    def field_registers(self, key: ElementKey) -> Dict[str, Timestamp]:
+        registers = self.registers.get(key)
+        if registers is None:
+            inherited = {} if key in self.added or key in self.removed else self.crdt.registers.get(key, {})
+            registers = self.registers[key] = dict(inherited)
+        return registers
+
+    def collection(self, collection: str) -> Iterator[Dict[str, Any]]:
+        """Present elements of a collection in array order, batch changes included"""
+        seen = set()
+        for element in self.document.data[collection]:
+            if isinstance(element, dict) and "id" in element:
+                key = (collection, element["id"])
+                seen.add(key)
+                element = self.elements.get(key, element)
+            if element is not None:
+                yield element
+        for key, element in self.elements.items():
+            if key[0] == collection and key not in seen and element is not None:
+                yield element
+
+    def attached_to_removed(self, connection: Dict[str, Any]) -> bool:
+        for end in connection_endpoints(connection):
+            try:
+                if self.removed_ts(("shapes", end)) is not None and self.element(("shapes", end)) is None:
+                    return True
+            except TypeError:
+                continue  # Unhashable endpoint: it cannot name a shape
+        return False
+
+    def highest_z(self, collection: str) -> Optional[float]:
+        if collection in self.max_z:
+            return self.max_z[collection]
+        if collection not in self.crdt.max_z:
+            self.crdt.max_z[collection] = max(
+                (z for z in (_z(element) for element in self.document.data[collection] if isinstance(element, dict))
+                 if z is not None),
+                default=None
+            )
+        return self.crdt.max_z[collection]
+
+    def saw_z(self, collection: str, z: Any):
+        if isinstance(z, (int, float)) and not isinstance(z, bool) and math.isfinite(z):
+            current = self.highest_z(collection)
+            self.max_z[collection] = z if current is None else max(current, z)
+
+    # Resolution
+
+    def timestamp(self, operation: Dict[str, Any], position: int) -> Timestamp:
+        if "ts" not in operation:
+            self.clock += 1
+            ts = (self.clock, self.crdt.replica)
+        else:
+            try:
+                ts = parse_timestamp(operation["ts"])
+            except DiagramOperationError as e:
+                raise DiagramOperationError(f"Operation {position}: {e}")
+            if ts[0] > self.clock + MAX_CLOCK_JUMP:
+                raise DiagramOperationError(f"Operation {position}: ts counter is too far ahead")
+            self.clock = max(self.clock, ts[0])
+        self.vector[ts[1]] = max(self.vector.get(ts[1], 0), ts[0])
+        return ts
+
+    def missing(self, position: int, key: ElementKey):
+        if self.strict:
+            raise DiagramOperationError(f"Operation {position}: element {key[1]} not found")
+
+    def resolve(self, position: int, operation: Any):
+        if not isinstance(operation, dict) or operation.get("op") not in MERGE_OPERATION_TYPES:
+            raise DiagramOperationError(f"Operation {position}: unknown op")
+        collection = operation.get("collection", "shapes")
+        if collection not in ELEMENT_COLLECTIONS:
+            raise DiagramOperationError(f"Operation {position}: unknown collection '{collection}'")
+        if operation["op"] == "add":
+            element = operation.get("element")
+            if not isinstance(element, dict) or "id" not in element:
+                raise DiagramOperationError(f"Operation {position}: add requires an element with an id")
+            key = (collection, element["id"])
+        else:
+            key = (collection, operation.get("id"))
+        try:
+            hash(key)
+        except TypeError:
+            raise DiagramOperationError(f"Operation {position}: element ids must be strings or numbers")
+        getattr(self, f"_resolve_{operation['op']}")(position, operation, key, self.timestamp(operation, position))
+
+    def _resolve_add(self, position: int, operation: Dict[str, Any], key: ElementKey, ts: Timestamp):
+        element = dict(operation["element"])
+        if self.element(key) is not None:
+            if self.strict:
+                raise DiagramOperationError(f"Operation {position}: element {key[1]} already exists")
+            # Two replicas added the same id: its fields merge like concurrent updates
+            self.exact = False
+            self.write(key, {field: value for field, value in element.items() if field != "id"}, ts)
+            return
+        removed = self.removed_ts(key)
+        if removed is not None and removed > ts:
+            return  # Removed by a later write
+        if key[0] == "connections" and self.attached_to_removed(element):
+            # Removing a shape takes its connections along, whichever arrives first
+            if self.strict:
+                raise DiagramOperationError(f"Operation {position}: connection {key[1]} is attached to a removed shape")
+            return
+        highest = self.highest_z(key[0])
+        if highest is not None and _z(element) is None:
+            # The collection is z-ordered: new elements go on top, as appending does without positions
+            element[Z_FIELD] = math.floor(highest) + 1
+            self.exact = False
+        self.saw_z(key[0], element.get(Z_FIELD))
+        self.elements[key] = element
+        self.added[key] = ts
+        self.removed.pop(key, None)
+        self.registers.pop(key, None)
+        self.operations.append({"op": "add", "collection": key[0], "element": element, "ts": list(ts)})
+
+    def _resolve_update(self, position: int, operation: Dict[str, Any], key: ElementKey, ts: Timestamp):
+        if not isinstance(operation.get("changes"), dict):
+            raise DiagramOperationError(f"Operation {position}: update requires a changes object")
+        if self.element(key) is None:
+            self.missing(position, key)
+            return
+        self.write(key, {field: value for field, value in operation["changes"].items() if field != "id"}, ts)
+
+    def _resolve_move(self, position: int, operation: Dict[str, Any], key: ElementKey, ts: Timestamp):
+        for axis in ("dx", "dy"):
+            if not isinstance(operation.get(axis, 0), (int, float)):
+                raise DiagramOperationError(f"Operation {position}: {axis} must be a number")
+        current = self.element(key)
+        if current is None:
+            self.missing(position, key)
+            return
+        try:
+            changes = {"x": current.get("x", 0) + operation.get("dx", 0), "y": current.get("y", 0) + operation.get("dy", 0)}
+        except TypeError:
+            raise DiagramOperationError(f"Operation {position}: element {key[1]} has no numeric position")
+        self.exact = False
+        self.write(key, changes, ts)
+
+    def _resolve_remove(self, position: int, operation: Dict[str, Any], key: ElementKey, ts: Timestamp):
+        if self.element(key) is None:
+            self.missing(position, key)
+            return
+        if self.added_ts(key) > ts:
+            return  # Re-added by a later write
+        self.tombstone(key, ts)
+        if key[0] == "shapes":
+            # The document drops the connections attached to a removed shape; they get tombstones too
+            for connection in list(self.collection("connections")):
+                if "id" in connection and key[1] in connection_endpoints(connection):
+                    self.tombstone(("connections", connection["id"]), ts)
+        self.operations.append({"op": "remove", "collection": key[0], "id": key[1], "ts": list(ts)})
+
+    def _resolve_reorder(self, position: int, operation: Dict[str, Any], key: ElementKey, ts: Timestamp):
+        """Move an element directly above `after` (to the bottom when it is absent or null)"""
+        if self.element(key) is None:
+            self.missing(position, key)
+            return
+        collection = key[0]
+        self.exact = False
+        if self.highest_z(collection) is None:
+            self.renumber(collection, list(self.collection(collection)), ts)
+        order = [element for element in z_order(list(self.collection(collection))) if element.get("id") != key[1]]
+        index = 0
+        after = operation.get("after")
+        if after is not None:
+            index = next((i + 1 for i, element in enumerate(order) if element.get("id") == after), None)
+            if index is None:
+                self.missing(position, (collection, after))
+                return
+        below = _z(order[index - 1]) if index > 0 else None
+        above = _z(order[index]) if index < len(order) else None
+        if below is None and above is None:
+            z = 1.0
+        elif below is None:
+            z = above - 1
+        elif above is None:
+            z = math.floor(below) + 1
+        else:
+            z = (below + above) / 2
+            if not below < z < above:
+                # Out of float precision between these two: respace the whole collection first
+                self.renumber(collection, order, ts)
+                z = index + 0.5
+        self.write(key, {Z_FIELD: z}, ts)
+
+    def renumber(self, collection: str, order: List[Dict[str, Any]], ts: Timestamp):
+        """Give every element in `order` an integer z position, bottom to top"""
+        for z, element in enumerate(order, 1):
+            if "id" in element and _z(element) != z:
+                self.write((collection, element["id"]), {Z_FIELD: z}, ts)
+
+    def write(self, key: ElementKey, changes: Dict[str, Any], ts: Timestamp):
+        """LWW: keep the fields whose register is not newer than `ts`, and emit them as an update"""
+        registers = self.field_registers(key)
+        default = self.added_ts(key)
+        kept = {field: value for field, value in changes.items() if ts >= registers.get(field, default)}
+        if not kept:
+            return
+        for field in kept:
+            registers[field] = ts
+        self.elements[key] = {**self.element(key), **kept}
+        if Z_FIELD in kept:
+            self.saw_z(key[0], kept[Z_FIELD])
+        self.operations.append({"op": "update", "collection": key[0], "id": key[1], "changes": kept, "ts": list(ts)})
+
+    def tombstone(self, key: ElementKey, ts: Timestamp):
+        self.elements[key] = None
+        self.removed[key] = ts
+        self.added.pop(key, None)
+        self.registers.pop(key, None)
@@ -0,0 +1,125 @@
+import asyncio
+from typing import Any, Dict, List, Optional, Tuple
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.core.config import settings
+from app.models.diagram_history import DiagramCheckpoint, DiagramRevision
+from app.services.blob_store import blob_store
+from app.services.diagram_ops import DiagramDocument
+
+# Revision kinds. "ops" and "save" carry a replayable op batch; the others are checkpointed.
+REVISION_BASELINE = "baseline"  # First recorded version of a diagram created before history existed
+REVISION_CREATE = "create"
+REVISION_OPS = "ops"  # PATCH or collaboration room batch
+REVISION_SAVE = "save"  # PUT whose new data could be expressed as ops
+REVISION_REPLACE = "replace"  # PUT whose new data could not
+REPLAYABLE_KINDS = (REVISION_OPS, REVISION_SAVE)
+
+class VersionUnavailable(Exception):
+    """Raised when a requested version is outside the recorded history"""
+
+def operation_cost(operations: Optional[List[Dict[str, Any]]]) -> int:
+    """Replay cost a revision adds towards the next checkpoint; empty batches still count"""
+    return max(1, len(operations or ()))
+
+def needs_checkpoint(kind: str, ops_since_checkpoint: int) -> bool:
+    return kind not in REPLAYABLE_KINDS or ops_since_checkpoint >= settings.DIAGRAM_CHECKPOINT_INTERVAL
+
+def revision_row(diagram_id: int, version: int, kind: str, operations=None, user_id: Optional[int] = None) -> Dict[str, Any]:
+    return {
+        "diagram_id": diagram_id,
+        "version": version,
+        "kind": kind,
+        "operations": operations,
+        "op_count": len(operations or ()),
+        "user_id": user_id
+    }
+
+def checkpoint_row(diagram_id: int, version: int, data: Dict[str, Any]) -> Dict[str, Any]:
+    return {"diagram_id": diagram_id, "version": version, "data": data, "data_blob": None}
+
+async def stored_checkpoints(db: AsyncSession, rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Checkpoint rows as written: snapshots reaching BLOB_MIN_BYTES move to the blob store, leaving data empty"""
+    stored = []
+    for row in rows:
+        blob = await blob_store.put_json(db, row["data"])
+        stored.append({**row, "data": {}, "data_blob": blob["digest"]} if blob else row)
+    return stored
+
+async def history_state(db: AsyncSession, diagram_id: int) -> Tuple[Optional[int], int]:
+    """(latest checkpoint version or None, replay cost of the revisions after it)"""
+    checkpoint = await db.scalar(
+        select(func.max(DiagramCheckpoint.version)).where(DiagramCheckpoint.diagram_id == diagram_id)
+    )
+    if checkpoint is None:
+        return None, 0
+    rows = await db.execute(
+        select(DiagramRevision.op_count)
+        .where(DiagramRevision.diagram_id == diagram_id, DiagramRevision.version > checkpoint)
+    )
+    return checkpoint, sum(max(1, count) for count in rows.scalars())
+
+async def record_revision(
+    db: AsyncSession,
+    diagram_id: int,
+    version: int,
+    kind: str,
+    data: Dict[str, Any],
+    operations: Optional[List[Dict[str, Any]]] = None,
+    user_id: Optional[int] = None,
+    previous: Optional[Tuple[int, Dict[str, Any]]] = None
+) -> int:
+    """Add the revision producing `version` (and any checkpoint it triggers) to the session.
+
+    `data` is the diagram at `version`; `previous` is (version, data) before the change and
+    becomes the baseline when the diagram has no history yet. Nothing is committed here, so
+    the history lands in the same transaction as the diagram write. Returns the replay cost
+    accumulated since the latest checkpoint.
+    """
+    checkpoint, since = await history_state(db, diagram_id)
+    if checkpoint is None and previous is not None:
+        db.add(DiagramRevision(**revision_row(diagram_id, previous[0], REVISION_BASELINE)))
+        baseline, = await stored_checkpoints(db, [checkpoint_row(diagram_id, *previous)])
+        db.add(DiagramCheckpoint(**baseline))
+        since = 0
+
+    db.add(DiagramRevision(**revision_row(diagram_id, version, kind, operations, user_id)))
+    since += operation_cost(operations) if kind in REPLAYABLE_KINDS else 0
+    if needs_checkpoint(kind, since):
+        snapshot, = await stored_checkpoints(db, [checkpoint_row(diagram_id, version, data)])
+        db.add(DiagramCheckpoint(**snapshot))
+        since = 0
+    return since
+
+def _replay(data: Dict[str, Any], batches: List[List[Dict[str, Any]]]) -> Dict[str, Any]:
+    document = DiagramDocument(data)
+    for operations in batches:
+        document.apply(operations)
+    return document.data
+
+async def load_version(db: AsyncSession, diagram_id: int, version: int) -> Dict[str, Any]:
+    """Diagram data at `version`: one checkpoint read plus at most one checkpoint interval of replay"""
+    checkpoint = (await db.execute(
+        select(DiagramCheckpoint.version, DiagramCheckpoint.data, DiagramCheckpoint.data_blob)
+        .where(DiagramCheckpoint.diagram_id == diagram_id, DiagramCheckpoint.version <= version)
+        .order_by(DiagramCheckpoint.version.desc(), DiagramCheckpoint.id.desc())
+        .limit(1)
+    )).first()
+    if checkpoint is None:
+        raise VersionUnavailable(f"Version {version} is not in this diagram's history")
+
+    revisions = (await db.execute(
+        select(DiagramRevision.version, DiagramRevision.kind, DiagramRevision.operations)
+        .where(
+            DiagramRevision.diagram_id == diagram_id,
+            DiagramRevision.version > checkpoint.version,
+            DiagramRevision.version <= version
+        )
+        .order_by(DiagramRevision.version)
+    )).all()
+    # A gap means a revision is not written yet (another process has not flushed it)
+    expected = list(range(checkpoint.version + 1, version + 1))
+    if [row.version for row in revisions] != expected or any(row.kind not in REPLAYABLE_KINDS for row in revisions):
+        raise VersionUnavailable(f"Version {version} cannot be reconstructed yet")
+    data = await blob_store.read_json(checkpoint.data_blob) if checkpoint.data_blob else checkpoint.data
+    return await asyncio.to_thread(_replay, data, [row.operations or [] for row in revisions])
@@ -0,0 +1,347 @@
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+import hashlib
+import json
+from app.core.config import settings
+
+# Longest id list reported per finding; counts are always exact
+MAX_REPORTED_IDS = 100
+
+DECISION_TYPES = {"diamond", "decision", "rhombus", "condition"}
+TERMINAL_TYPES = {"terminator", "start", "end", "oval"}
+
+# Shape and connection vocabularies that vote for a diagram type
+TYPE_VOCABULARY = {
+    "flowchart": {
+        "shapes": {"process", "rectangle", "parallelogram", "data", "io", "document", "subprocess"}
+                  | DECISION_TYPES | TERMINAL_TYPES,
+        "connections": {"arrow", "flow"}
+    },
+    "state_machine": {
+        "shapes": {"state", "initial", "final", "initial_state", "final_state", "choice"},
+        "connections": {"transition"}
+    },
+    "er": {
+        "shapes": {"entity", "table", "attribute", "relationship", "weak_entity"},
+        "connections": {"one-to-one", "one-to-many", "many-to-one", "many-to-many", "relation", "association"}
+    },
+    "sequence": {
+        "shapes": {"lifeline", "actor", "participant", "activation", "object"},
+        "connections": {"message", "sync", "async", "return", "reply"}
+    },
+    "tree": {
+        "shapes": {"node", "root", "leaf"},
+        "connections": set()
+    }
+}
+
+def _voters(part: str) -> Dict[str, List[str]]:
+    voters: Dict[str, List[str]] = {}
+    for diagram_type, vocabulary in TYPE_VOCABULARY.items():
+        for kind in vocabulary[part]:
+            voters.setdefault(kind, []).append(diagram_type)
+    return voters
+
+SHAPE_VOTERS = _voters("shapes")
+CONNECTION_VOTERS = _voters("connections")
+
+def _endpoints(connection: Dict[str, Any]):
+    return connection.get("source", connection.get("from")), connection.get("target", connection.get("to"))
+
+def _hashable(value: Any) -> bool:
+    try:
+        hash(value)
+    except TypeError:
+        return False
+    return True
+
+def _kind(element: Dict[str, Any]) -> str:
+    return str(element.get("type") or "").strip().lower()
+
+def _label(element: Dict[str, Any]) -> Optional[str]:
+    label = element.get("label", element.get("text"))
+    return str(label) if label not in (None, "") else None
+
+def content_hash(data: Dict[str, Any]) -> str:
+    """Canonical hash of the parts of a diagram the interpreter reads.
+
+    Geometry and styling are left out, so dragging shapes around does not
+    invalidate a cached interpretation.
+    """
+    shapes = [
+        (shape.get("id"), _kind(shape), _label(shape))
+        for shape in data.get("shapes") or [] if isinstance(shape, dict)
+    ]
+    connections = [
+        (*_endpoints(connection), _kind(connection), _label(connection), connection.get("cardinality"))
+        for connection in data.get("connections") or [] if isinstance(connection, dict)
+    ]
+    canonical = json.dumps([shapes, connections], separators=(",", ":"), sort_keys=True, default=str)
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+class DiagramGraph:
+    """Adjacency index over shapes (nodes) and connections (directed edges)"""
+
+    def __init__(self, data: Dict[str, Any]):
+        self.nodes: List[Dict[str, Any]] = []
+        self.ids: List[Any] = []
+        self.kinds: List[str] = []
+        self.position: Dict[Any, int] = {}
+        for shape in data.get("shapes") or []:
+            # A list or dict id cannot name a node (and could not be looked up if it did)
+            if isinstance(shape, dict) and "id" in shape and _hashable(shape["id"]) and shape["id"] not in self.position:
+                self.position[shape["id"]] = len(self.nodes)
+                self.nodes.append(shape)
+                self.ids.append(shape["id"])
+                self.kinds.append(_kind(shape))
+
+        count = len(self.nodes)
+        self.outgoing: List[List[int]] = [[] for _ in range(count)]
+        self.incoming: List[List[int]] = [[] for _ in range(count)]
+        self.out_edges: List[List[Dict[str, Any]]] = [[] for _ in range(count)]
+        self.edges: List[Dict[str, Any]] = []
+        self.edge_kinds: List[str] = []
+        self.dangling = 0
+        position = self.position
+        for connection in data.get("connections") or []:
+            if not isinstance(connection, dict):
+                continue
+            source, target = _endpoints(connection)
+            if not (_hashable(source) and _hashable(target)):
+                self.dangling += 1
+                continue
+            source, target = position.get(source), position.get(target)
+            if source is None or target is None:
+                self.dangling += 1
+                continue
+            self.outgoing[source].append(target)
+            self.incoming[target].append(source)
+            self.out_edges[source].append(connection)
+            self.edges.append(connection)
+            self.edge_kinds.append(_kind(connection))
+
+    def components(self) -> List[List[int]]:
+        """Weakly connected components, each in discovery order"""
+        seen = [False] * len(self.nodes)
+        components = []
+        for start in range(len(self.nodes)):
+            if seen[start]:
+                continue
+            seen[start] = True
+            component, stack = [], [start]
+            while stack:
+                node = stack.pop()
+                component.append(node)
+                for neighbour in self.outgoing[node] + self.incoming[node]:
+                    if not seen[neighbour]:
+                        seen[neighbour] = True
+                        stack.append(neighbour)
+            components.append(component)
+        return components
+
+    def cycles(self) -> List[List[int]]:
+        """Strongly connected components that contain a cycle (iterative Tarjan)"""
+        count = len(self.nodes)
+        index = [-1] * count
+        lowlink = [0] * count
+        on_stack = [False] * count
+        stack: List[int] = []
+        found = []
+        counter = 0
+        for root in range(count):
+            if index[root] != -1:
+                continue
+            work = [(root, 0)]
+            while work:
+                node, edge = work.pop()
+                if edge == 0:
+                    index[node] = lowlink[node] = counter
+                    counter += 1
+                    stack.append(node)
+                    on_stack[node] = True
+                recurse = False
+                successors = self.outgoing[node]
+                while edge < len(successors):
+                    successor = successors[edge]
+                    edge += 1
+                    if index[successor] == -1:
+                        work.append((node, edge))
+                        work.append((successor, 0))
+                        recurse = True
+                        break
+                    if on_stack[successor]:
+                        lowlink[node] = min(lowlink[node], index[successor])
+                if recurse:
+                    continue
+                if lowlink[node] == index[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack[member] = False
+                        component.append(member)
+                        if member == node:
+                            break
+                    if len(component) > 1 or node in successors:
+                        found.append(component[::-1])
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+        return found
+
+class DiagramInterpreter:
+    """Structural interpretation of a diagram in time linear in shapes + connections"""
+
+    def interpret(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        graph = DiagramGraph(data)
+        components = graph.components()
+        cycles = graph.cycles()
+        node_count = len(graph.nodes)
+
+        orphans = [
+            node for node in range(node_count)
+            if not graph.outgoing[node] and not graph.incoming[node]
+        ] if node_count > 1 else []
+        diagram_type, confidence = self._classify(graph, components, cycles)
+
+        decisions = [
+            node for node in range(node_count)
+            if graph.kinds[node] in DECISION_TYPES
+            or (diagram_type in ("flowchart", "state_machine") and len(graph.outgoing[node]) >= 2)
+        ]
+        entry_points = [node for node in range(node_count) if not graph.incoming[node] and graph.outgoing[node]]
+        exit_points = [node for node in range(node_count) if graph.incoming[node] and not graph.outgoing[node]]
+        connected = [component for component in components if len(component) > 1]
+
+        findings = {
+            "diagram_type": diagram_type,
+            "confidence": confidence,
+            "node_count": node_count,
+            "edge_count": len(graph.edges),
+            "dangling_connections": graph.dangling,
+            "decision_points": self._ids(graph, decisions),
+            "decision_point_count": len(decisions),
+            "entry_points": self._ids(graph, entry_points),
+            "exit_points": self._ids(graph, exit_points),
+            "cycles": [self._ids(graph, cycle) for cycle in cycles[:MAX_REPORTED_IDS]],
+            "cycle_count": len(cycles),
+            "orphan_nodes": self._ids(graph, orphans),
+            "orphan_count": len(orphans),
+            "component_count": len(connected) + len(orphans),
+            "components": [self._ids(graph, component) for component in connected[:MAX_REPORTED_IDS]]
+        }
+        findings["detected_elements"] = self._detected_elements(findings)
+        findings["suggestions"] = self._suggestions(graph, findings, cycles)
+        return findings
+
+    @staticmethod
+    def _ids(graph: DiagramGraph, nodes: List[int]) -> List[Any]:
+        return [graph.ids[node] for node in nodes[:MAX_REPORTED_IDS]]
+
+    @staticmethod
+    def _classify(graph: DiagramGraph, components, cycles):
+        """Vote with shape/connection vocabularies, then let graph structure break ties"""
+        votes = {diagram_type: 0.0 for diagram_type in TYPE_VOCABULARY}
+        for kinds, voters in ((graph.kinds, SHAPE_VOTERS), (graph.edge_kinds, CONNECTION_VOTERS)):
+            for kind in kinds:
+                for diagram_type in voters.get(kind, ()):
+                    votes[diagram_type] += 1
+        votes["er"] += sum(1 for edge in graph.edges if edge.get("cardinality"))
+
+        node_count, edge_count = len(graph.nodes), len(graph.edges)
+        if node_count > 1 and edge_count:
+            weight = 0.5 * node_count
+            roots = sum(1 for node in range(node_count) if not graph.incoming[node])
+            is_tree = (
+                edge_count == node_count - 1 and len(components) == 1 and not cycles and roots == 1
+                and all(len(parents) <= 1 for parents in graph.incoming)
+            )
+            if is_tree:
+                votes["tree"] += weight
+            labelled = sum(1 for edge in graph.edges if _label(edge))
+            if cycles and labelled >= edge_count / 2:
+                votes["state_machine"] += weight
+            elif not cycles:
+                votes["flowchart"] += weight / 2
+
+        total = sum(votes.values())
+        if total == 0:
+            return "flowchart", 0.3
+        diagram_type = max(votes, key=lambda name: (votes[name], name == "flowchart"))
+        return diagram_type, round(min(0.5 + 0.5 * votes[diagram_type] / total, 0.99), 2)
+
+    @staticmethod
+    def _detected_elements(findings: Dict[str, Any]) -> List[str]:
+        elements = []
+        if findings["decision_point_count"]:
+            elements.append("decision points")
+        if findings["edge_count"]:
+            elements.append("flows" if findings["diagram_type"] == "flowchart" else "connections")
+        if findings["cycle_count"]:
+            elements.append("cycles")
+        if findings["orphan_count"]:
+            elements.append("orphan nodes")
+        return elements
+
+    @staticmethod
+    def _suggestions(graph: DiagramGraph, findings: Dict[str, Any], cycles: List[List[int]]) -> List[str]:
+        suggestions = []
+        if findings["orphan_count"]:
+            suggestions.append(f"Connect or remove {findings['orphan_count']} shapes that have no connections")
+        if findings["dangling_connections"]:
+            suggestions.append(f"Fix {findings['dangling_connections']} connections that point at missing shapes")
+        if findings["component_count"] > 1 and findings["node_count"] > 1:
+            suggestions.append(f"The diagram splits into {findings['component_count']} disconnected parts")
+        if findings["diagram_type"] == "flowchart":
+            endless = sum(1 for cycle in cycles if not any(graph.kinds[node] in DECISION_TYPES for node in cycle))
+            if endless:
+                suggestions.append(f"{endless} loops have no decision that can exit them")
+        if findings["diagram_type"] == "tree" and len(findings["entry_points"]) > 1:
+            suggestions.append("A tree should have a single root")
+        unlabelled = [
+            node for node in range(len(graph.nodes))
+            if graph.kinds[node] in DECISION_TYPES and len(graph.outgoing[node]) >= 2
+            and not all(_label(edge) for edge in graph.out_edges[node])
+        ]
+        if unlabelled:
+            suggestions.append(f"Label the outgoing branches of {len(unlabelled)} decision points")
+        if not any(_label(node) for node in graph.nodes) and graph.nodes:
+            suggestions.append("Consider adding more descriptive labels")
+        return suggestions
+
+class InterpretationCache:
+    """Bounded LRU of interpretations keyed by content hash"""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        result = self._entries.get(key)
+        if result is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return result
+
+    def put(self, key: str, result: Dict[str, Any]):
+        if self.max_size <= 0:
+            return
+        self._entries[key] = result
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0
+        }
+
+diagram_interpreter = DiagramInterpreter()
+interpretation_cache = InterpretationCache(settings.AI_INTERPRET_CACHE_SIZE)
@@ -0,0 +1,217 @@
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+# Top-level keys of Diagram.data that hold id-addressable elements
+ELEMENT_COLLECTIONS = ("shapes", "connections")
+OPERATION_TYPES = ("add", "update", "remove", "move")
+
+class DiagramOperationError(ValueError):
+    """Raised when a batch of operations cannot be applied to a diagram"""
+
+def connection_endpoints(connection: Dict[str, Any]):
+    return (
+        connection.get("source", connection.get("from")),
+        connection.get("target", connection.get("to"))
+    )
+
+class DiagramDocument:
+    """Diagram data with an id index per collection so shape-level ops avoid full scans.
+
+    Elements are treated as immutable: an update replaces the element dict rather
+    than mutating it, so a shallow `snapshot()` is safe to hand to another thread.
+    """
+
+    def __init__(self, data: Dict[str, Any]):
+        self.data = dict(data or {})
+        self._index: Dict[str, Dict[Any, int]] = {}
+        for collection in ELEMENT_COLLECTIONS:
+            elements = list(self.data.get(collection) or [])
+            self.data[collection] = elements
+            self._reindex(collection)
+        # Ids touched / appended since track_changes(), per collection; None while not tracking
+        self.touched: Optional[Dict[str, Set[Any]]] = None
+        self.appended: Optional[Dict[str, Set[Any]]] = None
+
+    def track_changes(self):
+        """Record the element ids later ops touch, so storage can write back just those elements"""
+        self.touched = {collection: set() for collection in ELEMENT_COLLECTIONS}
+        self.appended = {collection: set() for collection in ELEMENT_COLLECTIONS}
+
+    def take_changes(self) -> Tuple[Dict[str, Set[Any]], Dict[str, Set[Any]]]:
+        """(touched, appended) ids since the last call; tracking continues from empty sets"""
+        changes = (self.touched, self.appended)
+        self.track_changes()
+        return changes
+
+    def requeue_changes(self, touched: Dict[str, Set[Any]], appended: Dict[str, Set[Any]]):
+        """Put back changes taken for a write that failed"""
+        for collection in ELEMENT_COLLECTIONS:
+            self.touched[collection] |= touched[collection]
+            self.appended[collection] |= appended[collection]
+
+    def _reindex(self, collection: str, start: int = 0):
+        index = self._index.setdefault(collection, {})
+        if start == 0:
+            index.clear()
+        for position, element in enumerate(self.data[collection][start:], start):
+            if isinstance(element, dict) and "id" in element:
+                index[element["id"]] = position
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Copy of the document that later ops will not mutate"""
+        snapshot = dict(self.data)
+        for collection in ELEMENT_COLLECTIONS:
+            snapshot[collection] = list(self.data[collection])
+        return snapshot
+
+    def get(self, collection: str, element_id: Any):
+        position = self._index.get(collection, {}).get(element_id)
+        return None if position is None else self.data[collection][position]
+
+    def position(self, collection: str, element_id: Any) -> Optional[int]:
+        return self._index.get(collection, {}).get(element_id)
+
+    def apply(self, operations: List[Dict[str, Any]]):
+        """Apply a batch atomically: the whole batch is validated before anything changes"""
+        self._validate(operations)
+        for operation in operations:
+            getattr(self, f"_apply_{operation['op']}")(operation)
+
+    def _validate(self, operations: List[Dict[str, Any]]):
+        present = {collection: set(self._index[collection]) for collection in ELEMENT_COLLECTIONS}
+        for position, operation in enumerate(operations):
+            if not isinstance(operation, dict) or operation.get("op") not in OPERATION_TYPES:
+                raise DiagramOperationError(f"Operation {position}: unknown op")
+            collection = operation.get("collection", "shapes")
+            if collection not in ELEMENT_COLLECTIONS:
+                raise DiagramOperationError(f"Operation {position}: unknown collection '{collection}'")
+
+            if operation["op"] == "add":
+                element = operation.get("element")
+                if not isinstance(element, dict) or "id" not in element:
+                    raise DiagramOperationError(f"Operation {position}: add requires an element with an id")
+                if element["id"] in present[collection]:
+                    raise DiagramOperationError(f"Operation {position}: element {element['id']} already exists")
+                present[collection].add(element["id"])
+                continue
+
+            element_id = operation.get("id")
+            if element_id not in present[collection]:
+                raise DiagramOperationError(f"Operation {position}: element {element_id} not found")
+            if operation["op"] == "update" and not isinstance(operation.get("changes"), dict):
+                raise DiagramOperationError(f"Operation {position}: update requires a changes object")
+            if operation["op"] == "move":
+                for key in ("dx", "dy"):
+                    if not isinstance(operation.get(key, 0), (int, float)):
+                        raise DiagramOperationError(f"Operation {position}: {key} must be a number")
+            if operation["op"] == "remove":
+                present[collection].discard(element_id)
+                if collection == "shapes":
+                    present["connections"] -= {
+                        conn["id"] for conn in self.data["connections"]
+                        if isinstance(conn, dict) and element_id in connection_endpoints(conn) and "id" in conn
+                    }
+
+    def _apply_add(self, operation: Dict[str, Any]):
+        collection = operation.get("collection", "shapes")
+        element = dict(operation["element"])
+        self.data[collection].append(element)
+        self._index[collection][element["id"]] = len(self.data[collection]) - 1
+        if self.touched is not None:
+            self.touched[collection].add(element["id"])
+            self.appended[collection].add(element["id"])
+
+    def _replace(self, collection: str, element_id: Any, element: Dict[str, Any]):
+        self.data[collection][self._index[collection][element_id]] = element
+        if self.touched is not None:
+            self.touched[collection].add(element_id)
+
+    def _apply_update(self, operation: Dict[str, Any]):
+        collection = operation.get("collection", "shapes")
+        changes = dict(operation["changes"])
+        changes.pop("id", None)
+        current = self.get(collection, operation["id"])
+        self._replace(collection, operation["id"], {**current, **changes})
+
+    def _apply_move(self, operation: Dict[str, Any]):
+        collection = operation.get("collection", "shapes")
+        current = self.get(collection, operation["id"])
+        moved = dict(current)
+        moved["x"] = current.get("x", 0) + operation.get("dx", 0)
+        moved["y"] = current.get("y", 0) + operation.get("dy", 0)
+        self._replace(collection, operation["id"], moved)
+
+    def _apply_remove(self, operation: Dict[str, Any]):
+        collection = operation.get("collection", "shapes")
+        self._remove(collection, {operation["id"]})
+        if collection == "shapes":
+            # Drop connections left dangling by the removed shape
+            dangling = {
+                conn["id"] for conn in self.data["connections"]
+                if isinstance(conn, dict) and "id" in conn and operation["id"] in connection_endpoints(conn)
+            }
+            if dangling:
+                self._remove("connections", dangling)
+
+    def _remove(self, collection: str, element_ids: set):
+        index = self._index[collection]
+        first = min(index[element_id] for element_id in element_ids)
+        for element_id in element_ids:
+            del index[element_id]
+        if self.touched is not None:
+            self.touched[collection] |= element_ids
+        elements = self.data[collection]
+        elements[first:] = [
+            element for element in elements[first:]
+            if not (isinstance(element, dict) and element.get("id") in element_ids)
+        ]
+        self._reindex(collection, first)
+
+def apply_operations(data: Dict[str, Any], operations: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Apply shape-level operations to diagram data and return the new data"""
+    document = DiagramDocument(data)
+    document.apply(operations)
+    return document.data
+
+def diff_operations(old: Dict[str, Any], new: Dict[str, Any]) -> Optional[List[Dict[str, Any]]]:
+    """Operations that turn `old` into exactly `new`, or None when ops cannot express the change.
+
+    Anything beyond adds at the end, removals and field changes (reordering, dropped
+    fields, other top-level keys) returns None.
+    """
+    before = DiagramDocument(old)
+    after = DiagramDocument(new)
+    if {k: v for k, v in before.data.items() if k not in ELEMENT_COLLECTIONS} != \
+            {k: v for k, v in after.data.items() if k not in ELEMENT_COLLECTIONS}:
+        return None
+
+    operations: List[Dict[str, Any]] = []
+    added: List[Dict[str, Any]] = []
+    removed_shapes = set()
+    for collection in ELEMENT_COLLECTIONS:
+        if any(not isinstance(e, dict) or "id" not in e for e in before.data[collection] + after.data[collection]):
+            return None
+        for element in before.data[collection]:
+            current = after.get(collection, element["id"])
+            if current is None:
+                if collection == "shapes":
+                    removed_shapes.add(element["id"])
+                # Removing a shape already drops the connections attached to it
+                elif removed_shapes.intersection(connection_endpoints(element)):
+                    continue
+                operations.append({"op": "remove", "collection": collection, "id": element["id"]})
+            elif current != element:
+                if not set(element) <= set(current):
+                    return None
+                changes = {key: value for key, value in current.items() if element.get(key, object()) != value}
+                operations.append({"op": "update", "collection": collection, "id": element["id"], "changes": changes})
+        for element in after.data[collection]:
+            if before.get(collection, element["id"]) is None:
+                added.append({"op": "add", "collection": collection, "element": element})
+    operations.extend(added)
+
+    # Replaying must land exactly on `new`, including element order
+    try:
+        replayed = apply_operations(before.data, operations)
+    except DiagramOperationError:
+        return None
+    return operations if replayed == after.data else None
@@ -0,0 +1,315 @@
+import asyncio
+import json
+from itertools import groupby
+from operator import itemgetter
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Set, Tuple
+from sqlalchemy import and_, bindparam, case, delete, func, insert, or_, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.core.config import settings
+from app.models.diagram import Diagram
+from app.models.diagram_element import DiagramElement
+from app.services.blob_store import blob_store
+from app.services.diagram_ops import ELEMENT_COLLECTIONS, DiagramDocument
+from app.services.spatial_index import shape_bounds
+
+# Diagram.storage values
+STORAGE_JSON = "json"
+STORAGE_ELEMENTS = "elements"
+STORAGE_BLOB = "blob"  # Not chosen directly: json data whose encoding reaches BLOB_MIN_BYTES is kept here
+STORAGES = (STORAGE_JSON, STORAGE_ELEMENTS)
+
+# Keys per IN (...) list, well under SQLite's bound-parameter limit
+KEY_CHUNK_SIZE = 500
+
+elements = DiagramElement.__table__
+_BOUNDS = ("min_x", "min_y", "max_x", "max_y")
+# Rewritten when an upsert hits an existing row; position stays so the element keeps its place
+_UPSERT_COLUMNS = _BOUNDS + ("source_key", "target_key", "payload")
+
+class ElementChanges(NamedTuple):
+    """Element rows to delete and upsert for one diagram, plus the tracked ids they came from"""
+    diagram_id: int
+    touched: Dict[str, Set[Any]]
+    appended: Dict[str, Set[Any]]
+    deletes: List[Dict[str, Any]]
+    upserts: List[Dict[str, Any]]
+
+def element_key(element_id: Any) -> str:
+    """Stored form of an element id; JSON keeps 1 and "1" apart"""
+    return json.dumps(element_id, separators=(",", ":"), ensure_ascii=False)
+
+def element_row(diagram_id: int, collection: str, element: Dict[str, Any], position: int) -> Dict[str, Any]:
+    row = dict.fromkeys(_BOUNDS + ("source_key", "target_key"))
+    row.update(
+        diagram_id=diagram_id,
+        collection=collection,
+        element_key=element_key(element["id"]),
+        position=position,
+        payload=json.dumps(element, separators=(",", ":"), ensure_ascii=False)
+    )
+    if collection == "shapes":
+        bounds = shape_bounds(element)
+        if bounds is not None:
+            row.update(zip(_BOUNDS, bounds))
+    else:
+        for column, end in (("source_key", element.get("source", element.get("from"))),
+                            ("target_key", element.get("target", element.get("to")))):
+            if end is not None:
+                row[column] = element_key(end)
+    return row
+
+def split_data(data: Optional[Dict[str, Any]]) -> Optional[Tuple[Dict[str, Any], Dict[str, List[Dict[str, Any]]]]]:
+    """(the data without its elements, elements per collection), or None if some element cannot be keyed.
+
+    Collections present in the data stay in the remainder as empty lists, so reassembly
+    gives back exactly the keys that were stored.
+    """
+    rest = dict(data or {})
+    collections = {}
+    for collection in ELEMENT_COLLECTIONS:
+        if collection not in rest:
+            continue
+        items = rest[collection]
+        if not isinstance(items, list):
+            return None
+        seen = set()
+        for element in items:
+            if not isinstance(element, dict) or "id" not in element:
+                return None
+            try:
+                if element["id"] in seen:
+                    return None
+                seen.add(element["id"])
+            except TypeError:
+                return None
+        collections[collection] = items
+        rest[collection] = []
+    return rest, collections
+
+def _assemble(rest: Dict[str, Any], payloads: Dict[str, List[str]]) -> Dict[str, Any]:
+    data = dict(rest)
+    for collection, texts in payloads.items():
+        # One parse per collection instead of one per element
+        data[collection] = json.loads("[" + ",".join(texts) + "]")
+    return data
+
+def blob_digest(storage: str, data: Optional[Dict[str, Any]]) -> Optional[str]:
+    """Digest a blob-stored diagram's data column points at, else None"""
+    return data["digest"] if storage == STORAGE_BLOB and data else None
+
+async def stored_form(db: AsyncSession, data: Dict[str, Any]) -> Tuple[str, Dict[str, Any]]:
+    """(storage, data column) for keeping `data` whole: inline, or as a blob reference when it is large"""
+    blob = await blob_store.put_json(db, data)
+    return (STORAGE_BLOB, blob) if blob else (STORAGE_JSON, data)
+
+async def load_many(db: AsyncSession, rows: Iterable[Tuple[int, str, Dict[str, Any]]]) -> Dict[int, Dict[str, Any]]:
+    """Full data per diagram from (id, storage, stored data) rows, reading all element rows in one query"""
+    stored = {diagram_id: (storage, data) for diagram_id, storage, data in rows}
+    split = [diagram_id for diagram_id, (storage, _) in stored.items() if storage == STORAGE_ELEMENTS]
+    result = {diagram_id: data for diagram_id, (storage, data) in stored.items() if storage == STORAGE_JSON}
+    in_blobs = [diagram_id for diagram_id, (storage, _) in stored.items() if storage == STORAGE_BLOB]
+    if in_blobs:
+        documents = await asyncio.gather(*(blob_store.read_json(stored[diagram_id][1]["digest"]) for diagram_id in in_blobs))
+        result.update(zip(in_blobs, documents))
+    if not split:
+        return result
+
+    c = elements.c
+    condition = c.diagram_id == split[0] if len(split) == 1 else c.diagram_id.in_(split)
+    element_rows = (await db.execute(
+        select(c.diagram_id, c.collection, c.payload).where(condition).order_by(c.diagram_id, c.collection, c.position)
+    )).all()
+    payloads: Dict[int, Dict[str, List[str]]] = {diagram_id: {} for diagram_id in split}
+    for (diagram_id, collection), group in groupby(element_rows, key=itemgetter(0, 1)):
+        payloads[diagram_id][collection] = list(map(itemgetter(2), group))
+    for diagram_id in split:
+        result[diagram_id] = _assemble(stored[diagram_id][1] or {}, payloads[diagram_id])
+    return result
+
+async def load_data(db: AsyncSession, diagram_id: int, storage: str, data: Dict[str, Any]) -> Dict[str, Any]:
+    """Full data of one diagram from its stored data column"""
+    if storage == STORAGE_BLOB:
+        return await blob_store.read_json(data["digest"])
+    if storage != STORAGE_ELEMENTS:
+        return data
+    return (await load_many(db, [(diagram_id, storage, data)]))[diagram_id]
+
+async def store_data(db: AsyncSession, diagram: Diagram, data: Dict[str, Any], storage: Optional[str] = None):
+    """Replace everything stored for a diagram with `data`, in `storage` or the diagram's current layout.
+
+    A new diagram (added to the session, not yet flushed) takes DIAGRAM_STORAGE. Data whose
+    elements cannot all be keyed by id is kept as JSON whatever the layout asked for, and
+    JSON above BLOB_MIN_BYTES goes to the blob store.
+    """
+    target = storage or diagram.storage or settings.DIAGRAM_STORAGE
+    split = split_data(data) if target == STORAGE_ELEMENTS else None
+    previous_blob = None
+    if diagram.id is not None and diagram.storage == STORAGE_ELEMENTS:
+        await db.execute(delete(elements).where(elements.c.diagram_id == diagram.id))
+    elif diagram.id is not None and diagram.storage == STORAGE_BLOB:
+        # Read from the row: callers may have deferred the data column
+        previous_blob = blob_digest(STORAGE_BLOB, await db.scalar(select(Diagram.data).where(Diagram.id == diagram.id)))
+    if split is None:
+        diagram.storage, diagram.data = await stored_form(db, data)
+    else:
+        diagram.storage, diagram.data = STORAGE_ELEMENTS, split[0]
+    # Released after the new reference is taken, so storing the same content again keeps its file
+    await blob_store.release(db, [previous_blob])
+    if split is None:
+        return
+    if diagram.id is None:
+        await db.flush()
+    rows = [
+        element_row(diagram.id, collection, element, position)
+        for collection, items in split[1].items() for position, element in enumerate(items)
+    ]
+    if rows:
+        await db.execute(insert(elements), rows)
+
+async def store_thumbnail(db: AsyncSession, diagram: Diagram, content: bytes, media_type: str):
+    """Point a diagram at a new thumbnail in the blob store, releasing its previous one.
+
+    Server renders are dropped with it; the next change to the data draws them again.
+    """
+    previous = [diagram.thumbnail_blob, *(diagram.thumbnail_sizes or {}).values()]
+    diagram.thumbnail_blob = await blob_store.put(db, content)
+    diagram.thumbnail_type = media_type
+    diagram.thumbnail = None  # Superseded Base64 copy
+    diagram.thumbnail_sizes = None
+    diagram.thumbnail_hash = None
+    await blob_store.release(db, previous)
+
+def collect_changes(diagram_id: int, document: DiagramDocument) -> ElementChanges:
+    """Rows for the elements ops touched since the document's last take_changes().
+
+    Touched elements that are gone are deleted; added ones are deleted and re-inserted after
+    the current last position, so a remove and re-add moves an element to the end as in the
+    document; the rest are upserted in place.
+    """
+    touched, appended = document.take_changes()
+    deletes, upserts = [], []
+    for collection in ELEMENT_COLLECTIONS:
+        added = []
+        for element_id in touched[collection]:
+            position = document.position(collection, element_id)
+            if position is None or element_id in appended[collection]:
+                deletes.append({"b_diagram_id": diagram_id, "b_collection": collection, "b_element_key": element_key(element_id)})
+            if position is None:
+                continue
+            row = element_row(diagram_id, collection, document.data[collection][position], position)
+            if element_id in appended[collection]:
+                added.append(row)
+            else:
+                upserts.append(_bound(row, 0))
+        added.sort(key=lambda row: row["position"])
+        upserts.extend(_bound(row, offset) for offset, row in enumerate(added, 1))
+    return ElementChanges(diagram_id, touched, appended, deletes, upserts)
+
+def _bound(row: Dict[str, Any], offset: int) -> Dict[str, Any]:
+    params = {f"b_{name}": value for name, value in row.items() if name != "position"}
+    params["b_offset"] = offset
+    return params
+
+_upsert_statements: Dict[str, Any] = {}
+
+def _upsert_statement(dialect: str):
+    """INSERT ... ON CONFLICT DO UPDATE placing new rows `b_offset` after the current last position"""
+    statement = _upsert_statements.get(dialect)
+    if statement is None:
+        c = elements.c
+        last_position = select(func.coalesce(func.max(c.position), -1)).where(
+            c.diagram_id == bindparam("b_diagram_id"), c.collection == bindparam("b_collection")
+        ).scalar_subquery()
+        columns = ("diagram_id", "collection", "element_key") + _UPSERT_COLUMNS
+        dialect_insert = postgresql.insert if dialect == "postgresql" else sqlite.insert
+        statement = dialect_insert(elements).values(
+            position=last_position + bindparam("b_offset"),
+            **{name: bindparam(f"b_{name}") for name in columns}
+        )
+        statement = _upsert_statements[dialect] = statement.on_conflict_do_update(
+            index_elements=[c.diagram_id, c.collection, c.element_key],
+            set_={name: statement.excluded[name] for name in _UPSERT_COLUMNS}
+        )
+    return statement
+
+_DELETE_STATEMENT = delete(elements).where(
+    elements.c.diagram_id == bindparam("b_diagram_id"),
+    elements.c.collection == bindparam("b_collection"),
+    elements.c.element_key == bindparam("b_element_key")
+)
+
+async def write_changes(db: AsyncSession, changes: List[ElementChanges]):
+    """Apply the changes of any number of diagrams: one batched DELETE, then one batched upsert"""
+    deletes = [row for change in changes for row in change.deletes]
+    upserts = [row for change in changes for row in change.upserts]
+    if deletes:
+        await db.execute(_DELETE_STATEMENT, deletes)
+    if upserts:
+        await db.execute(_upsert_statement(db.bind.dialect.name), upserts)
+
+async def write_document(db: AsyncSession, diagram_id: int, document: DiagramDocument):
+    """Write back the elements a tracked document's ops touched"""
+    await write_changes(db, [collect_changes(diagram_id, document)])
+
+def _chunks(items: List[Any]):
+    for start in range(0, len(items), KEY_CHUNK_SIZE):
+        yield items[start:start + KEY_CHUNK_SIZE]
+
+async def load_region(
+    db: AsyncSession, diagram_id: int, bbox: Tuple[float, float, float, float], zoom: float, min_pixels: float
+) -> Dict[str, Any]:
+    """DiagramSpatialIndex.region() answered from the element table's bbox index.
+
+    Only rows intersecting the viewport, the connections attached to them and the far ends
+    of those connections are read, so the cost follows the viewport rather than the diagram.
+    """
+    min_x, min_y, max_x, max_y = bbox
+    c = elements.c
+    shapes_of = and_(c.diagram_id == diagram_id, c.collection == "shapes")
+    width, height = c.max_x - c.min_x, c.max_y - c.min_y
+    # Same level-of-detail rule as the R-tree path: shapes with no size are always kept
+    large = or_(and_(width <= 0, height <= 0), width * zoom >= min_pixels, height * zoom >= min_pixels)
+
+    # Separate statements (and no ORDER BY) so SQLite answers each from an index; an OR
+    # across them makes it walk every element of the diagram instead
+    shape_rows = (await db.execute(
+        select(c.position, c.element_key, case((large, c.payload)))
+        .where(shapes_of, c.min_x <= max_x, c.max_x >= min_x, c.min_y <= max_y, c.max_y >= min_y)
+    )).all()
+    # Shapes without geometry cannot be placed, so every viewport gets them
+    shape_rows += (await db.execute(select(c.position, c.element_key, c.payload).where(shapes_of, c.min_x.is_(None)))).all()
+    shape_rows.sort(key=itemgetter(0))
+    visible = [row for row in shape_rows if row[2] is not None]
+    included = {row[1] for row in visible}
+
+    connection_rows = {}
+    for column in (c.source_key, c.target_key):
+        for keys in _chunks(sorted(included)):
+            for row in (await db.execute(
+                select(c.position, c.source_key, c.target_key, c.payload)
+                .where(c.diagram_id == diagram_id, c.collection == "connections", column.in_(keys))
+            )):
+                connection_rows[row.position] = row
+    connection_rows = [connection_rows[position] for position in sorted(connection_rows)]
+
+    # Far ends of connections leaving the viewport, so the client can draw the edge
+    far_ends = list({key for row in connection_rows for key in (row.source_key, row.target_key) if key is not None} - included)
+    context_rows = []
+    for keys in _chunks(far_ends):
+        context_rows.extend((await db.execute(
+            select(c.position, c.payload)
+            .where(c.diagram_id == diagram_id, c.collection == "shapes", c.element_key.in_(keys))
+        )).all())
+    context_rows.sort(key=itemgetter(0))
+
+    total = await db.scalar(
+        select(func.count()).select_from(elements).where(c.diagram_id == diagram_id, c.collection == "shapes")
+    )
+    return {
+        "shapes": json.loads("[" + ",".join(row[2] for row in visible) + "]"),
+        "connections": json.loads("[" + ",".join(row.payload for row in connection_rows) + "]"),
+        "context_shapes": json.loads("[" + ",".join(row.payload for row in context_rows) + "]"),
+        "total_shapes": total,
+        "culled": len(shape_rows) - len(visible)
+    }
@@ -0,0 +1,494 @@
+import asyncio
+import logging
+from typing import Any, Callable, Dict, List, NamedTuple, Optional
+from sqlalchemy import bindparam, insert, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+from app.core.config import settings
+from app.core.database import AsyncSessionLocal
+from app.core.metrics import registry
+from app.models.diagram import Diagram
+from app.models.diagram_history import DiagramCheckpoint, DiagramRevision
+from app.services.diagram_history import (
+    REVISION_BASELINE, REVISION_OPS, checkpoint_row, history_state, needs_checkpoint, operation_cost, revision_row,
+    stored_checkpoints
+)
+from app.services.diagram_crdt import DiagramCrdt
+from app.services.diagram_ops import DiagramDocument, DiagramOperationError
+from app.services.blob_store import blob_store
+from app.services.diagram_storage import (
+    STORAGE_ELEMENTS, STORAGE_JSON, ElementChanges, blob_digest, collect_changes, load_data, stored_form, write_changes
+)
+from app.services.search_index import extract_text, search_index
+
+logger = logging.getLogger(__name__)
+
+_revision_statements: Dict[str, Any] = {}
+
+def _revision_statement(dialect: str):
+    """INSERT ... ON CONFLICT DO NOTHING, so a version some other writer already recorded is skipped"""
+    statement = _revision_statements.get(dialect)
+    if statement is None:
+        table = DiagramRevision.__table__
+        dialect_insert = postgresql.insert if dialect == "postgresql" else sqlite.insert
+        statement = _revision_statements[dialect] = dialect_insert(table).on_conflict_do_nothing(
+            index_elements=[table.c.diagram_id, table.c.version]
+        )
+    return statement
+
+class VersionConflict(Exception):
+    """Raised when an edit was made against a version that is no longer current"""
+
+    def __init__(self, current_version: int):
+        super().__init__(f"Diagram is at version {current_version}")
+        self.current_version = current_version
+
+class DocumentDeleted(DiagramOperationError):
+    """Raised for edits to a room whose diagram was deleted while it was open"""
+
+    def __init__(self, diagram_id: int):
+        super().__init__(f"Diagram {diagram_id} has been deleted")
+
+class MergeResult(NamedTuple):
+    version: int
+    operations: List[Dict[str, Any]]  # What was applied, stamped with Lamport timestamps
+    exact: bool  # False when the server rewrote ops, so their sender must apply these instead
+
+class LiveDocument:
+    """Authoritative in-memory copy of a diagram that has an active collaboration room"""
+
+    def __init__(
+        self, diagram_id: int, owner_id: int, is_public: bool, version: int, data: Dict[str, Any],
+        storage: str = STORAGE_JSON, blob: Optional[str] = None
+    ):
+        self.diagram_id = diagram_id
+        self.owner_id = owner_id
+        self.is_public = is_public
+        self.version = version
+        self.storage = storage
+        # Digest of the stored data when it is in the blob store; the next flush releases it
+        self.blob = blob
+        self.document = self._document(data)
+        # Merge state for concurrent edits; starts over whenever the data is replaced
+        self.crdt = DiagramCrdt()
+        self.connections = 0
+        self.dirty = False
+        # Latest version known to be in the database
+        self.flushed_version = version
+        # History rows written with the next flush, in the same transaction as the data
+        self.pending_revisions: List[Dict[str, Any]] = []
+        self.pending_checkpoints: List[Dict[str, Any]] = []
+        self.ops_since_checkpoint = 0
+        # Label text last written to the search index; a flush only re-indexes when it changed
+        self.indexed_text = extract_text(self.document.data)
+
+    @property
+    def data(self) -> Dict[str, Any]:
+        return self.document.data
+
+    def _document(self, data: Dict[str, Any]) -> DiagramDocument:
+        document = DiagramDocument(data)
+        # Element-backed diagrams flush only the elements touched since the last flush
+        if self.storage == STORAGE_ELEMENTS:
+            document.track_changes()
+        return document
+
+class DocumentStore:
+    """Holds one LiveDocument per active room and writes dirty documents back in batches.
+
+    With several processes, only the one `is_writer` reports flushes; the others keep their
+    copies (and history) in step with its versions and drop what it announces as written.
+    """
+
+    def __init__(
+        self,
+        session_factory=AsyncSessionLocal,
+        flush_interval: float = settings.DIAGRAM_FLUSH_INTERVAL_SECONDS,
+        is_writer: Callable[[], bool] = lambda: True
+    ):
+        self.session_factory = session_factory
+        self.flush_interval = flush_interval
+        self.is_writer = is_writer
+        self.documents: Dict[int, LiveDocument] = {}
+        # Serializes flushes against REST writes so an older snapshot never lands after a newer save
+        self.write_lock = asyncio.Lock()
+        self._flush_task: Optional[asyncio.Task] = None
+        # Called with the ids of the diagrams each successful flush wrote
+        self.flush_listeners: List[Callable[[List[int]], None]] = []
+        self.stats = {
+            "ops_applied": 0,
+            "op_batches": 0,
+            "flushes": 0,
+            "rows_written": 0,
+            "revisions_written": 0,
+            "checkpoints_written": 0,
+            "flush_conflicts": 0
+        }
+
+    @staticmethod
+    def parse_room_id(diagram_id: str) -> Optional[int]:
+        try:
+            return int(diagram_id)
+        except (TypeError, ValueError):
+            return None
+
+    def get(self, diagram_id: int) -> Optional[LiveDocument]:
+        return self.documents.get(diagram_id)
+
+    async def open(self, diagram_id: int) -> Optional[LiveDocument]:
+        """Load (or reuse) the live document for a room; None if the diagram does not exist"""
+        live = self.documents.get(diagram_id)
+        if live is None:
+            # Loading under the write lock orders it after any in-flight REST write
+            async with self.write_lock:
+                live = self.documents.get(diagram_id)
+                if live is None:
+                    row = await self._load(diagram_id)
+                    if row is None:
+                        return None
+                    *fields, ops_since_checkpoint = row
+                    live = self.documents[diagram_id] = LiveDocument(*fields)
+                    live.ops_since_checkpoint = ops_since_checkpoint
+        live.connections += 1
+        self._ensure_flushing()
+        return live
+
+    def release(self, diagram_id: int):
+        """Drop a room reference; the document is flushed and evicted when the room empties"""
+        live = self.documents.get(diagram_id)
+        if live is None:
+            return
+        live.connections -= 1
+        if live.connections <= 0:
+            asyncio.create_task(self._evict(diagram_id))
+
+    def apply(
+        self,
+        diagram_id: int,
+        operations: List[Dict[str, Any]],
+        base_version: Optional[int] = None,
+        user_id: Optional[int] = None
+    ) -> int:
+        """Apply an op batch with the plain-batch checks and return the new version"""
+        return self.merge(diagram_id, operations, base_version, user_id, strict=True).version
+
+    def merge(
+        self,
+        diagram_id: int,
+        operations: List[Dict[str, Any]],
+        base_version: Optional[int] = None,
+        user_id: Optional[int] = None,
+        strict: bool = False,
+        version: Optional[int] = None
+    ) -> MergeResult:
+        """Merge an op batch into the live document; raises VersionConflict on a stale base_version.
+
+        Ops that lose to later writes are dropped rather than rejected (unless `strict`), and a
+        batch where nothing survives leaves the version as it was. `version` is for batches the
+        sequencing process already resolved: they become exactly that version, the one after
+        this document's, and are recorded as it recorded them.
+        """
+        live = self.documents.get(diagram_id)
+        if live is None:
+            # Rooms hold their document until the last member leaves, so only a delete removes it
+            raise DocumentDeleted(diagram_id)
+        if version is not None and version != live.version + 1:
+            raise VersionConflict(live.version)
+        if base_version is not None and base_version != live.version:
+            raise VersionConflict(live.version)
+        resolved = operations
+        operations, exact = live.crdt.merge(live.document, operations, strict)
+        if version is not None:
+            operations = resolved
+        elif not operations:
+            return MergeResult(live.version, operations, exact)
+        live.version += 1
+        live.dirty = True
+        live.pending_revisions.append(revision_row(diagram_id, live.version, REVISION_OPS, operations, user_id))
+        live.ops_since_checkpoint += operation_cost(operations)
+        if needs_checkpoint(REVISION_OPS, live.ops_since_checkpoint):
+            live.pending_checkpoints.append(checkpoint_row(diagram_id, live.version, live.document.snapshot()))
+            live.ops_since_checkpoint = 0
+        self.stats["ops_applied"] += len(operations)
+        self.stats["op_batches"] += 1
+        return MergeResult(live.version, operations, exact)
+
+    def replace(
+        self, diagram_id: int, data: Dict[str, Any], version: int, ops_since_checkpoint: int = 0,
+        storage: str = STORAGE_JSON, blob: Optional[str] = None
+    ):
+        """Adopt data that was just written (with its history) through REST; call after flush_held"""
+        live = self.documents.get(diagram_id)
+        if live is not None:
+            live.storage = storage
+            live.blob = blob
+            live.document = live._document(data)
+            live.crdt = DiagramCrdt()
+            live.version = version
+            live.flushed_version = version
+            live.dirty = False
+            live.ops_since_checkpoint = ops_since_checkpoint
+            live.indexed_text = extract_text(live.document.data)
+
+    def discard(self, diagram_id: int):
+        """Forget a deleted diagram's document and its unwritten changes; call with write_lock held"""
+        self.documents.pop(diagram_id, None)
+
+    def settle(self, diagram_id: int, version: int):
+        """Drop history the writing process has stored up to `version`"""
+        live = self.documents.get(diagram_id)
+        if live is None or version <= live.flushed_version:
+            return
+        live.flushed_version = version
+        live.pending_revisions = [row for row in live.pending_revisions if row["version"] > version]
+        live.pending_checkpoints = [row for row in live.pending_checkpoints if row["version"] > version]
+        if live.version <= version:
+            live.dirty = False
+
+    async def reload(self, diagram_id: int) -> Optional[LiveDocument]:
+        """Replace a live document (and drop its unwritten changes) with what is stored now"""
+        async with self.write_lock:
+            live = self.documents.get(diagram_id)
+            if live is None:
+                return None
+            row = await self._load(diagram_id)
+            if row is None:
+                return live
+            _, owner_id, is_public, version, data, storage, blob, ops_since_checkpoint = row
+            live.owner_id, live.is_public = owner_id, is_public
+            live.pending_revisions, live.pending_checkpoints = [], []
+            self.replace(diagram_id, data, version, ops_since_checkpoint, storage, blob)
+            return live
+
+    async def flush(self, diagram_ids: Optional[List[int]] = None) -> int:
+        """Write all (or the given) dirty documents in one batched statement; returns rows written"""
+        async with self.write_lock:
+            return await self.flush_held(diagram_ids)
+
+    async def flush_held(self, diagram_ids: Optional[List[int]] = None) -> int:
+        """flush() for callers that already hold write_lock"""
+        if not self.is_writer():
+            return 0
+        candidates = diagram_ids if diagram_ids is not None else list(self.documents)
+        batch, element_changes, revisions, checkpoints, search_rows = [], [], [], [], []
+        for diagram_id in candidates:
+            live = self.documents.get(diagram_id)
+            if live is not None and live.dirty:
+                if live.version <= live.flushed_version:
+                    # Copied from a process that already stored it (this one took over the writes)
+                    self.settle(diagram_id, live.version)
+                    continue
+                if live.storage == STORAGE_ELEMENTS:
+                    batch.append({"b_id": diagram_id, "b_version": live.version})
+                    element_changes.append(collect_changes(diagram_id, live.document))
+                else:
+                    batch.append({"b_id": diagram_id, "b_data": live.document.snapshot(), "b_version": live.version})
+                content = extract_text(live.document.data)
+                if content != live.indexed_text:
+                    search_rows.append({"diagram_id": diagram_id, "content": content, "previous": live.indexed_text})
+                    live.indexed_text = content
+                revisions.extend(live.pending_revisions)
+                checkpoints.extend(live.pending_checkpoints)
+                live.pending_revisions, live.pending_checkpoints = [], []
+                live.dirty = False
+        if not batch:
+            return 0
+
+        try:
+            written = await self._write(batch, element_changes, revisions, checkpoints, search_rows)
+        except Exception as e:
+            self._requeue(batch, element_changes, revisions, checkpoints, search_rows)
+            if not isinstance(e, IntegrityError):
+                raise
+            self.stats["flush_conflicts"] += 1
+            if len(batch) > 1:
+                # One diagram's bad rows must not hold back the rest of the batch
+                return sum([await self.flush_held([params["b_id"]]) for params in batch])
+            # Retrying the same rows would fail the same way on every flush from now on
+            diagram_id = batch[0]["b_id"]
+            live = self.documents.get(diagram_id)
+            if live is None:
+                return 0
+            if live.pending_revisions or live.pending_checkpoints:
+                logger.error(f"Flush of diagram {diagram_id} violates a constraint; dropping its unwritten history: {e}")
+                live.pending_revisions, live.pending_checkpoints = [], []
+                return await self.flush_held([diagram_id])
+            logger.error(f"Flush of diagram {diagram_id} violates a constraint; keeping its changes in memory only: {e}")
+            live.dirty = False
+            return 0
+
+        for diagram_id in {params["b_id"] for params in batch} - set(written):
+            # Deleted underneath the room; its edits have nowhere to go
+            logger.warning(f"Diagram {diagram_id} no longer exists; dropping its live document")
+            self.documents.pop(diagram_id, None)
+        for params in batch:
+            live = self.documents.get(params["b_id"])
+            if live is not None:
+                live.flushed_version = max(live.flushed_version, params["b_version"])
+        for listener in self.flush_listeners:
+            try:
+                listener(written)
+            except Exception as e:
+                logger.error(f"Flush listener failed: {e}")
+        self.stats["flushes"] += 1
+        self.stats["rows_written"] += len(written)
+        self.stats["revisions_written"] += sum(1 for row in revisions if row["diagram_id"] in written)
+        self.stats["checkpoints_written"] += sum(1 for row in checkpoints if row["diagram_id"] in written)
+        return len(written)
+
+    def _requeue(self, batch, element_changes, revisions, checkpoints, search_rows):
+        """Put a failed flush's changes back so the next flush writes them"""
+        previous_text = {row["diagram_id"]: row["previous"] for row in search_rows}
+        for changes in element_changes:
+            live = self.documents.get(changes.diagram_id)
+            if live is not None and live.storage == STORAGE_ELEMENTS:
+                live.document.requeue_changes(changes.touched, changes.appended)
+        for params in batch:
+            live = self.documents.get(params["b_id"])
+            if live is not None:
+                live.dirty = True
+                live.indexed_text = previous_text.get(params["b_id"], live.indexed_text)
+                live.pending_revisions[:0] = [row for row in revisions if row["diagram_id"] == params["b_id"]]
+                live.pending_checkpoints[:0] = [row for row in checkpoints if row["diagram_id"] == params["b_id"]]
+
+    async def shutdown(self):
+        if self._flush_task and not self._flush_task.done():
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+        self._flush_task = None
+        await self.flush()
+
+    async def _load(self, diagram_id: int):
+        """Row fields for LiveDocument plus the replay cost since the latest checkpoint"""
+        async with self.session_factory() as db:
+            row = (await db.execute(
+                select(Diagram.id, Diagram.owner_id, Diagram.is_public, Diagram.version, Diagram.data, Diagram.storage)
+                .where(Diagram.id == diagram_id)
+            )).first()
+            if row is None:
+                return None
+            data = await load_data(db, diagram_id, row.storage, row.data)
+            checkpoint, ops_since_checkpoint = await history_state(db, diagram_id)
+            if checkpoint is None:
+                # Created before history existed: the loaded state becomes the baseline revisions replay from
+                try:
+                    await db.execute(insert(DiagramRevision.__table__), [revision_row(diagram_id, row.version, REVISION_BASELINE)])
+                    await db.execute(
+                        insert(DiagramCheckpoint.__table__),
+                        await stored_checkpoints(db, [checkpoint_row(diagram_id, row.version, data)])
+                    )
+                    await db.commit()
+                except IntegrityError:
+                    # Another process recorded it first
+                    await db.rollback()
+            return (
+                row.id, row.owner_id, row.is_public, row.version, data, row.storage,
+                blob_digest(row.storage, row.data), ops_since_checkpoint
+            )
+
+    async def _write(
+        self,
+        batch: List[Dict[str, Any]],
+        element_changes: List[ElementChanges],
+        revisions: List[Dict[str, Any]],
+        checkpoints: List[Dict[str, Any]],
+        search_rows: List[Dict[str, Any]]
+    ) -> List[int]:
+        """Write a flush batch in one transaction; returns the ids of the diagrams that still exist"""
+        async with self.session_factory() as db:
+            table = Diagram.__table__
+            try:
+                existing = set((await db.execute(
+                    select(table.c.id).where(table.c.id.in_([params["b_id"] for params in batch]))
+                )).scalars())
+                if len(existing) < len(batch):
+                    batch = [params for params in batch if params["b_id"] in existing]
+                    element_changes = [changes for changes in element_changes if changes.diagram_id in existing]
+                    revisions = [row for row in revisions if row["diagram_id"] in existing]
+                    checkpoints = [row for row in checkpoints if row["diagram_id"] in existing]
+                    search_rows = [row for row in search_rows if row["diagram_id"] in existing]
+                # Whole-document rows go inline or, when large, to the blob store; fresh dicts keep
+                # the batch intact for requeueing if this write fails
+                data_rows = []
+                for params in batch:
+                    if "b_data" in params:
+                        storage, data = await stored_form(db, params["b_data"])
+                        data_rows.append({**params, "b_data": data, "b_storage": storage})
+                # Never moves a row back to an older version than another writer stored. One statement
+                # per row, since only rows this write replaced may let go of the blob they held
+                replaced, released = [], []
+                for params in data_rows:
+                    result = await db.execute(
+                        update(table).where(table.c.id == params["b_id"], table.c.version < params["b_version"]).values(
+                            version=params["b_version"], data=params["b_data"], storage=params["b_storage"]
+                        )
+                    )
+                    if result.rowcount:
+                        replaced.append(params)
+                        live = self.documents.get(params["b_id"])
+                        released.append(live.blob if live is not None else None)
+                    else:
+                        # The row keeps another writer's newer data, so the copy just stored is unreferenced
+                        released.append(blob_digest(params["b_storage"], params["b_data"]))
+                # Released after the new references are taken, so storing the same content again keeps its file
+                await blob_store.release(db, released)
+                # Element-backed rows only move their version; their elements are written below
+                version_rows = [params for params in batch if "b_data" not in params]
+                if version_rows:
+                    await db.execute(
+                        update(table).where(table.c.id == bindparam("b_id"), table.c.version < bindparam("b_version"))
+                        .values(version=bindparam("b_version")),
+                        version_rows
+                    )
+                await write_changes(db, element_changes)
+                if revisions:
+                    await db.execute(_revision_statement(db.bind.dialect.name), revisions)
+                if checkpoints:
+                    await db.execute(insert(DiagramCheckpoint.__table__), await stored_checkpoints(db, checkpoints))
+                await search_index.update_content(db, [
+                    {"diagram_id": row["diagram_id"], "content": row["content"]} for row in search_rows
+                ])
+                await db.commit()
+            except Exception:
+                await db.rollback()
+                raise
+        for params in replaced:
+            live = self.documents.get(params["b_id"])
+            if live is not None:
+                live.storage = params["b_storage"]
+                live.blob = blob_digest(params["b_storage"], params["b_data"])
+        return [params["b_id"] for params in batch]
+
+    async def _evict(self, diagram_id: int):
+        try:
+            await self.flush([diagram_id])
+        except Exception as e:
+            logger.error(f"Final flush of diagram {diagram_id} failed: {e}")
+            return
+        live = self.documents.get(diagram_id)
+        # Someone may have rejoined while the flush was in flight; a copy another process writes
+        # back has nothing to lose
+        if live is not None and live.connections <= 0 and (not live.dirty or not self.is_writer()):
+            del self.documents[diagram_id]
+
+    def _ensure_flushing(self):
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while self.documents:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Write-behind flush failed: {e}")
+
+document_store = DocumentStore()
+
+registry.callback("live_documents", "Diagrams held in memory for collaboration rooms", "gauge",
+                  lambda: [((), len(document_store.documents))])
+registry.callback("live_document_events", "Live document ops, batches, flushes and rows written", "counter",
+                  lambda: [((event,), count) for event, count in document_store.stats.items()], ("event",))
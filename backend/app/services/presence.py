@@ -0,0 +1,104 @@
+import asyncio
+import logging
+from typing import Any, Callable, Dict, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+def merge_cursor_batches(pending: Dict[str, Any], latest: Dict[str, Any]) -> Dict[str, Any]:
+    """One `cursors` frame with every connection's newest position from both batches"""
+    cursors = {cursor.get("member_id"): cursor for cursor in pending["cursors"]}
+    cursors.update((cursor.get("member_id"), cursor) for cursor in latest["cursors"])
+    return {**latest, "cursors": list(cursors.values())}
+
+def without_cursor(batch: Dict[str, Any], member_id: str) -> Dict[str, Any]:
+    """A `cursors` frame minus one connection's own cursor"""
+    return {**batch, "cursors": [cursor for cursor in batch["cursors"] if cursor.get("member_id") != member_id]}
+
+class PresenceAggregator:
+    """Keep the latest cursor per connection and publish one batched `cursors` frame per room per tick.
+
+    Cursors are keyed by member id, so a user with the diagram open in two tabs shows (and
+    leaves) two cursors.
+    """
+
+    def __init__(self, tick_hz: float, publish: Callable[[str, dict], None]):
+        self.interval = 1.0 / tick_hz if tick_hz > 0 else 0.05
+        self._publish = publish
+        self._cursors: Dict[str, Dict[str, Dict[str, Any]]] = {}
+        self._last_sent: Dict[str, Dict[str, Any]] = {}
+        self._dirty: Dict[str, Set[str]] = {}
+        self._task: Optional[asyncio.Task] = None
+        self.updates_received = 0
+        self.frames_published = 0
+
+    def update(self, diagram_id: str, member_id: str, user_id: int, username: str, position: Any):
+        """Record a connection's cursor position; nothing is sent until the next tick"""
+        self.updates_received += 1
+        self._cursors.setdefault(diagram_id, {})[member_id] = {
+            "member_id": member_id,
+            "user_id": user_id,
+            "username": username,
+            "position": position
+        }
+
+        dirty = self._dirty.setdefault(diagram_id, set())
+        if self._last_sent.get(diagram_id, {}).get(member_id) == position:
+            dirty.discard(member_id)
+        else:
+            dirty.add(member_id)
+
+        self._ensure_running()
+
+    def remove_member(self, diagram_id: str, member_id: str):
+        for table in (self._cursors, self._last_sent, self._dirty):
+            entries = table.get(diagram_id)
+            if entries is not None:
+                if isinstance(entries, set):
+                    entries.discard(member_id)
+                else:
+                    entries.pop(member_id, None)
+                if not entries:
+                    del table[diagram_id]
+
+    def flush(self):
+        """Publish pending cursor changes, one frame per room"""
+        dirty_rooms = [(room, users) for room, users in self._dirty.items() if users]
+        for diagram_id, member_ids in dirty_rooms:
+            cursors = self._cursors.get(diagram_id, {})
+            last_sent = self._last_sent.setdefault(diagram_id, {})
+            batch = []
+            for member_id in member_ids:
+                entry = cursors.get(member_id)
+                if entry is None:
+                    continue
+                batch.append(entry)
+                last_sent[member_id] = entry["position"]
+            member_ids.clear()
+
+            if batch:
+                self.frames_published += 1
+                self._publish(diagram_id, {"type": "cursors", "cursors": batch})
+
+    def _ensure_running(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        try:
+            while self._cursors:
+                await asyncio.sleep(self.interval)
+                try:
+                    self.flush()
+                except Exception as e:
+                    logger.error(f"Presence flush failed: {e}")
+        finally:
+            self._task = None
+
+    async def stop(self):
+        if self._task and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
@@ -0,0 +1,106 @@
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Dict, NamedTuple, Optional
+from app.core.compression import base_etag
+from app.core.config import settings
+
+class CachedResponse(NamedTuple):
+    etag: str
+    body: bytes
+    variants: Dict[str, bytes]  # Content-coding -> compressed body, filled in as clients ask
+
+def diagram_etag(diagram_id: int, version: int, updated_at: Optional[datetime], thumbnail: Optional[str] = None) -> str:
+    """Strong validator for GET /diagrams/{id}.
+
+    `version` moves with every data or metadata change; `updated_at` also moves when a room
+    flush rewrites the row without a new version, which changes the response's updated_at.
+    A thumbnail upload moves neither version nor (within the same second on SQLite)
+    updated_at, so the thumbnail's blob digest is part of the tag too.
+    """
+    stamp = int(updated_at.timestamp() * 1_000_000) if updated_at is not None else 0
+    suffix = f"-{thumbnail[:16]}" if thumbnail else ""
+    return f'"{diagram_id}-{version}-{stamp:x}{suffix}"'
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """If-None-Match uses the weak comparison (RFC 9110 13.1.2), so W/ prefixes are ignored.
+
+    A compressed variant's ETag ("...-br") also matches: it names the same version.
+    """
+    if not if_none_match:
+        return False
+    candidates = [candidate.strip() for candidate in if_none_match.split(",")]
+    return any(candidate == "*" or base_etag(candidate.removeprefix("W/")) == etag for candidate in candidates)
+
+class DiagramResponseCache:
+    """Per-process LRU of encoded GET /diagrams/{id} bodies, bounded by total bytes.
+
+    One entry per diagram: a request for a newer version replaces it, so collaborators
+    opening a popular diagram share a single encode (and one compression per content-coding)
+    per version.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[int, CachedResponse]" = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, diagram_id: int, etag: str) -> Optional[bytes]:
+        entry = self._entries.get(diagram_id)
+        if entry is None or entry.etag != etag:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(diagram_id)
+        self.hits += 1
+        return entry.body
+
+    def put(self, diagram_id: int, etag: str, body: bytes):
+        # One diagram may not take more than a quarter of the budget
+        if len(body) * 4 > self.max_bytes:
+            return
+        self.discard(diagram_id)
+        self._entries[diagram_id] = CachedResponse(etag, body, {})
+        self._bytes += len(body)
+        self._evict()
+
+    def get_variant(self, diagram_id: int, etag: str, encoding: str) -> Optional[bytes]:
+        entry = self._entries.get(diagram_id)
+        if entry is None or entry.etag != etag:
+            return None
+        return entry.variants.get(encoding)
+
+    def put_variant(self, diagram_id: int, etag: str, encoding: str, data: bytes):
+        """Attach a compressed body; ignored if the entry was replaced while it was compressing"""
+        entry = self._entries.get(diagram_id)
+        if entry is None or entry.etag != etag or encoding in entry.variants:
+            return
+        entry.variants[encoding] = data
+        self._bytes += len(data)
+        self._evict()
+
+    def _evict(self):
+        while self._bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= self._size(evicted)
+
+    @staticmethod
+    def _size(entry: CachedResponse) -> int:
+        return len(entry.body) + sum(len(data) for data in entry.variants.values())
+
+    def discard(self, diagram_id: int):
+        entry = self._entries.pop(diagram_id, None)
+        if entry is not None:
+            self._bytes -= self._size(entry)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0
+        }
+
+diagram_response_cache = DiagramResponseCache(settings.DIAGRAM_RESPONSE_CACHE_BYTES)
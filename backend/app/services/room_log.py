@@ -0,0 +1,50 @@
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Tuple, Union
+
+class RoomSnapshot:
+    """A room's document as of one sequence number, with its encoded frame per protocol"""
+
+    def __init__(self, seq: int, version: int, message: Dict[str, Any]):
+        self.seq = seq
+        self.version = version
+        self.message = message
+        # Encoded once per codec and reused for every joiner while the snapshot stays valid
+        self.frames: Dict[str, Union[str, bytes]] = {}
+
+class RoomLog:
+    """Sequence numbers for one room's broadcasts and a bounded buffer of the most recent ones.
+
+    `epoch` names this log: sequence numbers only mean something to the process (and the
+    log instance) that assigned them, so a client resuming with another epoch gets a snapshot.
+    """
+
+    def __init__(self, epoch: str, capacity: int):
+        self.epoch = epoch
+        self.seq = 0
+        # (seq, message, member id of the connection that sent it, if it came from one)
+        self.entries: Deque[Tuple[int, Dict[str, Any], Optional[str]]] = deque(maxlen=max(1, capacity))
+        self.snapshot: Optional[RoomSnapshot] = None
+        self.idle_since: Optional[float] = None
+
+    def append(self, message: Dict[str, Any], origin: Optional[str] = None) -> Dict[str, Any]:
+        """Stamp the next sequence number on a copy of `message`, buffer it and return it"""
+        self.seq += 1
+        stamped = {**message, "seq": self.seq}
+        self.entries.append((self.seq, stamped, origin))
+        return stamped
+
+    def since(self, seq: int, skip_origin: Optional[str] = None) -> Optional[List[Dict[str, Any]]]:
+        """Messages after `seq`, or None if the buffer no longer reaches back that far"""
+        if seq > self.seq or seq < 0:
+            return None
+        if seq < self.seq and (not self.entries or self.entries[0][0] > seq + 1):
+            return None
+        # Walk back from the newest entry: the missed tail is usually short
+        missed = []
+        for entry_seq, message, origin in reversed(self.entries):
+            if entry_seq <= seq:
+                break
+            if origin is None or origin != skip_origin:
+                missed.append(message)
+        missed.reverse()
+        return missed
@@ -0,0 +1,358 @@
+import logging
+import re
+import unicodedata
+from typing import Any, Dict, List, NamedTuple, Optional
+from fastapi import HTTPException, status
+from sqlalchemy import bindparam, func, select, text
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncSession
+from app.core.config import settings
+from app.core.database import engine
+from app.models.diagram import Diagram
+from app.services.diagram_ops import ELEMENT_COLLECTIONS
+from app.services.diagram_storage import load_many
+
+logger = logging.getLogger(__name__)
+
+# Element fields holding user-visible text (shape labels, text nodes, connection labels)
+TEXT_FIELDS = ("label", "text", "title", "content")
+BACKFILL_BATCH_SIZE = 1000
+SNIPPET_WORDS = 12
+
+_TERM = re.compile(r"\w+", re.UNICODE)
+
+class SearchHit(NamedTuple):
+    id: int
+    score: float
+    snippet: Optional[str]
+
+def extract_text(data: Optional[Dict[str, Any]]) -> str:
+    """Every label and text node in diagram data, one per line"""
+    pieces = []
+    for collection in ELEMENT_COLLECTIONS:
+        for element in (data or {}).get(collection) or ():
+            if isinstance(element, dict):
+                for field in TEXT_FIELDS:
+                    value = element.get(field)
+                    if isinstance(value, str) and value.strip():
+                        pieces.append(value)
+    return "\n".join(pieces)
+
+def query_terms(query: str) -> List[str]:
+    terms = _TERM.findall(query)[:settings.SEARCH_MAX_TERMS]
+    if not terms:
+        raise HTTPException(status_code=422, detail="Search query must contain at least one word")
+    return terms
+
+def _fold(word: str) -> str:
+    # Same normalisation as the unicode61 tokenizer with remove_diacritics
+    decomposed = unicodedata.normalize("NFKD", word.casefold())
+    return "".join(char for char in decomposed if not unicodedata.combining(char))
+
+def highlight(texts: List[str], terms: List[str]) -> Optional[str]:
+    """«Marked» excerpt around the first query term found in `texts`; the last term matches as a prefix"""
+    exact, prefix = {_fold(term) for term in terms[:-1]}, _fold(terms[-1])
+    for body in texts:
+        words = list(_TERM.finditer(body or ""))
+        matched = [
+            index for index, word in enumerate(words)
+            if _fold(word.group()) in exact or _fold(word.group()).startswith(prefix)
+        ]
+        if not matched:
+            continue
+        first = max(0, min(matched[0] - SNIPPET_WORDS // 4, len(words) - SNIPPET_WORDS))
+        window = words[first:first + SNIPPET_WORDS]
+        parts = [("«" + word.group() + "»") if first + i in matched else word.group() for i, word in enumerate(window)]
+        return ("…" if first else "") + " ".join(parts) + ("…" if first + SNIPPET_WORDS < len(words) else "")
+    return None
+
+def search_document(
+    diagram_id: int, title: str, description: Optional[str], owner_id: int, is_public: bool, content: str
+) -> Dict[str, Any]:
+    """One diagram's index entry, as passed to SearchBackend.upsert"""
+    return {
+        "id": diagram_id,
+        "title": title or "",
+        "description": description or "",
+        "content": content,
+        "owner_id": owner_id,
+        "is_public": bool(is_public)
+    }
+
+class SearchBackend:
+    """Inverted index over diagram title, description and label text.
+
+    Writes take the caller's session so the index changes commit (or roll back) with the
+    diagram write they belong to.
+    """
+
+    name = "none"
+
+    async def ensure_schema(self, conn: AsyncConnection):
+        pass
+
+    async def upsert(self, db: AsyncSession, documents: List[Dict[str, Any]]):
+        """Index or re-index diagrams; documents come from search_document()"""
+        pass
+
+    async def update_content(self, db: AsyncSession, rows: List[Dict[str, Any]]):
+        """Replace the label text of several diagrams; rows are {"diagram_id", "content"}"""
+        pass
+
+    async def delete(self, db: AsyncSession, diagram_id: int):
+        pass
+
+    async def count(self, db: AsyncSession) -> int:
+        return 0
+
+    async def search(self, db: AsyncSession, query: str, visibility: str, user_id: int, limit: int, offset: int):
+        """Ranked SearchHits (or rows with the same fields); visibility is "all", "owned" or "public" """
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Search is not available")
+
+    async def backfill(self, session_factory) -> int:
+        """Index every diagram when the index is empty (first start on an existing database)"""
+        async with session_factory() as db:
+            if await self.count(db) or not await db.scalar(select(func.count()).select_from(Diagram)):
+                return 0
+            indexed, last_id = 0, 0
+            while True:
+                rows = (await db.execute(
+                    select(
+                        Diagram.id, Diagram.title, Diagram.description, Diagram.owner_id, Diagram.is_public,
+                        Diagram.data, Diagram.storage
+                    ).where(Diagram.id > last_id).order_by(Diagram.id).limit(BACKFILL_BATCH_SIZE)
+                )).all()
+                if not rows:
+                    break
+                data = await load_many(db, [(row.id, row.storage, row.data) for row in rows])
+                await self.upsert(db, [
+                    search_document(row.id, row.title, row.description, row.owner_id, row.is_public, extract_text(data[row.id]))
+                    for row in rows
+                ])
+                await db.commit()
+                indexed += len(rows)
+                last_id = rows[-1].id
+            return indexed
+
+class Fts5SearchBackend(SearchBackend):
+    """SQLite FTS5 table keyed by diagram id, ranked with bm25 (title > description > labels).
+
+    Visibility is indexed too, as "u<owner id>" and "public" tokens in an unranked access
+    column, so the owner/public filter is a doclist intersection inside FTS5 rather than a
+    diagrams lookup per match.
+    """
+
+    name = "fts5"
+
+    async def ensure_schema(self, conn: AsyncConnection):
+        await conn.exec_driver_sql(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS diagram_search USING fts5("
+            "title, description, content, access, "
+            "tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')"
+        )
+
+    async def upsert(self, db: AsyncSession, documents: List[Dict[str, Any]]):
+        if not documents:
+            return
+        await db.execute(text("DELETE FROM diagram_search WHERE rowid = :id"), [{"id": doc["id"]} for doc in documents])
+        await db.execute(
+            text(
+                "INSERT INTO diagram_search (rowid, title, description, content, access) "
+                "VALUES (:id, :title, :description, :content, :access)"
+            ),
+            [
+                {**doc, "access": f"u{doc['owner_id']} public" if doc["is_public"] else f"u{doc['owner_id']}"}
+                for doc in documents
+            ]
+        )
+
+    async def update_content(self, db: AsyncSession, rows: List[Dict[str, Any]]):
+        if rows:
+            await db.execute(text("UPDATE diagram_search SET content = :content WHERE rowid = :diagram_id"), rows)
+
+    async def delete(self, db: AsyncSession, diagram_id: int):
+        await db.execute(text("DELETE FROM diagram_search WHERE rowid = :id"), {"id": diagram_id})
+
+    async def count(self, db: AsyncSession) -> int:
+        return await db.scalar(text("SELECT count(*) FROM diagram_search"))
+
+    @staticmethod
+    def _text_query(terms: List[str]) -> str:
+        # Quoted terms, so user input is never parsed as FTS5 syntax; the last one matches as a prefix
+        quoted = ['"' + term.replace('"', '""') + '"' for term in terms]
+        quoted[-1] += "*"
+        return "{title description content} : (" + " AND ".join(quoted) + ")"
+
+    @staticmethod
+    def _access_query(visibility: str, user_id: int) -> str:
+        if visibility == "owned":
+            return f'access : "u{int(user_id)}"'
+        if visibility == "public":
+            return 'access : "public"'
+        return f'access : ("u{int(user_id)}" OR "public")'
+
+    async def search(self, db: AsyncSession, query: str, visibility: str, user_id: int, limit: int, offset: int):
+        terms = query_terms(query)
+        text_query = self._text_query(terms)
+        weights = settings.SEARCH_FIELD_WEIGHTS
+        params = {
+            "match": f"{text_query} AND {self._access_query(visibility, user_id)}",
+            "limit": limit, "offset": offset, "cap": settings.SEARCH_MAX_CANDIDATES,
+            "w_title": weights[0], "w_description": weights[1], "w_content": weights[2]
+        }
+
+        # bm25 costs microseconds per match; for very common terms rank only the newest visible matches
+        floor = await db.scalar(
+            text("SELECT rowid FROM diagram_search WHERE diagram_search MATCH :match ORDER BY rowid DESC LIMIT 1 OFFSET :cap"),
+            params
+        )
+        ranked = (await db.execute(
+            text(
+                "SELECT rowid AS id, -bm25(diagram_search, :w_title, :w_description, :w_content, 0.0) AS score "
+                "FROM diagram_search WHERE diagram_search MATCH :match AND rowid > :floor "
+                "ORDER BY bm25(diagram_search, :w_title, :w_description, :w_content, 0.0) LIMIT :limit OFFSET :offset"
+            ),
+            {**params, "floor": floor or 0}
+        )).all()
+        if not ranked:
+            return []
+
+        # Excerpts for the returned page only, built here: FTS5 snippet() would re-run the match,
+        # and a prefix term loads its whole doclist however few rows are asked for
+        texts = {row.rowid: row for row in (await db.execute(
+            text("SELECT rowid, title, description, content FROM diagram_search WHERE rowid IN :ids")
+            .bindparams(bindparam("ids", expanding=True)),
+            {"ids": [row.id for row in ranked]}
+        )).all()}
+        snippets = {
+            diagram_id: highlight([row.title, row.description, row.content], terms)
+            for diagram_id, row in texts.items()
+        }
+        return [SearchHit(row.id, row.score, snippets.get(row.id)) for row in ranked]
+
+class PostgresSearchBackend(SearchBackend):
+    """PostgreSQL tsvector column with a GIN index, ranked with ts_rank over weighted fields"""
+
+    name = "postgres"
+
+    async def ensure_schema(self, conn: AsyncConnection):
+        await conn.exec_driver_sql(
+            "CREATE TABLE IF NOT EXISTS diagram_search ("
+            "diagram_id INTEGER PRIMARY KEY REFERENCES diagrams (id) ON DELETE CASCADE, "
+            "title TEXT NOT NULL DEFAULT '', description TEXT NOT NULL DEFAULT '', content TEXT NOT NULL DEFAULT '', "
+            "document tsvector GENERATED ALWAYS AS ("
+            "setweight(to_tsvector('simple', title), 'A') || "
+            "setweight(to_tsvector('simple', description), 'B') || "
+            "setweight(to_tsvector('simple', content), 'C')) STORED)"
+        )
+        await conn.exec_driver_sql(
+            "CREATE INDEX IF NOT EXISTS ix_diagram_search_document ON diagram_search USING GIN (document)"
+        )
+
+    async def upsert(self, db: AsyncSession, documents: List[Dict[str, Any]]):
+        if not documents:
+            return
+        await db.execute(
+            text(
+                "INSERT INTO diagram_search (diagram_id, title, description, content) "
+                "VALUES (:id, :title, :description, :content) "
+                "ON CONFLICT (diagram_id) DO UPDATE SET title = EXCLUDED.title, "
+                "description = EXCLUDED.description, content = EXCLUDED.content"
+            ),
+            [{key: doc[key] for key in ("id", "title", "description", "content")} for doc in documents]
+        )
+
+    async def update_content(self, db: AsyncSession, rows: List[Dict[str, Any]]):
+        if rows:
+            await db.execute(text("UPDATE diagram_search SET content = :content WHERE diagram_id = :diagram_id"), rows)
+
+    async def delete(self, db: AsyncSession, diagram_id: int):
+        await db.execute(text("DELETE FROM diagram_search WHERE diagram_id = :id"), {"id": diagram_id})
+
+    async def count(self, db: AsyncSession) -> int:
+        return await db.scalar(text("SELECT count(*) FROM diagram_search"))
+
+    @staticmethod
+    def _visibility_sql(visibility: str) -> str:
+        if visibility == "owned":
+            return "d.owner_id = :user_id"
+        if visibility == "public":
+            return "d.is_public"
+        return "(d.owner_id = :user_id OR d.is_public)"
+
+    async def search(self, db: AsyncSession, query: str, visibility: str, user_id: int, limit: int, offset: int):
+        # Quoted lexemes, so operators in user input are matched as text; the last one matches as a prefix
+        lexemes = ["'" + term.replace("'", "''") + "'" for term in query_terms(query)]
+        lexemes[-1] += ":*"
+        weights = settings.SEARCH_FIELD_WEIGHTS
+        maximum = max(weights) or 1.0
+        rows = await db.execute(
+            text(
+                # Like FTS5: rank at most SEARCH_MAX_CANDIDATES of the newest visible matches
+                "WITH candidates AS ("
+                "SELECT d.id AS id, s.document AS document, s.title || ' ' || s.description || ' ' || s.content AS body, "
+                "q.query AS query "
+                "FROM diagram_search s JOIN diagrams d ON d.id = s.diagram_id, to_tsquery('simple', :match) AS q(query) "
+                f"WHERE s.document @@ q.query AND {self._visibility_sql(visibility)} "
+                "ORDER BY d.id DESC LIMIT :cap), "
+                "hits AS ("
+                "SELECT id, ts_rank(CAST(:weights AS real[]), document, query) AS score, body, query FROM candidates "
+                "ORDER BY score DESC LIMIT :limit OFFSET :offset) "
+                "SELECT id, score, ts_headline('simple', body, query, "
+                "'StartSel=«, StopSel=», MaxWords=12, MinWords=4, FragmentDelimiter=…, MaxFragments=1') AS snippet "
+                "FROM hits ORDER BY score DESC"
+            ),
+            {
+                "match": " & ".join(lexemes), "user_id": user_id, "limit": limit, "offset": offset,
+                "cap": settings.SEARCH_MAX_CANDIDATES,
+                # ts_rank takes {D, C, B, A} weights in 0..1
+                "weights": [0.0, weights[2] / maximum, weights[1] / maximum, weights[0] / maximum]
+            }
+        )
+        return rows.all()
+
+SEARCH_BACKENDS = {
+    "none": SearchBackend,
+    "fts5": Fts5SearchBackend,
+    "postgres": PostgresSearchBackend
+}
+
+def create_search_backend(kind: str, dialect: str) -> SearchBackend:
+    """SEARCH_BACKEND=auto picks FTS5 on SQLite and tsvector on PostgreSQL"""
+    if kind == "auto":
+        kind = {"sqlite": "fts5", "postgresql": "postgres"}.get(dialect, "none")
+    if kind not in SEARCH_BACKENDS:
+        raise ValueError(f"Unknown SEARCH_BACKEND {kind!r}; expected auto or one of {sorted(SEARCH_BACKENDS)}")
+    return SEARCH_BACKENDS[kind]()
+
+class SearchIndex:
+    """The configured backend, replaced by the no-op one if its schema cannot be created"""
+
+    def __init__(self, backend: SearchBackend):
+        self.backend = backend
+
+    async def start(self, db_engine, session_factory):
+        try:
+            async with db_engine.begin() as conn:
+                await self.backend.ensure_schema(conn)
+        except Exception as e:
+            # e.g. an SQLite build without FTS5; diagrams keep working, search answers 503
+            logger.error(f"Search index ({self.backend.name}) unavailable: {e}")
+            self.backend = SearchBackend()
+            return
+        indexed = await self.backend.backfill(session_factory)
+        if indexed:
+            logger.info(f"Search index built for {indexed} existing diagrams")
+
+    async def upsert(self, db: AsyncSession, documents: List[Dict[str, Any]]):
+        await self.backend.upsert(db, documents)
+
+    async def update_content(self, db: AsyncSession, rows: List[Dict[str, Any]]):
+        await self.backend.update_content(db, rows)
+
+    async def delete(self, db: AsyncSession, diagram_id: int):
+        await self.backend.delete(db, diagram_id)
+
+    async def search(self, db: AsyncSession, query: str, visibility: str, user_id: int, limit: int, offset: int):
+        return await self.backend.search(db, query, visibility, user_id, limit, offset)
+
+search_index = SearchIndex(create_search_backend(settings.SEARCH_BACKEND, engine.dialect.name))
@@ -0,0 +1,223 @@
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+import math
+import numpy as np
+from app.core.config import settings
+
+def _str_order(boxes: np.ndarray, node_size: int) -> np.ndarray:
+    """Sort-Tile-Recursive order: vertical slices by center x, each sorted by center y"""
+    count = len(boxes)
+    slices = max(1, math.ceil(math.sqrt(math.ceil(count / node_size))))
+    per_slice = slices * node_size
+    center_x = boxes[:, 0] + boxes[:, 2]
+    center_y = boxes[:, 1] + boxes[:, 3]
+    slice_of = np.empty(count, dtype=np.int64)
+    slice_of[np.argsort(center_x, kind="stable")] = np.arange(count) // per_slice
+    return np.lexsort((center_y, slice_of))
+
+def shape_bounds(shape: Dict[str, Any]) -> Optional[Tuple[float, float, float, float]]:
+    """(min_x, min_y, max_x, max_y) of a shape, from its points if it has them, else x/y/width/height"""
+    try:
+        points = shape.get("points")
+        if isinstance(points, list) and points:
+            xs, ys = [], []
+            for point in points:
+                if isinstance(point, dict):
+                    xs.append(float(point["x"]))
+                    ys.append(float(point["y"]))
+                else:
+                    xs.append(float(point[0]))
+                    ys.append(float(point[1]))
+            bounds = (min(xs), min(ys), max(xs), max(ys))
+        else:
+            x, y = float(shape["x"]), float(shape["y"])
+            width, height = float(shape.get("width") or 0), float(shape.get("height") or 0)
+            bounds = (min(x, x + width), min(y, y + height), max(x, x + width), max(y, y + height))
+    except (KeyError, IndexError, TypeError, ValueError):
+        return None
+    return bounds if all(math.isfinite(value) for value in bounds) else None
+
+def expand_counts(counts: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """For counts [2, 0, 3] return owners [0, 0, 2, 2, 2] and offsets [0, 1, 0, 1, 2]"""
+    owners = np.repeat(np.arange(counts.size), counts)
+    offsets = np.arange(owners.size) - np.repeat(np.cumsum(counts) - counts, counts)
+    return owners, offsets
+
+class SpatialIndex:
+    """Packed (bulk-loaded) R-tree over bounding boxes, queried one level at a time with NumPy"""
+
+    def __init__(self, boxes: np.ndarray, node_size: int = 16):
+        self.boxes = boxes.reshape(-1, 4)
+        self.node_size = max(2, node_size)
+        # levels[0] groups items; levels[k] groups the nodes of levels[k - 1]
+        self.levels: List[Tuple[np.ndarray, np.ndarray, np.ndarray]] = []
+        self.item_order = np.zeros(0, dtype=np.int64)
+        if len(self.boxes):
+            self._build()
+
+    def _build(self):
+        self.item_order = _str_order(self.boxes, self.node_size)
+        current = self.boxes[self.item_order]
+        while True:
+            count = len(current)
+            starts = np.arange(0, count, self.node_size)
+            sizes = np.diff(np.r_[starts, count])
+            bounds = np.column_stack([
+                np.minimum.reduceat(current[:, 0], starts),
+                np.minimum.reduceat(current[:, 1], starts),
+                np.maximum.reduceat(current[:, 2], starts),
+                np.maximum.reduceat(current[:, 3], starts)
+            ])
+            if len(starts) == 1:
+                self.levels.append((bounds, starts, sizes))
+                return
+            # Reordering this level's nodes leaves their child ranges valid
+            order = _str_order(bounds, self.node_size)
+            self.levels.append((bounds[order], starts[order], sizes[order]))
+            current = bounds[order]
+
+    def query(self, min_x: float, min_y: float, max_x: float, max_y: float) -> np.ndarray:
+        """Indices of boxes intersecting the rectangle (edges touching count), in ascending order"""
+        if not len(self.boxes):
+            return np.zeros(0, dtype=np.int64)
+        nodes = np.arange(len(self.levels[-1][0]))
+        for bounds, starts, sizes in reversed(self.levels):
+            box = bounds[nodes]
+            nodes = nodes[(box[:, 0] <= max_x) & (box[:, 2] >= min_x) & (box[:, 1] <= max_y) & (box[:, 3] >= min_y)]
+            owners, offsets = expand_counts(sizes[nodes])
+            nodes = starts[nodes][owners] + offsets
+        items = self.item_order[nodes]
+        box = self.boxes[items]
+        hit = (box[:, 0] <= max_x) & (box[:, 2] >= min_x) & (box[:, 1] <= max_y) & (box[:, 3] >= min_y)
+        return np.sort(items[hit])
+
+class DiagramSpatialIndex:
+    """R-tree over one diagram version plus the lookups a viewport query needs"""
+
+    def __init__(self, data: Dict[str, Any], node_size: int = 16):
+        self.shapes = list(data.get("shapes") or [])
+        self.connections = [c for c in data.get("connections") or [] if isinstance(c, dict)]
+        self.indexed, self.boxes, self.unbounded = self._bounds(self.shapes)
+        self.extent = np.max(self.boxes[:, 2:] - self.boxes[:, :2], axis=1) if len(self.boxes) else np.zeros(0)
+        self.tree = SpatialIndex(self.boxes, node_size)
+
+        self.position_by_id: Dict[Any, int] = {}
+        for position, shape in enumerate(self.shapes):
+            if isinstance(shape, dict) and "id" in shape:
+                self.position_by_id.setdefault(shape["id"], position)
+        self.connections_by_shape: Dict[Any, List[int]] = {}
+        for position, connection in enumerate(self.connections):
+            for end in (connection.get("source", connection.get("from")), connection.get("target", connection.get("to"))):
+                try:
+                    self.connections_by_shape.setdefault(end, []).append(position)
+                except TypeError:
+                    continue
+
+    @staticmethod
+    def _bounds(shapes: List[Any]):
+        """(positions with geometry, their boxes, positions without any)"""
+        try:
+            # Common case: plain x/y/width/height shapes, converted in one pass
+            geometry = np.array([
+                (shape["x"], shape["y"], shape.get("width") or 0, shape.get("height") or 0)
+                for shape in shapes if "points" not in shape
+            ], dtype=np.float64).reshape(-1, 4)
+            if len(geometry) == len(shapes) and np.isfinite(geometry).all():
+                ends = geometry[:, :2] + geometry[:, 2:]
+                boxes = np.hstack([np.minimum(geometry[:, :2], ends), np.maximum(geometry[:, :2], ends)])
+                return np.arange(len(shapes), dtype=np.int64), boxes, []
+        except (KeyError, TypeError, ValueError, AttributeError):
+            pass
+        indexed, boxes, unbounded = [], [], []
+        for position, shape in enumerate(shapes):
+            bounds = shape_bounds(shape) if isinstance(shape, dict) else None
+            if bounds is None:
+                # No usable geometry: cannot be placed, so every viewport gets it
+                unbounded.append(position)
+            else:
+                indexed.append(position)
+                boxes.append(bounds)
+        return np.array(indexed, dtype=np.int64), np.array(boxes, dtype=np.float64).reshape(-1, 4), unbounded
+
+    def region(self, bbox: Tuple[float, float, float, float], zoom: float, min_pixels: float) -> Dict[str, Any]:
+        """Shapes intersecting bbox that are at least `min_pixels` across at this zoom, plus their connections"""
+        hits = self.tree.query(*bbox)
+        # Shapes with no size are kept: their rendered size is unknown
+        extent = self.extent[hits]
+        visible = (extent <= 0) | (extent * zoom >= min_pixels)
+        culled = int(np.count_nonzero(~visible))
+        positions = sorted(self.indexed[hits[visible]].tolist() + self.unbounded)
+
+        shapes = [self.shapes[position] for position in positions]
+        connection_positions = set()
+        for shape in shapes:
+            if isinstance(shape, dict) and "id" in shape:
+                try:
+                    connection_positions.update(self.connections_by_shape.get(shape["id"], ()))
+                except TypeError:
+                    continue
+        connections = [self.connections[position] for position in sorted(connection_positions)]
+
+        # Far ends of connections leaving the viewport, so the client can draw the edge
+        included = set(positions)
+        context = set()
+        for connection in connections:
+            for end in (connection.get("source", connection.get("from")), connection.get("target", connection.get("to"))):
+                try:
+                    position = self.position_by_id.get(end)
+                except TypeError:
+                    continue
+                if position is not None and position not in included:
+                    context.add(position)
+
+        return {
+            "shapes": shapes,
+            "connections": connections,
+            "context_shapes": [self.shapes[position] for position in sorted(context)],
+            "total_shapes": len(self.shapes),
+            "culled": culled
+        }
+
+class SpatialIndexCache:
+    """Per-process LRU of diagram id -> (version, index); a new version rebuilds on next query"""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._entries: "OrderedDict[int, Tuple[int, DiagramSpatialIndex]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, diagram_id: int, version: int) -> Optional[DiagramSpatialIndex]:
+        entry = self._entries.get(diagram_id)
+        if entry is None or entry[0] != version:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(diagram_id)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, diagram_id: int, version: int, index: DiagramSpatialIndex):
+        if self.max_size <= 0:
+            return
+        current = self._entries.get(diagram_id)
+        # A slow build for an older version must not replace a newer one
+        if current is not None and current[0] > version:
+            return
+        self._entries[diagram_id] = (version, index)
+        self._entries.move_to_end(diagram_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def discard(self, diagram_id: int):
+        self._entries.pop(diagram_id, None)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0
+        }
+
+spatial_index_cache = SpatialIndexCache(settings.SPATIAL_INDEX_CACHE_SIZE)
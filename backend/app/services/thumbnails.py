@@ -0,0 +1,360 @@
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Dict, List, Optional, Tuple
+from xml.sax.saxutils import escape
+import asyncio
+import hashlib
+import json
+import logging
+import multiprocessing
+import re
+from sqlalchemy import select, update
+from app.core.config import settings
+from app.core.database import AsyncSessionLocal
+from app.core.metrics import registry
+from app.models.diagram import Diagram
+from app.services.blob_store import blob_store
+from app.services.diagram_crdt import z_order
+from app.services.diagram_interpreter import DECISION_TYPES, TERMINAL_TYPES
+from app.services.diagram_storage import load_data
+from app.services.document_store import document_store
+from app.services.response_cache import diagram_response_cache
+from app.services.spatial_index import shape_bounds
+
+logger = logging.getLogger(__name__)
+
+# Part of the render hash: bump it when the drawing changes so stored thumbnails are redrawn
+RENDERER_VERSION = 2
+SVG_MEDIA_TYPE = "image/svg+xml"
+
+ELLIPSE_TYPES = {"circle", "ellipse"} | TERMINAL_TYPES
+TEXT_TYPES = {"text", "label", "note"}
+PADDING = 0.05  # Margin around the drawing, as a fraction of the thumbnail size
+MIN_LABEL_PIXELS = 5.0  # Labels smaller than this at a given size are left out
+MIN_POINT_SPACING = 0.75  # Freehand points closer than this many pixels to the last kept one are dropped
+MIN_SHAPE_PIXELS = 2.0  # Shapes smaller than this are drawn as the pixel cell they fall in
+MIN_LINE_PIXELS = 1.5  # Connections shorter than this are left out
+LABEL_FONT_SIZE = 14.0  # Diagram units
+
+# Only plain colors reach the SVG: no url(...) references or attribute breakouts
+_COLOR = re.compile(r"^(#[0-9a-fA-F]{3,8}|[a-zA-Z]{3,20}|rgba?\([0-9.,%\s]{5,40}\))$")
+
+def _color(value: Any, default: str) -> str:
+    return value if isinstance(value, str) and _COLOR.match(value) else default
+
+def _number(value: Any, default: float = 0.0) -> float:
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return default
+    return number if number == number and abs(number) != float("inf") else default
+
+def _points(shape: Dict[str, Any]) -> Optional[List[Tuple[float, float]]]:
+    points = shape.get("points")
+    if not isinstance(points, list) or not points:
+        return None
+    try:
+        return [
+            (float(point["x"]), float(point["y"])) if isinstance(point, dict) else (float(point[0]), float(point[1]))
+            for point in points
+        ]
+    except (KeyError, IndexError, TypeError, ValueError):
+        return None
+
+def _fmt(value: float) -> str:
+    return f"{value:.1f}".rstrip("0").rstrip(".")
+
+def _label(element: Dict[str, Any]) -> Optional[str]:
+    label = element.get("label", element.get("text"))
+    return str(label) if label not in (None, "") else None
+
+def render_svg(data: Dict[str, Any], size: int) -> bytes:
+    """A size x size SVG of the diagram, scaled to fit, with detail the size cannot show left out"""
+    placed = []
+    for shape in z_order(data.get("shapes") or []):
+        if isinstance(shape, dict):
+            bounds = shape_bounds(shape)
+            if bounds is not None:
+                placed.append((shape, bounds))
+
+    out = [
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{size}" height="{size}" viewBox="0 0 {size} {size}">',
+        '<rect width="100%" height="100%" fill="#ffffff"/>'
+    ]
+    if not placed:
+        out.append("</svg>")
+        return "".join(out).encode()
+
+    min_x = min(bounds[0] for _, bounds in placed)
+    min_y = min(bounds[1] for _, bounds in placed)
+    width = max(bounds[2] for _, bounds in placed) - min_x
+    height = max(bounds[3] for _, bounds in placed) - min_y
+    scale = size * (1 - 2 * PADDING) / max(width, height, 1.0)
+    # Centered on the canvas along the shorter side
+    offset_x = (size - width * scale) / 2
+    offset_y = (size - height * scale) / 2
+
+    def x_of(x: float) -> float:
+        return (x - min_x) * scale + offset_x
+
+    def y_of(y: float) -> float:
+        return (y - min_y) * scale + offset_y
+
+    # Connections first, so shapes are drawn over their ends
+    centers = {}
+    for shape, (x0, y0, x1, y1) in placed:
+        try:
+            centers[shape.get("id")] = ((x0 + x1) / 2, (y0 + y1) / 2)
+        except TypeError:
+            continue  # Unhashable id: nothing can connect to it
+    lines, seen = [], set()
+    for connection in data.get("connections") or []:
+        if not isinstance(connection, dict):
+            continue
+        route = _points(connection)
+        if route is None:
+            try:
+                ends = (centers.get(connection.get("source", connection.get("from"))),
+                        centers.get(connection.get("target", connection.get("to"))))
+            except TypeError:
+                continue
+            if None in ends:
+                continue
+            route = list(ends)
+        route = [(x_of(x), y_of(y)) for x, y in route]
+        if max(max(abs(x - route[0][0]), abs(y - route[0][1])) for x, y in route) < MIN_LINE_PIXELS:
+            continue
+        points = " ".join(f"{_fmt(x)},{_fmt(y)}" for x, y in route)
+        if points not in seen:
+            seen.add(points)
+            lines.append(points)
+    if lines:
+        out.append('<g fill="none" stroke="#9ca3af" stroke-width="1">')
+        out.extend(f'<polyline points="{points}"/>' for points in lines)
+        out.append("</g>")
+
+    labels, cells = [], set()
+    for shape, (x0, y0, x1, y1) in placed:
+        if max(x1 - x0, y1 - y0) * scale < MIN_SHAPE_PIXELS:
+            # Too small to show its outline or label: it only darkens the pixel it covers
+            cells.add((int(x_of((x0 + x1) / 2)), int(y_of((y0 + y1) / 2))))
+            continue
+        style = shape.get("style") if isinstance(shape.get("style"), dict) else {}
+        kind = str(shape.get("type") or "").strip().lower()
+        stroke = _color(style.get("stroke", shape.get("stroke", shape.get("color"))), "#374151")
+        fill = _color(style.get("fill", shape.get("fill")), "none")
+        stroke_width = _fmt(max(0.5, min(_number(style.get("strokeWidth", shape.get("strokeWidth")), 2.0) * scale, 3.0)))
+        attributes = f'fill="{fill}" stroke="{stroke}" stroke-width="{stroke_width}"'
+
+        points = _points(shape)
+        if points is not None:
+            # Freehand strokes and lines: a polyline thinned to what the size can resolve
+            kept = [points[0]]
+            for point in points[1:]:
+                if max(abs(point[0] - kept[-1][0]), abs(point[1] - kept[-1][1])) * scale >= MIN_POINT_SPACING:
+                    kept.append(point)
+            if len(kept) == 1 and len(points) > 1:
+                kept.append(points[-1])
+            coordinates = " ".join(f"{_fmt(x_of(x))},{_fmt(y_of(y))}" for x, y in kept)
+            out.append(
+                f'<polyline points="{coordinates}" fill="none" stroke="{stroke}" stroke-width="{stroke_width}" '
+                'stroke-linecap="round" stroke-linejoin="round"/>'
+            )
+            continue
+
+        left, top = x_of(x0), y_of(y0)
+        w, h = max((x1 - x0) * scale, 1.0), max((y1 - y0) * scale, 1.0)
+        if kind in ELLIPSE_TYPES:
+            out.append(f'<ellipse cx="{_fmt(left + w / 2)}" cy="{_fmt(top + h / 2)}" rx="{_fmt(w / 2)}" ry="{_fmt(h / 2)}" {attributes}/>')
+        elif kind in DECISION_TYPES:
+            corners = ((left + w / 2, top), (left + w, top + h / 2), (left + w / 2, top + h), (left, top + h / 2))
+            out.append(f'<polygon points="{" ".join(f"{_fmt(x)},{_fmt(y)}" for x, y in corners)}" {attributes}/>')
+        elif kind not in TEXT_TYPES:
+            out.append(f'<rect x="{_fmt(left)}" y="{_fmt(top)}" width="{_fmt(w)}" height="{_fmt(h)}" rx="1" {attributes}/>')
+
+        label = _label(shape)
+        font = _number(style.get("fontSize", shape.get("fontSize")), LABEL_FONT_SIZE) * scale
+        if kind not in TEXT_TYPES:
+            font = min(font, h * 0.8)
+        if label and font >= MIN_LABEL_PIXELS:
+            # Roughly what fits across the shape at an average glyph width of 0.6em
+            fits = max(1, int(w / (font * 0.6))) if kind not in TEXT_TYPES else len(label)
+            text = label if len(label) <= fits else label[:max(1, fits - 1)] + "…"
+            labels.append(
+                f'<text x="{_fmt(left + w / 2)}" y="{_fmt(top + h / 2)}" font-size="{_fmt(font)}" '
+                f'fill="{_color(style.get("color"), "#111827")}">{escape(text)}</text>'
+            )
+    if cells:
+        out.append(f'<path fill="#9ca3af" d="{"".join(f"M{x} {y}h1v1h-1z" for x, y in sorted(cells))}"/>')
+    if labels:
+        out.append('<g font-family="sans-serif" text-anchor="middle" dominant-baseline="central">')
+        out.extend(labels)
+        out.append("</g>")
+    out.append("</svg>")
+    return "".join(out).encode()
+
+def run_render(data: Dict[str, Any], sizes: List[int]) -> Dict[int, bytes]:
+    """Process-pool entry point: one SVG per size"""
+    return {size: render_svg(data, size) for size in sizes}
+
+def render_hash(data: Dict[str, Any], sizes: List[int]) -> str:
+    """Identifies a set of renders: unchanged data, sizes and renderer mean unchanged thumbnails"""
+    canonical = json.dumps([RENDERER_VERSION, sorted(sizes), data], separators=(",", ":"), sort_keys=True, default=str)
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+def _warm_up():
+    return None
+
+class ThumbnailRenderer:
+    """Redraws diagram thumbnails from their data in a process pool, debounced per diagram.
+
+    schedule() pushes a diagram's render back by `debounce` seconds on every change, but
+    never more than `max_delay` after the first unrendered one, so a room that never stops
+    editing still gets fresh thumbnails. A render whose data hashes the same as the stored
+    thumbnails is skipped; the SVGs go to the blob store, so identical drawings share files.
+    """
+
+    def __init__(
+        self,
+        sizes: List[int],
+        workers: int,
+        debounce: float,
+        max_delay: float,
+        session_factory=AsyncSessionLocal,
+        enabled: bool = True
+    ):
+        self.sizes = sorted({size for size in sizes if size > 0})
+        self.workers = max(1, workers)
+        self.debounce = debounce
+        self.max_delay = max(debounce, max_delay)
+        self.session_factory = session_factory
+        self.enabled = enabled and bool(self.sizes)
+        self._due: Dict[int, float] = {}
+        self._first_change: Dict[int, float] = {}
+        self._tasks: Dict[int, asyncio.Task] = {}
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self.stats = {"scheduled": 0, "rendered": 0, "unchanged": 0, "failed": 0}
+
+    def _executor(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            # spawn: forking a process that holds DB connections and event-loop threads is unsafe
+            self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+        return self._pool
+
+    async def start(self):
+        """Start the worker processes now rather than on the first render"""
+        if self.enabled:
+            loop = asyncio.get_running_loop()
+            await asyncio.gather(*[loop.run_in_executor(self._executor(), _warm_up) for _ in range(self.workers)])
+
+    async def shutdown(self):
+        for task in list(self._tasks.values()):
+            task.cancel()
+        self._tasks.clear()
+        self._due.clear()
+        self._first_change.clear()
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    def schedule(self, diagram_ids: List[int]):
+        """Note that these diagrams' data changed; each is rendered once its edits settle"""
+        if not self.enabled:
+            return
+        now = asyncio.get_running_loop().time()
+        for diagram_id in diagram_ids:
+            first = self._first_change.setdefault(diagram_id, now)
+            self._due[diagram_id] = min(now + self.debounce, first + self.max_delay)
+            self.stats["scheduled"] += 1
+            # A diagram being waited on or rendered picks the new deadline up when that finishes
+            if diagram_id not in self._tasks:
+                self._tasks[diagram_id] = asyncio.create_task(self._wait(diagram_id))
+
+    async def _wait(self, diagram_id: int):
+        loop = asyncio.get_running_loop()
+        try:
+            while (delay := self._due[diagram_id] - loop.time()) > 0:
+                await asyncio.sleep(delay)
+            del self._due[diagram_id], self._first_change[diagram_id]
+            await self.render(diagram_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.stats["failed"] += 1
+            logger.error(f"Thumbnail render of diagram {diagram_id} failed: {e}")
+        finally:
+            if self._tasks.get(diagram_id) is asyncio.current_task():
+                del self._tasks[diagram_id]
+                # Changed again while rendering
+                if diagram_id in self._due:
+                    self._tasks[diagram_id] = asyncio.create_task(self._wait(diagram_id))
+
+    async def render(self, diagram_id: int) -> bool:
+        """Render and store a diagram's thumbnails now; False if it is gone or they are up to date"""
+        async with self.session_factory() as db:
+            row = (await db.execute(
+                select(Diagram.storage, Diagram.data, Diagram.thumbnail_hash).where(Diagram.id == diagram_id)
+            )).first()
+            if row is None:
+                return False
+            # An active room is ahead of the row until its next flush
+            live = document_store.get(diagram_id)
+            data = live.document.snapshot() if live else await load_data(db, diagram_id, row.storage, row.data)
+        data = data or {}
+        digest = await asyncio.to_thread(render_hash, data, self.sizes)
+        if digest == row.thumbnail_hash:
+            self.stats["unchanged"] += 1
+            return False
+
+        renders = await self._execute(data)
+        async with self.session_factory() as db:
+            try:
+                current = (await db.execute(
+                    select(Diagram.thumbnail_blob, Diagram.thumbnail_sizes).where(Diagram.id == diagram_id)
+                )).first()
+                if current is None:
+                    return False
+                # One reference per column holding a digest: the largest render is both a size and the default
+                digests = await blob_store.put_many(db, [renders[size] for size in self.sizes] + [renders[self.sizes[-1]]])
+                # The largest render is the default thumbnail; updated_at stays put so a redraw
+                # does not reorder the dashboard (the diagram's ETag follows thumbnail_blob)
+                await db.execute(
+                    update(Diagram).where(Diagram.id == diagram_id).values(
+                        thumbnail=None,
+                        thumbnail_blob=digests[-1],
+                        thumbnail_type=SVG_MEDIA_TYPE,
+                        thumbnail_sizes={str(size): digest for size, digest in zip(self.sizes, digests[:-1])},
+                        thumbnail_hash=digest,
+                        updated_at=Diagram.updated_at
+                    )
+                )
+                await blob_store.release(db, [current.thumbnail_blob, *(current.thumbnail_sizes or {}).values()])
+                await db.commit()
+            except Exception:
+                await db.rollback()
+                raise
+        diagram_response_cache.discard(diagram_id)
+        self.stats["rendered"] += 1
+        return True
+
+    async def _execute(self, data: Dict[str, Any]) -> Dict[int, bytes]:
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(self._executor(), run_render, data, self.sizes)
+        except BrokenProcessPool:
+            logger.warning("Thumbnail worker pool broke; restarting it")
+            self._pool = None
+            raise
+
+thumbnail_renderer = ThumbnailRenderer(
+    settings.THUMBNAIL_SIZES,
+    settings.THUMBNAIL_WORKERS,
+    settings.THUMBNAIL_DEBOUNCE_SECONDS,
+    settings.THUMBNAIL_MAX_DELAY_SECONDS,
+    enabled=settings.THUMBNAIL_RENDER
+)
+# Room edits reach the row through the write-behind flush
+document_store.flush_listeners.append(thumbnail_renderer.schedule)
+
+registry.callback("thumbnail_renders", "Thumbnail renders scheduled, completed, skipped as unchanged and failed", "counter",
+                  lambda: [((event,), count) for event, count in thumbnail_renderer.stats.items()], ("event",))
@@ -0,0 +1,155 @@
+from typing import Any, Dict, List, Optional, Union
+import json
+import math
+import zlib
+import msgpack
+from app.core.config import settings
+
+# Wire ids for the binary protocol; append only, never renumber
+MESSAGE_TYPES = (
+    None,  # 0: type sent by name in the body
+    "drawing_update",
+    "cursor_move",
+    "cursors",
+    "ping",
+    "pong",
+    "user_joined",
+    "user_left",
+    "diagram_state",
+    "error",
+    "ai_job",
+    "diagram_snapshot",
+    "sync_request",
+    "sync_delta",
+    "diagram_deleted"
+)
+MESSAGE_TYPE_IDS = {name: type_id for type_id, name in enumerate(MESSAGE_TYPES) if name}
+
+# Cursor coordinates travel as integers in 1/COORDINATE_SCALE units
+COORDINATE_SCALE = 10
+# Fields of a presence cursor that is sent as a compact row
+CURSOR_FIELDS = {"member_id", "user_id", "username", "position"}
+
+FLAG_RAW = 0
+FLAG_DEFLATE = 1
+
+class FrameDecodeError(ValueError):
+    """Raised when an inbound frame cannot be decoded by the connection's protocol"""
+
+class JsonCodec:
+    """The original protocol: one JSON object per text frame"""
+
+    name = "json"
+    subprotocol: Optional[str] = None
+    binary = False
+
+    def encode(self, message: Dict[str, Any]) -> str:
+        return json.dumps(message)
+
+    def decode(self, frame: Union[str, bytes]) -> Dict[str, Any]:
+        try:
+            message = json.loads(frame)
+        except ValueError as e:
+            raise FrameDecodeError(f"Invalid JSON frame: {e}")
+        if not isinstance(message, dict):
+            raise FrameDecodeError("Frame must be a JSON object")
+        return message
+
+def _quantize(position: Any) -> Optional[List[int]]:
+    """[x, y] in fixed-point units, or None for anything that is not a plain {"x", "y"} point"""
+    if not isinstance(position, dict) or len(position) != 2:
+        return None
+    x, y = position.get("x"), position.get("y")
+    if not all(isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value) for value in (x, y)):
+        return None
+    return [round(x * COORDINATE_SCALE), round(y * COORDINATE_SCALE)]
+
+def _dequantize(position: List[int]) -> Dict[str, float]:
+    return {"x": position[0] / COORDINATE_SCALE, "y": position[1] / COORDINATE_SCALE}
+
+class MsgpackCodec:
+    """Binary protocol: one flag byte, then a MessagePack array [type id, body].
+
+    Cursor positions are quantized to integers and the "cursors" batch is sent as
+    rows of [user_id, username, x, y, member_id]. Frames whose MessagePack encoding exceeds
+    `compress_threshold` bytes are zlib-deflated (flag 1); small, frequent frames
+    stay raw (flag 0) so they cost no compression CPU.
+    """
+
+    name = "msgpack"
+    subprotocol = "diagram.msgpack.v1"
+    binary = True
+
+    def __init__(self, compress_threshold: int = 1024, compress_level: int = 6):
+        self.compress_threshold = compress_threshold
+        self.compress_level = compress_level
+
+    def encode(self, message: Dict[str, Any]) -> bytes:
+        message_type = message.get("type")
+        type_id = MESSAGE_TYPE_IDS.get(message_type, 0)
+        body = {key: value for key, value in message.items() if key != "type"} if type_id else message
+        if message_type == "cursors" and isinstance(body.get("cursors"), list):
+            # Cursors with an unusual position shape are passed through as maps
+            body["cursors"] = [self._cursor_row(cursor) for cursor in body["cursors"]]
+        elif message_type == "cursor_move":
+            position = _quantize(body.get("position"))
+            if position is not None:
+                body["position"] = position
+
+        payload = msgpack.packb([type_id, body], use_bin_type=True)
+        if 0 < self.compress_threshold < len(payload):
+            return bytes((FLAG_DEFLATE,)) + zlib.compress(payload, self.compress_level)
+        return bytes((FLAG_RAW,)) + payload
+
+    @staticmethod
+    def _cursor_row(cursor: Any) -> Any:
+        position = _quantize(cursor.get("position")) if isinstance(cursor, dict) and set(cursor) == CURSOR_FIELDS else None
+        if position is None:
+            return cursor
+        return [cursor.get("user_id"), cursor.get("username"), *position, cursor.get("member_id")]
+
+    def decode(self, frame: Union[str, bytes]) -> Dict[str, Any]:
+        if not isinstance(frame, (bytes, bytearray)) or not frame:
+            raise FrameDecodeError("Expected a binary frame")
+        try:
+            payload = bytes(frame[1:])
+            if frame[0] == FLAG_DEFLATE:
+                payload = zlib.decompress(payload)
+            elif frame[0] != FLAG_RAW:
+                raise FrameDecodeError(f"Unknown frame flag {frame[0]}")
+            type_id, body = msgpack.unpackb(payload, raw=False, strict_map_key=False)
+        except FrameDecodeError:
+            raise
+        except (ValueError, TypeError, zlib.error, msgpack.UnpackException) as e:
+            raise FrameDecodeError(f"Invalid binary frame: {e}")
+        if not isinstance(body, dict) or not isinstance(type_id, int) or not 0 <= type_id < len(MESSAGE_TYPES):
+            raise FrameDecodeError("Malformed binary frame")
+
+        message = dict(body)
+        if type_id:
+            message["type"] = MESSAGE_TYPES[type_id]
+        try:
+            if message.get("type") == "cursor_move" and isinstance(message.get("position"), list):
+                message["position"] = _dequantize(message["position"])
+            elif message.get("type") == "cursors" and isinstance(message.get("cursors"), list):
+                message["cursors"] = [
+                    {"member_id": row[4] if len(row) > 4 else None, "user_id": row[0], "username": row[1], "position": _dequantize(row[2:4])}
+                    if isinstance(row, list) else row
+                    for row in message["cursors"]
+                ]
+        except (IndexError, TypeError) as e:
+            raise FrameDecodeError(f"Malformed cursor position: {e}")
+        return message
+
+JSON_CODEC = JsonCodec()
+MSGPACK_CODEC = MsgpackCodec(settings.WS_COMPRESS_THRESHOLD_BYTES)
+
+# Server preference order when a client offers several subprotocols
+CODECS_BY_SUBPROTOCOL = {MSGPACK_CODEC.subprotocol: MSGPACK_CODEC}
+
+def negotiate(offered: List[str]):
+    """Pick the codec for a new connection from its Sec-WebSocket-Protocol offer; JSON if none match"""
+    for subprotocol, codec in CODECS_BY_SUBPROTOCOL.items():
+        if subprotocol in offered:
+            return codec
+    return JSON_CODEC
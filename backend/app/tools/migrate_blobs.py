@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+Move existing thumbnails and large diagram documents into the content-addressed blob store.
+
+Base64 thumbnails become blob thumbnails; whole-document (json) diagrams and history
+checkpoints whose JSON reaches BLOB_MIN_BYTES move out of their rows. Identical content is
+stored once. Afterwards unreferenced blobs are collected, and --scan-orphans also deletes
+files no blobs row knows about (left behind by writes that rolled back).
+
+Run from the backend directory, ideally while the server is stopped:
+    python -m app.tools.migrate_blobs
+    python -m app.tools.migrate_blobs --no-data --scan-orphans
+"""
+
+import argparse
+import asyncio
+import base64
+import binascii
+import json
+import os
+import time
+from sqlalchemy import select, update
+from app.core.database import AsyncSessionLocal, engine
+from app.models import Blob, Diagram, DiagramCheckpoint
+from app.services.blob_store import blob_store
+from app.services.diagram_history import stored_checkpoints
+from app.services.diagram_storage import STORAGE_JSON, store_thumbnail, stored_form
+from app.tools.schema import ensure_schema
+
+def decode_thumbnail(value: str):
+    """(media type, bytes) of a Base64 thumbnail column, as GET /thumbnail reads it; None if invalid"""
+    media_type, encoded = "image/png", value
+    if encoded.startswith("data:") and "," in encoded:
+        header, encoded = encoded.split(",", 1)
+        media_type = header[5:].split(";", 1)[0] or media_type
+    try:
+        return media_type, base64.b64decode(encoded)
+    except (ValueError, binascii.Error):
+        return None
+
+async def migrate_thumbnails(batch_size: int, stats):
+    last_id = 0
+    while True:
+        async with AsyncSessionLocal() as db:
+            diagrams = (await db.execute(
+                select(Diagram).where(Diagram.id > last_id, Diagram.thumbnail.isnot(None))
+                .order_by(Diagram.id).limit(batch_size)
+            )).scalars().all()
+            if not diagrams:
+                return
+            for diagram in diagrams:
+                decoded = decode_thumbnail(diagram.thumbnail)
+                if decoded is None:
+                    stats["invalid_thumbnails"] += 1
+                    continue
+                await store_thumbnail(db, diagram, decoded[1], decoded[0])
+                diagram.updated_at = Diagram.updated_at  # Keeps the dashboard order
+                stats["thumbnails"] += 1
+            await db.commit()
+            last_id = diagrams[-1].id
+
+async def migrate_data(batch_size: int, stats):
+    last_id = 0
+    while True:
+        async with AsyncSessionLocal() as db:
+            diagrams = (await db.execute(
+                select(Diagram).where(Diagram.id > last_id, Diagram.storage == STORAGE_JSON)
+                .order_by(Diagram.id).limit(batch_size)
+            )).scalars().all()
+            if not diagrams:
+                return
+            for diagram in diagrams:
+                # Small documents are left untouched rather than rewritten in place
+                storage, data = await stored_form(db, diagram.data)
+                if storage != STORAGE_JSON:
+                    diagram.storage, diagram.data = storage, data
+                    diagram.updated_at = Diagram.updated_at
+                    stats["diagrams"] += 1
+            await db.commit()
+            last_id = diagrams[-1].id
+
+async def migrate_checkpoints(batch_size: int, stats):
+    last_id = 0
+    while True:
+        async with AsyncSessionLocal() as db:
+            rows = (await db.execute(
+                select(DiagramCheckpoint.id, DiagramCheckpoint.data)
+                .where(DiagramCheckpoint.id > last_id, DiagramCheckpoint.data_blob.is_(None))
+                .order_by(DiagramCheckpoint.id).limit(batch_size)
+            )).all()
+            if not rows:
+                return
+            stored = await stored_checkpoints(db, [{"id": row.id, "data": row.data, "data_blob": None} for row in rows])
+            for row in stored:
+                if row["data_blob"]:
+                    await db.execute(
+                        update(DiagramCheckpoint).where(DiagramCheckpoint.id == row["id"])
+                        .values(data=row["data"], data_blob=row["data_blob"])
+                    )
+                    stats["checkpoints"] += 1
+            await db.commit()
+            last_id = rows[-1].id
+
+async def scan_orphans(stats):
+    """Delete blob files (and leftover temporary files) that have no blobs row"""
+    async with AsyncSessionLocal() as db:
+        known = set((await db.execute(select(Blob.digest))).scalars())
+
+    def scan():
+        removed = 0
+        for directory, _, names in os.walk(blob_store.root):
+            for name in names:
+                if name not in known:
+                    os.unlink(os.path.join(directory, name))
+                    removed += 1
+        return removed
+
+    stats["orphan_files"] = await asyncio.to_thread(scan)
+
+async def run(args):
+    started = time.perf_counter()
+    stats = {"thumbnails": 0, "invalid_thumbnails": 0, "diagrams": 0, "checkpoints": 0}
+    try:
+        await ensure_schema()
+        if not args.no_thumbnails:
+            await migrate_thumbnails(args.batch_size, stats)
+        if not args.no_data:
+            await migrate_data(args.batch_size, stats)
+            await migrate_checkpoints(args.batch_size, stats)
+        stats["collected"] = await blob_store.collect()
+        if args.scan_orphans:
+            await scan_orphans(stats)
+    finally:
+        await engine.dispose()
+    return {**stats, "blob_min_bytes": blob_store.min_bytes, "seconds": round(time.perf_counter() - started, 2)}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--no-thumbnails", action="store_true", help="leave Base64 thumbnails in their rows")
+    parser.add_argument("--no-data", action="store_true", help="leave diagram data and checkpoints in their rows")
+    parser.add_argument("--scan-orphans", action="store_true", help="also delete files no blobs row references")
+    parser.add_argument("--batch-size", type=int, default=50, help="rows per transaction")
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(run(args)), indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+Move existing diagrams between the json and elements storage layouts (Diagram.storage).
+
+Brings an older database's schema up to date first (app.tools.schema: the diagram_elements
+table, the diagrams.storage column and the like), then converts diagrams in id order, one transaction per batch. Run it while the server is
+stopped, or at least while the diagrams being converted have no open collaboration room:
+a live room keeps writing in the layout it was opened with.
+
+Run from the backend directory:
+    python -m app.tools.migrate_storage --to elements --min-elements 500
+    python -m app.tools.migrate_storage --to json --ids 12 40
+"""
+
+import argparse
+import asyncio
+import json
+import time
+from sqlalchemy import select
+from app.core.database import AsyncSessionLocal, engine
+from app.models import Diagram
+from app.services.diagram_ops import ELEMENT_COLLECTIONS
+from app.services.diagram_storage import STORAGE_ELEMENTS, STORAGES, load_data, store_data
+from app.tools.schema import ensure_schema
+
+async def migrate(target: str, ids, min_elements: int, batch_size: int):
+    stats = {"converted": 0, "kept_json": 0, "below_min_elements": 0, "elements": 0}
+    last_id = 0
+    while True:
+        async with AsyncSessionLocal() as db:
+            # Blob-stored diagrams are whole-document JSON too, just kept outside the row
+            if target == STORAGE_ELEMENTS:
+                pending = Diagram.storage != STORAGE_ELEMENTS
+            else:
+                pending = Diagram.storage == STORAGE_ELEMENTS
+            query = select(Diagram).where(Diagram.id > last_id, pending)
+            if ids:
+                query = query.where(Diagram.id.in_(ids))
+            diagrams = (await db.execute(query.order_by(Diagram.id).limit(batch_size))).scalars().all()
+            if not diagrams:
+                return stats
+            for diagram in diagrams:
+                data = await load_data(db, diagram.id, diagram.storage, diagram.data)
+                count = sum(len(data.get(collection) or ()) for collection in ELEMENT_COLLECTIONS)
+                if count < min_elements:
+                    stats["below_min_elements"] += 1
+                    continue
+                await store_data(db, diagram, data, target)
+                if (diagram.storage == STORAGE_ELEMENTS) == (target == STORAGE_ELEMENTS):
+                    stats["converted"] += 1
+                    stats["elements"] += count
+                else:
+                    # Some element has no id, or a repeated one
+                    stats["kept_json"] += 1
+            await db.commit()
+            last_id = diagrams[-1].id
+
+async def run(args):
+    started = time.perf_counter()
+    try:
+        await ensure_schema()
+        stats = await migrate(args.to, args.ids, args.min_elements, args.batch_size)
+    finally:
+        await engine.dispose()
+    return {"to": args.to, **stats, "seconds": round(time.perf_counter() - started, 2)}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--to", choices=STORAGES, required=True)
+    parser.add_argument("--ids", type=int, nargs="+", help="only these diagrams")
+    parser.add_argument("--min-elements", type=int, default=0, help="leave smaller diagrams as they are")
+    parser.add_argument("--batch-size", type=int, default=50, help="diagrams per transaction")
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(run(args)), indent=2))
+
+if __name__ == "__main__":
+    main()
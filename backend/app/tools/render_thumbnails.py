@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+"""
+Render server-side thumbnails for existing diagrams (new changes are rendered by the server).
+
+Diagrams whose stored renders already match their data are skipped, so it is cheap to run
+again. Uses THUMBNAIL_SIZES and THUMBNAIL_WORKERS worker processes.
+
+Run from the backend directory:
+    python -m app.tools.render_thumbnails
+    python -m app.tools.render_thumbnails --ids 12 40
+"""
+
+import argparse
+import asyncio
+import json
+import time
+from sqlalchemy import select
+from app.core.database import AsyncSessionLocal, engine
+from app.models import Diagram
+from app.services.thumbnails import thumbnail_renderer
+from app.tools.schema import ensure_schema
+
+async def run(args):
+    started = time.perf_counter()
+    stats = {"rendered": 0, "unchanged": 0, "failed": 0}
+    try:
+        await ensure_schema()
+        async with AsyncSessionLocal() as db:
+            query = select(Diagram.id).order_by(Diagram.id)
+            if args.ids:
+                query = query.where(Diagram.id.in_(args.ids))
+            ids = (await db.execute(query)).scalars().all()
+        await thumbnail_renderer.start()
+        for diagram_id in ids:
+            try:
+                stats["rendered" if await thumbnail_renderer.render(diagram_id) else "unchanged"] += 1
+            except Exception as e:
+                stats["failed"] += 1
+                print(f"Diagram {diagram_id}: {e}")
+    finally:
+        await thumbnail_renderer.shutdown()
+        await engine.dispose()
+    return {**stats, "sizes": thumbnail_renderer.sizes, "seconds": round(time.perf_counter() - started, 2)}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--ids", type=int, nargs="+", help="only these diagrams")
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(run(args)), indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""
+Bring an older database's schema up to date: missing tables, the ADDED_COLUMNS and the indexes
+added to existing tables. The server does this on startup; the migration tools do it first.
+
+Run from the backend directory:
+    python -m app.tools.schema
+"""
+
+import asyncio
+from sqlalchemy import inspect, text
+from app.core.database import engine
+from app.models import Base
+
+# Columns added to existing tables since they were first created; create_all only makes new tables
+ADDED_COLUMNS = (
+    ("diagrams", "version", "INTEGER NOT NULL DEFAULT 1"),
+    ("diagrams", "storage", "VARCHAR(20) NOT NULL DEFAULT 'json'"),
+    ("diagrams", "thumbnail_blob", "VARCHAR(64)"),
+    ("diagrams", "thumbnail_type", "VARCHAR(100)"),
+    ("diagrams", "thumbnail_sizes", "JSON"),
+    ("diagrams", "thumbnail_hash", "VARCHAR(64)"),
+    ("diagram_checkpoints", "data_blob", "VARCHAR(64)"),
+)
+
+def create_indexes(sync_conn):
+    """create_all skips the indexes of tables that already exist, so add the ones declared since"""
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(sync_conn, checkfirst=True)
+
+async def upgrade_schema(conn):
+    """Create missing tables on an open connection, then add any ADDED_COLUMNS and indexes an older database lacks"""
+    await conn.run_sync(Base.metadata.create_all)
+    existing = await conn.run_sync(lambda sync_conn: {
+        table: {column["name"] for column in inspect(sync_conn).get_columns(table)}
+        for table in {table for table, _, _ in ADDED_COLUMNS}
+    })
+    for table, column, definition in ADDED_COLUMNS:
+        if column not in existing[table]:
+            await conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {definition}"))
+    await conn.run_sync(create_indexes)
+
+async def ensure_schema():
+    """Bring the configured database up to date"""
+    async with engine.begin() as conn:
+        await upgrade_schema(conn)
+
+async def run():
+    try:
+        await ensure_schema()
+    finally:
+        # The pool's connections would otherwise keep the process from exiting
+        await engine.dispose()
+
+if __name__ == "__main__":
+    asyncio.run(run())
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+Clean-up engine benchmark: DiagramCleaner.clean latency across diagram sizes
+
+Run from the backend directory:
+    python -m benchmarks.bench_cleanup --sizes 100 1000 10000 100000 --repeat 5
+"""
+
+import argparse
+import json
+import random
+import statistics
+import time
+
+from app.services.diagram_cleanup import DiagramCleaner
+
+def generate_diagram(count, seed):
+    """Hand-drawn-looking layout: a loose grid with jitter, so every pass has real work to do"""
+    rng = random.Random(seed)
+    columns = max(int(count ** 0.5), 1)
+    shapes = []
+    for i in range(count):
+        row, column = divmod(i, columns)
+        width = rng.choice((80, 100, 120))
+        height = rng.choice((40, 60))
+        shapes.append({
+            "id": f"s{i}",
+            "type": rng.choice(("rectangle", "ellipse", "diamond")),
+            "x": column * 140 + rng.uniform(-25, 25),
+            "y": row * 90 + rng.uniform(-20, 20),
+            "width": width,
+            "height": height
+        })
+    connections = [
+        {"id": f"c{i}", "source": f"s{i}", "target": f"s{i + 1}"}
+        for i in range(0, count - 1, 2)
+    ]
+    return {"shapes": shapes, "connections": connections}
+
+def run(args):
+    cleaner = DiagramCleaner()
+    results = []
+    for size in args.sizes:
+        data = generate_diagram(size, args.seed)
+        timings = []
+        improvements = []
+        for _ in range(args.repeat):
+            started = time.perf_counter()
+            _, improvements = cleaner.clean(data)
+            timings.append((time.perf_counter() - started) * 1000)
+        results.append({
+            "shapes": size,
+            "runs": args.repeat,
+            "min_ms": round(min(timings), 2),
+            "median_ms": round(statistics.median(timings), 2),
+            "max_ms": round(max(timings), 2),
+            "improvements": improvements
+        })
+    print(json.dumps(results, indent=2))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000, 100000])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=7)
+    run(parser.parse_args())
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""
+Compression benchmark: ratio and CPU per content-coding for encoded diagram responses,
+at the configured level and at a higher one
+
+Run from the backend directory:
+    python -m benchmarks.bench_compression --shapes 200 2000 20000 --repeat 5
+"""
+
+import argparse
+import json
+import random
+import time
+
+from app.core.compression import COMPRESSORS, LEVELS
+
+def diagram_body(shapes, rng):
+    data = {
+        "shapes": [
+            {"id": f"s{i}", "type": rng.choice(("rectangle", "ellipse", "diamond")), "x": rng.randint(0, 8000),
+             "y": rng.randint(0, 6000), "width": 120, "height": 60, "label": f"Step {i}",
+             "style": {"fill": "#ffffff", "stroke": "#333333", "strokeWidth": 2}}
+            for i in range(shapes)
+        ],
+        "connections": [{"id": f"c{i}", "source": f"s{i}", "target": f"s{i + 1}"} for i in range(shapes - 1)]
+    }
+    return json.dumps({"id": 1, "title": "bench", "data": data, "version": 1}, separators=(",", ":")).encode()
+
+def measure(compressor, body, level, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        compressed = compressor(body, level)
+    return len(compressed), (time.perf_counter() - started) / repeat * 1000
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--shapes", type=int, nargs="+", default=[200, 2000, 20000])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--high-level", type=int, default=9, help="level to compare the configured one against")
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    results = []
+    for shapes in args.shapes:
+        body = diagram_body(shapes, rng)
+        for encoding, compressor in COMPRESSORS.items():
+            for level in sorted({LEVELS[encoding], args.high_level}):
+                size, ms = measure(compressor, body, level, args.repeat)
+                results.append({
+                    "shapes": shapes,
+                    "encoding": encoding,
+                    "level": level,
+                    "configured": level == LEVELS[encoding],
+                    "bytes": len(body),
+                    "compressed_bytes": size,
+                    "ratio": round(len(body) / size, 1),
+                    "compress_ms": round(ms, 2)
+                })
+    print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    main()
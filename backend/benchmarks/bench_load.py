@@ -0,0 +1,353 @@
+#!/usr/bin/env python3
+"""
+Load benchmark: collaboration rooms and diagram CRUD driven in-process against the ASGI app
+
+HTTP goes through httpx's ASGI transport and WebSocket clients speak ASGI directly, so
+the app, its lifespan (backplane, job pool, write-behind flusher) and every client share
+one event loop and no sockets are involved. Client work competes with the server for
+that loop: compare runs on the same machine rather than reading the numbers as capacity.
+
+Scenarios:
+    collab  M rooms x N clients; each client sends drawing_update ops and cursor_move at
+            the given rates and pings once a second. Reports fan-out latency (sender to
+            each peer), ping round trips and frames delivered per second.
+    crud    C workers list, read, PATCH, PUT and create/delete diagrams of S shapes.
+            Reports per-operation latency and requests per second.
+
+Run from the backend directory:
+    python -m benchmarks.bench_load --rooms 10 --clients 5 --duration 10 > load.json
+    python -m benchmarks.bench_load --compare load.json   # exit 1 if a p95 regressed
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import deque
+from urllib.parse import urlsplit
+
+PASSWORD = "bench-password"
+
+def percentile(samples, pct):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return round(ordered[index] * 1000, 2)
+
+def summarize(samples, seconds):
+    return {
+        "samples": len(samples),
+        "per_second": round(len(samples) / seconds, 1) if seconds else None,
+        "p50_ms": percentile(samples, 50),
+        "p95_ms": percentile(samples, 95),
+        "p99_ms": percentile(samples, 99),
+        "max_ms": round(max(samples) * 1000, 2) if samples else None
+    }
+
+def diagram_data(shapes):
+    return {
+        "shapes": [
+            {"id": f"s{i}", "type": "rectangle", "x": (i % 50) * 140, "y": (i // 50) * 90,
+             "width": 120, "height": 60, "label": f"Step {i}"}
+            for i in range(shapes)
+        ],
+        "connections": [{"id": f"c{i}", "source": f"s{i}", "target": f"s{i + 1}"} for i in range(shapes - 1)]
+    }
+
+def move_op(rng, shapes):
+    return {"op": "move", "collection": "shapes", "id": f"s{rng.randrange(shapes)}",
+            "dx": rng.randint(-20, 20), "dy": rng.randint(-20, 20)}
+
+class AsgiWebSocket:
+    """WebSocket client that calls the ASGI app directly, on the caller's event loop"""
+
+    def __init__(self, app, url):
+        parts = urlsplit(url)
+        self.scope = {
+            "type": "websocket", "asgi": {"version": "3.0"}, "scheme": "ws", "http_version": "1.1",
+            "path": parts.path, "raw_path": parts.path.encode(), "root_path": "",
+            "query_string": parts.query.encode(), "headers": [(b"host", b"bench")],
+            "client": ("127.0.0.1", 0), "server": ("bench", 80), "subprotocols": []
+        }
+        self.app = app
+        self._inbound = asyncio.Queue()
+        self._outbound = asyncio.Queue()
+        self._task = None
+
+    async def connect(self):
+        self._task = asyncio.create_task(self.app(self.scope, self._inbound.get, self._outbound.put))
+        await self._inbound.put({"type": "websocket.connect"})
+        message = await self._outbound.get()
+        if message["type"] != "websocket.accept":
+            raise RuntimeError(f"WebSocket rejected: {message}")
+
+    async def send_json(self, payload):
+        await self._inbound.put({"type": "websocket.receive", "text": json.dumps(payload)})
+
+    async def receive_json(self):
+        """Next frame from the server, or None once it has closed the connection"""
+        message = await self._outbound.get()
+        if message["type"] == "websocket.close":
+            return None
+        return json.loads(message["text"] if message.get("text") is not None else message["bytes"])
+
+    async def close(self):
+        await self._inbound.put({"type": "websocket.disconnect", "code": 1000})
+        await self._task
+        # The server sends nothing after a client disconnect; end the stream for the reader
+        await self._outbound.put({"type": "websocket.close", "code": 1000})
+
+class CollabClient:
+    def __init__(self, name, app, room_id, token, args, results, rng):
+        self.name = name
+        self.ws = AsgiWebSocket(app, f"/api/v1/ws/{room_id}?token={token}")
+        self.args = args
+        self.results = results
+        self.rng = rng
+        self.sequence = 0
+        self.pings = deque()
+
+    async def reader(self):
+        while True:
+            message = await self.ws.receive_json()
+            if message is None:
+                return
+            kind = message.get("type")
+            self.results["frames"][kind] = self.results["frames"].get(kind, 0) + 1
+            if kind == "drawing_update":
+                sent_at = self.results["sent_at"].get(message["data"].get("bench_id"))
+                if sent_at is not None:
+                    self.results["fanout"].append(time.perf_counter() - sent_at)
+            elif kind == "pong" and self.pings:
+                self.results["ping"].append(time.perf_counter() - self.pings.popleft())
+            elif kind == "error":
+                self.results["errors"] += 1
+
+    async def writer(self, deadline):
+        args, now = self.args, time.perf_counter()
+        # Random phase so clients do not all fire on the same tick
+        next_op = now + self.rng.random() / args.op_rate
+        next_cursor = now + self.rng.random() / args.cursor_rate
+        next_ping = now + self.rng.random()
+        while True:
+            now = time.perf_counter()
+            if now >= deadline:
+                return
+            if now >= next_op:
+                self.sequence += 1
+                bench_id = f"{self.name}:{self.sequence}"
+                self.results["sent_at"][bench_id] = time.perf_counter()
+                await self.ws.send_json({"type": "drawing_update", "data": {
+                    "ops": [move_op(self.rng, args.shapes)], "bench_id": bench_id
+                }})
+                self.results["ops_sent"] += 1
+                next_op += 1 / args.op_rate
+            if now >= next_cursor:
+                await self.ws.send_json({"type": "cursor_move", "position": {
+                    "x": self.rng.uniform(0, 4000), "y": self.rng.uniform(0, 3000)
+                }})
+                self.results["cursors_sent"] += 1
+                next_cursor += 1 / args.cursor_rate
+            if now >= next_ping:
+                self.pings.append(time.perf_counter())
+                await self.ws.send_json({"type": "ping"})
+                next_ping += 1.0
+            await asyncio.sleep(max(0.0, min(next_op, next_cursor, next_ping, deadline) - time.perf_counter()))
+
+async def run_collab(app, http, tokens, args):
+    rng = random.Random(args.seed)
+    headers = {"Authorization": f"Bearer {tokens[0]}"}
+    rooms = []
+    for room in range(args.rooms):
+        response = await http.post("/api/v1/diagrams/", headers=headers, json={
+            "title": f"collab {room}", "data": diagram_data(args.shapes), "is_public": True
+        })
+        rooms.append(response.json()["id"])
+
+    results = {"fanout": [], "ping": [], "sent_at": {}, "frames": {}, "errors": 0, "ops_sent": 0, "cursors_sent": 0}
+    clients = [
+        CollabClient(f"{room_id}-{index}", app, room_id, tokens[index % len(tokens)], args, results,
+                     random.Random(rng.random()))
+        for room_id in rooms
+        for index in range(args.clients)
+    ]
+    for client in clients:
+        await client.ws.connect()
+    readers = [asyncio.create_task(client.reader()) for client in clients]
+
+    started = time.perf_counter()
+    await asyncio.gather(*[client.writer(started + args.duration) for client in clients])
+    elapsed = time.perf_counter() - started
+    # Let the last broadcasts drain before disconnecting
+    await asyncio.sleep(0.2)
+    for client in clients:
+        await client.ws.close()
+    await asyncio.gather(*readers)
+
+    delivered = sum(results["frames"].values())
+    return {
+        "rooms": args.rooms,
+        "clients_per_room": args.clients,
+        "op_rate_per_client": args.op_rate,
+        "cursor_rate_per_client": args.cursor_rate,
+        "seconds": round(elapsed, 2),
+        "ops_sent": results["ops_sent"],
+        "cursor_moves_sent": results["cursors_sent"],
+        "frames_delivered": delivered,
+        "frames_delivered_per_second": round(delivered / elapsed, 1),
+        "frames_by_type": results["frames"],
+        "errors": results["errors"],
+        "fanout_latency": summarize(results["fanout"], elapsed),
+        "ping_rtt": summarize(results["ping"], elapsed)
+    }
+
+async def crud_worker(http, headers, diagrams, args, rng, deadline, samples, statuses):
+    async def timed(kind, method, url, **kwargs):
+        started = time.perf_counter()
+        response = await http.request(method, url, headers=headers, **kwargs)
+        samples.setdefault(kind, []).append(time.perf_counter() - started)
+        key = f"{kind} {response.status_code}"
+        statuses[key] = statuses.get(key, 0) + 1
+        return response
+
+    versions = {diagram_id: 1 for diagram_id in diagrams}
+    while time.perf_counter() < deadline:
+        diagram_id = rng.choice(diagrams)
+        roll = rng.random()
+        if roll < 0.45:
+            await timed("get", "GET", f"/api/v1/diagrams/{diagram_id}")
+        elif roll < 0.60:
+            await timed("list", "GET", "/api/v1/diagrams/", params={"view": "summary", "limit": 50})
+        elif roll < 0.85:
+            ops = [move_op(rng, args.shapes) for _ in range(rng.randint(1, 5))]
+            response = await timed("patch", "PATCH", f"/api/v1/diagrams/{diagram_id}",
+                                   json={"version": versions[diagram_id], "operations": ops})
+            if response.status_code == 200:
+                versions[diagram_id] = response.json()["version"]
+        elif roll < 0.95:
+            data = diagram_data(args.shapes)
+            response = await timed("put", "PUT", f"/api/v1/diagrams/{diagram_id}", json={"data": data})
+            if response.status_code == 200:
+                versions[diagram_id] = response.json()["version"]
+        else:
+            response = await timed("create", "POST", "/api/v1/diagrams/", json={
+                "title": "scratch", "data": diagram_data(args.shapes)
+            })
+            if response.status_code == 200:
+                await timed("delete", "DELETE", f"/api/v1/diagrams/{response.json()['id']}")
+
+async def run_crud(http, tokens, args):
+    rng = random.Random(args.seed + 1)
+    workers = []
+    for index in range(args.workers):
+        headers = {"Authorization": f"Bearer {tokens[index % len(tokens)]}"}
+        diagrams = []
+        for number in range(args.diagrams_per_worker):
+            response = await http.post("/api/v1/diagrams/", headers=headers, json={
+                "title": f"crud {index}-{number}", "data": diagram_data(args.shapes)
+            })
+            diagrams.append(response.json()["id"])
+        workers.append((headers, diagrams))
+
+    samples, statuses = {}, {}
+    started = time.perf_counter()
+    # Each worker edits only its own diagrams, so version conflicts are not part of the measurement
+    await asyncio.gather(*[
+        crud_worker(http, headers, diagrams, args, random.Random(rng.random()), started + args.duration, samples, statuses)
+        for headers, diagrams in workers
+    ])
+    elapsed = time.perf_counter() - started
+    requests = sum(len(values) for values in samples.values())
+    return {
+        "workers": args.workers,
+        "shapes_per_diagram": args.shapes,
+        "seconds": round(elapsed, 2),
+        "requests": requests,
+        "requests_per_second": round(requests / elapsed, 1),
+        "statuses": statuses,
+        "latency": {kind: summarize(values, elapsed) for kind, values in sorted(samples.items())}
+    }
+
+def latency_summaries(result, path=()):
+    """(path, summary) for every latency summary in a result document"""
+    if isinstance(result, dict):
+        if "p95_ms" in result:
+            yield "/".join(path), result
+        else:
+            for key, value in result.items():
+                yield from latency_summaries(value, path + (key,))
+
+def regressions(baseline, current, tolerance, floor_ms):
+    previous = dict(latency_summaries(baseline))
+    found = []
+    for path, summary in latency_summaries(current):
+        before = previous.get(path, {}).get("p95_ms")
+        after = summary["p95_ms"]
+        if before is not None and after is not None and after > before * (1 + tolerance) and after - before > floor_ms:
+            found.append({"metric": path, "baseline_p95_ms": before, "p95_ms": after})
+    return found
+
+async def run(args):
+    import httpx
+    from app.main import app
+
+    for name in ("app", "httpx"):
+        logging.getLogger(name).setLevel(logging.WARNING)
+    result = {"scenario": args.scenario, "seed": args.seed}
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench") as http:
+            tokens = []
+            for index in range(args.users):
+                username = f"bench{index}"
+                await http.post("/api/v1/auth/register", json={"username": username, "password": PASSWORD})
+                response = await http.post("/api/v1/auth/login", json={"username": username, "password": PASSWORD})
+                tokens.append(response.json()["access_token"])
+
+            if args.scenario in ("all", "collab"):
+                result["collab"] = await run_collab(app, http, tokens, args)
+            if args.scenario in ("all", "crud"):
+                result["crud"] = await run_crud(http, tokens, args)
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenario", choices=("all", "collab", "crud"), default="all")
+    parser.add_argument("--rooms", type=int, default=10)
+    parser.add_argument("--clients", type=int, default=5, help="WebSocket clients per room")
+    parser.add_argument("--op-rate", type=float, default=2.0, help="drawing_update messages per client per second")
+    parser.add_argument("--cursor-rate", type=float, default=15.0, help="cursor_move messages per client per second")
+    parser.add_argument("--workers", type=int, default=8, help="concurrent CRUD workers")
+    parser.add_argument("--diagrams-per-worker", type=int, default=5)
+    parser.add_argument("--shapes", type=int, default=200, help="shapes per diagram")
+    parser.add_argument("--users", type=int, default=4, help="accounts shared by the clients (each costs a bcrypt hash)")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds per scenario")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--compare", help="earlier output of this benchmark; exit 1 if any p95 regressed")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed p95 increase as a fraction")
+    parser.add_argument("--floor-ms", type=float, default=1.0, help="ignore p95 increases smaller than this")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    # The app opens ./test.db relative to the working directory; keep the benchmark's copy private
+    sys.path.insert(0, os.getcwd())
+    os.chdir(tempfile.mkdtemp())
+
+    result = asyncio.run(run(args))
+    if baseline is not None:
+        result["regressions"] = regressions(baseline, result, args.tolerance, args.floor_ms)
+    print(json.dumps(result, indent=2))
+    if result.get("regressions"):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+Login-storm benchmark: WebSocket ping latency while bcrypt logins hammer the same worker
+
+Run from the backend directory:
+    python -m benchmarks.bench_login_storm --logins 200 --concurrency 16
+    python -m benchmarks.bench_login_storm --inline   # hash on the event loop, for comparison
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+def percentile(samples, pct):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return round(ordered[index] * 1000, 2)
+
+def summarize(samples):
+    return {
+        "samples": len(samples),
+        "p50_ms": percentile(samples, 50),
+        "p95_ms": percentile(samples, 95),
+        "p99_ms": percentile(samples, 99),
+        "max_ms": round(max(samples) * 1000, 2) if samples else None
+    }
+
+def ping_loop(websocket, stop, samples):
+    while not stop.is_set():
+        started = time.perf_counter()
+        websocket.send_json({"type": "ping"})
+        while websocket.receive_json().get("type") != "pong":
+            pass
+        samples.append(time.perf_counter() - started)
+        time.sleep(0.005)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--logins", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--baseline-seconds", type=float, default=2.0)
+    parser.add_argument("--inline", action="store_true", help="run bcrypt on the event loop (pre-pool behaviour)")
+    args = parser.parse_args()
+
+    # The app opens ./test.db relative to the working directory; keep the benchmark's copy private
+    sys.path.insert(0, os.getcwd())
+    os.chdir(tempfile.mkdtemp())
+
+    from fastapi.testclient import TestClient
+    from app.main import app
+    from app.services import auth
+
+    if args.inline:
+        async def run_inline(func, *func_args):
+            return func(*func_args)
+        auth.password_hash_pool.run = run_inline
+
+    with TestClient(app) as client:
+        client.post("/api/v1/auth/register", json={"username": "bench", "password": "bench-password"})
+        token = client.post(
+            "/api/v1/auth/login", json={"username": "bench", "password": "bench-password"}
+        ).json()["access_token"]
+
+        with client.websocket_connect(f"/api/v1/ws/bench?token={token}") as websocket:
+            websocket.receive_json()
+
+            stop = threading.Event()
+            baseline = []
+            pinger = threading.Thread(target=ping_loop, args=(websocket, stop, baseline))
+            pinger.start()
+            time.sleep(args.baseline_seconds)
+            stop.set()
+            pinger.join()
+
+            stop = threading.Event()
+            during_storm = []
+            pinger = threading.Thread(target=ping_loop, args=(websocket, stop, during_storm))
+            pinger.start()
+
+            statuses = {}
+            def login(_):
+                response = client.post(
+                    "/api/v1/auth/login", json={"username": "bench", "password": "bench-password"}
+                )
+                return response.status_code
+
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+                for code in pool.map(login, range(args.logins)):
+                    statuses[code] = statuses.get(code, 0) + 1
+            storm_seconds = time.perf_counter() - started
+
+            stop.set()
+            pinger.join()
+
+    print(json.dumps({
+        "mode": "inline" if args.inline else "pool",
+        "logins": args.logins,
+        "concurrency": args.concurrency,
+        "storm_seconds": round(storm_seconds, 2),
+        "login_statuses": statuses,
+        "ws_ping_baseline": summarize(baseline),
+        "ws_ping_during_storm": summarize(during_storm)
+    }, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+Search benchmark: ranked FTS5 query latency over a large diagram corpus
+
+Run from the backend directory:
+    python -m benchmarks.bench_search --diagrams 100000 --repeat 20
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import statistics
+import tempfile
+import time
+
+from sqlalchemy import insert, text
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from app.core.database import create_engine_for
+from app.models import Base, Diagram, User
+from app.services.search_index import Fts5SearchBackend, extract_text, search_document
+
+VOCABULARY_SIZE = 20000
+
+SYLLABLES = "ka lo mi ne ru sa te vo pi da fe gu ho ji be ze ma no ri su".split()
+
+def vocabulary(size, rng):
+    """Pseudo-words; drawn with Zipf weights so a few are everywhere and most are rare"""
+    words = set()
+    while len(words) < size:
+        words.add("".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))))
+    return sorted(words, key=lambda word: rng.random())
+
+def generate_diagram(rng, words, cum_weights, index):
+    pick = lambda count: " ".join(rng.choices(words, cum_weights=cum_weights, k=count))
+    shapes = [
+        {"id": f"s{i}", "type": "rectangle", "x": i * 120, "y": 0, "width": 100, "height": 60, "label": pick(2)}
+        for i in range(rng.randint(3, 12))
+    ]
+    return {
+        "title": f"{pick(3)} {index}",
+        "description": pick(8),
+        "data": {"shapes": shapes, "connections": []}
+    }
+
+def queries(words):
+    return {
+        "most_common_word": words[0],
+        "common_word": words[10],
+        "mid_frequency_word": words[200],
+        "rare_word": words[3000],
+        "two_words": f"{words[5]} {words[50]}",
+        "prefix": words[1][:3],
+        "no_match": "zzzz"
+    }
+
+async def build(path, count, owners, seed):
+    engine = create_engine_for(f"sqlite:///{path}")
+    backend = Fts5SearchBackend()
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        await backend.ensure_schema(conn)
+    Session = async_sessionmaker(engine, expire_on_commit=False)
+    rng = random.Random(seed)
+    words = vocabulary(VOCABULARY_SIZE, rng)
+    cum_weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(len(words))))
+    async with Session() as db:
+        await db.execute(insert(User.__table__), [
+            {"username": f"owner{i}", "password_hash": "x", "is_active": True} for i in range(owners)
+        ])
+        for start in range(0, count, 5000):
+            diagrams = [generate_diagram(rng, words, cum_weights, i) for i in range(start, min(start + 5000, count))]
+            await db.execute(insert(Diagram.__table__), [
+                {"id": start + i + 1, "owner_id": (start + i) % owners + 1, "is_public": (start + i) % 10 == 0,
+                 "version": 1, **diagram}
+                for i, diagram in enumerate(diagrams)
+            ])
+            await backend.upsert(db, [
+                search_document(start + i + 1, diagram["title"], diagram["description"], (start + i) % owners + 1,
+                                (start + i) % 10 == 0, extract_text(diagram["data"]))
+                for i, diagram in enumerate(diagrams)
+            ])
+        await db.commit()
+    return engine, Session, backend, words
+
+async def run(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        started = time.perf_counter()
+        engine, Session, backend, words = await build(os.path.join(tmp, "search.db"), args.diagrams, args.owners, args.seed)
+        build_seconds = time.perf_counter() - started
+
+        results = []
+        async with Session() as db:
+            for name, query in queries(words).items():
+                timings, hits = [], []
+                for _ in range(args.repeat):
+                    started = time.perf_counter()
+                    hits = await backend.search(db, query, "all", 1, args.limit, 0)
+                    timings.append((time.perf_counter() - started) * 1000)
+                matches = await db.scalar(
+                    text("SELECT count(*) FROM diagram_search WHERE diagram_search MATCH :match"),
+                    {"match": backend._text_query(query.split())}
+                )
+                results.append({
+                    "query": name,
+                    "q": query,
+                    "matching_diagrams": matches,
+                    "hits_returned": len(hits),
+                    "median_ms": round(statistics.median(timings), 2),
+                    "p95_ms": round(sorted(timings)[int(len(timings) * 0.95) - 1], 2),
+                    "max_ms": round(max(timings), 2)
+                })
+        await engine.dispose()
+
+    print(json.dumps({
+        "diagrams": args.diagrams,
+        "owners": args.owners,
+        "visible_to_user": "own diagrams plus public (10%)",
+        "build_seconds": round(build_seconds, 1),
+        "queries": results
+    }, indent=2))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--diagrams", type=int, default=100000)
+    parser.add_argument("--owners", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--limit", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=7)
+    asyncio.run(run(parser.parse_args()))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Storage layout benchmark: json column vs diagram_elements rows for the same diagrams.
+
+Per size and layout it times a full read (row plus reassembly), the write-behind flush
+after a few edits in a live room, and an uncached viewport query (R-tree build vs the
+element table's bbox index).
+
+Run from the backend directory:
+    python -m benchmarks.bench_storage --shapes 2000 20000 --edits 10 --repeat 5
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import tempfile
+import time
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from app.core.database import create_engine_for
+from app.models import Base, Diagram, User
+from app.services.diagram_storage import STORAGES, load_data, load_region, store_data
+from app.services.document_store import DocumentStore
+from app.services.spatial_index import DiagramSpatialIndex
+
+def diagram_data(shapes, rng):
+    return {
+        "shapes": [
+            {"id": f"s{i}", "type": "rectangle", "x": rng.randint(0, 40000), "y": rng.randint(0, 40000),
+             "width": 120, "height": 60, "label": f"Step {i}", "style": {"fill": "#ffffff", "stroke": "#333333"}}
+            for i in range(shapes)
+        ],
+        "connections": [{"id": f"c{i}", "source": f"s{i}", "target": f"s{rng.randrange(shapes)}"} for i in range(shapes)],
+        "viewport": {"x": 0, "y": 0, "zoom": 1}
+    }
+
+def millis(samples):
+    return round(statistics.median(samples) * 1000, 2)
+
+async def measure(Session, store, diagram_id, storage, shapes, args, rng):
+    reads, flushes, regions = [], [], []
+    for _ in range(args.repeat):
+        async with Session() as db:
+            started = time.perf_counter()
+            row = (await db.execute(select(Diagram.data, Diagram.storage).where(Diagram.id == diagram_id))).first()
+            await load_data(db, diagram_id, row.storage, row.data)
+            reads.append(time.perf_counter() - started)
+
+        for _ in range(args.edits):
+            store.apply(diagram_id, [{"op": "move", "id": f"s{rng.randrange(shapes)}", "dx": 3, "dy": -2}])
+        started = time.perf_counter()
+        await store.flush([diagram_id])
+        flushes.append(time.perf_counter() - started)
+
+        # Viewport of about 1% of the canvas, as an uncached (first) region read pays it
+        x, y = rng.randint(0, 36000), rng.randint(0, 36000)
+        bbox = (x, y, x + 4000, y + 4000)
+        async with Session() as db:
+            started = time.perf_counter()
+            if storage == "elements":
+                await load_region(db, diagram_id, bbox, 1.0, 1.0)
+            else:
+                data = await db.scalar(select(Diagram.data).where(Diagram.id == diagram_id))
+                DiagramSpatialIndex(data).region(bbox, 1.0, 1.0)
+            regions.append(time.perf_counter() - started)
+    return {"full_read_ms": millis(reads), "flush_ms": millis(flushes), "region_ms": millis(regions)}
+
+async def run(args):
+    rng = random.Random(args.seed)
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_engine_for(f"sqlite:///{os.path.join(tmp, 'bench.db')}")
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        Session = async_sessionmaker(engine, expire_on_commit=False)
+        store = DocumentStore(session_factory=Session, flush_interval=3600)
+        try:
+            async with Session() as db:
+                owner = User(username="bench", password_hash="x")
+                db.add(owner)
+                await db.commit()
+            for shapes in args.shapes:
+                data = diagram_data(shapes, rng)
+                for storage in STORAGES:
+                    async with Session() as db:
+                        diagram = Diagram(title=f"bench {shapes}", owner_id=owner.id)
+                        db.add(diagram)
+                        await store_data(db, diagram, data, storage)
+                        await db.commit()
+                    await store.open(diagram.id)
+                    results.append({
+                        "shapes": shapes,
+                        "storage": storage,
+                        "edits_per_flush": args.edits,
+                        **await measure(Session, store, diagram.id, storage, shapes, args, rng)
+                    })
+            await store.shutdown()
+        finally:
+            await engine.dispose()
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--shapes", type=int, nargs="+", default=[2000, 20000])
+    parser.add_argument("--edits", type=int, default=10, help="ops applied between flushes")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(run(args)), indent=2))
+
+if __name__ == "__main__":
+    main()
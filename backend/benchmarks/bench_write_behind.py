@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Write-behind benchmark: DB writes saved by the live document store under sustained editing
+
+Run from the backend directory:
+    python -m benchmarks.bench_write_behind --rooms 20 --users 5 --rate 10 --duration 10
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import tempfile
+import time
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from app.core.database import create_engine_for
+from app.models import Base, Diagram, User
+from app.services.document_store import DocumentStore
+
+async def create_database(path, rooms, shapes_per_diagram):
+    engine = create_engine_for(f"sqlite:///{path}")
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    Session = async_sessionmaker(engine, expire_on_commit=False)
+    async with Session() as db:
+        owner = User(username="bench", password_hash="x")
+        db.add(owner)
+        await db.flush()
+        for room in range(rooms):
+            shapes = [
+                {"id": f"s{i}", "type": "rectangle", "x": i * 20, "y": 0, "width": 10, "height": 10}
+                for i in range(shapes_per_diagram)
+            ]
+            db.add(Diagram(title=f"bench {room}", data={"shapes": shapes, "connections": []}, owner_id=owner.id))
+        await db.commit()
+        ids = list((await db.execute(select(Diagram.id))).scalars())
+    return engine, Session, ids
+
+async def editor(store, diagram_id, rate, deadline, shapes_per_diagram):
+    interval = 1.0 / rate
+    while time.perf_counter() < deadline:
+        store.apply(diagram_id, [{
+            "op": "move",
+            "id": f"s{random.randrange(shapes_per_diagram)}",
+            "dx": random.randint(-5, 5),
+            "dy": random.randint(-5, 5)
+        }])
+        await asyncio.sleep(interval)
+
+async def run(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        engine, Session, ids = await create_database(os.path.join(tmp, "bench.db"), args.rooms, args.shapes)
+        store = DocumentStore(session_factory=Session, flush_interval=args.flush_interval)
+
+        for diagram_id in ids:
+            for _ in range(args.users):
+                await store.open(diagram_id)
+
+        started = time.perf_counter()
+        deadline = started + args.duration
+        await asyncio.gather(*[
+            editor(store, diagram_id, args.rate, deadline, args.shapes)
+            for diagram_id in ids
+            for _ in range(args.users)
+        ])
+        for diagram_id in ids:
+            for _ in range(args.users):
+                store.release(diagram_id)
+        await store.shutdown()
+        await engine.dispose()
+        elapsed = time.perf_counter() - started
+
+    stats = store.stats
+    result = {
+        "rooms": args.rooms,
+        "users_per_room": args.users,
+        "ops_per_user_per_second": args.rate,
+        "duration_s": round(elapsed, 2),
+        "ops_applied": stats["ops_applied"],
+        "write_through_row_writes": stats["op_batches"],
+        "write_behind_row_writes": stats["rows_written"],
+        "write_behind_statements": stats["flushes"],
+        "row_write_reduction": round(stats["op_batches"] / max(stats["rows_written"], 1), 1),
+        "statement_reduction": round(stats["op_batches"] / max(stats["flushes"], 1), 1)
+    }
+    print(json.dumps(result, indent=2))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rooms", type=int, default=20)
+    parser.add_argument("--users", type=int, default=5)
+    parser.add_argument("--rate", type=float, default=10.0, help="ops per user per second")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds of sustained editing")
+    parser.add_argument("--shapes", type=int, default=200, help="shapes per diagram")
+    parser.add_argument("--flush-interval", type=float, default=2.0)
+    asyncio.run(run(parser.parse_args()))
+
+if __name__ == "__main__":
+    main()
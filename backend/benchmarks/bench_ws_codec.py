@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+WebSocket codec benchmark: bytes per frame and encode/decode CPU, JSON vs diagram.msgpack.v1
+
+"json+deflate" is the JSON frame after permessage-deflate-style compression (zlib, no
+context takeover), i.e. roughly what a compressing transport puts on the wire.
+
+Run from the backend directory:
+    python -m benchmarks.bench_ws_codec --iterations 2000 --users 20 --shapes 2000
+"""
+
+import argparse
+import json
+import random
+import time
+import zlib
+
+from app.services.ws_codec import JSON_CODEC, MsgpackCodec
+
+def sample_messages(users, shapes, seed):
+    rng = random.Random(seed)
+    cursors = [
+        {
+            "member_id": f"node:{i}", "user_id": i, "username": f"user{i}",
+            "position": {"x": round(rng.uniform(0, 4000), 1), "y": round(rng.uniform(0, 3000), 1)}
+        }
+        for i in range(users)
+    ]
+    move = {"op": "move", "collection": "shapes", "id": "s42", "dx": 12.5, "dy": -3.0}
+    element = {
+        "id": "s4242", "type": "rectangle", "x": 120.0, "y": 340.0, "width": 100, "height": 60,
+        "label": "Validate input", "style": {"fill": "#ffffff", "stroke": "#333333", "strokeWidth": 2}
+    }
+    state = {
+        "shapes": [
+            {"id": f"s{i}", "type": rng.choice(("rectangle", "ellipse", "diamond")), "x": rng.randint(0, 8000),
+             "y": rng.randint(0, 6000), "width": 100, "height": 60, "label": f"Step {i}"}
+            for i in range(shapes)
+        ],
+        "connections": [{"id": f"c{i}", "source": f"s{i}", "target": f"s{i + 1}"} for i in range(shapes - 1)]
+    }
+    return {
+        "cursor_move": {"type": "cursor_move", "position": cursors[0]["position"]},
+        "cursors": {"type": "cursors", "cursors": cursors},
+        "op_move": {"type": "drawing_update", "data": {"ops": [move], "version": 1024}, "user_id": 3, "username": "user3"},
+        "op_add": {"type": "drawing_update", "data": {"ops": [{"op": "add", "collection": "shapes", "element": element}], "version": 1025}, "user_id": 3, "username": "user3"},
+        "large_state": {"type": "drawing_update", "data": {"ops": [], "snapshot": state, "version": 1026}, "user_id": 3, "username": "user3"}
+    }
+
+def deflate(frame):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+    return compressor.compress(frame) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+def time_per_call(func, arg, iterations):
+    started = time.perf_counter()
+    for _ in range(iterations):
+        func(arg)
+    return (time.perf_counter() - started) / iterations * 1e6
+
+def run(args):
+    msgpack_codec = MsgpackCodec(args.compress_threshold)
+    results = []
+    for name, message in sample_messages(args.users, args.shapes, args.seed).items():
+        iterations = max(1, args.iterations // 100) if name == "large_state" else args.iterations
+        json_frame = JSON_CODEC.encode(message)
+        binary_frame = msgpack_codec.encode(message)
+        json_bytes = len(json_frame.encode())
+        results.append({
+            "message": name,
+            "json_bytes": json_bytes,
+            "json_deflate_bytes": len(deflate(json_frame.encode())),
+            "msgpack_bytes": len(binary_frame),
+            "msgpack_deflated": binary_frame[0] == 1,
+            "size_ratio": round(len(binary_frame) / json_bytes, 3),
+            "json_encode_us": round(time_per_call(JSON_CODEC.encode, message, iterations), 2),
+            "json_encode_deflate_us": round(time_per_call(lambda m: deflate(JSON_CODEC.encode(m).encode()), message, iterations), 2),
+            "msgpack_encode_us": round(time_per_call(msgpack_codec.encode, message, iterations), 2),
+            "json_decode_us": round(time_per_call(JSON_CODEC.decode, json_frame, iterations), 2),
+            "msgpack_decode_us": round(time_per_call(msgpack_codec.decode, binary_frame, iterations), 2)
+        })
+    print(json.dumps(results, indent=2))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=2000)
+    parser.add_argument("--users", type=int, default=20, help="cursors in one batched presence frame")
+    parser.add_argument("--shapes", type=int, default=2000, help="shapes in the large state frame")
+    parser.add_argument("--compress-threshold", type=int, default=1024)
+    parser.add_argument("--seed", type=int, default=7)
+    run(parser.parse_args())
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+import itertools
+import os
+import tempfile
+
+# Settings are read when the app is imported, so the test environment goes first
+_root = tempfile.mkdtemp(prefix="diagramflow-tests-")
+os.environ.update({
+    "DATABASE_URL": f"sqlite:///{_root}/test.db",
+    "BLOB_STORE_PATH": os.path.join(_root, "blobs"),
+    "WS_BACKPLANE": "memory",
+    "WS_BACKPLANE_SOCKET": os.path.join(_root, "backplane.sock"),
+    "THUMBNAIL_RENDER": "false",
+    "AI_JOB_WORKERS": "1",
+    "DIAGRAM_FLUSH_INTERVAL_SECONDS": "0.05"
+})
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+from app.core.database import create_engine_for
+from app.main import app
+from app.models import Base
+from app.services.search_index import search_index
+
+_usernames = itertools.count(1)
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+@pytest.fixture(scope="session")
+def client():
+    with TestClient(app) as client:
+        yield client
+
+@pytest.fixture
+def make_user(client):
+    """Register and log in a new user; returns (user id, auth headers, token)"""
+    def make():
+        username = f"user{next(_usernames)}"
+        user = client.post("/api/v1/auth/register", json={"username": username, "password": "secret"}).json()
+        token = client.post("/api/v1/auth/login", json={"username": username, "password": "secret"}).json()["access_token"]
+        return user["id"], {"Authorization": f"Bearer {token}"}, token
+    return make
+
+@pytest.fixture
+async def sessions(tmp_path):
+    """Session factory for an empty database of its own, for services tested without the app"""
+    engine = create_engine_for(f"sqlite:///{tmp_path}/services.db")
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        await search_index.backend.ensure_schema(conn)
+    yield async_sessionmaker(engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+    await engine.dispose()
@@ -0,0 +1,55 @@
+import asyncio
+from typing import Any, Dict, List, Optional
+from app.services.ws_codec import JSON_CODEC
+
+SHAPE = {"type": "rectangle", "width": 10, "height": 10}
+
+def shape(shape_id: str, x: float = 0, y: float = 0, **fields) -> Dict[str, Any]:
+    return {**SHAPE, "id": shape_id, "x": x, "y": y, **fields}
+
+def diagram_data(*shapes: Dict[str, Any], connections: Optional[List[Dict[str, Any]]] = None) -> Dict[str, Any]:
+    return {"shapes": list(shapes), "connections": connections or []}
+
+class FakeWebSocket:
+    """Enough of starlette's WebSocket for ConnectionManager; `gate` holds sends until it is set"""
+
+    def __init__(self, subprotocols: Optional[List[str]] = None):
+        self.scope = {"subprotocols": subprotocols or []}
+        self.sent: List[Any] = []
+        self.closed: Optional[int] = None
+        self.gate = asyncio.Event()
+        self.gate.set()
+
+    async def accept(self, subprotocol: Optional[str] = None):
+        self.subprotocol = subprotocol
+
+    async def send_text(self, frame: str):
+        await self.gate.wait()
+        self.sent.append(frame)
+
+    async def send_bytes(self, frame: bytes):
+        await self.gate.wait()
+        self.sent.append(frame)
+
+    async def close(self, code: int = 1000, reason: Optional[str] = None):
+        self.closed = code
+
+    def messages(self, codec=JSON_CODEC) -> List[Dict[str, Any]]:
+        return [codec.decode(frame) for frame in self.sent]
+
+async def settle(rounds: int = 5):
+    """Let writer tasks drain their queues"""
+    for _ in range(rounds):
+        await asyncio.sleep(0)
+
+async def insert_diagram(sessions, data: Dict[str, Any], version: int = 1, is_public: bool = True) -> int:
+    """Add a diagram (and an owner for it) straight to a test database; returns its id"""
+    from app.models import Diagram, User
+    async with sessions() as db:
+        owner = User(username=f"owner{id(data)}-{version}", password_hash="x")
+        db.add(owner)
+        await db.flush()
+        diagram = Diagram(title="Test", data=data, owner_id=owner.id, is_public=is_public, version=version)
+        db.add(diagram)
+        await db.commit()
+        return diagram.id
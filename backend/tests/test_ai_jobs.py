@@ -0,0 +1,54 @@
+import pytest
+from app.services.ai_jobs import AIJobQueue
+from tests.helpers import diagram_data, shape
+
+pytestmark = pytest.mark.anyio
+
+DATA = diagram_data(shape("a", 3, 2), shape("b", 4, 1))
+
+@pytest.fixture
+def sent():
+    return []
+
+@pytest.fixture
+async def queue(sent):
+    queue = AIJobQueue(1, 1, 4, retention_seconds=60, notify=lambda room, message: sent.append((room, message["job"])))
+    yield queue
+    await queue.shutdown()
+
+async def test_rooms_joining_a_running_job_get_its_progress(queue, sent):
+    job, deduplicated = await queue.submit("clean", DATA, 1, 10, room="10")
+    assert not deduplicated
+    shared, deduplicated = await queue.submit("clean", DATA, 2, 20, room="20")
+    assert deduplicated and shared is job
+    assert not job.finished
+    await job.done.wait()
+
+    by_room = {}
+    for room, frame in sent:
+        by_room.setdefault(room, []).append(frame)
+    assert by_room["20"][-1]["status"] == "succeeded"
+    assert by_room["20"][-1]["result"]["cleaned_data"]["shapes"][0]["x"] == 0
+    assert {frame["diagram_id"] for frame in by_room["10"]} == {10}
+    assert {frame["diagram_id"] for frame in by_room["20"]} == {20}
+    assert job.to_dict(diagram_id=job.diagram_ids[2])["diagram_id"] == 20
+
+async def test_a_finished_job_is_pushed_once_to_a_new_room(queue, sent):
+    job, _ = await queue.submit("clean", DATA, 1, 10, room="10")
+    await job.done.wait()
+    await queue.submit("clean", DATA, 1, 10, room="10")
+    assert [room for room, _ in sent].count("10") == 3  # queued, running, succeeded
+    await queue.submit("clean", DATA, 2, 30, room="30")
+    (room, frame), = [entry for entry in sent if entry[0] == "30"]
+    assert frame["status"] == "succeeded" and frame["diagram_id"] == 30
+
+def test_deduplicated_submissions_report_the_callers_diagram(client, make_user):
+    _, first, _ = make_user()
+    _, second, _ = make_user()
+    body = {"kind": "clean", "diagram_data": diagram_data(shape("z", 7, 7), shape("y", 123, 9))}
+    job = client.post("/api/v1/ai/jobs", json={**body, "diagram_id": 101}, headers=first).json()
+    joined = client.post("/api/v1/ai/jobs", json={**body, "diagram_id": 202}, headers=second).json()
+    assert joined["job_id"] == job["job_id"] and joined["deduplicated"]
+    assert joined["diagram_id"] == 202
+    assert client.get(f"/api/v1/ai/jobs/{job['job_id']}", headers=second).json()["diagram_id"] == 202
+    assert client.get(f"/api/v1/ai/jobs/{job['job_id']}", headers=first).json()["diagram_id"] == 101
@@ -0,0 +1,72 @@
+import time
+from app.services.auth import AuthCache, auth_cache
+
+class User:
+    def __init__(self, user_id: int):
+        self.id = user_id
+
+def test_hit_and_miss_are_counted():
+    cache = AuthCache(max_size=4, ttl_seconds=60)
+    user = User(1)
+    assert cache.get("t1") is None
+    cache.put("t1", user)
+    assert cache.get("t1") is user
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+
+def test_entries_expire_after_the_ttl(monkeypatch):
+    cache = AuthCache(max_size=4, ttl_seconds=30)
+    cache.put("t1", User(1))
+    now = time.monotonic()
+    monkeypatch.setattr(time, "monotonic", lambda: now + 31)
+    assert cache.get("t1") is None
+    assert cache.stats()["size"] == 0
+
+def test_token_expiry_caps_the_lifetime(monkeypatch):
+    cache = AuthCache(max_size=4, ttl_seconds=300)
+    cache.put("expired", User(1), token_expiry=time.time() - 1)
+    assert cache.stats()["size"] == 0
+
+    cache.put("t1", User(1), token_expiry=time.time() + 5)
+    now = time.monotonic()
+    monkeypatch.setattr(time, "monotonic", lambda: now + 10)
+    assert cache.get("t1") is None
+
+def test_least_recently_used_token_is_evicted():
+    cache = AuthCache(max_size=2, ttl_seconds=60)
+    cache.put("t1", User(1))
+    cache.put("t2", User(2))
+    cache.get("t1")
+    cache.put("t3", User(3))
+    assert cache.get("t2") is None
+    assert cache.get("t1") is not None
+    assert cache.get("t3") is not None
+
+def test_invalidate_user_drops_every_token_of_that_user():
+    cache = AuthCache(max_size=4, ttl_seconds=60)
+    cache.put("a1", User(1))
+    cache.put("a2", User(1))
+    cache.put("b1", User(2))
+    cache.invalidate_user(1)
+    assert cache.get("a1") is None and cache.get("a2") is None
+    assert cache.get("b1") is not None
+    assert cache.stats()["invalidations"] == 2
+
+def test_zero_size_disables_the_cache():
+    cache = AuthCache(max_size=0, ttl_seconds=60)
+    cache.put("t1", User(1))
+    assert cache.get("t1") is None
+
+def test_repeat_requests_are_served_from_the_cache(client, make_user):
+    user_id, headers, token = make_user()
+    assert client.get("/api/v1/auth/me", headers=headers).json()["id"] == user_id
+    hits = auth_cache.hits
+    assert client.get("/api/v1/auth/me", headers=headers).json()["id"] == user_id
+    assert auth_cache.hits == hits + 1
+
+    auth_cache.invalidate_user(user_id)
+    assert client.get("/api/v1/auth/me", headers=headers).status_code == 200
+
+def test_invalid_tokens_are_rejected(client):
+    response = client.get("/api/v1/auth/me", headers={"Authorization": "Bearer not-a-token"})
+    assert response.status_code == 401
@@ -0,0 +1,42 @@
+import asyncio
+import pytest
+from app.services.backplane import Backplane, InProcessBackplane, UnixSocketBackplane, create_backplane
+
+pytestmark = pytest.mark.anyio
+
+def test_a_backplane_must_implement_publish():
+    with pytest.raises(TypeError):
+        Backplane()
+    assert isinstance(create_backplane("memory", ""), InProcessBackplane)
+    with pytest.raises(ValueError):
+        create_backplane("carrier-pigeon", "")
+
+async def wait_for(condition, timeout: float = 2.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        assert asyncio.get_running_loop().time() < deadline, "timed out"
+        await asyncio.sleep(0.01)
+
+async def test_envelopes_reach_every_other_node(tmp_path):
+    path = str(tmp_path / "backplane.sock")
+    nodes = [UnixSocketBackplane(path, reconnect_delay=0.05) for _ in range(3)]
+    received = {node.node_id: [] for node in nodes}
+    for node in nodes:
+        node.set_handler(received[node.node_id].append)
+        await node.start()
+    assert sum(node.is_broker for node in nodes) == 1
+
+    client = next(node for node in nodes if not node.is_broker)
+    client.publish({"kind": "broadcast", "room": "1", "message": {"n": 1}})
+    others = [node for node in nodes if node is not client]
+    await wait_for(lambda: all(received[node.node_id] for node in others))
+    for node in others:
+        assert received[node.node_id] == [{"kind": "broadcast", "room": "1", "message": {"n": 1}, "origin": client.node_id}]
+    # A node never hears its own envelopes
+    assert received[client.node_id] == []
+
+    # When a client goes away, the rest are told to forget its members
+    await client.stop()
+    await wait_for(lambda: all(any(e["kind"] == "node_down" for e in received[node.node_id]) for node in others))
+    for node in others:
+        await node.stop()
@@ -0,0 +1,79 @@
+import os
+import pytest
+from sqlalchemy import select
+from app.models import Blob
+from app.services.blob_store import BlobStore, content_digest, encode_json
+from tests.helpers import diagram_data, shape
+
+pytestmark = pytest.mark.anyio
+
+@pytest.fixture
+async def store(sessions, tmp_path):
+    store = BlobStore(root=str(tmp_path / "blobs"), min_bytes=256, session_factory=sessions, gc_interval=0)
+    await store.start()
+    yield store
+    await store.shutdown()
+
+async def refcounts(sessions):
+    async with sessions() as db:
+        return dict((await db.execute(select(Blob.digest, Blob.refcount))).all())
+
+async def test_identical_content_is_stored_once_with_a_reference_each(store, sessions):
+    async with sessions() as db:
+        digests = await store.put_many(db, [b"one", b"two", b"one"])
+        assert await store.put(db, b"one") == digests[0]
+        await db.commit()
+    one, two = content_digest(b"one"), content_digest(b"two")
+    assert digests == [one, two, one]
+    assert await refcounts(sessions) == {one: 3, two: 1}
+    assert store.stats["files_written"] == 2 and store.stats["deduplicated"] == 2
+    assert await store.read(one) == b"one"
+
+async def test_references_roll_back_with_the_transaction(store, sessions):
+    async with sessions() as db:
+        await store.put(db, b"kept")
+        await db.commit()
+        await store.put(db, b"kept")
+        await store.release(db, [content_digest(b"kept"), None])
+        await db.rollback()
+    assert await refcounts(sessions) == {content_digest(b"kept"): 1}
+
+async def test_collect_removes_only_unreferenced_blobs(store, sessions):
+    async with sessions() as db:
+        shared, single = await store.put_many(db, [b"shared", b"single"])
+        await store.put(db, b"shared")
+        await db.commit()
+        await store.release(db, [shared, single])
+        await db.commit()
+    assert await store.collect() == 1
+    assert os.path.exists(store.path(shared))
+    assert not os.path.exists(store.path(single))
+    assert await refcounts(sessions) == {shared: 1}
+
+    # Putting collected content again brings its file back
+    async with sessions() as db:
+        await store.put(db, b"single")
+        await db.commit()
+    assert await store.read(single) == b"single"
+
+async def test_only_documents_over_the_threshold_become_blobs(store, sessions):
+    small = diagram_data(shape("s1"))
+    large = diagram_data(*(shape(f"s{i}") for i in range(10)))
+    async with sessions() as db:
+        assert await store.put_json(db, small) is None
+        blob = await store.put_json(db, large)
+        await db.commit()
+    assert blob == {"digest": content_digest(encode_json(large)), "size": len(encode_json(large))}
+    assert await store.read_json(blob["digest"]) == large
+
+def test_identical_thumbnails_share_one_blob(client, make_user):
+    _, headers, _ = make_user()
+    image = b"\x89PNG\r\n\x1a\n" + os.urandom(64)
+    ids = [client.post("/api/v1/diagrams/", json={"title": "T", "data": diagram_data()}, headers=headers).json()["id"] for _ in range(2)]
+    for diagram_id in ids:
+        response = client.put(f"/api/v1/diagrams/{diagram_id}/thumbnail", content=image, headers={**headers, "Content-Type": "image/png"})
+        assert response.status_code == 204
+    urls = {client.get(f"/api/v1/diagrams/{diagram_id}", headers=headers).json()["thumbnail_url"].split("?v=")[1] for diagram_id in ids}
+    assert urls == {content_digest(image)[:16]}
+    thumbnail = client.get(f"/api/v1/diagrams/{ids[0]}/thumbnail", headers=headers)
+    assert thumbnail.content == image
@@ -0,0 +1,97 @@
+import gzip
+import pytest
+from fastapi import FastAPI
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from fastapi.testclient import TestClient
+from app.core.compression import COMPRESSORS, CompressionMiddleware, base_etag, negotiate_encoding, variant_etag
+from app.core.config import settings
+
+BODY = b'{"shapes": [' + b",".join(b'{"id": "s%d", "x": 0}' % i for i in range(200)) + b"]}"
+
+@pytest.fixture
+def gzip_only(monkeypatch):
+    monkeypatch.setattr(settings, "COMPRESSION_ENCODINGS", ["gzip"])
+
+def test_q_values_pick_the_best_available_encoding(monkeypatch):
+    monkeypatch.setattr(settings, "COMPRESSION_ENCODINGS", ["zstd", "br", "gzip"])
+    monkeypatch.setitem(COMPRESSORS, "br", COMPRESSORS["gzip"])
+    monkeypatch.setitem(COMPRESSORS, "zstd", COMPRESSORS["gzip"])
+    assert negotiate_encoding(None) is None and negotiate_encoding("") is None
+    # Equal weights go to the server's preference; a higher q wins over it
+    assert negotiate_encoding("gzip, br, zstd") == "zstd"
+    assert negotiate_encoding("gzip;q=1.0, br; q=0.5") == "gzip"
+    # q=0 means "not acceptable", including through the wildcard
+    assert negotiate_encoding("zstd;q=0, br;q=0, *") == "gzip"
+    assert negotiate_encoding("*;q=0") is None
+    assert negotiate_encoding("gzip;q=0") is None
+    assert negotiate_encoding("gzip;q=oops") is None
+    # identity is never a compression; unknown codings are ignored
+    assert negotiate_encoding("identity") is None
+    assert negotiate_encoding("deflate, compress") is None
+    assert negotiate_encoding("GZIP") == "gzip"
+
+def test_configured_encodings_the_process_cannot_produce_are_skipped(monkeypatch):
+    monkeypatch.setattr(settings, "COMPRESSION_ENCODINGS", ["snappy", "gzip"])
+    assert negotiate_encoding("snappy, gzip;q=0.1") == "gzip"
+
+def test_variant_etags_map_back_to_their_representation():
+    assert variant_etag('"7-3-ab"', "gzip") == '"7-3-ab-gzip"'
+    assert base_etag('"7-3-ab-gzip"') == '"7-3-ab"'
+    assert base_etag('"7-3-ab"') == '"7-3-ab"'
+    assert variant_etag("unquoted", "gzip") == "unquoted"
+
+def build_client(minimum_size=100):
+    app = FastAPI()
+
+    @app.get("/json")
+    def json_body():
+        return Response(BODY, media_type="application/json", headers={"ETag": '"1-1-ab"'})
+
+    @app.get("/small")
+    def small_body():
+        return JSONResponse({"ok": True})
+
+    @app.get("/png")
+    def png_body():
+        return Response(b"\x89PNG" + bytes(500), media_type="image/png")
+
+    @app.get("/encoded")
+    def encoded_body():
+        return Response(gzip.compress(BODY), media_type="application/json", headers={"Content-Encoding": "gzip"})
+
+    @app.get("/stream")
+    def streamed_body():
+        return StreamingResponse(iter([BODY, BODY]), media_type="application/json")
+
+    app.add_middleware(CompressionMiddleware, minimum_size=minimum_size)
+    return TestClient(app)
+
+def get(client, path, accept="gzip"):
+    # httpx decodes gzip itself; reading the raw stream shows what was sent
+    with client.stream("GET", path, headers={"Accept-Encoding": accept}) as response:
+        return response, b"".join(response.iter_raw())
+
+def test_large_compressible_bodies_are_compressed_with_a_variant_etag(gzip_only):
+    response, raw = get(build_client(), "/json")
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert response.headers["Vary"] == "Accept-Encoding"
+    assert response.headers["ETag"] == '"1-1-ab-gzip"'
+    assert int(response.headers["Content-Length"]) == len(raw) < len(BODY)
+    assert gzip.decompress(raw) == BODY
+
+def test_bodies_below_the_threshold_or_without_a_coding_pass_through(gzip_only):
+    client = build_client()
+    for path, accept in (("/small", "gzip"), ("/png", "gzip"), ("/json", "identity"), ("/json", "gzip;q=0")):
+        response, raw = get(client, path, accept)
+        assert "Content-Encoding" not in response.headers, (path, accept)
+    assert raw == BODY and response.headers["ETag"] == '"1-1-ab"'
+    # The threshold is the middleware's own
+    response, _ = get(build_client(minimum_size=len(BODY) + 1), "/json")
+    assert "Content-Encoding" not in response.headers
+
+def test_encoded_and_streamed_bodies_are_left_alone(gzip_only):
+    client = build_client()
+    response, raw = get(client, "/encoded")
+    assert response.headers["Content-Encoding"] == "gzip" and gzip.decompress(raw) == BODY
+    response, raw = get(client, "/stream")
+    assert "Content-Encoding" not in response.headers and raw == BODY + BODY
@@ -0,0 +1,34 @@
+import pytest
+from sqlalchemy import text
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from app.core.config import settings
+from app.core.database import async_database_url, create_engine_for, engine_options
+
+pytestmark = pytest.mark.anyio
+
+def test_plain_urls_map_onto_the_async_drivers():
+    assert async_database_url("sqlite:///./app.db") == "sqlite+aiosqlite:///./app.db"
+    assert async_database_url("postgres://u@h/db") == "postgresql+asyncpg://u@h/db"
+    assert async_database_url("postgresql://u@h/db") == "postgresql+asyncpg://u@h/db"
+    assert async_database_url("postgresql+asyncpg://u@h/db") == "postgresql+asyncpg://u@h/db"
+
+def test_file_databases_use_the_configured_queue_pool(monkeypatch):
+    monkeypatch.setattr(settings, "DB_POOL_SIZE", 3)
+    options = engine_options("sqlite+aiosqlite:///./app.db")
+    assert options["poolclass"] is AsyncAdaptedQueuePool and options["pool_size"] == 3
+    assert options["pool_pre_ping"] is True
+    # A pool of in-memory connections would be a pool of separate empty databases
+    assert "poolclass" not in engine_options("sqlite+aiosqlite:///:memory:")
+
+async def test_sqlite_connections_get_wal_and_a_busy_timeout(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "SQLITE_BUSY_TIMEOUT_MS", 1234)
+    engine = create_engine_for(f"sqlite:///{tmp_path}/pragmas.db")
+    try:
+        assert isinstance(engine.pool, AsyncAdaptedQueuePool)
+        assert engine.pool.size() == settings.DB_POOL_SIZE
+        async with engine.connect() as conn:
+            assert (await conn.scalar(text("PRAGMA journal_mode"))).lower() == "wal"
+            assert await conn.scalar(text("PRAGMA busy_timeout")) == 1234
+            assert await conn.scalar(text("PRAGMA synchronous")) == 1  # NORMAL
+    finally:
+        await engine.dispose()
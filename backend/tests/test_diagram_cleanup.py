@@ -0,0 +1,82 @@
+import itertools
+import random
+import numpy as np
+from app.services.diagram_cleanup import DiagramCleaner
+from tests.helpers import diagram_data, shape
+
+def positions(data):
+    return [(item["x"], item["y"]) for item in data["shapes"]]
+
+def overlapping(data):
+    boxes = [(item["x"], item["y"], item["width"], item["height"]) for item in data["shapes"]]
+    return [
+        (a, b) for a, b in itertools.combinations(range(len(boxes)), 2)
+        if min(boxes[a][0] + boxes[a][2], boxes[b][0] + boxes[b][2]) > max(boxes[a][0], boxes[b][0])
+        and min(boxes[a][1] + boxes[a][3], boxes[b][1] + boxes[b][3]) > max(boxes[a][1], boxes[b][1])
+    ]
+
+def test_shapes_on_the_grid_stay_on_it():
+    data = diagram_data(*(shape(f"s{i}", 0, i * 60, width=90, height=40) for i in range(3)))
+    cleaned, improvements = DiagramCleaner().clean(data)
+    assert positions(cleaned) == [(0, 0), (0, 60), (0, 120)]
+    assert improvements == ["Repositioned 0 of 3 shapes"]
+
+def test_stacked_shapes_are_separated_along_the_grid():
+    cleaned, improvements = DiagramCleaner().clean(diagram_data(shape("a"), shape("b")))
+    assert positions(cleaned) == [(0, 0), (20, 0)]
+    assert "Resolved 1 overlapping shape pairs" in improvements
+    assert not any(line.startswith("Aligned") for line in improvements)
+
+def test_near_aligned_edges_snap_to_the_grid():
+    data = diagram_data(*(shape(f"s{i}", x, i * 100, width=40, height=40) for i, x in enumerate((2, 1, -2))))
+    cleaned, improvements = DiagramCleaner().clean(data)
+    assert [x for x, _ in positions(cleaned)] == [0, 0, 0]
+    assert "Aligned 3 shape edges and centers" in improvements
+
+def test_center_groups_put_the_widest_edge_on_the_grid():
+    data = diagram_data(shape("wide", 3, 0, width=100, height=40), shape("narrow", 33, 100, width=40, height=40))
+    cleaned, _ = DiagramCleaner().clean(data)
+    (wide_x, _), (narrow_x, _) = positions(cleaned)
+    assert wide_x == 0
+    assert narrow_x + 20 == wide_x + 50
+
+def test_only_uneven_rows_are_equalized():
+    even = diagram_data(*(shape(f"s{i}", i * 60, 0, width=40, height=40) for i in range(4)))
+    _, improvements = DiagramCleaner().clean(even)
+    assert not any(line.startswith("Equalized") for line in improvements)
+
+    uneven = diagram_data(*(shape(f"s{i}", x, 0, width=40, height=40) for i, x in enumerate((0, 100, 210, 300))))
+    cleaned, improvements = DiagramCleaner().clean(uneven)
+    assert [x for x, _ in positions(cleaned)] == [0, 100, 200, 300]
+    assert "Equalized spacing in 1 rows and 0 columns" in improvements
+
+def test_overlap_broad_phase_matches_brute_force():
+    rng = random.Random(3)
+    data = diagram_data(*(
+        shape(f"s{i}", rng.uniform(0, 800), rng.uniform(0, 800), width=rng.choice((0, 20, 60, 150)), height=rng.choice((20, 60)))
+        for i in range(300)
+    ))
+    cleaner = DiagramCleaner()
+    _, x, y, w, h = cleaner._extract(data["shapes"])
+    expected = [pair for pair in overlapping(data) if w[pair[0]] > 0 and w[pair[1]] > 0]
+    i, j = cleaner._overlapping_pairs(x, y, w, h, cleaner._cell_size(w, h))
+    assert sorted(zip(i.tolist(), j.tolist())) == expected
+
+    active = np.zeros(x.size, dtype=bool)
+    active[::7] = True
+    i, j = cleaner._overlapping_pairs(x, y, w, h, cleaner._cell_size(w, h), active)
+    found = set(zip(i.tolist(), j.tolist()))
+    assert {pair for pair in expected if active[pair[0]] or active[pair[1]]} <= found <= set(expected)
+
+def test_clean_leaves_no_overlaps_and_keeps_other_fields():
+    rng = random.Random(5)
+    data = diagram_data(*(
+        shape(f"s{i}", rng.uniform(0, 300), rng.uniform(0, 300), width=40, height=30, label=f"L{i}")
+        for i in range(60)
+    ), {"id": "text", "type": "text", "x": "n/a"})
+    cleaned, improvements = DiagramCleaner().clean(data)
+    assert overlapping({"shapes": cleaned["shapes"][:60]}) == []
+    assert all(item["x"] % 10 == 0 and item["y"] % 10 == 0 for item in cleaned["shapes"][:60])
+    assert [item["label"] for item in cleaned["shapes"][:60]] == [f"L{i}" for i in range(60)]
+    assert cleaned["shapes"][60] == {"id": "text", "type": "text", "x": "n/a"}
+    assert not any(line.endswith("could not be separated") for line in improvements)
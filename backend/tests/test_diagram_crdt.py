@@ -0,0 +1,105 @@
+import copy
+import random
+import pytest
+from app.services.diagram_crdt import DiagramCrdt, z_order
+from app.services.diagram_ops import DiagramDocument, DiagramOperationError
+from tests.helpers import diagram_data, shape
+
+BASE = diagram_data(*(shape(f"s{i}", i * 10, 0) for i in range(6)))
+
+def replica(data=BASE):
+    return DiagramCrdt(), DiagramDocument(copy.deepcopy(data))
+
+def by_id(document):
+    return {item["id"]: item for item in document.data["shapes"]}
+
+def random_ops(rng, replicas=("a", "b", "c"), count=60):
+    """Stamped ops from several replicas, each replica's in counter order"""
+    ops = {name: [] for name in replicas}
+    for n in range(count):
+        name = rng.choice(replicas)
+        ts = [len(ops[name]) + 1, name]
+        roll = rng.random()
+        if roll < 0.1:
+            operation = {"op": "remove", "id": f"s{rng.randrange(6)}"}
+        elif roll < 0.2:
+            operation = {"op": "add", "element": shape(f"{name}{n}", n, n)}
+        else:
+            field = rng.choice(("x", "y", "label"))
+            operation = {"op": "update", "id": f"s{rng.randrange(6)}", "changes": {field: rng.randrange(100)}}
+        ops[name].append({**operation, "ts": ts})
+    return ops
+
+def interleave(rng, ops):
+    """A random delivery order that keeps each replica's own ops in order"""
+    queues = {name: list(batch) for name, batch in ops.items()}
+    delivered = []
+    while any(queues.values()):
+        name = rng.choice([name for name, queue in queues.items() if queue])
+        delivered.append(queues[name].pop(0))
+    return delivered
+
+def test_any_delivery_order_converges():
+    rng = random.Random(17)
+    for _ in range(20):
+        ops = random_ops(rng)
+        results = []
+        for _ in range(4):
+            crdt, document = replica()
+            for operation in interleave(rng, ops):
+                crdt.merge(document, [operation])
+            results.append(by_id(document))
+        assert all(result == results[0] for result in results[1:])
+
+def test_last_writer_wins_with_replica_id_breaking_ties():
+    for order in ((0, 1), (1, 0)):
+        crdt, document = replica()
+        writes = [
+            {"op": "update", "id": "s1", "changes": {"label": "from a"}, "ts": [5, "a"]},
+            {"op": "update", "id": "s1", "changes": {"label": "from b"}, "ts": [5, "b"]}
+        ]
+        for i in order:
+            crdt.merge(document, [writes[i]])
+        assert by_id(document)["s1"]["label"] == "from b"
+        assert crdt.vector == {"a": 5, "b": 5}
+
+def test_removal_is_only_undone_by_a_later_add():
+    crdt, document = replica()
+    crdt.merge(document, [{"op": "remove", "id": "s1", "ts": [3, "a"]}])
+    applied, _ = crdt.merge(document, [{"op": "update", "id": "s1", "changes": {"x": 1}, "ts": [9, "b"]}])
+    assert applied == [] and "s1" not in by_id(document)
+    crdt.merge(document, [{"op": "add", "element": shape("s1", 7, 7), "ts": [2, "b"]}])
+    assert "s1" not in by_id(document)
+    crdt.merge(document, [{"op": "add", "element": shape("s1", 7, 7), "ts": [4, "b"]}])
+    assert by_id(document)["s1"]["x"] == 7
+
+    # Plain batches keep their checks
+    with pytest.raises(DiagramOperationError):
+        crdt.merge(document, [{"op": "update", "id": "gone", "changes": {}}], strict=True)
+
+def test_moves_resolve_to_absolute_writes():
+    crdt, document = replica()
+    applied, exact = crdt.merge(document, [{"op": "move", "id": "s2", "dx": 5, "dy": -5}])
+    assert not exact
+    assert applied[0]["op"] == "update" and applied[0]["changes"] == {"x": 25, "y": -5}
+
+def test_reorders_place_an_element_between_its_new_neighbours():
+    crdt, document = replica()
+    _, exact = crdt.merge(document, [{"op": "reorder", "id": "s0", "after": "s3"}])
+    assert not exact
+    assert [item["id"] for item in z_order(document.data["shapes"])] == ["s1", "s2", "s3", "s0", "s4", "s5"]
+    crdt.merge(document, [{"op": "reorder", "id": "s5", "after": None}])
+    assert [item["id"] for item in z_order(document.data["shapes"])][0] == "s5"
+
+def test_a_delta_brings_a_lagging_replica_up_to_date():
+    rng = random.Random(5)
+    ops = random_ops(rng)
+    server, server_document = replica()
+    for operation in interleave(rng, ops):
+        server.merge(server_document, [operation])
+
+    client, client_document = replica()
+    for name, batch in ops.items():
+        client.merge(client_document, batch[:len(batch) // 2])
+    client.merge(client_document, server.delta(server_document, client.vector))
+    assert by_id(client_document) == by_id(server_document)
@@ -0,0 +1,90 @@
+from app.services.diagram_interpreter import DiagramGraph, InterpretationCache, content_hash, diagram_interpreter
+from tests.helpers import diagram_data, shape
+
+def link(source, target, **fields):
+    return {"source": source, "target": target, **fields}
+
+def test_shape_and_connection_vocabularies_pick_the_type():
+    flowchart = diagram_data(
+        shape("start", type="start"), shape("check", type="diamond"), shape("a", type="process"), shape("b", type="process"),
+        connections=[link("start", "check"), link("check", "a", label="yes"), link("check", "b", label="no")]
+    )
+    result = diagram_interpreter.interpret(flowchart)
+    assert result["diagram_type"] == "flowchart"
+    assert result["decision_points"] == ["check"] and result["entry_points"] == ["start"]
+    assert result["exit_points"] == ["a", "b"]
+
+    er = diagram_data(
+        shape("user", type="entity"), shape("order", type="entity"),
+        connections=[link("user", "order", type="one-to-many", cardinality="1:n")]
+    )
+    assert diagram_interpreter.interpret(er)["diagram_type"] == "er"
+
+    # Untyped nodes: a single-rooted acyclic graph with one parent each reads as a tree
+    tree = diagram_data(
+        *(shape(name, type="") for name in "rabc"),
+        connections=[link("r", "a"), link("r", "b"), link("a", "c")]
+    )
+    assert diagram_interpreter.interpret(tree)["diagram_type"] == "tree"
+
+def test_labelled_cycles_read_as_a_state_machine():
+    data = diagram_data(
+        shape("idle", type=""), shape("busy", type=""), shape("done", type=""),
+        connections=[link("idle", "busy", label="go"), link("busy", "idle", label="stop"), link("busy", "done", label="finish")]
+    )
+    result = diagram_interpreter.interpret(data)
+    assert result["diagram_type"] == "state_machine"
+    assert result["cycles"] == [["idle", "busy"]] and result["cycle_count"] == 1
+
+def test_cycles_include_self_loops_and_every_strong_component():
+    data = diagram_data(
+        *(shape(name) for name in "abcdef"),
+        connections=[link("a", "b"), link("b", "c"), link("c", "a"), link("c", "d"), link("d", "d"), link("e", "f")]
+    )
+    graph = DiagramGraph(data)
+    cycles = [sorted(graph.ids[node] for node in cycle) for cycle in graph.cycles()]
+    assert sorted(cycles) == [["a", "b", "c"], ["d"]]
+
+def test_orphans_and_components_are_reported_separately():
+    data = diagram_data(
+        *(shape(name) for name in "abcdxy"),
+        connections=[link("a", "b"), link("c", "d"), link("d", "c")]
+    )
+    result = diagram_interpreter.interpret(data)
+    assert result["orphan_nodes"] == ["x", "y"] and result["orphan_count"] == 2
+    assert sorted(sorted(component) for component in result["components"]) == [["a", "b"], ["c", "d"]]
+    assert result["component_count"] == 4
+    assert "Connect or remove 2 shapes that have no connections" in result["suggestions"]
+    # A single shape on its own is not an orphan
+    assert diagram_interpreter.interpret(diagram_data(shape("solo")))["orphan_count"] == 0
+
+def test_unhashable_ids_are_skipped_and_their_connections_dangle():
+    data = diagram_data(
+        shape("a"), shape(["list"]), shape({"dict": 1}), shape("b"), shape("a"),
+        connections=[link("a", "b"), link("a", ["list"]), link({"x": 1}, "b"), link("a", "missing"), "not a connection"]
+    )
+    result = diagram_interpreter.interpret(data)
+    assert result["node_count"] == 2 and result["edge_count"] == 1
+    assert result["dangling_connections"] == 3
+
+def test_the_content_hash_ignores_geometry_and_styling():
+    data = diagram_data(shape("a", 0, 0), shape("b", 5, 5), connections=[link("a", "b", label="next")])
+    moved = diagram_data(shape("a", 90, 90, color="red"), shape("b", 5, 5), connections=[link("a", "b", label="next", points=[1, 2])])
+    relabelled = diagram_data(shape("a", 0, 0), shape("b", 5, 5), connections=[link("a", "b", label="then")])
+    assert content_hash(data) == content_hash(moved)
+    assert content_hash(data) != content_hash(relabelled)
+
+def test_the_cache_is_a_bounded_lru_with_hit_counts():
+    cache = InterpretationCache(max_size=2)
+    cache.put("a", {"n": 1})
+    cache.put("b", {"n": 2})
+    assert cache.get("a") == {"n": 1}
+    cache.put("c", {"n": 3})
+    # "b" was least recently used once "a" was read
+    assert cache.get("b") is None
+    assert cache.get("c") == {"n": 3}
+    assert cache.stats() == {"size": 2, "hits": 2, "misses": 1, "hit_rate": 0.6667}
+
+    disabled = InterpretationCache(max_size=0)
+    disabled.put("a", {"n": 1})
+    assert disabled.get("a") is None
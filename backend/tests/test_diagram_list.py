@@ -0,0 +1,37 @@
+from tests.helpers import diagram_data, shape
+
+def create(client, headers, title, is_public=False):
+    return client.post(
+        "/api/v1/diagrams/", json={"title": title, "data": diagram_data(shape("s1")), "is_public": is_public}, headers=headers
+    ).json()["id"]
+
+def test_keyset_pages_cover_every_diagram_once(client, make_user):
+    _, headers, _ = make_user()
+    created = [create(client, headers, f"d{i}") for i in range(5)]
+    seen, cursor = [], None
+    while True:
+        params = {"scope": "owned", "view": "summary", "limit": 2, **({"cursor": cursor} if cursor else {})}
+        response = client.get("/api/v1/diagrams/", params=params, headers=headers)
+        assert response.status_code == 200
+        page = response.json()
+        assert all("data" not in item and "thumbnail" not in item for item in page)
+        seen.extend(item["id"] for item in page)
+        cursor = response.headers.get("X-Next-Cursor")
+        if not cursor:
+            break
+    # Newest first; ids break ties between rows updated in the same instant
+    assert seen == sorted(created, reverse=True)
+
+def test_full_view_includes_data(client, make_user):
+    _, headers, _ = make_user()
+    create(client, headers, "full")
+    item, = client.get("/api/v1/diagrams/", params={"scope": "owned"}, headers=headers).json()
+    assert item["data"]["shapes"][0]["id"] == "s1"
+
+def test_other_users_private_diagrams_are_hidden(client, make_user):
+    _, owner, _ = make_user()
+    _, other, _ = make_user()
+    private = create(client, owner, "private")
+    public = create(client, owner, "public", is_public=True)
+    visible = {item["id"] for item in client.get("/api/v1/diagrams/", params={"view": "summary"}, headers=other).json()}
+    assert public in visible and private not in visible
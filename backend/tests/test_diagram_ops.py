@@ -0,0 +1,46 @@
+import pytest
+from app.services.diagram_ops import DiagramDocument, DiagramOperationError, apply_operations, diff_operations
+from tests.helpers import diagram_data, shape
+
+CONNECTED = diagram_data(shape("a"), shape("b", 50), connections=[{"id": "c1", "source": "a", "target": "b"}])
+
+def test_ops_apply_in_order():
+    document = DiagramDocument(CONNECTED)
+    document.apply([
+        {"op": "add", "collection": "shapes", "element": shape("c", 100)},
+        {"op": "update", "collection": "shapes", "id": "c", "changes": {"label": "C", "id": "ignored"}},
+        {"op": "move", "collection": "shapes", "id": "a", "dx": 5, "dy": -5}
+    ])
+    assert document.get("shapes", "c")["label"] == "C"
+    assert document.get("shapes", "c")["id"] == "c"
+    assert (document.get("shapes", "a")["x"], document.get("shapes", "a")["y"]) == (5, -5)
+    # Elements are replaced, not mutated, so the original data is untouched
+    assert CONNECTED["shapes"][0]["x"] == 0
+
+def test_removing_a_shape_drops_its_connections():
+    data = apply_operations(CONNECTED, [{"op": "remove", "collection": "shapes", "id": "a"}])
+    assert [s["id"] for s in data["shapes"]] == ["b"]
+    assert data["connections"] == []
+
+def test_a_bad_op_rejects_the_whole_batch():
+    document = DiagramDocument(CONNECTED)
+    with pytest.raises(DiagramOperationError, match="Operation 1"):
+        document.apply([
+            {"op": "remove", "collection": "shapes", "id": "a"},
+            {"op": "update", "collection": "connections", "id": "c1", "changes": {"label": "x"}}
+        ])
+    assert len(document.data["shapes"]) == 2 and len(document.data["connections"]) == 1
+
+def test_duplicate_adds_are_rejected():
+    with pytest.raises(DiagramOperationError, match="already exists"):
+        apply_operations(CONNECTED, [{"op": "add", "collection": "shapes", "element": shape("a")}])
+
+def test_diff_operations_replays_onto_the_new_data():
+    new = diagram_data(shape("b", 60, label="B"), shape("d"))
+    operations = diff_operations(CONNECTED, new)
+    assert operations is not None
+    assert apply_operations(CONNECTED, operations) == new
+
+def test_diff_operations_gives_up_on_reordering():
+    reordered = diagram_data(shape("b", 50), shape("a"), connections=CONNECTED["connections"])
+    assert diff_operations(CONNECTED, reordered) is None
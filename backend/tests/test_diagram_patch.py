@@ -0,0 +1,51 @@
+from tests.helpers import diagram_data, shape
+
+def create_diagram(client, headers):
+    response = client.post(
+        "/api/v1/diagrams/", json={"title": "Patch", "data": diagram_data(shape("s1")), "is_public": False}, headers=headers
+    )
+    return response.json()
+
+def patch(client, headers, diagram_id, version, *operations):
+    return client.patch(f"/api/v1/diagrams/{diagram_id}", json={"version": version, "operations": list(operations)}, headers=headers)
+
+def test_patch_applies_ops_and_bumps_the_version(client, make_user):
+    _, headers, _ = make_user()
+    diagram = create_diagram(client, headers)
+    response = patch(
+        client, headers, diagram["id"], diagram["version"],
+        {"op": "move", "id": "s1", "dx": 10, "dy": 20},
+        {"op": "add", "element": shape("s2", 1, 1)}
+    )
+    assert response.status_code == 200
+    assert response.json()["version"] == diagram["version"] + 1
+    data = client.get(f"/api/v1/diagrams/{diagram['id']}", headers=headers).json()["data"]
+    assert [(s["id"], s["x"], s["y"]) for s in data["shapes"]] == [("s1", 10, 20), ("s2", 1, 1)]
+
+def test_patch_against_a_stale_version_conflicts(client, make_user):
+    _, headers, _ = make_user()
+    diagram = create_diagram(client, headers)
+    assert patch(client, headers, diagram["id"], diagram["version"], {"op": "remove", "id": "s1"}).status_code == 200
+    response = patch(client, headers, diagram["id"], diagram["version"], {"op": "add", "element": shape("s3")})
+    assert response.status_code == 409
+    assert f"version {diagram['version'] + 1}" in response.json()["detail"]
+
+def test_patch_with_an_invalid_op_is_rejected(client, make_user):
+    _, headers, _ = make_user()
+    diagram = create_diagram(client, headers)
+    response = patch(client, headers, diagram["id"], diagram["version"], {"op": "update", "id": "missing", "changes": {}})
+    assert response.status_code == 422
+    assert client.get(f"/api/v1/diagrams/{diagram['id']}", headers=headers).json()["version"] == diagram["version"]
+
+def test_patch_needs_ownership(client, make_user):
+    _, owner, _ = make_user()
+    _, other, _ = make_user()
+    diagram = create_diagram(client, owner)
+    assert patch(client, other, diagram["id"], diagram["version"], {"op": "remove", "id": "s1"}).status_code == 403
+
+def test_put_with_a_stale_version_conflicts(client, make_user):
+    _, headers, _ = make_user()
+    diagram = create_diagram(client, headers)
+    url = f"/api/v1/diagrams/{diagram['id']}"
+    assert client.put(url, json={"title": "Renamed", "version": diagram["version"]}, headers=headers).status_code == 200
+    assert client.put(url, json={"title": "Again", "version": diagram["version"]}, headers=headers).status_code == 409
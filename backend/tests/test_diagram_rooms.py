@@ -0,0 +1,48 @@
+import asyncio
+import pytest
+from sqlalchemy import func, select
+from starlette.websockets import WebSocketDisconnect
+from app.core.database import AsyncSessionLocal
+from app.models import DiagramRevision
+from tests.helpers import diagram_data, shape
+
+def create_diagram(client, headers, data=None):
+    response = client.post(
+        "/api/v1/diagrams/", json={"title": "Room", "data": data or diagram_data(shape("s1")), "is_public": True}, headers=headers
+    )
+    assert response.status_code == 200
+    return response.json()["id"]
+
+def receive_until(websocket, message_type):
+    while True:
+        message = websocket.receive_json()
+        if message["type"] == message_type:
+            return message
+
+def revision_count(client, diagram_id):
+    async def count():
+        async with AsyncSessionLocal() as db:
+            return await db.scalar(select(func.count()).where(DiagramRevision.diagram_id == diagram_id))
+    return client.portal.call(count)
+
+def test_deleting_a_diagram_closes_its_room(client, make_user):
+    _, headers, token = make_user()
+    diagram_id = create_diagram(client, headers)
+    with client.websocket_connect(f"/api/v1/ws/{diagram_id}?token={token}") as websocket:
+        receive_until(websocket, "diagram_snapshot")
+        websocket.send_json({"type": "drawing_update", "data": {"ops": [
+            {"op": "add", "collection": "shapes", "element": shape("s2")}
+        ]}})
+        websocket.send_json({"type": "ping"})
+        receive_until(websocket, "pong")
+
+        assert client.delete(f"/api/v1/diagrams/{diagram_id}", headers=headers).status_code == 200
+        assert receive_until(websocket, "diagram_deleted")["diagram_id"] == str(diagram_id)
+        with pytest.raises(WebSocketDisconnect) as closed:
+            websocket.receive_json()
+        assert closed.value.code == 4004
+
+    assert client.get(f"/api/v1/diagrams/{diagram_id}", headers=headers).status_code == 404
+    # Nothing the room had pending was written back for the deleted row
+    client.portal.call(asyncio.sleep, 0.2)
+    assert revision_count(client, diagram_id) == 0
@@ -0,0 +1,88 @@
+import pytest
+from sqlalchemy import func, select
+from app.models import Diagram, DiagramElement
+from app.services.diagram_ops import DiagramDocument
+from app.services.diagram_storage import STORAGE_ELEMENTS, STORAGE_JSON, load_data, load_many, store_data, write_document
+from app.tools import migrate_storage
+from tests.helpers import diagram_data, insert_diagram, shape
+
+pytestmark = pytest.mark.anyio
+
+def link(connection_id, source, target):
+    return {"id": connection_id, "source": source, "target": target}
+
+async def split(sessions, data, **fields):
+    """A diagram stored as element rows; returns its id"""
+    diagram_id = await insert_diagram(sessions, data, **fields)
+    async with sessions() as db:
+        await store_data(db, await db.get(Diagram, diagram_id), data, STORAGE_ELEMENTS)
+        await db.commit()
+    return diagram_id
+
+async def element_rows(sessions, diagram_id):
+    async with sessions() as db:
+        return await db.scalar(select(func.count()).where(DiagramElement.diagram_id == diagram_id))
+
+async def stored(sessions, diagram_id):
+    async with sessions() as db:
+        diagram = await db.get(Diagram, diagram_id)
+        return diagram.storage, await load_data(db, diagram_id, diagram.storage, diagram.data)
+
+async def test_saving_writes_back_only_the_touched_elements(sessions):
+    data = diagram_data(shape("a"), shape("b"), shape("c"), connections=[link("ab", "a", "b")])
+    diagram_id = await split(sessions, data)
+    document = DiagramDocument(data)
+    document.track_changes()
+    document.apply([
+        {"op": "update", "collection": "shapes", "id": "b", "changes": {"label": "B"}},
+        {"op": "remove", "collection": "shapes", "id": "a"},
+        {"op": "add", "collection": "shapes", "element": shape("d", 4, 4)},
+        {"op": "remove", "collection": "shapes", "id": "c"},
+        {"op": "add", "collection": "shapes", "element": shape("c", 9, 9)}
+    ])
+    async with sessions() as db:
+        await write_document(db, diagram_id, document)
+        await db.commit()
+
+    storage, data = await stored(sessions, diagram_id)
+    assert storage == STORAGE_ELEMENTS and data == document.data
+    # Removing "a" took its connection with it; the re-added "c" moved to the end
+    assert [item["id"] for item in data["shapes"]] == ["b", "d", "c"] and data["connections"] == []
+    assert data["shapes"][0]["label"] == "B" and data["shapes"][2]["x"] == 9
+    assert await element_rows(sessions, diagram_id) == 3
+
+    # Nothing touched since: the next write changes nothing
+    async with sessions() as db:
+        await write_document(db, diagram_id, document)
+        await db.commit()
+    assert (await stored(sessions, diagram_id))[1] == data
+
+async def test_load_many_reassembles_each_diagram_in_element_order(sessions):
+    first = diagram_data(*(shape(f"s{i}") for i in (3, 1, 2)), connections=[link("c1", "s3", "s1")])
+    first["meta"] = {"zoom": 2}
+    second = {"shapes": [shape("x"), shape("y")]}
+    inline = diagram_data(shape("j"))
+    ids = [await split(sessions, first), await split(sessions, second), await insert_diagram(sessions, inline)]
+    async with sessions() as db:
+        rows = (await db.execute(select(Diagram.id, Diagram.storage, Diagram.data).where(Diagram.id.in_(ids)))).all()
+        loaded = await load_many(db, [tuple(row) for row in rows])
+    # Keys come back exactly as stored: "meta" kept, no "connections" invented for the second diagram
+    assert loaded == dict(zip(ids, [first, second, inline]))
+
+async def test_migrate_storage_round_trips_between_layouts(sessions, monkeypatch):
+    monkeypatch.setattr(migrate_storage, "AsyncSessionLocal", sessions)
+    data = diagram_data(shape("a"), shape("b", label="B"), connections=[link("ab", "a", "b")])
+    unkeyed = diagram_data(shape("a"), {"type": "rectangle"})
+    small = diagram_data(shape("a"))
+    ids = [await insert_diagram(sessions, item) for item in (data, unkeyed, small)]
+
+    stats = await migrate_storage.migrate(STORAGE_ELEMENTS, ids, min_elements=2, batch_size=2)
+    assert stats == {"converted": 1, "kept_json": 1, "below_min_elements": 1, "elements": 3}
+    assert await stored(sessions, ids[0]) == (STORAGE_ELEMENTS, data)
+    assert await element_rows(sessions, ids[0]) == 3
+    assert await stored(sessions, ids[1]) == (STORAGE_JSON, unkeyed)
+
+    stats = await migrate_storage.migrate(STORAGE_JSON, ids, min_elements=0, batch_size=2)
+    assert stats["converted"] == 1
+    assert await stored(sessions, ids[0]) == (STORAGE_JSON, data)
+    assert await element_rows(sessions, ids[0]) == 0
@@ -0,0 +1,206 @@
+import copy
+import pytest
+from sqlalchemy import delete, func, select, update
+from sqlalchemy.exc import IntegrityError
+from app.core.config import settings
+from app.models import Blob, Diagram, DiagramCheckpoint, DiagramRevision
+from app.services.blob_store import blob_store
+from app.services.diagram_history import load_version
+from app.services.diagram_ops import DiagramOperationError
+from app.services.document_store import DocumentDeleted, DocumentStore, VersionConflict
+from tests.helpers import diagram_data, insert_diagram, shape
+
+pytestmark = pytest.mark.anyio
+
+ADD = {"op": "add", "collection": "shapes", "element": shape("s2", 5, 5)}
+
+async def stored(sessions, diagram_id):
+    async with sessions() as db:
+        row = (await db.execute(select(Diagram.version, Diagram.data).where(Diagram.id == diagram_id))).one()
+        revisions = await db.scalar(select(func.count()).where(DiagramRevision.diagram_id == diagram_id))
+        return row.version, row.data, revisions
+
+async def refcounts(sessions):
+    async with sessions() as db:
+        return dict((await db.execute(select(Blob.digest, Blob.refcount))).all())
+
+async def test_edits_stay_in_memory_until_the_flush(sessions):
+    diagram_id = await insert_diagram(sessions, diagram_data(shape("s1")))
+    store = DocumentStore(session_factory=sessions, flush_interval=3600)
+    live = await store.open(diagram_id)
+    assert store.apply(diagram_id, [ADD]) == 2
+    assert [s["id"] for s in live.data["shapes"]] == ["s1", "s2"]
+    assert (await stored(sessions, diagram_id))[0] == 1
+
+    assert await store.flush() == 1
+    version, data, revisions = await stored(sessions, diagram_id)
+    assert version == 2 and [s["id"] for s in data["shapes"]] == ["s1", "s2"]
+    # The baseline written on open plus the batch
+    assert revisions == 2
+    assert await store.flush() == 0
+    await store.shutdown()
+
+async def test_stale_base_versions_conflict(sessions):
+    diagram_id = await insert_diagram(sessions, diagram_data(shape("s1")))
+    store = DocumentStore(session_factory=sessions, flush_interval=3600)
+    await store.open(diagram_id)
+    store.apply(diagram_id, [ADD], base_version=1)
+    with pytest.raises(VersionConflict) as conflict:
+        store.apply(diagram_id, [{"op": "remove", "collection": "shapes", "id": "s1"}], base_version=1)
+    assert conflict.value.current_version == 2
+    await store.shutdown()
+
+async def test_a_rejected_batch_changes_nothing(sessions):
+    diagram_id = await insert_diagram(sessions, diagram_data(shape("s1")))
+    store = DocumentStore(session_factory=sessions, flush_interval=3600)
+    live = await store.open(diagram_id)
+    with pytest.raises(DiagramOperationError):
+        store.apply(diagram_id, [ADD, {"op": "update", "collection": "shapes", "id": "nope", "changes": {}}])
+    assert live.version == 1 and len(live.data["shapes"]) == 1 and not live.dirty
+    await store.shutdown()
+
+async def test_the_last_release_flushes_and_evicts(sessions):
+    diagram_id = await insert_diagram(sessions, diagram_data(shape("s1")))
+    store = DocumentStore(session_factory=sessions, flush_interval=3600)
+    await store.open(diagram_id)
+    store.apply(diagram_id, [ADD])
+    store.release(diagram_id)
+    await store._evict(diagram_id)
+    assert store.get(diagram_id) is None
+    assert (await stored(sessions, diagram_id))[0] == 2
+    await store.shutdown()
+
+async def test_edits_to_a_discarded_document_fail_cleanly(sessions):
+    diagram_id = await insert_diagram(sessions, diagram_data(shape("s1")))
+    store = DocumentStore(session_factory=sessions, flush_interval=3600)
+    await store.open(diagram_id)
+    store.apply(diagram_id, [ADD])
+    async with store.write_lock:
+        store.discard(diagram_id)
+    with pytest.raises(DocumentDeleted):
+        store.merge(diagram_id, [ADD])
+    assert await store.flush() == 0
+    await store.shutdown()
+
+async def test_sequenced_batches_keep_a_replica_in_step(sessions):
+    diagram_id = await insert_diagram(sessions, diagram_data(shape("s1")))
+    writer = DocumentStore(session_factory=sessions, flush_interval=3600)
+    replica = DocumentStore(session_factory=sessions, flush_interval=3600, is_writer=lambda: False)
+    await writer.open(diagram_id)
+    copy = await replica.open(diagram_id)
+    move = [{"op": "update", "collection": "shapes", "id": "s1", "changes": {"x": 40}}]
+    for operations in ([ADD], move):
+        result = writer.merge(diagram_id, operations)
+        replica.merge(diagram_id, result.operations, version=result.version)
+    assert copy.version == 3 and copy.data == writer.get(diagram_id).data
+    # Out of order: the replica has to resync rather than skip a version
+    with pytest.raises(VersionConflict):
+        replica.merge(diagram_id, move, version=5)
+
+    assert await replica.flush() == 0
+    assert await writer.flush() == 1
+    replica.settle(diagram_id, 3)
+    assert copy.pending_revisions == [] and not copy.dirty
+    async with sessions() as db:
+        versions = (await db.execute(
+            select(DiagramRevision.version).where(DiagramRevision.diagram_id == diagram_id).order_by(DiagramRevision.version)
+        )).scalars().all()
+    assert versions == [1, 2, 3]
+    await writer.shutdown()
+    await replica.shutdown()
+
+async def test_a_revision_stored_elsewhere_does_not_wedge_the_flush(sessions):
+    diagram_id = await insert_diagram(sessions, diagram_data(shape("s1")))
+    store = DocumentStore(session_factory=sessions, flush_interval=3600)
+    await store.open(diagram_id)
+    async with sessions() as db:
+        db.add(DiagramRevision(diagram_id=diagram_id, version=2, kind="ops", operations=[], op_count=0))
+        await db.commit()
+    store.apply(diagram_id, [ADD])
+    assert await store.flush() == 1
+    version, data, revisions = await stored(sessions, diagram_id)
+    assert version == 2 and len(data["shapes"]) == 2 and revisions == 2
+    await store.shutdown()
+
+async def test_a_constraint_error_is_isolated_and_not_retried_forever(sessions, monkeypatch):
+    good = await insert_diagram(sessions, diagram_data(shape("s1")))
+    bad = await insert_diagram(sessions, diagram_data(shape("s1")), version=2)
+    store = DocumentStore(session_factory=sessions, flush_interval=3600)
+    await store.open(good)
+    await store.open(bad)
+    write = store._write
+
+    async def failing_write(batch, *rows):
+        if any(params["b_id"] == bad for params in batch):
+            raise IntegrityError("INSERT", {}, Exception("constraint"))
+        return await write(batch, *rows)
+
+    monkeypatch.setattr(store, "_write", failing_write)
+    store.apply(good, [ADD])
+    store.apply(bad, [ADD])
+    assert await store.flush() == 1
+    assert (await stored(sessions, good))[0] == 2
+    assert store.stats["flush_conflicts"] >= 1
+    # Kept in memory, but no longer retried on every flush
+    assert store.get(bad).version == 3 and not store.get(bad).dirty
+    assert await store.flush() == 0
+    await store.shutdown()
+
+async def test_a_diagram_deleted_underneath_leaves_the_rest_of_the_batch(sessions):
+    kept = await insert_diagram(sessions, diagram_data(shape("s1")))
+    deleted = await insert_diagram(sessions, diagram_data(shape("s1")))
+    store = DocumentStore(session_factory=sessions, flush_interval=3600)
+    await store.open(kept)
+    await store.open(deleted)
+    store.apply(kept, [ADD])
+    store.apply(deleted, [ADD])
+    async with sessions() as db:
+        for table in (DiagramRevision, DiagramCheckpoint):
+            await db.execute(delete(table).where(table.diagram_id == deleted))
+        await db.execute(delete(Diagram).where(Diagram.id == deleted))
+        await db.commit()
+    assert await store.flush() == 1
+    assert (await stored(sessions, kept))[0] == 2
+    assert store.get(deleted) is None
+    await store.shutdown()
+
+async def test_every_flushed_version_can_be_rebuilt_across_checkpoints(sessions, monkeypatch):
+    monkeypatch.setattr(settings, "DIAGRAM_CHECKPOINT_INTERVAL", 3)
+    diagram_id = await insert_diagram(sessions, diagram_data(shape("s1")))
+    store = DocumentStore(session_factory=sessions, flush_interval=3600)
+    live = await store.open(diagram_id)
+    snapshots = {1: copy.deepcopy(live.data)}
+    for i in range(8):
+        store.apply(diagram_id, [{"op": "update", "collection": "shapes", "id": "s1", "changes": {"x": i}}])
+        snapshots[live.version] = copy.deepcopy(live.data)
+        if i == 4:
+            await store.flush()
+    await store.flush()
+    async with sessions() as db:
+        assert await db.scalar(select(func.count()).where(DiagramCheckpoint.diagram_id == diagram_id)) > 2
+        for version, data in snapshots.items():
+            assert await load_version(db, diagram_id, version) == data
+    await store.shutdown()
+
+async def test_only_replaced_rows_release_their_previous_blob(sessions, monkeypatch):
+    monkeypatch.setattr(blob_store, "min_bytes", 1)
+    monkeypatch.setattr(settings, "DIAGRAM_CHECKPOINT_INTERVAL", 1000)
+    diagram_id = await insert_diagram(sessions, diagram_data(shape("s1")))
+    store = DocumentStore(session_factory=sessions, flush_interval=3600)
+    live = await store.open(diagram_id)
+    store.apply(diagram_id, [ADD])
+    await store.flush()
+    first = live.blob
+    before = await refcounts(sessions)
+    assert first is not None and before[first] == 1
+
+    # Another writer stores a newer version first: the row keeps pointing at the first blob
+    async with sessions() as db:
+        await db.execute(update(Diagram).where(Diagram.id == diagram_id).values(version=10))
+        await db.commit()
+    store.apply(diagram_id, [{"op": "remove", "collection": "shapes", "id": "s2"}])
+    await store.flush()
+    # ...and the copy this flush stored is not left referenced
+    assert {digest: count for digest, count in (await refcounts(sessions)).items() if count} == before
+    assert live.blob == first
+    await store.shutdown()
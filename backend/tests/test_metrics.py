@@ -0,0 +1,47 @@
+import pytest
+from app.core.metrics import Metric, MetricsRegistry
+
+def test_a_metric_must_implement_its_children_and_samples():
+    with pytest.raises(TypeError):
+        Metric("m", "doc")
+
+    class Partial(Metric):
+        def _new_child(self):
+            return None
+
+    with pytest.raises(TypeError):
+        Partial("m", "doc")
+
+def test_render_uses_the_text_exposition_format():
+    registry = MetricsRegistry()
+    registry.counter("requests", "Requests", ("route",)).labels('/a"b').inc(2)
+    registry.gauge("depth", "Depth").set(1.5)
+    histogram = registry.histogram("latency", "Latency", buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 5.0):
+        histogram.observe(value)
+    registry.callback("rooms", "Rooms", "gauge", lambda: [(("r1",), 3)], ("room",))
+
+    lines = registry.render().splitlines()
+    assert "# TYPE requests counter" in lines
+    assert 'requests_total{route="/a\\"b"} 2' in lines
+    assert "depth 1.5" in lines
+    assert [line for line in lines if line.startswith("latency_")] == [
+        'latency_bucket{le="0.1"} 1', 'latency_bucket{le="1"} 2', 'latency_bucket{le="+Inf"} 3',
+        "latency_sum 5.55", "latency_count 3"
+    ]
+    assert 'rooms{room="r1"} 3' in lines
+
+def test_duplicate_names_and_wrong_label_counts_are_rejected():
+    registry = MetricsRegistry()
+    counter = registry.counter("c", "C", ("a", "b"))
+    with pytest.raises(ValueError):
+        registry.gauge("c", "again")
+    with pytest.raises(ValueError):
+        counter.labels("only-one")
+
+def test_metrics_endpoint(client):
+    client.get("/health")
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    assert "# TYPE http_requests counter" in response.text
@@ -0,0 +1,44 @@
+import asyncio
+import threading
+import pytest
+from fastapi import HTTPException
+from app.services.auth import PasswordHashPool, password_hash_pool
+
+pytestmark = pytest.mark.anyio
+
+async def test_a_saturated_pool_refuses_with_retry_after():
+    pool = PasswordHashPool(workers=1, max_pending=2)
+    release = threading.Event()
+    running = [asyncio.create_task(pool.run(release.wait)) for _ in range(2)]
+    await asyncio.sleep(0.05)
+    assert pool.pending == 2
+    with pytest.raises(HTTPException) as refused:
+        await pool.run(lambda: "never")
+    assert refused.value.status_code == 503
+    # Two calls ahead on one worker at the initial 0.2 s estimate
+    assert refused.value.headers == {"Retry-After": "1"}
+    assert pool.rejected == 1
+
+    release.set()
+    assert await asyncio.gather(*running) == [True, True]
+    assert pool.pending == 0
+    assert await pool.run(lambda: "hashed") == "hashed"
+
+async def test_a_failing_call_releases_its_slot():
+    pool = PasswordHashPool(workers=1, max_pending=1)
+
+    def broken():
+        raise ValueError("malformed hash")
+
+    for _ in range(3):
+        with pytest.raises(ValueError):
+            await pool.run(broken)
+    assert pool.pending == 0 and pool.rejected == 0
+
+def test_login_answers_503_while_hashing_is_saturated(client, monkeypatch):
+    credentials = {"username": "busy-hasher", "password": "secret"}
+    assert client.post("/api/v1/auth/register", json=credentials).status_code == 200
+    monkeypatch.setattr(password_hash_pool, "pending", password_hash_pool.max_pending)
+    response = client.post("/api/v1/auth/login", json=credentials)
+    assert response.status_code == 503
+    assert int(response.headers["Retry-After"]) >= 1
@@ -0,0 +1,83 @@
+import pytest
+from app.api.v1.endpoints.websocket import OVERFLOW_COALESCE, ConnectionManager
+from app.services.backplane import InProcessBackplane
+from app.services.presence import PresenceAggregator
+from tests.helpers import FakeWebSocket, settle
+
+pytestmark = pytest.mark.anyio
+
+class User:
+    def __init__(self, user_id: int):
+        self.id = user_id
+        self.username = f"u{user_id}"
+
+def collecting_aggregator():
+    published = []
+    return PresenceAggregator(20, lambda room, message: published.append((room, message))), published
+
+async def test_each_connection_has_its_own_cursor():
+    presence, published = collecting_aggregator()
+    presence.update("room", "n:1", 7, "u7", {"x": 1, "y": 1})
+    presence.update("room", "n:2", 7, "u7", {"x": 2, "y": 2})
+    presence.flush()
+    (room, batch), = published
+    assert sorted(cursor["member_id"] for cursor in batch["cursors"]) == ["n:1", "n:2"]
+
+    # Closing one tab leaves the other tab's cursor in place
+    presence.remove_member("room", "n:1")
+    presence.update("room", "n:2", 7, "u7", {"x": 3, "y": 3})
+    presence.flush()
+    assert [cursor["member_id"] for cursor in published[-1][1]["cursors"]] == ["n:2"]
+    await presence.stop()
+
+async def test_unchanged_cursors_are_not_resent():
+    presence, published = collecting_aggregator()
+    presence.update("room", "n:1", 1, "u1", {"x": 1, "y": 1})
+    presence.flush()
+    presence.update("room", "n:1", 1, "u1", {"x": 1, "y": 1})
+    presence.flush()
+    assert len(published) == 1
+    await presence.stop()
+
+async def connected(manager, *user_ids):
+    sockets = []
+    for user_id in user_ids:
+        websocket = FakeWebSocket()
+        await manager.connect(websocket, "room", User(user_id))
+        sockets.append(websocket)
+    await settle()
+    for websocket in sockets:
+        websocket.sent.clear()
+    return sockets
+
+def cursor_batches(websocket):
+    return [message["cursors"] for message in websocket.messages() if message["type"] == "cursors"]
+
+async def test_senders_do_not_get_their_own_cursor_back():
+    manager = ConnectionManager(backplane=InProcessBackplane())
+    a, b = await connected(manager, 1, 2)
+    manager.presence.update("room", manager.user_connections[a]["member_id"], 1, "u1", {"x": 5, "y": 5})
+    manager.presence.flush()
+    await settle()
+    assert cursor_batches(a) == []
+    assert [[cursor["user_id"] for cursor in batch] for batch in cursor_batches(b)] == [[1]]
+    await manager.shutdown()
+
+async def test_coalesced_cursor_batches_keep_every_member():
+    manager = ConnectionManager(overflow_policy=OVERFLOW_COALESCE, backplane=InProcessBackplane())
+    a, b, viewer = await connected(manager, 1, 2, 3)
+    member_a, member_b = (manager.user_connections[websocket]["member_id"] for websocket in (a, b))
+    viewer.gate.clear()
+    manager.presence.update("room", member_a, 1, "u1", {"x": 1, "y": 1})
+    manager.presence.flush()
+    manager.presence.update("room", member_b, 2, "u2", {"x": 2, "y": 2})
+    manager.presence.flush()
+    manager.presence.update("room", member_a, 1, "u1", {"x": 3, "y": 3})
+    manager.presence.flush()
+    viewer.gate.set()
+    await settle()
+    batch, = cursor_batches(viewer)
+    assert {cursor["member_id"]: cursor["position"] for cursor in batch} == {
+        member_a: {"x": 3, "y": 3}, member_b: {"x": 2, "y": 2}
+    }
+    await manager.shutdown()
@@ -0,0 +1,79 @@
+import json
+from datetime import datetime
+from app.core.compression import variant_etag
+from app.services.response_cache import DiagramResponseCache, diagram_etag, etag_matches
+from tests.helpers import diagram_data, shape
+
+def test_etags_move_with_version_timestamp_and_thumbnail():
+    stamp = datetime(2024, 1, 1, 12, 0, 0)
+    etag = diagram_etag(7, 3, stamp)
+    assert etag != diagram_etag(7, 4, stamp)
+    assert etag != diagram_etag(7, 3, datetime(2024, 1, 1, 12, 0, 1))
+    assert etag != diagram_etag(7, 3, stamp, "ab" * 32)
+
+def test_if_none_match_uses_the_weak_comparison():
+    etag = '"7-3-ab"'
+    assert etag_matches(etag, etag)
+    assert etag_matches(f'"other", W/{etag}', etag)
+    assert etag_matches(variant_etag(etag, "gzip"), etag)
+    assert etag_matches("*", etag)
+    assert not etag_matches('"7-2-ab"', etag)
+    assert not etag_matches(None, etag)
+
+def test_cache_keeps_one_entry_per_diagram_within_its_byte_budget():
+    cache = DiagramResponseCache(max_bytes=100)
+    cache.put(1, "a", b"x" * 20)
+    cache.put(1, "b", b"y" * 20)
+    assert cache.get(1, "a") is None
+    assert cache.get(1, "b") == b"y" * 20
+    # More than a quarter of the budget is never cached
+    cache.put(2, "c", b"z" * 30)
+    assert cache.get(2, "c") is None
+
+    cache.put(3, "d", b"w" * 20)
+    cache.put_variant(3, "d", "gzip", b"v" * 20)
+    cache.put_variant(3, "stale", "br", b"v" * 20)
+    assert cache.get_variant(3, "d", "gzip") == b"v" * 20
+    assert cache.get_variant(3, "d", "br") is None
+    cache.put(4, "e", b"u" * 25)
+    cache.put(5, "f", b"t" * 25)
+    # Least recently used goes first once the bytes run over
+    assert cache.get(1, "b") is None
+    assert cache.stats()["bytes"] <= 100
+
+def test_get_revalidates_with_304_until_the_diagram_changes(client, make_user):
+    _, headers, _ = make_user()
+    diagram = client.post("/api/v1/diagrams/", json={"title": "E", "data": diagram_data(shape("s1"))}, headers=headers).json()
+    url = f"/api/v1/diagrams/{diagram['id']}"
+    first = client.get(url, headers=headers)
+    etag = first.headers["ETag"]
+    assert first.headers["Cache-Control"] == "private, no-cache"
+
+    cached = client.get(url, headers={**headers, "If-None-Match": etag})
+    assert cached.status_code == 304 and cached.headers["ETag"] == etag
+
+    client.patch(url, json={"version": diagram["version"], "operations": [{"op": "add", "element": shape("s2")}]}, headers=headers)
+    changed = client.get(url, headers={**headers, "If-None-Match": etag})
+    assert changed.status_code == 200 and changed.headers["ETag"] != etag
+    assert [item["id"] for item in changed.json()["data"]["shapes"]] == ["s1", "s2"]
+
+    renamed = client.put(url, json={"title": "Renamed"}, headers=headers)
+    assert renamed.status_code == 200
+    after_put = client.get(url, headers={**headers, "If-None-Match": changed.headers["ETag"]})
+    assert after_put.status_code == 200 and after_put.json()["title"] == "Renamed"
+
+def test_large_bodies_get_a_compressed_variant_with_its_own_etag(client, make_user):
+    _, headers, _ = make_user()
+    data = diagram_data(*(shape(f"s{i}", i, i, label="text " * 10) for i in range(100)))
+    diagram_id = client.post("/api/v1/diagrams/", json={"title": "Big", "data": data}, headers=headers).json()["id"]
+    url = f"/api/v1/diagrams/{diagram_id}"
+    response = client.get(url, headers={**headers, "Accept-Encoding": "gzip"})
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert response.headers["ETag"].endswith('-gzip"')
+    assert len(data["shapes"]) == len(response.json()["data"]["shapes"])
+
+    raw = client.get(url, headers={**headers, "Accept-Encoding": "identity"})
+    assert "Content-Encoding" not in raw.headers
+    assert json.loads(raw.content) == response.json()
+    revalidated = client.get(url, headers={**headers, "Accept-Encoding": "gzip", "If-None-Match": response.headers["ETag"]})
+    assert revalidated.status_code == 304
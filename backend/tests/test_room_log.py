@@ -0,0 +1,89 @@
+import pytest
+from app.api.v1.endpoints.websocket import ConnectionManager
+from app.services.backplane import InProcessBackplane
+from app.services.document_store import DocumentStore
+from app.services.room_log import RoomLog
+from tests.helpers import FakeWebSocket, diagram_data, insert_diagram, settle, shape
+
+pytestmark = pytest.mark.anyio
+
+class User:
+    def __init__(self, user_id: int):
+        self.id = user_id
+        self.username = f"u{user_id}"
+
+def test_since_returns_the_missed_tail_without_the_members_own():
+    log = RoomLog("e", capacity=4)
+    for i in range(3):
+        assert log.append({"n": i}, origin="a" if i == 1 else None)["seq"] == i + 1
+    assert [m["n"] for m in log.since(0)] == [0, 1, 2]
+    assert [m["n"] for m in log.since(0, skip_origin="a")] == [0, 2]
+    assert log.since(3) == []
+    assert log.since(4) is None and log.since(-1) is None
+
+def test_since_gives_up_once_the_buffer_no_longer_reaches_back():
+    log = RoomLog("e", capacity=2)
+    for i in range(5):
+        log.append({"n": i})
+    assert log.since(2) is None
+    assert [m["n"] for m in log.since(3)] == [3, 4]
+
+@pytest.fixture
+async def manager(sessions):
+    documents = DocumentStore(session_factory=sessions, flush_interval=3600)
+    manager = ConnectionManager(backplane=InProcessBackplane(), replay_buffer_size=8, documents=documents)
+    yield manager
+    await manager.shutdown()
+    await documents.shutdown()
+
+def last_state(websocket):
+    return [m for m in websocket.messages() if m["type"] == "diagram_state"][-1]
+
+async def test_a_reconnecting_client_resumes_without_its_own_messages(manager):
+    first, second = FakeWebSocket(), FakeWebSocket()
+    await manager.connect(first, "lobby", User(1))
+    await manager.connect(second, "lobby", User(2))
+    await settle()
+    state = last_state(second)
+    manager.broadcast_to_diagram_sync("lobby", {"type": "note", "n": 1}, exclude_websocket=first)
+    manager.broadcast_to_diagram_sync("lobby", {"type": "note", "n": 2}, exclude_websocket=second)
+    manager.disconnect(second)
+    manager.broadcast_to_diagram_sync("lobby", {"type": "note", "n": 3}, exclude_websocket=first)
+
+    returning = FakeWebSocket()
+    await manager.connect(returning, "lobby", User(2), state["seq"], state["epoch"], state["member_id"])
+    await settle()
+    messages = returning.messages()
+    assert messages[0]["sync"] == "resume"
+    # Its own note 2 is skipped; what everyone saw after it left is replayed
+    assert [m.get("n") for m in messages[1:] if m["type"] == "note"] == [1, 3]
+
+async def test_an_unknown_epoch_gets_a_snapshot_of_the_live_document(manager, sessions):
+    diagram_id = await insert_diagram(sessions, diagram_data(shape("s1")))
+    room = str(diagram_id)
+    live = await manager.documents.open(diagram_id)
+    editor = FakeWebSocket()
+    await manager.connect(editor, room, User(1))
+    update = {"ops": [{"op": "add", "collection": "shapes", "element": shape("s2")}]}
+    manager.submit_drawing_update(editor, room, update, User(1), live)
+    assert live.version == 2
+
+    joiner = FakeWebSocket()
+    await manager.connect(joiner, room, User(2), last_seq=1, epoch="some-other-process.1")
+    await settle()
+    messages = joiner.messages()
+    assert messages[0]["sync"] == "snapshot"
+    # The snapshot cached when the editor joined, plus the buffered update after it
+    snapshot, tail = messages[1], messages[2:]
+    assert snapshot["type"] == "diagram_snapshot" and snapshot["version"] == 1
+    assert [(m["type"], m["data"]["version"]) for m in tail if m["type"] == "drawing_update"] == [("drawing_update", 2)]
+
+    # Once the buffered tail is gone, a fresh snapshot is built at the live version
+    for i in range(10):
+        manager.broadcast_to_diagram_sync(room, {"type": "note", "n": i})
+    late = FakeWebSocket()
+    await manager.connect(late, room, User(3))
+    await settle()
+    snapshot = late.messages()[1]
+    assert snapshot["version"] == 2
+    assert [item["id"] for item in snapshot["data"]["shapes"]] == ["s1", "s2"]
@@ -0,0 +1,111 @@
+import asyncio
+import pytest
+from sqlalchemy import select
+from app.api.v1.endpoints.websocket import ConnectionManager
+from app.models import DiagramRevision
+from app.services.backplane import UnixSocketBackplane
+from app.services.diagram_history import load_version
+from app.services.document_store import DocumentStore, VersionConflict
+from tests.helpers import FakeWebSocket, diagram_data, insert_diagram, shape
+
+pytestmark = pytest.mark.anyio
+
+class User:
+    def __init__(self, user_id: int):
+        self.id = user_id
+        self.username = f"u{user_id}"
+
+async def wait_for(condition, timeout: float = 5.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        assert asyncio.get_running_loop().time() < deadline, "timed out"
+        await asyncio.sleep(0.01)
+
+@pytest.fixture
+async def workers(sessions, tmp_path):
+    """Two processes' worth of room state sharing one database and a unix backplane; sequencer first"""
+    path = str(tmp_path / "backplane.sock")
+    pairs = []
+    for _ in range(2):
+        store = DocumentStore(session_factory=sessions, flush_interval=3600)
+        manager = ConnectionManager(backplane=UnixSocketBackplane(path, reconnect_delay=0.05), documents=store)
+        await manager.start()
+        pairs.append((manager, store))
+    pairs.sort(key=lambda pair: not pair[0].backplane.sequencer)
+    yield pairs
+    for manager, store in pairs:
+        await store.shutdown()
+        await manager.shutdown()
+
+async def join(manager, store, diagram_id: int, user: User):
+    live = await store.open(diagram_id)
+    websocket = FakeWebSocket()
+    await manager.connect(websocket, str(diagram_id), user)
+    return websocket, live
+
+def update(i: int) -> dict:
+    return {"ops": [
+        {"op": "add", "collection": "shapes", "element": shape(f"n{i}", i, i)},
+        {"op": "update", "collection": "shapes", "id": "s1", "changes": {"x": i}}
+    ]}
+
+async def test_edits_from_both_processes_get_one_contiguous_history(workers, sessions):
+    (sequencer, sequencer_store), (replica, replica_store) = workers
+    assert not replica.backplane.sequencer
+    diagram_id = await insert_diagram(sessions, diagram_data(shape("s1")))
+    room = str(diagram_id)
+    first, primary = await join(sequencer, sequencer_store, diagram_id, User(1))
+    second, copy = await join(replica, replica_store, diagram_id, User(2))
+    await wait_for(lambda: room in sequencer.remote_members and room in replica.remote_members)
+
+    for i in range(20):
+        manager, websocket, user, live = (
+            (sequencer, first, User(1), primary) if i % 2 else (replica, second, User(2), copy)
+        )
+        manager.submit_drawing_update(websocket, room, update(i), user, live)
+    await wait_for(lambda: primary.version == 21 and copy.version == 21)
+    assert copy.data == primary.data
+
+    # Only the sequencer writes, and the replica drops the history it announced as stored
+    assert await replica_store.flush() == 0
+    assert await sequencer_store.flush() == 1
+    await wait_for(lambda: not copy.pending_revisions)
+    async with sessions() as db:
+        versions = (await db.execute(
+            select(DiagramRevision.version).where(DiagramRevision.diagram_id == diagram_id).order_by(DiagramRevision.version)
+        )).scalars().all()
+        assert versions == list(range(1, 22))
+        assert await load_version(db, diagram_id, 21) == primary.data
+
+async def test_forwarded_rest_batches_get_the_sequencers_version(workers, sessions):
+    (sequencer, sequencer_store), (replica, replica_store) = workers
+    diagram_id = await insert_diagram(sessions, diagram_data(shape("s1")))
+    room = str(diagram_id)
+    _, primary = await join(sequencer, sequencer_store, diagram_id, User(1))
+    _, copy = await join(replica, replica_store, diagram_id, User(2))
+    await wait_for(lambda: room in replica.remote_members)
+
+    assert replica.sequenced_elsewhere(room) and not sequencer.sequenced_elsewhere(room)
+    version = await replica.forward_ops(room, update(1)["ops"], 1, User(2))
+    assert version == 2 == primary.version
+    await wait_for(lambda: copy.version == 2)
+    with pytest.raises(VersionConflict) as conflict:
+        await replica.forward_ops(room, update(2)["ops"], 1, User(2))
+    assert conflict.value.current_version == 2
+
+async def test_a_late_joiner_catches_up_with_unflushed_edits(workers, sessions):
+    (sequencer, sequencer_store), (replica, replica_store) = workers
+    diagram_id = await insert_diagram(sessions, diagram_data(shape("s1")))
+    room = str(diagram_id)
+    first, primary = await join(sequencer, sequencer_store, diagram_id, User(1))
+    for i in range(3):
+        sequencer.submit_drawing_update(first, room, update(i), User(1), primary)
+    assert primary.version == 4
+
+    # Opens the stored (older) document, then reloads once the sequencer has written its edits
+    second, copy = await join(replica, replica_store, diagram_id, User(2))
+    await wait_for(lambda: copy.version == 4)
+    assert copy.data == primary.data
+    await wait_for(lambda: any(message["type"] == "diagram_snapshot" for message in second.messages()))
+    snapshot = [message for message in second.messages() if message["type"] == "diagram_snapshot"][-1]
+    assert snapshot["version"] == 4 and snapshot["data"] == primary.data
@@ -0,0 +1,57 @@
+import os
+import subprocess
+import sys
+import pytest
+from sqlalchemy import inspect, select, text
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+from app.core.database import create_engine_for
+from app.models import Base, Diagram
+from app.tools.schema import upgrade_schema
+
+pytestmark = pytest.mark.anyio
+
+# The diagrams table as the first release created it
+ORIGINAL_DIAGRAMS = """
+CREATE TABLE diagrams (
+    id INTEGER PRIMARY KEY,
+    title VARCHAR(200) NOT NULL,
+    description TEXT,
+    data JSON NOT NULL,
+    thumbnail TEXT,
+    owner_id INTEGER NOT NULL REFERENCES users (id),
+    is_public BOOLEAN,
+    created_at DATETIME DEFAULT (CURRENT_TIMESTAMP),
+    updated_at DATETIME
+)
+"""
+
+async def test_an_original_database_gains_the_added_columns(tmp_path):
+    engine = create_engine_for(f"sqlite:///{tmp_path}/old.db")
+    try:
+        await upgrade_original(engine)
+    finally:
+        await engine.dispose()
+
+async def upgrade_original(engine):
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.tables["users"].create)
+        await conn.execute(text(ORIGINAL_DIAGRAMS))
+        await conn.execute(text("INSERT INTO users (id, username, password_hash, is_active) VALUES (1, 'old', 'x', 1)"))
+        await conn.execute(text("""INSERT INTO diagrams (id, title, data, owner_id, is_public) VALUES (1, 'Old', '{"shapes": [], "connections": []}', 1, 0)"""))
+    async with engine.begin() as conn:
+        await upgrade_schema(conn)
+    # Running it again finds nothing left to add
+    async with engine.begin() as conn:
+        await upgrade_schema(conn)
+
+    async with async_sessionmaker(engine, class_=AsyncSession)() as db:
+        diagram = (await db.execute(select(Diagram))).scalar_one()
+        assert (diagram.version, diagram.storage, diagram.thumbnail_blob) == (1, "json", None)
+    async with engine.connect() as conn:
+        indexes = await conn.run_sync(lambda sync_conn: {index["name"] for index in inspect(sync_conn).get_indexes("diagrams")})
+    assert {"ix_diagrams_owner_updated", "ix_diagrams_public_updated", "ix_diagrams_updated"} <= indexes
+
+def test_running_it_on_its_own_exits_once_done(tmp_path):
+    env = {**os.environ, "DATABASE_URL": f"sqlite:///{tmp_path}/standalone.db"}
+    subprocess.run([sys.executable, "-m", "app.tools.schema"], env=env, cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))), check=True, timeout=60)
+    assert os.path.exists(tmp_path / "standalone.db")
@@ -0,0 +1,116 @@
+import uuid
+import pytest
+from sqlalchemy.exc import OperationalError
+from app.core.config import settings
+from app.services.document_store import DocumentStore
+from app.services.search_index import Fts5SearchBackend, SearchBackend, SearchIndex, search_index
+from tests.helpers import diagram_data, insert_diagram, shape
+
+SEARCH = "/api/v1/diagrams/search"
+
+def word(prefix="w"):
+    """A term no other test has indexed; the client's database is shared across tests"""
+    return prefix + uuid.uuid4().hex[:10]
+
+def create(client, headers, title="Untitled", labels=(), **fields):
+    data = diagram_data(*(shape(f"s{i}", label=label) for i, label in enumerate(labels)))
+    return client.post("/api/v1/diagrams/", json={"title": title, "data": data, **fields}, headers=headers).json()
+
+def found(client, headers, q, **params):
+    response = client.get(SEARCH, params={"q": q, **params}, headers=headers)
+    assert response.status_code == 200, response.text
+    return [hit["id"] for hit in response.json()]
+
+def test_create_put_patch_and_delete_keep_the_index_current(client, make_user):
+    _, headers, _ = make_user()
+    title, label, renamed, added = word(), word(), word(), word()
+    diagram = create(client, headers, title=title, labels=[label])
+    url = f"/api/v1/diagrams/{diagram['id']}"
+    assert found(client, headers, title) == [diagram["id"]]
+    hit = client.get(SEARCH, params={"q": label}, headers=headers).json()[0]
+    assert hit["snippet"] == f"«{label}»"
+
+    version = client.put(url, json={"title": renamed}, headers=headers).json()["version"]
+    assert found(client, headers, title) == []
+    assert found(client, headers, renamed) == [diagram["id"]]
+
+    patch = {"version": version, "operations": [{"op": "add", "element": shape("s9", label=added)}]}
+    assert client.patch(url, json=patch, headers=headers).status_code == 200
+    assert found(client, headers, added) == [diagram["id"]]
+
+    client.delete(url, headers=headers)
+    assert found(client, headers, renamed) == []
+
+def test_visibility_follows_the_scope(client, make_user):
+    _, owner, _ = make_user()
+    _, other, _ = make_user()
+    term = word()
+    private = create(client, owner, title=term)["id"]
+    public = create(client, owner, title=term, is_public=True)["id"]
+    assert sorted(found(client, owner, term)) == [private, public]
+    assert found(client, owner, term, scope="public") == [public]
+    assert sorted(found(client, owner, term, scope="owned")) == [private, public]
+    assert found(client, other, term) == [public]
+    assert found(client, other, term, scope="owned") == []
+
+def test_query_syntax_in_user_input_is_matched_as_text(client, make_user):
+    _, headers, _ = make_user()
+    term = word()
+    diagram = create(client, headers, title=f"title: do NOT {term} near")["id"]
+    # Unquoted, NOT and NEAR would be FTS5 operators and the colon a column filter
+    assert found(client, headers, f"NOT {term} NEAR") == [diagram]
+    assert found(client, headers, f'title:{term} "*') == [diagram]
+    assert client.get(SEARCH, params={"q": '"*:()'}, headers=headers).status_code == 422
+
+def test_only_the_last_term_matches_as_a_prefix(client, make_user):
+    _, headers, _ = make_user()
+    first, last = word("first"), word("last")
+    diagram = create(client, headers, labels=[f"{first} {last}"])["id"]
+    assert found(client, headers, f"{first} {last[:8]}") == [diagram]
+    assert found(client, headers, f"{first[:8]} {last}") == []
+
+def test_common_terms_rank_only_the_newest_candidates(client, make_user, monkeypatch):
+    _, headers, _ = make_user()
+    term = word()
+    ids = [create(client, headers, title=term)["id"] for _ in range(4)]
+    monkeypatch.setattr(settings, "SEARCH_MAX_CANDIDATES", 2)
+    assert sorted(found(client, headers, term)) == ids[-2:]
+
+def test_search_answers_503_without_a_backend(client, make_user, monkeypatch):
+    _, headers, _ = make_user()
+    monkeypatch.setattr(search_index, "backend", SearchBackend())
+    assert client.get(SEARCH, params={"q": "anything"}, headers=headers).status_code == 503
+    # Diagrams keep working
+    assert "id" in create(client, headers, labels=["still saved"])
+
+class WithoutFts5(Fts5SearchBackend):
+    async def ensure_schema(self, conn):
+        raise OperationalError("CREATE VIRTUAL TABLE", {}, Exception("no such module: fts5"))
+
+@pytest.mark.anyio
+async def test_an_sqlite_build_without_fts5_falls_back_to_no_search(sessions):
+    index = SearchIndex(WithoutFts5())
+    await index.start(sessions.kw["bind"], sessions)
+    assert type(index.backend) is SearchBackend
+
+async def public_hits(sessions, term):
+    async with sessions() as db:
+        return [hit.id for hit in await search_index.backend.search(db, term, "public", 0, 10, 0)]
+
+@pytest.mark.anyio
+async def test_backfill_indexes_existing_diagrams_once_and_flushes_reindex_labels(sessions):
+    before, after = word(), word()
+    ids = [await insert_diagram(sessions, diagram_data(shape("s1", label=before)), version=v) for v in (1, 2)]
+    assert await public_hits(sessions, before) == []
+    assert await search_index.backend.backfill(sessions) == 2
+    assert sorted(await public_hits(sessions, before)) == ids
+    # The index is no longer empty, so a restart leaves it alone
+    assert await search_index.backend.backfill(sessions) == 0
+
+    store = DocumentStore(session_factory=sessions, flush_interval=3600)
+    await store.open(ids[0])
+    store.apply(ids[0], [{"op": "update", "collection": "shapes", "id": "s1", "changes": {"label": after}}])
+    assert await store.flush() == 1
+    assert await public_hits(sessions, after) == [ids[0]]
+    assert await public_hits(sessions, before) == [ids[1]]
+    await store.shutdown()
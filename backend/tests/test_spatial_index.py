@@ -0,0 +1,65 @@
+import random
+import numpy as np
+from app.services.spatial_index import DiagramSpatialIndex, SpatialIndex, expand_counts, shape_bounds
+from tests.helpers import diagram_data, shape
+
+def brute_force(boxes, min_x, min_y, max_x, max_y):
+    return [
+        i for i, (x0, y0, x1, y1) in enumerate(boxes)
+        if x0 <= max_x and x1 >= min_x and y0 <= max_y and y1 >= min_y
+    ]
+
+def test_expand_counts():
+    owners, offsets = expand_counts(np.array([2, 0, 3]))
+    assert owners.tolist() == [0, 0, 2, 2, 2]
+    assert offsets.tolist() == [0, 1, 0, 1, 2]
+
+def test_queries_match_a_linear_scan():
+    rng = random.Random(11)
+    boxes = []
+    for _ in range(2000):
+        x, y = rng.uniform(0, 5000), rng.uniform(0, 5000)
+        boxes.append((x, y, x + rng.uniform(0, 80), y + rng.uniform(0, 80)))
+    tree = SpatialIndex(np.array(boxes), node_size=8)
+    for _ in range(50):
+        x, y = rng.uniform(-100, 5000), rng.uniform(-100, 5000)
+        window = (x, y, x + rng.uniform(0, 900), y + rng.uniform(0, 900))
+        assert tree.query(*window).tolist() == brute_force(boxes, *window)
+
+def test_touching_edges_count_and_empty_trees_return_nothing():
+    tree = SpatialIndex(np.array([[0, 0, 10, 10], [20, 0, 30, 10]], dtype=np.float64))
+    assert tree.query(10, 10, 20, 20).tolist() == [0, 1]
+    assert tree.query(11, 0, 19, 10).tolist() == []
+    assert SpatialIndex(np.zeros((0, 4))).query(0, 0, 1, 1).tolist() == []
+
+def test_shape_bounds_handles_points_and_negative_sizes():
+    assert shape_bounds({"points": [{"x": 5, "y": 1}, [2, 8]]}) == (2, 1, 5, 8)
+    assert shape_bounds({"x": 10, "y": 10, "width": -4, "height": 3}) == (6, 10, 10, 13)
+    assert shape_bounds({"x": "left"}) is None
+
+def test_region_culls_small_shapes_and_returns_connection_context():
+    data = diagram_data(
+        shape("in", 0, 0, width=50, height=50),
+        shape("far", 1000, 1000, width=50, height=50),
+        shape("tiny", 10, 10, width=0.5, height=0.5),
+        {"id": "loose", "type": "text"},
+        connections=[{"id": "c1", "source": "in", "target": "far"}, {"id": "c2", "source": "far", "target": "tiny"}]
+    )
+    region = DiagramSpatialIndex(data).region((0, 0, 100, 100), zoom=1.0, min_pixels=1.0)
+    assert [item["id"] for item in region["shapes"]] == ["in", "loose"]
+    assert region["culled"] == 1
+    assert [item["id"] for item in region["connections"]] == ["c1"]
+    assert [item["id"] for item in region["context_shapes"]] == ["far"]
+    assert region["total_shapes"] == 4
+
+    zoomed = DiagramSpatialIndex(data).region((0, 0, 100, 100), zoom=4.0, min_pixels=1.0)
+    assert [item["id"] for item in zoomed["shapes"]] == ["in", "tiny", "loose"]
+
+def test_region_endpoint(client, make_user):
+    _, headers, _ = make_user()
+    data = diagram_data(*(shape(f"s{i}", i * 100, 0, width=40, height=40) for i in range(10)))
+    diagram_id = client.post("/api/v1/diagrams/", json={"title": "r", "data": data}, headers=headers).json()["id"]
+    response = client.get(f"/api/v1/diagrams/{diagram_id}/region", params={"bbox": "150,0,420,40"}, headers=headers)
+    assert [item["id"] for item in response.json()["shapes"]] == ["s2", "s3", "s4"]
+    bad = client.get(f"/api/v1/diagrams/{diagram_id}/region", params={"bbox": "5,5,1,1"}, headers=headers)
+    assert bad.status_code == 422
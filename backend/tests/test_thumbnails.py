@@ -0,0 +1,125 @@
+import asyncio
+import os
+import pytest
+from sqlalchemy import select, update
+from app.core.config import settings
+from app.core.database import AsyncSessionLocal
+from app.models import Diagram
+from app.services.blob_store import blob_store
+from app.services.thumbnails import SVG_MEDIA_TYPE, ThumbnailRenderer, run_render
+from tests.helpers import diagram_data, insert_diagram, shape
+
+class InProcessRenderer(ThumbnailRenderer):
+    """Renders on a thread instead of spawning worker processes"""
+
+    async def _execute(self, data):
+        return await asyncio.to_thread(run_render, data, self.sizes)
+
+async def until(condition, timeout: float = 5.0):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while not condition():
+        assert loop.time() < deadline, "timed out"
+        await asyncio.sleep(0.01)
+
+async def thumbnails(sessions, diagram_id):
+    async with sessions() as db:
+        return (await db.execute(
+            select(Diagram.thumbnail_blob, Diagram.thumbnail_type, Diagram.thumbnail_sizes, Diagram.thumbnail_hash)
+            .where(Diagram.id == diagram_id)
+        )).one()
+
+@pytest.mark.anyio
+async def test_a_burst_of_changes_renders_once_it_settles(sessions):
+    diagram_id = await insert_diagram(sessions, diagram_data(shape("s1")))
+    renderer = InProcessRenderer([64], workers=1, debounce=0.1, max_delay=10, session_factory=sessions)
+    for _ in range(3):
+        renderer.schedule([diagram_id])
+        await asyncio.sleep(0.03)
+    assert renderer.stats["rendered"] == 0
+    await until(lambda: renderer.stats["rendered"] == 1)
+    assert renderer.stats["scheduled"] == 3 and not renderer._tasks
+    await renderer.shutdown()
+
+@pytest.mark.anyio
+async def test_continuous_changes_still_render_after_the_max_delay(sessions):
+    diagram_id = await insert_diagram(sessions, diagram_data(shape("s1")))
+    renderer = InProcessRenderer([64], workers=1, debounce=0.1, max_delay=0.2, session_factory=sessions)
+    loop = asyncio.get_running_loop()
+    stop = loop.time() + 0.8
+    while loop.time() < stop:
+        renderer.schedule([diagram_id])
+        await asyncio.sleep(0.03)
+    # Rendered while the edits kept coming; later rounds found the same data and skipped
+    assert renderer.stats["rendered"] == 1 and renderer.stats["unchanged"] >= 1
+    await renderer.shutdown()
+
+@pytest.mark.anyio
+async def test_each_size_is_stored_and_unchanged_data_is_not_redrawn(sessions):
+    diagram_id = await insert_diagram(sessions, diagram_data(shape("s1", label="Start")))
+    renderer = InProcessRenderer([128, 32, 32], workers=1, debounce=0, max_delay=0, session_factory=sessions)
+    assert renderer.sizes == [32, 128]
+    assert await renderer.render(diagram_id) is True
+    blob, media_type, sizes, digest = await thumbnails(sessions, diagram_id)
+    assert media_type == SVG_MEDIA_TYPE and set(sizes) == {"32", "128"} and blob == sizes["128"]
+    assert b'width="32"' in await blob_store.read(sizes["32"])
+
+    assert await renderer.render(diagram_id) is False
+    assert renderer.stats["unchanged"] == 1
+    # Geometry changes the drawing, so it is redrawn
+    async with sessions() as db:
+        await db.execute(update(Diagram).where(Diagram.id == diagram_id).values(data=diagram_data(shape("s1", 50, 0, label="Start"))))
+        await db.commit()
+    assert await renderer.render(diagram_id) is True
+    assert (await thumbnails(sessions, diagram_id)).thumbnail_hash != digest
+    assert await renderer.render(-1) is False
+
+PNG = b"\x89PNG\r\n\x1a\n" + os.urandom(32)
+
+def create(client, headers, **fields):
+    return client.post("/api/v1/diagrams/", json={"title": "T", "data": diagram_data(shape("s1")), **fields}, headers=headers).json()
+
+def test_put_accepts_only_the_owners_image_bodies(client, make_user, monkeypatch):
+    _, headers, _ = make_user()
+    _, other, _ = make_user()
+    url = f"/api/v1/diagrams/{create(client, headers, is_public=True)['id']}/thumbnail"
+    image = {**headers, "Content-Type": "image/png"}
+    assert client.put(url, content=b"text", headers={**headers, "Content-Type": "text/plain"}).status_code == 415
+    assert client.put(url, content=PNG, headers={**other, "Content-Type": "image/png"}).status_code == 403
+    assert client.put(url, content=b"", headers=image).status_code == 422
+    assert client.put("/api/v1/diagrams/999999/thumbnail", content=PNG, headers=image).status_code == 404
+    monkeypatch.setattr(settings, "THUMBNAIL_MAX_BYTES", 16)
+    assert client.put(url, content=PNG, headers=image).status_code == 413
+    monkeypatch.undo()
+    assert client.get(url, headers=headers).status_code == 404
+
+    assert client.put(url, content=PNG, headers={**headers, "Content-Type": "image/png; charset=binary"}).status_code == 204
+    response = client.get(url, headers=other)
+    assert response.content == PNG and response.headers["Content-Type"] == "image/png"
+
+def test_get_caches_versioned_urls_for_good_and_revalidates_the_rest(client, make_user):
+    _, headers, _ = make_user()
+    _, other, _ = make_user()
+    diagram_id = create(client, headers)["id"]
+    url = f"/api/v1/diagrams/{diagram_id}/thumbnail"
+    client.put(url, content=PNG, headers={**headers, "Content-Type": "image/png"})
+    versioned = client.get(f"/api/v1/diagrams/{diagram_id}", headers=headers).json()["thumbnail_url"]
+    assert versioned.startswith(url + "?v=")
+
+    assert "immutable" in client.get(versioned, headers=headers).headers["Cache-Control"]
+    plain = client.get(url, headers=headers)
+    assert plain.headers["Cache-Control"] == "private, max-age=300"
+    assert client.get(url, headers={**headers, "If-None-Match": plain.headers["ETag"]}).status_code == 304
+    # Private diagram
+    assert client.get(url, headers=other).status_code == 403
+
+def test_size_picks_the_smallest_render_that_covers_it(client, make_user):
+    _, headers, _ = make_user()
+    diagram_id = create(client, headers)["id"]
+    renderer = InProcessRenderer([32, 64], workers=1, debounce=0, max_delay=0, session_factory=AsyncSessionLocal)
+    assert client.portal.call(renderer.render, diagram_id)
+    url = f"/api/v1/diagrams/{diagram_id}/thumbnail"
+    for size, width in ((1, 32), (32, 32), (33, 64), (1000, 64), (None, 64)):
+        response = client.get(url, params={"size": size} if size else {}, headers=headers)
+        assert response.headers["Content-Type"] == SVG_MEDIA_TYPE
+        assert f'width="{width}"'.encode() in response.content
@@ -0,0 +1,71 @@
+import json
+import msgpack
+import pytest
+from app.services.ws_codec import (
+    FLAG_DEFLATE, FLAG_RAW, JSON_CODEC, MSGPACK_CODEC, FrameDecodeError, MsgpackCodec, negotiate
+)
+from tests.helpers import diagram_data, shape
+
+def test_cursor_batches_round_trip_as_rows():
+    codec = MsgpackCodec(compress_threshold=0)
+    message = {"type": "cursors", "cursors": [
+        {"member_id": "n:1", "user_id": 1, "username": "a", "position": {"x": 10.5, "y": -3.2}},
+        {"user_id": 2, "username": "b", "position": {"x": 1, "y": 2}, "tool": "pen"}
+    ]}
+    frame = codec.encode(message)
+    assert frame[0] == FLAG_RAW
+    _, body = msgpack.unpackb(frame[1:], raw=False)
+    assert body["cursors"][0] == [1, "a", 105, -32, "n:1"]
+    assert isinstance(body["cursors"][1], dict)
+    assert codec.decode(frame) == message
+
+def test_rows_without_a_member_id_still_decode():
+    codec = MsgpackCodec(compress_threshold=0)
+    frame = bytes((FLAG_RAW,)) + msgpack.packb([3, {"cursors": [[1, "a", 10, 20]]}])
+    cursor, = codec.decode(frame)["cursors"]
+    assert cursor == {"member_id": None, "user_id": 1, "username": "a", "position": {"x": 1.0, "y": 2.0}}
+
+def test_cursor_moves_are_quantized():
+    codec = MsgpackCodec(compress_threshold=0)
+    decoded = codec.decode(codec.encode({"type": "cursor_move", "position": {"x": 1.26, "y": 3}}))
+    assert decoded == {"type": "cursor_move", "position": {"x": 1.3, "y": 3.0}}
+
+def test_large_frames_are_deflated_and_small_ones_are_not():
+    codec = MsgpackCodec(compress_threshold=256)
+    small = {"type": "ping"}
+    large = {"type": "diagram_snapshot", "data": diagram_data(*(shape(f"s{i}", i, i) for i in range(50))), "version": 3}
+    assert codec.encode(small)[0] == FLAG_RAW
+    frame = codec.encode(large)
+    assert frame[0] == FLAG_DEFLATE
+    assert len(frame) < len(json.dumps(large))
+    assert codec.decode(frame) == large
+
+def test_unknown_types_travel_by_name():
+    message = {"type": "custom", "value": [1, 2]}
+    assert MSGPACK_CODEC.decode(MSGPACK_CODEC.encode(message)) == message
+
+@pytest.mark.parametrize("frame", [b"", "text", bytes((7,)) + b"x", bytes((FLAG_RAW,)) + b"\xc1", bytes((FLAG_RAW,)) + msgpack.packb([99, {}])])
+def test_bad_frames_raise_decode_errors(frame):
+    with pytest.raises(FrameDecodeError):
+        MSGPACK_CODEC.decode(frame)
+
+def test_json_codec_rejects_non_objects():
+    assert JSON_CODEC.decode(JSON_CODEC.encode({"type": "ping"})) == {"type": "ping"}
+    with pytest.raises(FrameDecodeError):
+        JSON_CODEC.decode("[1]")
+
+def test_negotiation_prefers_msgpack_and_falls_back_to_json():
+    assert negotiate(["other", MSGPACK_CODEC.subprotocol]) is MSGPACK_CODEC
+    assert negotiate(["other"]) is JSON_CODEC
+    assert negotiate([]) is JSON_CODEC
+
+def test_msgpack_subprotocol_over_a_real_socket(client, make_user):
+    _, headers, token = make_user()
+    diagram_id = client.post("/api/v1/diagrams/", json={"title": "w", "data": diagram_data(shape("s1"))}, headers=headers).json()["id"]
+    with client.websocket_connect(f"/api/v1/ws/{diagram_id}?token={token}", subprotocols=[MSGPACK_CODEC.subprotocol]) as ws:
+        assert ws.accepted_subprotocol == MSGPACK_CODEC.subprotocol
+        state = MSGPACK_CODEC.decode(ws.receive_bytes())
+        assert state["type"] == "diagram_state"
+        ws.send_bytes(MSGPACK_CODEC.encode({"type": "ping"}))
+        while MSGPACK_CODEC.decode(ws.receive_bytes())["type"] != "pong":
+            pass
@@ -0,0 +1,68 @@
+import pytest
+from app.api.v1.endpoints.websocket import (
+    OVERFLOW_COALESCE, OVERFLOW_DISCONNECT, OVERFLOW_DROP_OLDEST, ClientConnection, ConnectionManager
+)
+from app.services.backplane import InProcessBackplane
+from tests.helpers import FakeWebSocket, settle
+
+pytestmark = pytest.mark.anyio
+
+class User:
+    def __init__(self, user_id: int):
+        self.id = user_id
+        self.username = f"u{user_id}"
+
+def blocked_client(policy: str, max_size: int = 3):
+    websocket = FakeWebSocket()
+    websocket.gate.clear()
+    failures = []
+    client = ClientConnection(websocket, max_size, policy, lambda *args: failures.append(args))
+    return websocket, client, failures
+
+async def test_drop_oldest_keeps_the_newest_frames():
+    websocket, client, _ = blocked_client(OVERFLOW_DROP_OLDEST)
+    for frame in "abcde":
+        assert client.enqueue(frame)
+    assert client.queue_depth == 3
+    assert client.dropped_frames == 2
+    client.start()
+    websocket.gate.set()
+    await settle()
+    assert websocket.sent == ["c", "d", "e"]
+    client.stop()
+
+async def test_coalesce_replaces_a_pending_frame_in_place():
+    websocket, client, _ = blocked_client(OVERFLOW_COALESCE)
+    client.enqueue("a1", ("cursors", "a"))
+    client.enqueue("x")
+    client.enqueue("a2", ("cursors", "a"))
+    client.enqueue("b1", ("cursors", "b"))
+    assert client.queue_depth == 3
+    client.start()
+    websocket.gate.set()
+    await settle()
+    assert websocket.sent == ["a2", "x", "b1"]
+    client.stop()
+
+async def test_disconnect_policy_reports_the_slow_client():
+    websocket, client, failures = blocked_client(OVERFLOW_DISCONNECT, max_size=1)
+    assert client.enqueue("a")
+    assert not client.enqueue("b")
+    assert failures == [(client, 1013, "Client too slow")]
+
+async def test_a_stalled_peer_does_not_hold_up_the_room():
+    manager = ConnectionManager(queue_size=4, overflow_policy=OVERFLOW_DROP_OLDEST, backplane=InProcessBackplane())
+    slow, fast = FakeWebSocket(), FakeWebSocket()
+    await manager.connect(slow, "room", User(1))
+    await manager.connect(fast, "room", User(2))
+    await settle()
+    slow.gate.clear()
+    for i in range(10):
+        manager.broadcast_to_diagram_sync("room", {"type": "drawing_update", "data": {"i": i}})
+        await settle()
+    received = [message["data"]["i"] for message in fast.messages() if message["type"] == "drawing_update"]
+    assert received == list(range(10))
+    assert manager.outbound[slow].dropped_frames > 0
+    manager.disconnect(slow)
+    manager.disconnect(fast)
+    await manager.shutdown()
@@ -23,9 +23,15 @@ CREATE TABLE IF NOT EXISTS diagrams (
     title VARCHAR(200) NOT NULL,
     description TEXT,
     data JSONB NOT NULL,
+    storage VARCHAR(20) NOT NULL DEFAULT 'json',
     thumbnail TEXT,
+    thumbnail_blob VARCHAR(64),
+    thumbnail_type VARCHAR(100),
+    thumbnail_sizes JSONB,
+    thumbnail_hash VARCHAR(64),
     owner_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
     is_public BOOLEAN DEFAULT FALSE,
+    version INTEGER NOT NULL DEFAULT 1,
     created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
     updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
 );
@@ -47,6 +53,9 @@ CREATE INDEX IF NOT EXISTS idx_users_email ON users(email);
 CREATE INDEX IF NOT EXISTS idx_diagrams_owner ON diagrams(owner_id);
 CREATE INDEX IF NOT EXISTS idx_diagrams_public ON diagrams(is_public);
 CREATE INDEX IF NOT EXISTS idx_diagrams_created ON diagrams(created_at);
+CREATE INDEX IF NOT EXISTS ix_diagrams_owner_updated ON diagrams(owner_id, updated_at, id);
+CREATE INDEX IF NOT EXISTS ix_diagrams_public_updated ON diagrams(is_public, updated_at, id);
+CREATE INDEX IF NOT EXISTS ix_diagrams_updated ON diagrams(updated_at, id);
 CREATE INDEX IF NOT EXISTS idx_collaboration_sessions_diagram ON collaboration_sessions(diagram_id);
 CREATE INDEX IF NOT EXISTS idx_collaboration_sessions_user ON collaboration_sessions(user_id);
 CREATE INDEX IF NOT EXISTS idx_collaboration_sessions_active ON collaboration_sessions(is_active);